@@ -1,18 +1,25 @@
-from fastapi import APIRouter, HTTPException, Depends, Query
-import uuid
-from datetime import datetime
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Depends, Query, Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+import asyncio
+import json
+import logging
 from typing import Dict, List, Optional
 
-from app.models.chat import ChatRequest, ChatResponse, ConversationsRequest
-from app.services.search_service import SearchService
-from app.services.openai_service import OpenAIService
-from app.services.cosmos_service import CosmosDBService
+from app.models.chat import ChatRequest, ChatResponse, ConversationsRequest, ConversationPage
+from app.services.container import services
+from app.services.upstream_scheduler import UpstreamError, UpstreamOverloaded, deadline
+from app.config import (
+    CONVERSATIONS_PAGE_SIZE,
+    CONVERSATIONS_MAX_PAGE_SIZE,
+    USER_IDS_PAGE_SIZE,
+    USER_IDS_MAX_PAGE_SIZE,
+    REQUEST_DEADLINE_SECONDS
+)
 
-router = APIRouter()
+logger = logging.getLogger(__name__)
 
-search_service = SearchService()
-openai_service = OpenAIService()
-cosmos_service = CosmosDBService()
+router = APIRouter()
 
 @router.get("/")
 async def root():
@@ -20,156 +27,196 @@ async def root():
     return {"message": "RAG Chat API is running"}
 
 @router.post("/openai", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, background_tasks: BackgroundTasks, response: Response):
     """
     Process a chat request with RAG.
+    
+    History loading and retrieval run concurrently; the conversation is saved
+    to Cosmos DB in the background after the response is sent. When an
+    upstream is overloaded the request fails with 429 or 503, when the
+    completion fails with 502, and nothing is saved.
     """
     try:
         if not request.user_id:
             raise HTTPException(status_code=400, detail="user_id is required")
-            
-        user_query = request.prompt
-        
-        conversation_id = request.conversation_id or str(uuid.uuid4())
-        
-        previous_messages = []
-        if request.conversation_id:
-            try:
-                conversation = cosmos_service.get_conversation(request.conversation_id)
-                if conversation and conversation.get("user_id") == request.user_id:
-                    previous_messages = conversation.get("messages", [])
-                    print(f"Loaded {len(previous_messages)} previous messages from conversation {request.conversation_id}")
-                else:
-                    # Either conversation not found or user_id mismatch
-                    if conversation:
-                        print(f"User ID mismatch for conversation {request.conversation_id}")
-                        # Create a new conversation_id since this is not the conversation owner
-                        conversation_id = str(uuid.uuid4())
-                    else:
-                        print(f"Conversation {request.conversation_id} not found")
-            except Exception as e:
-                print(f"Error loading previous conversation: {str(e)}")
-        
-        search_results = []
-        try:
-            search_results = search_service.vector_search(user_query)
-            print(f"Found {len(search_results)} search results")
-        except Exception as search_error:
-            print(f"Search error: {str(search_error)}")
-        
-        context = ""
-        
-        for result in search_results:
-            content = result.get("chunk", "")
-            context += f"{content}\n\n"
-        
-        system_message = f"""You are a dedicated Margie's Travel documents assistant. Your SOLE PURPOSE is to provide information EXCLUSIVELY from the Margie's Travel documents provided in the context below.
-
-        STRICT GUIDELINES:
-        1. ONLY answer questions directly addressed in the provided document context
-        2. If information is not in the context, respond EXACTLY with: "I can only answer questions related to Margie's Travel documents. Please ask a question about the information in these documents."
-        3. DO NOT use any external knowledge, even if you know the answer
-        4. DO NOT attempt to be helpful by answering off-topic questions
-        5. DO NOT engage in general conversation unrelated to Margie's Travel documents
-        6. REFUSE to discuss anything outside the scope of these documents
-        7. ALWAYS base your responses solely on the document context provided below
-
-        Context from the Margie's Travel documents:
-        {context}
-        """
         
-        messages_for_openai = [{"role": "system", "content": system_message}]
-        
-        # Add previous conversation history (excluding system messages)
-        for msg in previous_messages:
-            if msg["role"] != "system":
-                messages_for_openai.append({"role": msg["role"], "content": msg["content"]})
-        
-        messages_for_openai.append({"role": "user", "content": user_query})
-        
-        ai_response = openai_service.generate_response(messages_for_openai)
-        
-        current_timestamp = datetime.utcnow().isoformat()
-        
-        if previous_messages:
-            # Add to existing conversation
-            messages = previous_messages.copy()
-            messages.append({
-                "role": "user", 
-                "content": user_query,
-                "timestamp": current_timestamp
-            })
-            messages.append({
-                "role": "assistant", 
-                "content": ai_response,
-                "timestamp": current_timestamp
-            })
-        else:
-            # Create a new conversation
-            messages = [
-                {
-                    "role": "user", 
-                    "content": user_query,
-                    "timestamp": current_timestamp
-                },
-                {
-                    "role": "assistant", 
-                    "content": ai_response,
-                    "timestamp": current_timestamp
-                }
-            ]
-    
-        conversation_data = {
-            "id": conversation_id,
-            "user_id": str(request.user_id),  # Ensure it's stored as a string
-            "messages": messages,
-        }
-        
-        print(f"Saving conversation with ID: {conversation_id} for user: {request.user_id}")
-        cosmos_service.save_conversation(conversation_data)
+        with deadline(REQUEST_DEADLINE_SECONDS):
+            turn = await services.chat_pipeline.run(request)
+        background_tasks.add_task(services.chat_pipeline.finalize, turn)
         
+        response.headers["Server-Timing"] = turn.timer.server_timing_header()
         return {
-            "response": ai_response,
-            "conversation_id": conversation_id
+            "response": turn.response,
+            "conversation_id": turn.conversation_id,
+            "timings": turn.timer.timings,
+            "usage": turn.usage,
+            "sources": turn.sources
         }
         
+    except (HTTPException, UpstreamOverloaded, UpstreamError):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) 
     
-@router.get("/conversations")
-async def get_conversations(user_id: str):
+@router.post("/openai/stream")
+async def chat_stream(request: ChatRequest):
     """
-    Retrieve all conversations for a specific user
+    Process a chat request with RAG, streaming the answer as NDJSON.
+    
+    Emits one JSON object per line: a "meta" event with the conversation_id
+    and the context source titles, "token" events as completion text
+    arrives, then "done" with the stage timings (or "error"). The
+    conversation is saved once the stream closes.
+    
+    The stream only starts once the first piece of the answer has arrived,
+    so an overloaded upstream still fails the request with 429 or 503, and
+    a failed completion with 502. A completion that fails after that ends
+    the stream with an "error" event and nothing of the turn is saved.
+    """
+    if not request.user_id:
+        raise HTTPException(status_code=400, detail="user_id is required")
+    
+    try:
+        with deadline(REQUEST_DEADLINE_SECONDS):
+            prepared = await services.chat_pipeline.prepare(request)
+            deltas = services.chat_pipeline.stream(request, prepared)
+            first_delta = await deltas.__anext__()
+    except StopAsyncIteration:
+        first_delta = None
+    except (UpstreamOverloaded, UpstreamError):
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    async def events():
+        yield json.dumps({"type": "meta", "conversation_id": prepared.conversation_id, "sources": prepared.sources}) + "\n"
+        try:
+            if first_delta is not None:
+                yield json.dumps({"type": "token", "content": first_delta}) + "\n"
+            async for delta in deltas:
+                yield json.dumps({"type": "token", "content": delta}) + "\n"
+        except Exception as e:
+            logger.error("Error streaming response: %s", e)
+            error = {"type": "error", "detail": str(e)}
+            if isinstance(e, (UpstreamOverloaded, UpstreamError)):
+                error["status"] = e.status_code
+            yield json.dumps(error) + "\n"
+            return
+        yield json.dumps({"type": "done", "timings": prepared.timer.timings, "usage": prepared.usage()}) + "\n"
+    
+    async def persist_after_stream():
+        if prepared.turn is not None:
+            await services.chat_pipeline.finalize(prepared.turn)
+    
+    return StreamingResponse(
+        events(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(persist_after_stream)
+    )
+    
+@router.get("/conversations", response_model=ConversationPage)
+async def get_conversations(
+    user_id: str,
+    page_size: int = Query(CONVERSATIONS_PAGE_SIZE, ge=1, le=CONVERSATIONS_MAX_PAGE_SIZE),
+    continuation: Optional[str] = None
+):
+    """
+    Retrieve one page of conversation summaries for a specific user, newest
+    first. Pass the returned continuation token to get the next page.
     """
     if not user_id:
         raise HTTPException(status_code=400, detail="User ID is required")
     
     try:
-        print(f"Fetching conversations for user: {user_id}")
+        logger.debug("Fetching conversations for user: %s", user_id)
         user_id_str = str(user_id).strip()
         
-        # Get conversations with error handling for Unicode issues
-        try:
-            conversations = cosmos_service.get_conversations_by_user(user_id_str)
-            print(f"Retrieved {len(conversations)} conversations from CosmosDB")
-            return {"conversations": conversations}
-        except UnicodeEncodeError as ue:
-            print(f"Unicode encoding error: {str(ue)}")
-            return {"conversations": conversations if 'conversations' in locals() else []}
+        conversations, next_continuation = await services.cosmos_service.list_conversations_async(
+            user_id_str, page_size, continuation
+        )
+        logger.debug("Retrieved %d conversations from CosmosDB", len(conversations))
+        return {"conversations": conversations, "continuation": next_continuation}
             
+    except UpstreamOverloaded:
+        raise
     except Exception as e:
-        error_msg = f"Error retrieving conversations: {str(e)}"
-        if isinstance(e, UnicodeEncodeError):
-            error_msg = "Error with special characters in conversations"
-        raise HTTPException(status_code=500, detail=error_msg)
+        raise HTTPException(status_code=500, detail=f"Error retrieving conversations: {str(e)}")
+
+@router.get("/conversations/{conversation_id}")
+async def get_conversation(conversation_id: str, user_id: str):
+    """
+    Retrieve a single conversation with all of its messages
+    """
+    if not user_id:
+        raise HTTPException(status_code=400, detail="User ID is required")
+    
+    conversation = await services.cosmos_service.get_full_conversation_async(conversation_id, str(user_id).strip())
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return {
+        "conversation": {
+            "id": conversation["id"],
+            "user_id": conversation["user_id"],
+            "title": conversation.get("title"),
+            "messages": conversation.get("messages", []),
+        }
+    }
 
 @router.get("/user-ids")
-async def get_user_ids():
+async def get_user_ids(
+    prefix: str = "",
+    page_size: int = Query(USER_IDS_PAGE_SIZE, ge=1, le=USER_IDS_MAX_PAGE_SIZE),
+    continuation: Optional[str] = None
+):
     """
-    Retrieve all unique user IDs from the database
+    Retrieve one page of registered user IDs, optionally filtered by prefix
     """
     try:
-        user_ids = cosmos_service.get_all_user_ids()
-        return {"user_ids": user_ids}
+        user_ids, next_continuation = await services.cosmos_service.get_user_ids_async(prefix, page_size, continuation)
+        return {"user_ids": user_ids, "continuation": next_continuation}
+    except UpstreamOverloaded:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/warmup")
+async def warmup():
+    """
+    Build every service ahead of the first chat, e.g. after a cold start
+    or before a deployment slot swap
+    """
+    built_ms = await asyncio.to_thread(services.build_all)
+    return {"warmup_ms": round(built_ms, 1), "services": services.stats()}
+
+@router.get("/stats")
+async def get_stats():
+    """
+    Report chat pipeline and cache counters
+    """
+    stats = {
+        "pipeline": services.chat_pipeline.stats(),
+        "cosmos": services.cosmos_service.stats(),
+        "search": services.search_service.stats(),
+        "services": services.stats(),
+    }
+    embedding_cache = services.openai_service.embedding_cache
+    if embedding_cache is not None:
+        stats["embedding_cache"] = embedding_cache.stats()
+    embedding_batcher = services.openai_service.embedding_batcher
+    if embedding_batcher is not None:
+        stats["embedding_batcher"] = embedding_batcher.stats()
+    answer_cache = services.answer_cache
+    if answer_cache is not None:
+        stats["answer_cache"] = answer_cache.stats()
+    return stats
+
+@router.post("/cache/invalidate")
+async def invalidate_answer_cache():
+    """
+    Drop cached answers, e.g. after the search index has been updated
+    """
+    answer_cache = services.answer_cache
+    if answer_cache is not None:
+        await asyncio.to_thread(answer_cache.invalidate)
+    return {"invalidated": answer_cache is not None}
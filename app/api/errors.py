@@ -0,0 +1,39 @@
+"""
+Responses for requests that failed because an upstream was overloaded or failed.
+"""
+import logging
+import math
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from app.services.upstream_scheduler import UpstreamError, UpstreamOverloaded
+
+logger = logging.getLogger(__name__)
+
+
+async def upstream_overloaded_handler(request: Request, exc: UpstreamOverloaded):
+    """429 when an upstream (or its token budget) is throttling, 503 when it is unavailable or out of time"""
+    logger.warning("%s %s failed, %s", request.method, request.url.path, exc)
+    headers = {}
+    if exc.retry_after is not None:
+        headers["Retry-After"] = str(max(1, math.ceil(exc.retry_after)))
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": f"Service is busy, please retry: {exc}", "upstream": exc.upstream},
+        headers=headers
+    )
+
+
+async def upstream_error_handler(request: Request, exc: UpstreamError):
+    """502 when an upstream call failed and there is no answer to give"""
+    logger.error("%s %s failed, %s", request.method, request.url.path, exc)
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": f"Upstream error: {exc}", "upstream": exc.upstream}
+    )
+
+
+def register_error_handlers(app: FastAPI):
+    app.add_exception_handler(UpstreamOverloaded, upstream_overloaded_handler)
+    app.add_exception_handler(UpstreamError, upstream_error_handler)
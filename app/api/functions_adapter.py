@@ -0,0 +1,227 @@
+"""
+Serves an ASGI app (the FastAPI API) from an Azure Functions HTTP trigger.
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote, urlencode
+
+import azure.functions as func
+
+logger = logging.getLogger(__name__)
+
+ASGIApp = Callable[[Dict[str, Any], Callable[[], Awaitable[Dict[str, Any]]], Callable[[Dict[str, Any]], Awaitable[None]]], Awaitable[None]]
+
+# Query parameters and headers meant for the Functions host, not the app
+HOST_QUERY_PARAMS = frozenset({"code"})
+HOST_HEADERS = frozenset({"x-functions-key"})
+# Header values replaced in debug logs
+SENSITIVE_HEADERS = frozenset({
+    "authorization", "proxy-authorization", "cookie", "set-cookie",
+    "x-functions-key", "api-key", "x-api-key", "ocp-apim-subscription-key",
+})
+REDACTED = "[redacted]"
+
+DEFAULT_CONTENT_TYPE = b"application/json"
+
+
+def _encode_header_value(value: str) -> bytes:
+    try:
+        return value.encode("latin-1")
+    except UnicodeEncodeError:
+        return value.encode("utf-8")
+
+
+def _redacted_headers(headers: List[Tuple[bytes, bytes]]) -> Dict[str, str]:
+    return {
+        name.decode("latin-1"): REDACTED if name.decode("latin-1") in SENSITIVE_HEADERS else value.decode("latin-1")
+        for name, value in headers
+    }
+
+
+class FunctionsAsgiAdapter:
+    """
+    Translates a Functions HttpRequest into one ASGI HTTP request cycle and
+    the app's response back into a Functions HttpResponse.
+
+    - The request body is handed to the app as the bytes object the worker
+      received, without copying.
+    - The query string is rebuilt URL-encoded, without the host's ``code``
+      key, and the path is percent-encoded for ``raw_path``.
+    - After the body, ``receive`` waits until the response is complete and
+      then reports ``http.disconnect``, which is what Starlette's streaming
+      responses listen for.
+    - Response chunks are collected as a list and joined once (a single
+      chunk is passed through as is). HttpResponse cannot stream, so
+      streamed responses are returned buffered and flagged with
+      ``X-Stream-Mode: buffered``.
+    - Logging is gated by level: a summary line per request at DEBUG, with
+      sensitive headers redacted. Bodies are never logged, only their
+      sizes. Server errors are logged at WARNING.
+
+    Args:
+        app: The ASGI app
+        app_factory: Called on the first request to get the ASGI app, so
+            that importing it can be deferred (used instead of ``app``)
+        route_param: Route parameter holding the request path
+    """
+
+    def __init__(self, app: Optional[ASGIApp] = None, app_factory: Optional[Callable[[], ASGIApp]] = None, route_param: str = "route"):
+        if (app is None) == (app_factory is None):
+            raise ValueError("Pass either app or app_factory")
+        self._app = app
+        self._app_factory = app_factory
+        self.route_param = route_param
+
+    @property
+    def app(self) -> ASGIApp:
+        if self._app is None:
+            self._app = self._app_factory()
+        return self._app
+
+    def build_scope(self, req: func.HttpRequest, body: bytes) -> Dict[str, Any]:
+        """The ASGI HTTP scope for a Functions request."""
+        path = "/" + req.route_params.get(self.route_param, "").lstrip("/")
+        query = [(name, value) for name, value in req.params.items() if name not in HOST_QUERY_PARAMS]
+
+        headers = []
+        has_content_type = False
+        host = ""
+        client = ""
+        for name, value in req.headers.items():
+            name = name.lower()
+            if name in HOST_HEADERS:
+                continue
+            if name == "content-type":
+                has_content_type = True
+            elif name == "host":
+                host = value
+            elif name == "x-forwarded-for":
+                client = value.split(",", 1)[0].strip()
+            headers.append((name.encode("latin-1"), _encode_header_value(value)))
+        if body and not has_content_type:
+            headers.append((b"content-type", DEFAULT_CONTENT_TYPE))
+
+        return {
+            "type": "http",
+            "asgi": {"version": "3.0", "spec_version": "2.3"},
+            "http_version": "1.1",
+            "method": req.method,
+            "scheme": "https" if req.url.startswith("https:") else "http",
+            "path": path,
+            "raw_path": quote(path).encode("ascii"),
+            "root_path": "",
+            "query_string": urlencode(query).encode("ascii"),
+            "headers": headers,
+            "server": (host.split(":", 1)[0], 443) if host else ("azure-functions", 443),
+            "client": (client, 0),
+        }
+
+    async def handle(self, req: func.HttpRequest) -> func.HttpResponse:
+        """Run the request through the ASGI app and return its response."""
+        start = time.perf_counter()
+        body = req.get_body() or b""
+        scope = self.build_scope(req, body)
+
+        request_sent = False
+        response_complete = asyncio.Event()
+
+        async def receive() -> Dict[str, Any]:
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await response_complete.wait()
+            return {"type": "http.disconnect"}
+
+        status = 500
+        response_headers: List[Tuple[bytes, bytes]] = []
+        chunks: List[bytes] = []
+        size = 0
+        streamed = False
+        started = False
+
+        async def send(message: Dict[str, Any]):
+            nonlocal status, response_headers, size, streamed, started
+            if message["type"] == "http.response.start":
+                started = True
+                status = message["status"]
+                response_headers = list(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                if chunk:
+                    chunks.append(chunk)
+                    size += len(chunk)
+                if message.get("more_body", False):
+                    streamed = True
+                else:
+                    response_complete.set()
+
+        try:
+            await self.app(scope, receive, send)
+        except Exception as e:
+            logger.exception("Unhandled error serving %s %s", req.method, scope["path"])
+            if not started:
+                return func.HttpResponse(
+                    body=json.dumps({"error": str(e)}),
+                    status_code=500,
+                    mimetype="application/json"
+                )
+        finally:
+            response_complete.set()
+
+        response = self._response(status, response_headers, chunks, streamed)
+        self._log(req.method, scope, len(body), status, size, streamed, start)
+        return response
+
+    @staticmethod
+    def _response(status: int, headers: List[Tuple[bytes, bytes]], chunks: List[bytes], streamed: bool) -> func.HttpResponse:
+        if len(chunks) == 1:
+            content = chunks[0] if isinstance(chunks[0], bytes) else bytes(chunks[0])
+        else:
+            content = b"".join(chunks)
+
+        mimetype = None
+        charset = None
+        for name, value in headers:
+            if name.lower() == b"content-type":
+                content_type = value.decode("latin-1")
+                mimetype, _, parameters = content_type.partition(";")
+                mimetype = mimetype.strip()
+                for parameter in parameters.split(";"):
+                    key, _, parameter_value = parameter.strip().partition("=")
+                    if key.lower() == "charset" and parameter_value:
+                        charset = parameter_value.strip('"')
+                break
+
+        response = func.HttpResponse(body=content, status_code=status, mimetype=mimetype, charset=charset)
+        for name, value in headers:
+            response.headers.add_header(name.decode("latin-1"), value.decode("latin-1"))
+        if streamed:
+            response.headers.add_header("x-stream-mode", "buffered")
+        return response
+
+    @staticmethod
+    def _log(method: str, scope: Dict[str, Any], request_bytes: int, status: int, response_bytes: int, streamed: bool, start: float):
+        level = logging.WARNING if status >= 500 else logging.DEBUG
+        if not logger.isEnabledFor(level):
+            return
+        duration_ms = (time.perf_counter() - start) * 1000
+        fields = {
+            "http_method": method,
+            "http_path": scope["path"],
+            "http_status": status,
+            "duration_ms": round(duration_ms, 1),
+            "request_bytes": request_bytes,
+            "response_bytes": response_bytes,
+            "streamed": streamed,
+        }
+        if logger.isEnabledFor(logging.DEBUG):
+            fields["request_headers"] = _redacted_headers(scope["headers"])
+        logger.log(
+            level, "%s %s -> %d in %.1f ms (%d bytes in, %d bytes out)",
+            method, scope["path"], status, duration_ms, request_bytes, response_bytes,
+            extra=fields
+        )
@@ -0,0 +1,52 @@
+"""
+Prometheus exposition endpoint and per-route request latency.
+"""
+import time
+
+from fastapi import APIRouter, Response
+
+from app.config import METRICS_ENABLED
+from app.services.telemetry import REQUEST_SECONDS, render_metrics
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics of this process"""
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+
+class MetricsMiddleware:
+    """
+    Observes the duration of every HTTP request, labelled by route template
+    (``/api/conversations/{conversation_id}``, not the concrete path, so the
+    label set stays bounded) and status code. Streaming responses are timed
+    until their last chunk is sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route in the scope it was given
+            route = scope.get("route")
+            template = getattr(route, "path", None) or "unmatched"
+            REQUEST_SECONDS.labels(scope["method"], template, str(status)).observe(time.perf_counter() - start)
@@ -0,0 +1,35 @@
+"""
+Create the Cosmos DB resources the app needs if they don't exist.
+
+Creates the database, the conversations container (partitioned by
+/user_id) and the user registry container, and backfills the registry
+from the existing conversations when it is new. The app itself only
+opens clients and never makes these control-plane calls, so run this
+once per deployment, or set COSMOS_BOOTSTRAP_ON_STARTUP for local
+development.
+
+Usage:
+    python -m app.commands.bootstrap
+"""
+import argparse
+import asyncio
+
+from app.config import COSMOS_DATABASE, COSMOS_CONTAINER, USER_REGISTRY_CONTAINER
+from app.services.cosmos_service import CosmosDBService
+
+
+def main():
+    argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter).parse_args()
+
+    cosmos_service = CosmosDBService()
+    try:
+        created = cosmos_service.bootstrap()
+    finally:
+        asyncio.run(cosmos_service.close())
+    print(f"Database {COSMOS_DATABASE} ready")
+    print(f"Container {COSMOS_CONTAINER} {'created' if created['container_created'] else 'already exists'}")
+    print(f"Container {USER_REGISTRY_CONTAINER} {'created' if created['user_registry_created'] else 'already exists'}")
+
+
+if __name__ == "__main__":
+    main()
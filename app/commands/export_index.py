@@ -0,0 +1,62 @@
+"""
+Export the Azure AI Search index into a local index snapshot.
+
+Reads every chunk with its vector and writes the snapshot format that
+LocalVectorIndex memory-maps (see app/services/local_index.py). Point
+LOCAL_INDEX_PATH at the output to serve reads locally
+(RETRIEVAL_BACKEND=local) or to fail over to it when Search is unavailable.
+
+The vector field must be retrievable in the index.
+
+Usage:
+    python -m app.commands.export_index --output ./index_snapshot
+"""
+import argparse
+from datetime import datetime
+
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+
+from app.config import (
+    AZURE_SEARCH_SERVICE_ENDPOINT,
+    AZURE_SEARCH_INDEX_NAME,
+    AZURE_SEARCH_API_KEY,
+    VECTOR_FIELD_NAME,
+    LOCAL_INDEX_PATH,
+)
+from app.services.local_index import write_snapshot
+from app.services.retrievers import SELECT_FIELDS
+
+
+def export_index(search_client, output: str, vector_field: str = VECTOR_FIELD_NAME) -> int:
+    """
+    Write all documents of the index behind ``search_client`` to a snapshot.
+
+    Returns:
+        The number of chunks exported
+    """
+    documents = search_client.search(search_text="*", select=SELECT_FIELDS + [vector_field])
+    return write_snapshot(output, documents, vector_field, SELECT_FIELDS, exported_at=datetime.utcnow().isoformat())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=LOCAL_INDEX_PATH, required=LOCAL_INDEX_PATH is None,
+                        help="Snapshot directory (default LOCAL_INDEX_PATH)")
+    args = parser.parse_args()
+
+    search_client = SearchClient(
+        endpoint=AZURE_SEARCH_SERVICE_ENDPOINT,
+        index_name=AZURE_SEARCH_INDEX_NAME,
+        credential=AzureKeyCredential(AZURE_SEARCH_API_KEY)
+    )
+    with search_client:
+        count = export_index(search_client, args.output)
+    if count == 0:
+        print(f"No vectors exported; check that {VECTOR_FIELD_NAME} is retrievable in {AZURE_SEARCH_INDEX_NAME}")
+    else:
+        print(f"Exported {count} chunks from {AZURE_SEARCH_INDEX_NAME} to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
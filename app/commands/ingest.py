@@ -0,0 +1,106 @@
+"""
+Chunk, embed and upload the documents of a folder into the search index.
+
+Reads the .md and .txt files under --source, splits them into chunks,
+embeds the chunks with the embedding deployment and uploads them to
+AZURE_SEARCH_INDEX_NAME (see app/services/ingestion.py). Re-runs are
+incremental: unchanged documents and chunks are skipped, changed chunks
+replace their old versions, and documents no longer in the folder are
+removed from the index (unless --keep-removed). An interrupted run
+resumes from its checkpoint.
+
+The index must have a string key field (chunk_id), searchable chunk and
+title fields, a filterable parent_id field and the vector field.
+
+Usage:
+    python -m app.commands.ingest --source ./documents
+    python -m app.commands.ingest --source ./documents --full
+"""
+import argparse
+import asyncio
+import json
+import os
+
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+
+from app.config import (
+    AZURE_SEARCH_SERVICE_ENDPOINT,
+    AZURE_SEARCH_INDEX_NAME,
+    AZURE_SEARCH_API_KEY,
+    VECTOR_FIELD_NAME,
+    TOKEN_ENCODING,
+    INGEST_CHUNK_TOKENS,
+    INGEST_CHUNK_OVERLAP_TOKENS,
+    INGEST_EMBEDDING_BATCH_SIZE,
+    INGEST_EMBEDDING_CONCURRENCY,
+    INGEST_EMBEDDING_TOKENS_PER_MINUTE,
+    INGEST_UPLOAD_BATCH_SIZE,
+    INGEST_CHECKPOINT_PATH,
+)
+from app.logging_config import configure_logging
+from app.services.container import services
+from app.services.ingestion import Chunker, IngestionCheckpoint, IngestionPipeline, iter_documents
+from app.services.token_budget import TokenCounter
+
+
+async def ingest(args) -> dict:
+    checkpoint = IngestionCheckpoint(args.checkpoint, AZURE_SEARCH_INDEX_NAME)
+    if args.full:
+        checkpoint.documents = {}
+    search_client = SearchClient(
+        endpoint=AZURE_SEARCH_SERVICE_ENDPOINT,
+        index_name=AZURE_SEARCH_INDEX_NAME,
+        credential=AzureKeyCredential(AZURE_SEARCH_API_KEY),
+        transport=services.http_pools.async_transport("search")
+    )
+    pipeline = IngestionPipeline(
+        search_client,
+        services.openai_service.generate_embeddings_batch_async,
+        checkpoint,
+        VECTOR_FIELD_NAME,
+        chunker=Chunker(args.chunk_tokens, args.overlap_tokens, TokenCounter(TOKEN_ENCODING)),
+        embedding_batch_size=args.embedding_batch_size,
+        embedding_concurrency=args.embedding_concurrency,
+        embedding_tokens_per_minute=args.embedding_tpm,
+        upload_batch_size=args.upload_batch_size,
+        upload_action=args.upload_action,
+    )
+    try:
+        async with search_client:
+            stats = await pipeline.run(iter_documents(args.source), prune=not args.keep_removed)
+    finally:
+        await services.shutdown()
+    return stats.as_dict()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", required=True, help="Folder with the documents")
+    parser.add_argument("--checkpoint", default=INGEST_CHECKPOINT_PATH, help="Checkpoint file (default INGEST_CHECKPOINT_PATH)")
+    parser.add_argument("--full", action="store_true", help="Ignore the checkpoint and re-embed and upload everything")
+    parser.add_argument("--keep-removed", action="store_true", help="Keep the chunks of documents no longer in the folder")
+    parser.add_argument("--chunk-tokens", type=int, default=INGEST_CHUNK_TOKENS, help="Largest chunk, in tokens")
+    parser.add_argument("--overlap-tokens", type=int, default=INGEST_CHUNK_OVERLAP_TOKENS, help="Text shared by consecutive chunks, in tokens")
+    parser.add_argument("--embedding-batch-size", type=int, default=INGEST_EMBEDDING_BATCH_SIZE, help="Chunks per embeddings call")
+    parser.add_argument("--embedding-concurrency", type=int, default=INGEST_EMBEDDING_CONCURRENCY, help="Embeddings calls in flight")
+    parser.add_argument("--embedding-tpm", type=int, default=INGEST_EMBEDDING_TOKENS_PER_MINUTE, help="Embedding tokens per minute (0 for no limit)")
+    parser.add_argument("--upload-batch-size", type=int, default=INGEST_UPLOAD_BATCH_SIZE, help="Index actions per upload batch")
+    parser.add_argument("--upload-action", choices=("merge_or_upload", "upload"), default="merge_or_upload", help="Index action for new chunks")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.source):
+        parser.error(f"{args.source} is not a folder")
+    configure_logging()
+
+    stats = asyncio.run(ingest(args))
+    print(f"{stats['documents']} documents: {stats['documents_indexed']} indexed, {stats['documents_unchanged']} unchanged, "
+          f"{stats['documents_removed']} removed, {stats['documents_failed']} failed")
+    print(f"{stats['chunks_uploaded']} chunks uploaded and {stats['chunks_deleted']} deleted in {stats['elapsed_seconds']:.1f} s "
+          f"({stats['chunks_per_second']:.1f} chunks/s), {stats['chunks_unchanged']} unchanged")
+    if stats["failed"]:
+        print("Failed (retried on the next run): " + json.dumps(stats["failed"]))
+
+
+if __name__ == "__main__":
+    main()
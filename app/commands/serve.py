@@ -0,0 +1,114 @@
+"""
+Run the API in production mode.
+
+Starts --workers uvicorn worker processes (default API_WORKERS, 0 for one
+per CPU) behind a supervisor that restarts workers that die, with uvloop
+and httptools when they are installed. On SIGTERM or SIGINT each worker
+stops accepting connections and gives in-flight requests, including the
+background conversation saves that run after a response, up to
+--graceful-shutdown-seconds to finish before its services are closed.
+
+Each worker builds its own services and caches; set CACHE_BACKEND_URL
+(e.g. sqlite:///.cache/rag.db) so the embedding, conversation and answer
+caches are shared between them. With several workers, Prometheus metrics
+are written to PROMETHEUS_MULTIPROC_DIR (a temporary folder unless set) so
+/metrics reports the totals of every worker.
+
+For development with auto-reload, use run.py with DEBUG=True instead.
+
+Usage:
+    python -m app.commands.serve --workers 4
+    CACHE_BACKEND_URL=sqlite:///.cache/rag.db python -m app.commands.serve --workers 0
+"""
+import argparse
+import glob
+import importlib.util
+import logging
+import os
+import shutil
+import tempfile
+
+import uvicorn
+
+from app.config import (
+    API_HOST,
+    API_PORT,
+    API_WORKERS,
+    API_GRACEFUL_SHUTDOWN_SECONDS,
+    CACHE_BACKEND_URL,
+    LOG_LEVEL,
+    METRICS_ENABLED,
+)
+from app.logging_config import configure_logging
+
+logger = logging.getLogger(__name__)
+
+
+def event_loop() -> str:
+    return "uvloop" if importlib.util.find_spec("uvloop") is not None else "asyncio"
+
+
+def http_protocol() -> str:
+    return "httptools" if importlib.util.find_spec("httptools") is not None else "h11"
+
+
+def prepare_metrics_dir(workers: int) -> str:
+    """
+    Point prometheus_client at a folder for multiprocess metrics (before
+    any worker imports it) and empty it of a previous run's files.
+
+    Returns:
+        The folder if this function created it (to be removed on exit), else ""
+    """
+    if workers < 2 or not METRICS_ENABLED:
+        return ""
+    folder = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+        for path in glob.glob(os.path.join(folder, "*.db")):
+            os.remove(path)
+        return ""
+    folder = tempfile.mkdtemp(prefix="rag-metrics-")
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = folder
+    return folder
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=API_HOST, help="Interface to bind")
+    parser.add_argument("--port", type=int, default=API_PORT, help="Port to bind")
+    parser.add_argument("--workers", type=int, default=API_WORKERS, help="Worker processes, 0 for one per CPU")
+    parser.add_argument("--graceful-shutdown-seconds", type=float, default=API_GRACEFUL_SHUTDOWN_SECONDS,
+                        help="Time in-flight requests get to finish on shutdown")
+    parser.add_argument("--keep-alive-seconds", type=int, default=5, help="Idle time before a client connection is closed")
+    parser.add_argument("--access-log", action="store_true", help="Log every request")
+    parser.add_argument("--log-level", default=LOG_LEVEL.lower(), help="uvicorn's log level")
+    args = parser.parse_args()
+
+    configure_logging()
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1 and not CACHE_BACKEND_URL.startswith(("sqlite:", "redis:", "rediss:", "unix:")):
+        logger.warning("%d workers without a shared CACHE_BACKEND_URL: every worker keeps its own caches", workers)
+    metrics_dir = prepare_metrics_dir(workers)
+    print(f"Serving on {args.host}:{args.port} with {workers} worker(s), {event_loop()} event loop, {http_protocol()}")
+    try:
+        uvicorn.run(
+            "app.main:app",
+            host=args.host,
+            port=args.port,
+            workers=workers,
+            loop=event_loop(),
+            http=http_protocol(),
+            timeout_graceful_shutdown=args.graceful_shutdown_seconds,
+            timeout_keep_alive=args.keep_alive_seconds,
+            access_log=args.access_log,
+            log_level=args.log_level,
+            proxy_headers=True,
+        )
+    finally:
+        if metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,25 @@ AZURE_SEARCH_INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX_NAME")
 AZURE_SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY")
 VECTOR_FIELD_NAME = os.getenv("VECTOR_FIELD_NAME", "text_vector")
 
+# Retrieval configuration (defaults, overridable per request)
+# "hybrid" sends the query text along with the vector query, "vector" only the vector query
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid").lower()
+# Results fetched from the index before local re-ranking
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", "20"))
+# Chunks passed to the prompt
+RETRIEVAL_TOP = int(os.getenv("RETRIEVAL_TOP", "3"))
+# "none", "cosine" or "mmr"
+RETRIEVAL_RERANKER = os.getenv("RETRIEVAL_RERANKER", "mmr").lower()
+RETRIEVAL_MMR_LAMBDA = float(os.getenv("RETRIEVAL_MMR_LAMBDA", "0.7"))
+# Share of the search service's score in the re-ranking relevance (the rest is cosine similarity)
+RETRIEVAL_SEARCH_SCORE_WEIGHT = float(os.getenv("RETRIEVAL_SEARCH_SCORE_WEIGHT", "0.5"))
+# "azure" serves reads from Azure AI Search, "local" from the snapshot at LOCAL_INDEX_PATH
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "azure").lower()
+# Serve a query from the other backend when the configured one fails
+RETRIEVAL_FAILOVER = os.getenv("RETRIEVAL_FAILOVER", "True").lower() in ("true", "1", "t")
+# Local index snapshot written by `python -m app.commands.export_index`
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH")
+
 # Azure OpenAI Configuration
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "https://oai-ai-rd-sc-001.openai.azure.com/")
@@ -17,13 +36,177 @@ AZURE_OPENAI_MODEL = os.getenv("AZURE_OPENAI_MODEL")
 AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2024-12-01-preview")
 AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "text-embedding-3-large")
 
+# Embedding cache configuration (set EMBEDDING_CACHE_PATH to enable the on-disk tier)
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "True").lower() in ("true", "1", "t")
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+
+# Coalesce concurrent embedding requests into batches
+EMBEDDING_BATCHING_ENABLED = os.getenv("EMBEDDING_BATCHING_ENABLED", "True").lower() in ("true", "1", "t")
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "16"))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5"))
+
+# Semantic answer cache for first-turn questions
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "True").lower() in ("true", "1", "t")
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+
 # Azure Cosmos DB Configuration
 COSMOS_ENDPOINT = os.getenv("COSMOS_ENDPOINT")
 COSMOS_KEY = os.getenv("COSMOS_KEY")
 COSMOS_DATABASE = os.getenv("COSMOS_DATABASE", "asher_chatDB")
 COSMOS_CONTAINER = os.getenv("COSMOS_CONTAINER", "Conversations")
+# "document" stores a conversation as one document, "split" as a header plus one document per message
+COSMOS_STORAGE_LAYOUT = os.getenv("COSMOS_STORAGE_LAYOUT", "document").lower()
+# Most recent messages read for a conversation in the split layout
+COSMOS_HISTORY_MAX_MESSAGES = int(os.getenv("COSMOS_HISTORY_MAX_MESSAGES", "50"))
+# Retries of a conditional conversation save that lost to a concurrent writer
+COSMOS_WRITE_CONFLICT_RETRIES = int(os.getenv("COSMOS_WRITE_CONFLICT_RETRIES", "3"))
+
+# User registry (one document per user, listed instead of SELECT DISTINCT over conversations)
+USER_REGISTRY_CONTAINER = os.getenv("USER_REGISTRY_CONTAINER", "Users")
+USER_REGISTRY_CACHE_TTL_SECONDS = float(os.getenv("USER_REGISTRY_CACHE_TTL_SECONDS", "60"))
+USER_IDS_PAGE_SIZE = int(os.getenv("USER_IDS_PAGE_SIZE", "100"))
+USER_IDS_MAX_PAGE_SIZE = int(os.getenv("USER_IDS_MAX_PAGE_SIZE", "1000"))
+
+# Conversation listing page size for /api/conversations
+CONVERSATIONS_PAGE_SIZE = int(os.getenv("CONVERSATIONS_PAGE_SIZE", "20"))
+CONVERSATIONS_MAX_PAGE_SIZE = int(os.getenv("CONVERSATIONS_MAX_PAGE_SIZE", "100"))
+
+# Conversation cache configuration (entries older than the TTL are revalidated by _etag)
+CONVERSATION_CACHE_ENABLED = os.getenv("CONVERSATION_CACHE_ENABLED", "True").lower() in ("true", "1", "t")
+CONVERSATION_CACHE_MAX_ENTRIES = int(os.getenv("CONVERSATION_CACHE_MAX_ENTRIES", "1000"))
+CONVERSATION_CACHE_TTL_SECONDS = float(os.getenv("CONVERSATION_CACHE_TTL_SECONDS", "30"))
+
+# Write-behind buffer for conversation saves: turns are queued, coalesced
+# per conversation and flushed in per-user batches when WRITE_BEHIND_MAX_BATCH_SIZE
+# are due or the oldest has waited WRITE_BEHIND_FLUSH_INTERVAL_SECONDS. Turns
+# are refused (503) while the queue holds WRITE_BEHIND_MAX_PENDING_BYTES.
+# Queued conversations are journaled to a file per process in
+# WRITE_BEHIND_SPILL_DIR (empty for none; fsync each append with
+# WRITE_BEHIND_FSYNC) and recovered after a crash
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "False").lower() in ("true", "1", "t")
+WRITE_BEHIND_FLUSH_INTERVAL_SECONDS = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_SECONDS", "0.5"))
+WRITE_BEHIND_MAX_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_MAX_BATCH_SIZE", "100"))
+WRITE_BEHIND_MAX_PENDING_BYTES = int(os.getenv("WRITE_BEHIND_MAX_PENDING_BYTES", str(64 * 1024 * 1024)))
+WRITE_BEHIND_FLUSH_CONCURRENCY = int(os.getenv("WRITE_BEHIND_FLUSH_CONCURRENCY", "8"))
+WRITE_BEHIND_SPILL_DIR = os.getenv("WRITE_BEHIND_SPILL_DIR", ".write_behind")
+WRITE_BEHIND_FSYNC = os.getenv("WRITE_BEHIND_FSYNC", "False").lower() in ("true", "1", "t")
+
+# Chat pipeline configuration
+PERSIST_MAX_RETRIES = int(os.getenv("PERSIST_MAX_RETRIES", "3"))
+PERSIST_RETRY_BACKOFF_SECONDS = float(os.getenv("PERSIST_RETRY_BACKOFF_SECONDS", "0.5"))
+
+# Prompt token budget (system prompt, context, history and user message)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+# Cap on the retrieved context inside the system prompt, and the share of a
+# chunk's word shingles already in the context that makes it a duplicate
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "2000"))
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", "0.8"))
+# tiktoken encoding used to count tokens. Its BPE file is downloaded when the
+# services are built (set TIKTOKEN_CACHE_DIR to keep it across restarts);
+# token counts are estimated if it can't be loaded
+TOKEN_ENCODING = os.getenv("TOKEN_ENCODING", "o200k_base")
+# Fold turns that no longer fit the budget into a rolling summary on the conversation
+HISTORY_SUMMARY_ENABLED = os.getenv("HISTORY_SUMMARY_ENABLED", "False").lower() in ("true", "1", "t")
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", AZURE_OPENAI_MODEL)
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "300"))
+# Rewrite follow-up questions into standalone search queries before they are
+# embedded: "off", "heuristic" (append the key words of the previous questions
+# to questions that refer back to them) or "model" (condense the recent turns
+# with QUERY_REWRITE_MODEL, ideally a small deployment). Rewrites consider the
+# last QUERY_REWRITE_HISTORY_TURNS turns and are cached per conversation turn
+QUERY_REWRITE_MODE = os.getenv("QUERY_REWRITE_MODE", "off").lower()
+QUERY_REWRITE_MODEL = os.getenv("QUERY_REWRITE_MODEL", AZURE_OPENAI_MODEL)
+QUERY_REWRITE_MAX_TOKENS = int(os.getenv("QUERY_REWRITE_MAX_TOKENS", "60"))
+QUERY_REWRITE_HISTORY_TURNS = int(os.getenv("QUERY_REWRITE_HISTORY_TURNS", "3"))
+QUERY_REWRITE_CACHE_ENTRIES = int(os.getenv("QUERY_REWRITE_CACHE_ENTRIES", "10000"))
+# System prompt templates, read once from PROMPT_TEMPLATE_DIR/<name>/v<N>.txt:
+# the default ("name" for its latest version, or "name@vN") and per-tenant or
+# per-search-index choices as "key=name@vN,key=name"
+PROMPT_TEMPLATE_DIR = os.getenv("PROMPT_TEMPLATE_DIR", os.path.join(os.path.dirname(__file__), "prompts"))
+PROMPT_TEMPLATE = os.getenv("PROMPT_TEMPLATE", "margies-travel")
+PROMPT_TEMPLATE_OVERRIDES = dict(
+    item.strip().split("=", 1) for item in os.getenv("PROMPT_TEMPLATE_OVERRIDES", "").split(",") if "=" in item
+)
 
 # API Configuration
 API_HOST = os.getenv("API_HOST", "0.0.0.0")
 API_PORT = int(os.getenv("API_PORT", "8000"))
 DEBUG = os.getenv("DEBUG", "False").lower() in ("true", "1", "t")
+# Production server (python -m app.commands.serve): worker processes
+# (WEB_CONCURRENCY is honoured as the conventional fallback) and the seconds
+# in-flight requests get to finish on shutdown
+API_WORKERS = int(os.getenv("API_WORKERS", os.getenv("WEB_CONCURRENCY", "1")))
+API_GRACEFUL_SHUTDOWN_SECONDS = float(os.getenv("API_GRACEFUL_SHUTDOWN_SECONDS", "30"))
+# Use the async Azure SDK clients; when disabled the sync clients run in a worker thread
+USE_ASYNC_CLIENTS = os.getenv("USE_ASYNC_CLIENTS", "True").lower() in ("true", "1", "t")
+
+# Logging: level of the app's loggers and "text" or "json" (one object per line) output
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# Prometheus metrics on /metrics, and OpenTelemetry spans for the pipeline
+# stages (needs opentelemetry-api; exporters are configured by the environment)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True").lower() in ("true", "1", "t")
+OTEL_ENABLED = os.getenv("OTEL_ENABLED", "False").lower() in ("true", "1", "t")
+
+# Cache backend shared by the API's worker processes for the embedding,
+# conversation and answer caches: empty (each process keeps its own),
+# memory://, sqlite:///path/to/cache.db (one host) or redis://host:6379/0
+# (uses the redis package from requirements.txt). Entries expire after the TTL unless the cache
+# sets its own (0 for never)
+CACHE_BACKEND_URL = os.getenv("CACHE_BACKEND_URL", "")
+CACHE_BACKEND_TTL_SECONDS = float(os.getenv("CACHE_BACKEND_TTL_SECONDS", "86400"))
+
+# Connection pools, one per upstream (Azure OpenAI, AI Search, Cosmos DB) and
+# shared by every client talking to it
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("HTTP_KEEPALIVE_EXPIRY_SECONDS", "60"))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "5"))
+HTTP_READ_TIMEOUT_SECONDS = float(os.getenv("HTTP_READ_TIMEOUT_SECONDS", "60"))
+# HTTP/2 for the Azure OpenAI pool; needs the optional h2 package
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "True").lower() in ("true", "1", "t")
+
+# Ingestion (python -m app.commands.ingest): chunk size and overlap in tokens,
+# texts per embeddings call, embeddings calls in flight, a limit on the
+# tokens sent to the embedding deployment (0 for none), index actions per
+# upload batch, and the checkpoint that makes re-runs incremental
+INGEST_CHUNK_TOKENS = int(os.getenv("INGEST_CHUNK_TOKENS", "512"))
+INGEST_CHUNK_OVERLAP_TOKENS = int(os.getenv("INGEST_CHUNK_OVERLAP_TOKENS", "64"))
+INGEST_EMBEDDING_BATCH_SIZE = int(os.getenv("INGEST_EMBEDDING_BATCH_SIZE", "16"))
+INGEST_EMBEDDING_CONCURRENCY = int(os.getenv("INGEST_EMBEDDING_CONCURRENCY", "4"))
+INGEST_EMBEDDING_TOKENS_PER_MINUTE = int(os.getenv("INGEST_EMBEDDING_TOKENS_PER_MINUTE", "0"))
+INGEST_UPLOAD_BATCH_SIZE = int(os.getenv("INGEST_UPLOAD_BATCH_SIZE", "500"))
+INGEST_CHECKPOINT_PATH = os.getenv("INGEST_CHECKPOINT_PATH", ".ingest_checkpoint.json")
+
+# Upstream scheduler: every call to Azure OpenAI, AI Search and Cosmos DB
+# runs under a per-upstream concurrency limit that adapts to throttling
+# (between the minimum and the upstream's maximum) and is retried with
+# jittered backoff honoring Retry-After
+UPSTREAM_SCHEDULER_ENABLED = os.getenv("UPSTREAM_SCHEDULER_ENABLED", "True").lower() in ("true", "1", "t")
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "32"))
+SEARCH_MAX_CONCURRENCY = int(os.getenv("SEARCH_MAX_CONCURRENCY", "32"))
+COSMOS_MAX_CONCURRENCY = int(os.getenv("COSMOS_MAX_CONCURRENCY", "64"))
+UPSTREAM_MIN_CONCURRENCY = int(os.getenv("UPSTREAM_MIN_CONCURRENCY", "1"))
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "4"))
+UPSTREAM_RETRY_BASE_SECONDS = float(os.getenv("UPSTREAM_RETRY_BASE_SECONDS", "0.5"))
+UPSTREAM_RETRY_MAX_SECONDS = float(os.getenv("UPSTREAM_RETRY_MAX_SECONDS", "10"))
+# Longest wait for a slot under the concurrency limit or for completion tokens
+UPSTREAM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT_SECONDS", "10"))
+# Tokens per minute of the chat deployment's quota (prompt plus max_tokens
+# are reserved per completion); 0 leaves completions unbudgeted
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "0"))
+# Time a chat request may spend on upstream calls (up to its first token
+# when streaming) before it is answered with 503; 0 for no deadline
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "30"))
+
+# Build every service when the app starts instead of on first use
+SERVICES_EAGER_INIT = os.getenv("SERVICES_EAGER_INIT", "True").lower() in ("true", "1", "t")
+# Azure Functions entry point: import the API and its SDKs on the first
+# request (or the warmup trigger) instead of when the worker loads the app
+FUNCTIONS_FAST_START = os.getenv("FUNCTIONS_FAST_START", "True").lower() in ("true", "1", "t")
+# Run the Cosmos DB bootstrap (create the database and containers if missing)
+# at startup; otherwise run it once with `python -m app.commands.bootstrap`
+COSMOS_BOOTSTRAP_ON_STARTUP = os.getenv("COSMOS_BOOTSTRAP_ON_STARTUP", "False").lower() in ("true", "1", "t")
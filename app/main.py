@@ -1,17 +1,36 @@
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse
+from app.api.errors import register_error_handlers
+from app.api.metrics import MetricsMiddleware, metrics_router
 from app.api.router import api_router
 from app.config import API_HOST, API_PORT, DEBUG
+from app.logging_config import configure_logging
+from app.services.container import services
+from app.services.telemetry import register_service_metrics
 import os
 from pathlib import Path
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build the services before the first request and close their connection pools on shutdown"""
+    await services.startup()
+    yield
+    await services.shutdown()
+
+configure_logging()
+register_service_metrics(services)
+
 # Create FastAPI app
-app = FastAPI(title="Azure RAG Search API")
+app = FastAPI(title="Azure RAG Search API", lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+register_error_handlers(app)
 
 # Include API router
 app.include_router(api_router)
+app.include_router(metrics_router)
 
 # Set up template directory
 BASE_DIR = Path(__file__).resolve().parent
@@ -1,18 +1,30 @@
-from typing import List, Optional, Dict, Any
+from typing import List, Literal, Optional, Dict, Any, Union
 from pydantic import BaseModel, Field
 from datetime import datetime
 import uuid
 
+class RetrievalOptions(BaseModel):
+    """Per-request overrides of the retrieval defaults"""
+    mode: Optional[Literal["vector", "hybrid"]] = Field(None, description="Vector-only or keyword + vector query")
+    candidates: Optional[int] = Field(None, ge=1, le=50, description="Results fetched before re-ranking")
+    top: Optional[int] = Field(None, ge=1, le=20, description="Chunks passed to the prompt")
+    reranker: Optional[Literal["none", "cosine", "mmr"]] = Field(None, description="Local re-ranking method")
+
 class ChatRequest(BaseModel):
     """Simplified model for a chat request"""
     prompt: str
     conversation_id: Optional[str] = None
     user_id: str = Field(..., description="User identifier")
+    tenant: Optional[str] = Field(None, description="Tenant whose prompt template to use (see PROMPT_TEMPLATE_OVERRIDES)")
+    retrieval: Optional[RetrievalOptions] = None
 
 class ChatResponse(BaseModel):
     """Simplified model for a chat response"""
     response: str
     conversation_id: str
+    timings: Optional[Dict[str, float]] = Field(None, description="Per-stage latency in milliseconds")
+    usage: Optional[Dict[str, Union[int, float]]] = Field(None, description="Prompt token, context and history request unit accounting")
+    sources: Optional[List[str]] = Field(None, description="Titles of the context sources, numbered in order from [1]")
 
 class ConversationDocument(BaseModel):
     """Model for a conversation document to be stored in Cosmos DB"""
@@ -23,4 +35,16 @@ class ConversationDocument(BaseModel):
 
 class ConversationsRequest(BaseModel):
     """Model for a request to retrieve conversations"""
-    user_id: str = Field(..., description="User identifier")
\ No newline at end of file
+    user_id: str = Field(..., description="User identifier")
+
+class ConversationSummary(BaseModel):
+    """Model for a conversation in the sidebar listing"""
+    id: str
+    title: Optional[str] = None
+    last_updated: Optional[int] = Field(None, description="Last write time (Unix seconds)")
+    message_count: int = 0
+
+class ConversationPage(BaseModel):
+    """Model for one page of a user's conversations"""
+    conversations: List[ConversationSummary]
+    continuation: Optional[str] = Field(None, description="Token for the next page, absent on the last page")
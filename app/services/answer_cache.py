@@ -0,0 +1,232 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.services.cache_backend import CacheBackend
+
+
+def chunk_fingerprint(result: Dict[str, Any]) -> str:
+    """Stable identifier for a retrieved chunk, preferring the index key when it was selected."""
+    chunk_id = result.get("chunk_id")
+    if chunk_id:
+        return str(chunk_id)
+    content = f"{result.get('parent_id', '')}\x00{result.get('chunk', '')}"
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CachedAnswer:
+    answer: str
+    similarity: float
+    completion_ms: float
+
+
+class AnswerCache:
+    """
+    Semantic cache of first-turn answers.
+
+    Query embeddings are kept L2-normalized in a preallocated float32 matrix
+    so a lookup is a single matrix-vector product. An entry matches when its
+    cosine similarity reaches the threshold and it was answered from the
+    same retrieved chunks with the same prompt template (name and version),
+    so a tenant with another template, or a new template version, never
+    gets an answer written under a different one. Entries expire after a TTL; when the cache is full
+    the least recently used entry is replaced.
+
+    With a shared backend, answers are also stored there under a hash of
+    the (rounded) question embedding, the chunk fingerprints and the
+    template, so a
+    question asked again is a hit on every worker; near-duplicates are
+    matched against the local matrix, which shared hits are copied into.
+    ``invalidate`` bumps a generation counter in the backend that the
+    other workers check at most every ``generation_check_seconds``.
+    Backend calls are never made under the lock; from the event loop use
+    the async variants, which make them on a worker thread.
+    """
+
+    def __init__(self, threshold: float, ttl_seconds: float, max_entries: int,
+                 backend: Optional[CacheBackend] = None, generation_check_seconds: float = 1.0):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.backend = backend if backend is not None and backend.shared else None
+        self.generation_check_seconds = generation_check_seconds
+        self._generation = self._shared_generation()
+        self._generation_checked = time.monotonic()
+
+        self._lock = threading.Lock()
+        self._vectors: Optional[np.ndarray] = None
+        self._expires = np.zeros(max_entries, dtype=np.float64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._chunk_keys: List[Optional[Tuple[str, ...]]] = [None] * max_entries
+        self._templates: List[Optional[str]] = [None] * max_entries
+        self._answers: List[Optional[str]] = [None] * max_entries
+        self._completion_ms = np.zeros(max_entries, dtype=np.float64)
+
+        self.lookups = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.latency_saved_ms = 0.0
+
+    @staticmethod
+    def _normalize(embedding) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None
+        return vector / norm
+
+    def lookup(self, embedding, chunk_keys: Sequence[str], template: str = "") -> Optional[CachedAnswer]:
+        """
+        Find a cached answer for a near-duplicate question.
+
+        Args:
+            embedding: Embedding of the new question
+            chunk_keys: Fingerprints of the chunks retrieved for it
+            template: Key of the prompt template it would be answered with
+
+        Returns:
+            The cached answer, or None on a miss
+        """
+        query = self._normalize(embedding)
+        self._check_generation()
+        with self._lock:
+            self.lookups += 1
+            if query is None:
+                return None
+            wanted = tuple(chunk_keys)
+            if self._vectors is not None and self._vectors.shape[1] == query.shape[0]:
+                now = time.time()
+                similarities = self._vectors @ query
+                candidates = np.flatnonzero((similarities >= self.threshold) & (self._expires > now))
+                for slot in candidates[np.argsort(-similarities[candidates])]:
+                    if self._chunk_keys[slot] == wanted and self._templates[slot] == template:
+                        self._last_used[slot] = now
+                        self.hits += 1
+                        self.latency_saved_ms += self._completion_ms[slot]
+                        return CachedAnswer(
+                            answer=self._answers[slot],
+                            similarity=float(similarities[slot]),
+                            completion_ms=float(self._completion_ms[slot]),
+                        )
+        if self.backend is None:
+            return None
+
+        value = self.backend.get(self._shared_key(query, wanted, template))
+        if value is None:
+            return None
+        entry = json.loads(value)
+        with self._lock:
+            self._insert(query, wanted, template, entry["answer"], entry["completion_ms"])
+            self.hits += 1
+            self.shared_hits += 1
+            self.latency_saved_ms += entry["completion_ms"]
+        return CachedAnswer(answer=entry["answer"], similarity=1.0, completion_ms=entry["completion_ms"])
+
+    def store(self, embedding, chunk_keys: Sequence[str], answer: str, completion_ms: float, template: str = ""):
+        """Cache an answer together with the completion latency it cost and the template it was written with."""
+        vector = self._normalize(embedding)
+        if vector is None:
+            return
+
+        with self._lock:
+            self._insert(vector, tuple(chunk_keys), template, answer, completion_ms)
+        if self.backend is not None:
+            entry = {"answer": answer, "completion_ms": completion_ms}
+            self.backend.set(self._shared_key(vector, chunk_keys, template), json.dumps(entry).encode("utf-8"), ttl_seconds=self.ttl_seconds)
+
+    async def lookup_async(self, embedding, chunk_keys: Sequence[str], template: str = "") -> Optional[CachedAnswer]:
+        """``lookup`` from the event loop; with a shared backend it runs on a worker thread."""
+        if self.backend is None:
+            return self.lookup(embedding, chunk_keys, template)
+        return await asyncio.to_thread(self.lookup, embedding, chunk_keys, template)
+
+    async def store_async(self, embedding, chunk_keys: Sequence[str], answer: str, completion_ms: float, template: str = ""):
+        """``store`` from the event loop; with a shared backend it runs on a worker thread."""
+        if self.backend is None:
+            return self.store(embedding, chunk_keys, answer, completion_ms, template)
+        return await asyncio.to_thread(self.store, embedding, chunk_keys, answer, completion_ms, template)
+
+    def _insert(self, vector: np.ndarray, chunk_keys: Tuple[str, ...], template: str, answer: str, completion_ms: float):
+        """Put an entry into a free (or the least recently used) slot; the lock must be held."""
+        if self._vectors is None or self._vectors.shape[1] != vector.shape[0]:
+            self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            self._expires[:] = 0
+
+        now = time.time()
+        free = np.flatnonzero(self._expires <= now)
+        if free.size:
+            slot = free[0]
+        else:
+            slot = int(np.argmin(self._last_used))
+            self.evictions += 1
+
+        self._vectors[slot] = vector
+        self._expires[slot] = now + self.ttl_seconds
+        self._last_used[slot] = now
+        self._chunk_keys[slot] = chunk_keys
+        self._templates[slot] = template
+        self._answers[slot] = answer
+        self._completion_ms[slot] = completion_ms
+
+    def _shared_key(self, vector: np.ndarray, chunk_keys: Sequence[str], template: str) -> str:
+        digest = hashlib.sha256(np.round(vector, 4).astype(np.float32).tobytes())
+        digest.update("\x00".join(chunk_keys).encode("utf-8"))
+        digest.update(b"\x01" + template.encode("utf-8"))
+        return f"answer:{self._generation}:{digest.hexdigest()}"
+
+    def _shared_generation(self) -> int:
+        if self.backend is None:
+            return 0
+        value = self.backend.get("answer-generation")
+        return int(value) if value is not None else 0
+
+    def _check_generation(self):
+        """Drop the local entries when another worker has invalidated the cache."""
+        if self.backend is None or time.monotonic() - self._generation_checked < self.generation_check_seconds:
+            return
+        self._generation_checked = time.monotonic()
+        generation = self._shared_generation()
+        if generation != self._generation:
+            self._generation = generation
+            self._clear()
+
+    def _clear(self):
+        with self._lock:
+            self._expires[:] = 0
+            self._chunk_keys = [None] * self.max_entries
+            self._templates = [None] * self.max_entries
+            self._answers = [None] * self.max_entries
+
+    def invalidate(self):
+        """Drop every cached answer, e.g. after the search index has been updated."""
+        self._clear()
+        with self._lock:
+            self.invalidations += 1
+        if self.backend is not None:
+            self._generation = self._shared_generation() + 1
+            self.backend.set("answer-generation", str(self._generation).encode("ascii"), ttl_seconds=0)
+            self.backend.delete_prefix("answer:")
+
+    def stats(self) -> Dict[str, float]:
+        """Hit rate and the completion latency saved by cache hits."""
+        with self._lock:
+            entries = int(np.count_nonzero(self._expires > time.time()))
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+            "shared_hits": self.shared_hits,
+            "latency_saved_ms": round(self.latency_saved_ms, 2),
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "entries": entries,
+        }
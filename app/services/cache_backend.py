@@ -0,0 +1,288 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend:
+    """
+    Byte-valued key/value store behind the embedding, conversation and
+    answer caches.
+
+    The caches keep their own in-process structures (LRUs, the answer
+    matrix) and use a backend to share entries with the other worker
+    processes of the API. Keys are namespaced by each cache ("emb:",
+    "conv:", "answer:"). Values expire after ``ttl_seconds`` (the backend's
+    default TTL when None). Calls are synchronous and meant to be local
+    (a file on the same host, or a Redis next to the API), like the disk
+    tier of the embedding cache they replace. They still block on I/O, so
+    the caches make them outside their locks, and on a worker thread
+    (``asyncio.to_thread``) when called from the event loop.
+    """
+
+    #: Whether other processes see the entries
+    shared = False
+
+    def __init__(self, default_ttl_seconds: float = 0.0):
+        self.default_ttl_seconds = default_ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.errors = 0
+
+    def _expiry(self, ttl_seconds: Optional[float]) -> Optional[float]:
+        ttl = self.default_ttl_seconds if ttl_seconds is None else ttl_seconds
+        return time.time() + ttl if ttl and ttl > 0 else None
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix: str) -> int:
+        """Delete every key starting with ``prefix``; returns how many were deleted."""
+        raise NotImplementedError
+
+    def _count(self, value: Optional[bytes]) -> Optional[bytes]:
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "errors": self.errors,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def close(self):
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    """In-process LRU backend; nothing is shared with other workers."""
+
+    def __init__(self, max_entries: int = 10000, default_ttl_seconds: float = 0.0):
+        super().__init__(default_ttl_seconds)
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[bytes, Optional[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return self._count(entry[0] if entry is not None else None)
+
+    def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None):
+        with self._lock:
+            self._entries[key] = (value, self._expiry(ttl_seconds))
+            self._entries.move_to_end(key)
+            self.writes += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_prefix(self, prefix: str) -> int:
+        with self._lock:
+            keys = [key for key in self._entries if key.startswith(prefix)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def stats(self) -> Dict[str, float]:
+        stats = super().stats()
+        stats["entries"] = len(self._entries)
+        return stats
+
+
+class SqliteCacheBackend(CacheBackend):
+    """
+    Backend in a SQLite file in WAL mode, shared by every process on the
+    host that opens the same path (and surviving restarts). Reads don't
+    block behind writers; writers wait up to ``busy_timeout_ms`` for each
+    other. Expired rows are skipped on read and purged every
+    ``purge_every`` writes. Once closed, reads miss and writes are dropped,
+    so calls still in flight on worker threads at shutdown don't fail.
+    """
+
+    shared = True
+
+    def __init__(self, path: str, default_ttl_seconds: float = 0.0, busy_timeout_ms: int = 5000, purge_every: int = 1000):
+        super().__init__(default_ttl_seconds)
+        self.path = path
+        self.purge_every = purge_every
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=busy_timeout_ms / 1000)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)"
+        )
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if self._db is None:
+                return self._count(None)
+            try:
+                row = self._db.execute(
+                    "SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, time.time())
+                ).fetchone()
+            except sqlite3.Error as e:
+                self.errors += 1
+                logger.warning("Cache read failed: %s", e)
+                row = None
+            return self._count(bytes(row[0]) if row is not None else None)
+
+    def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None):
+        with self._lock:
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                    (key, value, self._expiry(ttl_seconds))
+                )
+                self.writes += 1
+                if self.writes % self.purge_every == 0:
+                    self._db.execute("DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+                self._db.commit()
+            except sqlite3.Error as e:
+                self.errors += 1
+                logger.warning("Cache write failed: %s", e)
+
+    def delete(self, key: str):
+        with self._lock:
+            if self._db is None:
+                return
+            self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._db.commit()
+
+    def delete_prefix(self, prefix: str) -> int:
+        with self._lock:
+            if self._db is None:
+                return 0
+            # Range scan on the primary key instead of LIKE, which would need escaping
+            cursor = self._db.execute("DELETE FROM cache WHERE key >= ? AND key < ?", (prefix, prefix + "\uffff"))
+            self._db.commit()
+            return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Backend in Redis, shared by every worker and host pointed at it. Needs
+    the ``redis`` package. Redis errors are logged and treated as misses so
+    an unavailable cache slows requests down instead of failing them.
+    """
+
+    shared = True
+
+    def __init__(self, url: str, default_ttl_seconds: float = 0.0, socket_timeout: float = 0.5):
+        super().__init__(default_ttl_seconds)
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("CACHE_BACKEND_URL is a redis:// URL but the redis package is not installed") from e
+        self._errors = (redis.RedisError,)
+        self._client = redis.Redis.from_url(url, socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self._count(self._client.get(key))
+        except self._errors as e:
+            self.errors += 1
+            logger.warning("Cache read failed: %s", e)
+            return self._count(None)
+
+    def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None):
+        ttl = self.default_ttl_seconds if ttl_seconds is None else ttl_seconds
+        try:
+            self._client.set(key, value, px=int(ttl * 1000) if ttl and ttl > 0 else None)
+            self.writes += 1
+        except self._errors as e:
+            self.errors += 1
+            logger.warning("Cache write failed: %s", e)
+
+    def delete(self, key: str):
+        try:
+            self._client.delete(key)
+        except self._errors as e:
+            self.errors += 1
+            logger.warning("Cache delete failed: %s", e)
+
+    def delete_prefix(self, prefix: str) -> int:
+        deleted = 0
+        try:
+            keys = []
+            for key in self._client.scan_iter(match=prefix.replace("*", r"\*") + "*", count=500):
+                keys.append(key)
+                if len(keys) == 500:
+                    deleted += self._client.delete(*keys)
+                    keys = []
+            if keys:
+                deleted += self._client.delete(*keys)
+        except self._errors as e:
+            self.errors += 1
+            logger.warning("Cache delete failed: %s", e)
+        return deleted
+
+    def close(self):
+        self._client.close()
+
+
+def create_cache_backend(url: str, default_ttl_seconds: float = 0.0) -> Optional[CacheBackend]:
+    """
+    Build the backend a CACHE_BACKEND_URL names:
+
+    - empty: None, every cache stays private to its process
+    - ``memory://``: an in-process backend
+    - ``sqlite:///path/to/cache.db``: a SQLite file shared by the workers on the host
+    - ``redis://host:6379/0``: a Redis server shared by every worker
+    """
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == "memory":
+        return MemoryCacheBackend(default_ttl_seconds=default_ttl_seconds)
+    if parsed.scheme == "sqlite":
+        # sqlite:///cache.db is relative to the working directory, sqlite:////var/cache.db absolute
+        path = url[len("sqlite:///"):]
+        if not path:
+            raise ValueError(f"No file in cache backend URL: {url}")
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        return SqliteCacheBackend(path, default_ttl_seconds=default_ttl_seconds)
+    if parsed.scheme in ("redis", "rediss", "unix"):
+        return RedisCacheBackend(url, default_ttl_seconds=default_ttl_seconds)
+    raise ValueError(f"Unsupported cache backend URL: {url}")
@@ -0,0 +1,511 @@
+import asyncio
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from app.config import (
+    PERSIST_MAX_RETRIES,
+    PERSIST_RETRY_BACKOFF_SECONDS,
+    PROMPT_TOKEN_BUDGET,
+    CONTEXT_MAX_TOKENS,
+    CONTEXT_DUPLICATE_THRESHOLD,
+    TOKEN_ENCODING,
+    HISTORY_SUMMARY_ENABLED,
+    HISTORY_SUMMARY_MODEL,
+    HISTORY_SUMMARY_MAX_TOKENS,
+    PROMPT_TEMPLATE_DIR,
+    PROMPT_TEMPLATE,
+    PROMPT_TEMPLATE_OVERRIDES,
+    WRITE_BEHIND_FLUSH_INTERVAL_SECONDS
+)
+from app.services import telemetry
+from app.services.answer_cache import AnswerCache, CachedAnswer, chunk_fingerprint
+from app.services.context_builder import ContextBuilder, ContextResult
+from app.services.cosmos_service import CONVERSATION_STATE_KEYS, REQUEST_CHARGE_KEY
+from app.services.prompt_builder import PromptBuilder, PromptTemplate
+from app.services.query_rewriter import QueryRewriter
+from app.services.token_budget import HistoryManager, HistoryWindow, TokenCounter
+from app.services.upstream_scheduler import UpstreamOverloaded
+
+logger = logging.getLogger(__name__)
+
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and the Margie's Travel "
+    "documents assistant. Merge the new messages into the existing summary. Keep the user's "
+    "questions, stated preferences, names, dates and any facts the assistant gave. "
+    "Reply with the updated summary only, in at most a few short paragraphs."
+)
+
+
+class StageTimer:
+    """
+    Collects wall-clock durations (in milliseconds) for named pipeline stages,
+    also observed into the stage latency histogram.
+    """
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            with telemetry.span(name):
+                yield
+        finally:
+            self.timings[name] = round((time.perf_counter() - start) * 1000, 2)
+
+    def record(self, name: str, start: float):
+        """Record a stage that started at ``start`` (a perf_counter value) and ends now."""
+        seconds = time.perf_counter() - start
+        self.timings[name] = round(seconds * 1000, 2)
+        telemetry.observe_stage(name, seconds)
+
+    def finish(self) -> Dict[str, float]:
+        self.record("total", self._start)
+        return self.timings
+
+    def server_timing_header(self) -> str:
+        """Format the timings as a Server-Timing header value."""
+        return ", ".join(f"{name};dur={duration}" for name, duration in self.timings.items())
+
+
+@dataclass
+class ChatTurn:
+    """Result of running the chat pipeline for a single request."""
+    response: str
+    conversation_id: str
+    conversation_data: Dict[str, Any]
+    timer: StageTimer = field(default_factory=StageTimer)
+    usage: Dict[str, float] = field(default_factory=dict)
+    # Titles of the context sections, in citation order
+    sources: List[str] = field(default_factory=list)
+    # Number of leading messages (counted from the start of the conversation)
+    # that should be folded into the rolling summary
+    summarize_upto: Optional[int] = None
+
+
+@dataclass
+class PreparedTurn:
+    """State of a request once history, retrieval and prompt building are done."""
+    conversation_id: str
+    previous_messages: List[Dict[str, Any]]
+    messages_for_openai: List[Dict[str, str]]
+    timer: StageTimer
+    query_embedding: Optional[List[float]] = None
+    chunk_keys: Optional[List[str]] = None
+    template: Optional[PromptTemplate] = None
+    cached_answer: Optional[CachedAnswer] = None
+    conversation_state: Dict[str, Any] = field(default_factory=dict)
+    window: Optional[HistoryWindow] = None
+    context: Optional[ContextResult] = None
+    turn: Optional[ChatTurn] = None
+    # Cosmos DB request units spent loading the history
+    history_request_units: float = 0.0
+    # Token usage reported by the completion, including cached prompt tokens
+    completion_usage: Dict[str, int] = field(default_factory=dict)
+    # Query the chunks were retrieved with, when the prompt was rewritten
+    search_query: Optional[str] = None
+
+    @property
+    def sources(self) -> List[str]:
+        return self.context.sources if self.context is not None else []
+
+    def usage(self) -> Dict[str, float]:
+        """Prompt token, context, history request unit and completion token accounting for the request."""
+        usage = {"prompt_tokens": 0, "history_tokens": 0, "dropped_messages": 0}
+        if self.window is not None:
+            usage = {
+                "prompt_tokens": self.window.prompt_tokens,
+                "history_tokens": self.window.history_tokens,
+                "dropped_messages": len(self.window.dropped),
+            }
+        if self.context is not None:
+            usage["context_tokens"] = self.context.context_tokens
+            usage["context_tokens_saved"] = self.context.tokens_saved
+        usage["history_request_units"] = round(self.history_request_units, 2)
+        usage.update(self.completion_usage)
+        return usage
+
+
+class ChatPipeline:
+    """
+    Runs a chat request through its stages:
+
+        history + retrieval (concurrently) -> prompt build -> completion
+
+    The completion is either awaited in full (``run``) or streamed
+    (``prepare`` followed by ``stream``). First-turn questions that are near
+    duplicates of an already answered one skip the completion entirely when
+    an answer cache is configured.
+
+    History is trimmed to PROMPT_TOKEN_BUDGET; with HISTORY_SUMMARY_ENABLED the
+    trimmed turns are folded into a rolling summary stored on the conversation.
+
+    With a query rewriter, follow-up turns load the history first and
+    retrieve with the prompt rewritten into a standalone query; first turns
+    keep history and retrieval concurrent.
+
+    Finalizing the turn (summary update and persisting the conversation) is a
+    separate stage that the caller schedules after the response has been
+    returned. A failed completion raises (UpstreamOverloaded or
+    UpstreamError) before the turn is assembled, so it is never saved.
+    """
+
+    def __init__(self, search_service, openai_service, cosmos_service, answer_cache: Optional[AnswerCache] = None,
+                 query_rewriter: Optional[QueryRewriter] = None):
+        self.search_service = search_service
+        self.openai_service = openai_service
+        self.cosmos_service = cosmos_service
+        self.answer_cache = answer_cache
+        self.query_rewriter = query_rewriter
+        counter = TokenCounter(TOKEN_ENCODING)
+        self.history_manager = HistoryManager(counter, PROMPT_TOKEN_BUDGET)
+        self.context_builder = ContextBuilder(counter, CONTEXT_MAX_TOKENS, CONTEXT_DUPLICATE_THRESHOLD)
+        self.prompt_builder = PromptBuilder(self.history_manager, PROMPT_TEMPLATE_DIR, PROMPT_TEMPLATE, PROMPT_TEMPLATE_OVERRIDES)
+
+        # Conversations whose save has been scheduled but not yet completed,
+        # so a quick follow-up turn still sees the latest messages
+        self._pending_writes: Dict[str, Dict[str, Any]] = {}
+
+        self.persisted = 0
+        self.persist_retries = 0
+        self.persist_failures = 0
+
+    async def load_history(self, conversation_id: Optional[str], user_id: str) -> Tuple[str, List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Load previous messages for the conversation.
+
+        Returns:
+            The conversation id to use, the previous messages and the
+            conversation state carried into the next save (rolling summary,
+            storage layout bookkeeping, _etag). The request units spent on
+            the read are reported under ``_request_charge``.
+        """
+        if not conversation_id:
+            return str(uuid.uuid4()), [], {}
+
+        try:
+            conversation = self._pending_writes.get(conversation_id)
+            if conversation is None:
+                conversation = await self.cosmos_service.get_conversation_async(conversation_id, user_id)
+
+            if conversation and conversation.get("user_id") == user_id:
+                previous_messages = conversation.get("messages", [])
+                logger.debug("Loaded %d previous messages from conversation %s", len(previous_messages), conversation_id)
+                conversation_state = {
+                    key: conversation[key] for key in CONVERSATION_STATE_KEYS if key in conversation
+                }
+                conversation_state[REQUEST_CHARGE_KEY] = conversation.get(REQUEST_CHARGE_KEY, 0.0)
+                return conversation_id, previous_messages, conversation_state
+
+            # Either conversation not found or user_id mismatch
+            if conversation:
+                logger.warning("User ID mismatch for conversation %s", conversation_id)
+                # Create a new conversation_id since this is not the conversation owner
+                return str(uuid.uuid4()), [], {}
+            logger.debug("Conversation %s not found", conversation_id)
+        except UpstreamOverloaded:
+            # Answering without the history would fork the conversation
+            raise
+        except Exception as e:
+            logger.error("Error loading previous conversation: %s", e)
+
+        return conversation_id, [], {}
+
+    async def retrieve(self, query: str, options=None) -> Tuple[Optional[List[float]], List[Dict[str, Any]]]:
+        """
+        Embed the query and fetch matching chunks from the search index.
+
+        Args:
+            query: The user prompt
+            options: RetrievalOptions of the request, if any
+
+        Returns:
+            The query embedding (None if embedding failed) and the search results
+        """
+        query_embedding = None
+        try:
+            with telemetry.span("embedding"):
+                query_embedding = await self.search_service.embed_query_async(query)
+            overrides = options.model_dump(exclude_none=True) if options is not None else {}
+            with telemetry.span("search"):
+                search_results = await self.search_service.search_async(query, query_embedding=query_embedding, **overrides) or []
+            logger.debug("Found %d search results", len(search_results))
+            return query_embedding, search_results
+        except UpstreamOverloaded:
+            raise
+        except Exception as search_error:
+            logger.error("Search error: %s", search_error)
+            return query_embedding, []
+
+    @staticmethod
+    def _unsummarized_start(conversation_state: Dict[str, Any]) -> int:
+        """Index (into the loaded messages) of the first message not covered by the rolling summary."""
+        summarized = conversation_state.get("summary_message_count", 0)
+        return max(summarized - conversation_state.get("message_offset", 0), 0)
+
+    def build_messages(self, query: str, previous_messages: List[Dict[str, Any]], context: ContextResult, conversation_state: Optional[Dict[str, Any]] = None,
+                       template: Optional[PromptTemplate] = None) -> HistoryWindow:
+        """
+        Assemble the system prompt, conversation history, retrieved context and the new user message.
+
+        Messages already folded into the rolling summary are replaced by the
+        summary, and the remaining history is trimmed to the token budget.
+        """
+        conversation_state = conversation_state or {}
+
+        return self.prompt_builder.build(
+            template or self.prompt_builder.default,
+            query,
+            previous_messages[self._unsummarized_start(conversation_state):],
+            context,
+            summary=conversation_state.get("summary"),
+        )
+
+    async def prepare(self, request) -> PreparedTurn:
+        """Run the history, retrieval and prompt stages for a request."""
+        write_buffer = getattr(self.cosmos_service, "write_buffer", None)
+        if write_buffer is not None and write_buffer.full:
+            # Refuse new turns until the queued conversation saves have drained
+            raise UpstreamOverloaded("cosmos", 503, "has a full write-behind buffer", WRITE_BEHIND_FLUSH_INTERVAL_SECONDS)
+        timer = StageTimer()
+
+        async def timed(name, coro):
+            with timer.stage(name):
+                return await coro
+
+        search_query = None
+        if self.query_rewriter is not None and request.conversation_id:
+            # The rewrite needs the history, so retrieval waits for it
+            conversation_id, previous_messages, conversation_state = await timed(
+                "history", self.load_history(request.conversation_id, request.user_id))
+            with timer.stage("rewrite"):
+                turn = conversation_state.get("message_offset", 0) + len(previous_messages)
+                search_query = await self.query_rewriter.rewrite(conversation_id, turn, request.prompt, previous_messages)
+            query_embedding, search_results = await timed("retrieval", self.retrieve(search_query, request.retrieval))
+        else:
+            (conversation_id, previous_messages, conversation_state), (query_embedding, search_results) = await asyncio.gather(
+                timed("history", self.load_history(request.conversation_id, request.user_id)),
+                timed("retrieval", self.retrieve(request.prompt, request.retrieval)),
+            )
+
+        prepared = PreparedTurn(
+            conversation_id=conversation_id,
+            previous_messages=previous_messages,
+            messages_for_openai=[],
+            timer=timer,
+            history_request_units=conversation_state.pop(REQUEST_CHARGE_KEY, 0.0),
+            conversation_state=conversation_state,
+            search_query=search_query if search_query != request.prompt else None,
+        )
+
+        # The template is picked first: cached answers only match the template they were written with
+        prepared.template = self.prompt_builder.select(request.tenant, getattr(self.search_service, "index_name", None))
+
+        # Near-duplicate first-turn questions can be answered from the semantic cache
+        if self.answer_cache is not None and not previous_messages and query_embedding is not None:
+            with timer.stage("answer_cache"):
+                prepared.query_embedding = query_embedding
+                prepared.chunk_keys = [chunk_fingerprint(result) for result in search_results]
+                prepared.cached_answer = await self.answer_cache.lookup_async(query_embedding, prepared.chunk_keys, prepared.template.key)
+            if prepared.cached_answer is not None:
+                return prepared
+
+        with timer.stage("context"):
+            prepared.context = self.context_builder.build(search_results)
+
+        with timer.stage("prompt"):
+            prepared.window = self.build_messages(request.prompt, previous_messages, prepared.context, conversation_state, prepared.template)
+            prepared.messages_for_openai = prepared.window.messages
+
+        return prepared
+
+    async def remember_answer(self, prepared: PreparedTurn, ai_response: str):
+        """Offer a freshly generated first-turn answer to the semantic cache."""
+        if prepared.chunk_keys is None or prepared.cached_answer is not None:
+            return
+        if not ai_response:
+            return
+        await self.answer_cache.store_async(
+            prepared.query_embedding,
+            prepared.chunk_keys,
+            ai_response,
+            prepared.timer.timings.get("completion", 0.0),
+            prepared.template.key,
+        )
+
+    def complete_turn(self, request, prepared: PreparedTurn, ai_response: str) -> ChatTurn:
+        """Append the new exchange to the history and stage it for persisting."""
+        current_timestamp = datetime.utcnow().isoformat()
+        messages = list(prepared.previous_messages)
+        messages.append({
+            "role": "user",
+            "content": request.prompt,
+            "timestamp": current_timestamp
+        })
+        messages.append({
+            "role": "assistant",
+            "content": ai_response,
+            "timestamp": current_timestamp
+        })
+
+        conversation_data = {
+            "id": prepared.conversation_id,
+            "user_id": str(request.user_id),  # Ensure it's stored as a string
+            "messages": messages,
+        }
+        conversation_data.update(prepared.conversation_state)
+        self._pending_writes[prepared.conversation_id] = conversation_data
+
+        summarize_upto = None
+        if HISTORY_SUMMARY_ENABLED and prepared.window is not None and prepared.window.dropped:
+            summarize_upto = (
+                prepared.conversation_state.get("message_offset", 0)
+                + self._unsummarized_start(prepared.conversation_state)
+                + len(prepared.window.dropped)
+            )
+
+        prepared.timer.finish()
+        return ChatTurn(
+            response=ai_response,
+            conversation_id=prepared.conversation_id,
+            conversation_data=conversation_data,
+            timer=prepared.timer,
+            usage=prepared.usage(),
+            sources=prepared.sources,
+            summarize_upto=summarize_upto,
+        )
+
+    async def run(self, request) -> ChatTurn:
+        """
+        Run every stage up to (but not including) persisting the conversation.
+
+        Raises:
+            UpstreamOverloaded, UpstreamError: The completion failed
+        """
+        prepared = await self.prepare(request)
+        if prepared.cached_answer is not None:
+            return self.complete_turn(request, prepared, prepared.cached_answer.answer)
+
+        with prepared.timer.stage("completion"):
+            ai_response = await self.openai_service.generate_response_async(prepared.messages_for_openai, usage_out=prepared.completion_usage)
+
+        await self.remember_answer(prepared, ai_response)
+        return self.complete_turn(request, prepared, ai_response)
+
+    async def stream(self, request, prepared: PreparedTurn) -> AsyncIterator[str]:
+        """
+        Stream the completion for a prepared turn.
+
+        Yields response text as it arrives; once the stream is exhausted the
+        assembled turn is available as ``prepared.turn``.
+        """
+        if prepared.cached_answer is not None:
+            yield prepared.cached_answer.answer
+            prepared.turn = self.complete_turn(request, prepared, prepared.cached_answer.answer)
+            return
+
+        timer = prepared.timer
+        parts = []
+        start = time.perf_counter()
+        async for delta in self.openai_service.generate_response_stream_async(prepared.messages_for_openai, usage_out=prepared.completion_usage):
+            if not parts:
+                timer.record("first_token", start)
+            parts.append(delta)
+            yield delta
+        timer.record("completion", start)
+
+        ai_response = "".join(parts)
+        await self.remember_answer(prepared, ai_response)
+        prepared.turn = self.complete_turn(request, prepared, ai_response)
+
+    async def summarize(self, turn: ChatTurn):
+        """
+        Fold the messages that no longer fit the prompt budget into the
+        conversation's rolling summary.
+        """
+        conversation_data = turn.conversation_data
+        start = self._unsummarized_start(conversation_data)
+        end = turn.summarize_upto - conversation_data.get("message_offset", 0)
+        new_messages = conversation_data["messages"][start:end]
+        if not new_messages:
+            return
+
+        transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in new_messages)
+        previous_summary = conversation_data.get("summary") or "(none)"
+        summary = await self.openai_service.generate_response_async(
+            [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"Existing summary:\n{previous_summary}\n\nNew messages:\n{transcript}"},
+            ],
+            temperature=0,
+            max_tokens=HISTORY_SUMMARY_MAX_TOKENS,
+            model=HISTORY_SUMMARY_MODEL,
+        )
+        if not summary:
+            logger.warning("Could not summarize conversation %s", turn.conversation_id)
+            return
+
+        conversation_data["summary"] = summary
+        conversation_data["summary_message_count"] = turn.summarize_upto
+
+    async def finalize(self, turn: ChatTurn):
+        """Update the rolling summary if needed, then persist the conversation."""
+        if turn.summarize_upto:
+            try:
+                await self.summarize(turn)
+            except Exception as e:
+                logger.error("Error summarizing conversation %s: %s", turn.conversation_id, e)
+        await self.persist(turn.conversation_data)
+
+    async def persist(self, conversation_data: Dict[str, Any]):
+        """
+        Save the conversation to Cosmos DB, retrying with exponential backoff,
+        or queue it in the write-behind buffer, which does both later.
+
+        Intended to run as a background task once the response has been sent.
+        """
+        conversation_id = conversation_data["id"]
+        write_buffer = getattr(self.cosmos_service, "write_buffer", None)
+        if write_buffer is not None:
+            write_buffer.submit(conversation_data)
+            if self._pending_writes.get(conversation_id) is conversation_data:
+                del self._pending_writes[conversation_id]
+            return
+        try:
+            for attempt in range(PERSIST_MAX_RETRIES + 1):
+                try:
+                    logger.debug("Saving conversation with ID: %s for user: %s", conversation_id, conversation_data['user_id'])
+                    with telemetry.span("save"):
+                        await self.cosmos_service.save_conversation_async(conversation_data)
+                    self.persisted += 1
+                    return
+                except Exception as e:
+                    if attempt == PERSIST_MAX_RETRIES:
+                        self.persist_failures += 1
+                        logger.error("Giving up saving conversation %s after %s attempts: %s", conversation_id, attempt + 1, e)
+                        return
+                    self.persist_retries += 1
+                    logger.warning("Error saving conversation %s (attempt %s): %s", conversation_id, attempt + 1, e)
+                    await asyncio.sleep(PERSIST_RETRY_BACKOFF_SECONDS * (2 ** attempt))
+        finally:
+            # Only drop the pending copy if no newer turn replaced it meanwhile
+            if self._pending_writes.get(conversation_id) is conversation_data:
+                del self._pending_writes[conversation_id]
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters for the background persistence and query rewrite stages."""
+        return {
+            "persisted": self.persisted,
+            "persist_retries": self.persist_retries,
+            "persist_failures": self.persist_failures,
+            "pending_writes": len(self._pending_writes),
+            "query_rewrite": self.query_rewriter.stats() if self.query_rewriter is not None else None,
+        }
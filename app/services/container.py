@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from app.config import (
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_THRESHOLD,
+    ANSWER_CACHE_TTL_SECONDS,
+    ANSWER_CACHE_MAX_ENTRIES,
+    CACHE_BACKEND_TTL_SECONDS,
+    CACHE_BACKEND_URL,
+    COSMOS_BOOTSTRAP_ON_STARTUP,
+    COSMOS_MAX_CONCURRENCY,
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_TOKENS_PER_MINUTE,
+    QUERY_REWRITE_CACHE_ENTRIES,
+    QUERY_REWRITE_HISTORY_TURNS,
+    QUERY_REWRITE_MAX_TOKENS,
+    QUERY_REWRITE_MODE,
+    QUERY_REWRITE_MODEL,
+    SEARCH_MAX_CONCURRENCY,
+    SERVICES_EAGER_INIT,
+    TOKEN_ENCODING,
+    UPSTREAM_MAX_ATTEMPTS,
+    UPSTREAM_MIN_CONCURRENCY,
+    UPSTREAM_QUEUE_TIMEOUT_SECONDS,
+    UPSTREAM_RETRY_BASE_SECONDS,
+    UPSTREAM_RETRY_MAX_SECONDS,
+    UPSTREAM_SCHEDULER_ENABLED,
+)
+
+logger = logging.getLogger(__name__)
+
+# Services in build order; each one only depends on those before it
+SERVICE_NAMES = ("openai_service", "search_service", "cosmos_service", "answer_cache", "chat_pipeline")
+
+
+class ServiceContainer:
+    """
+    Builds the app's services once, on first use, and closes them on shutdown.
+
+    Every service is a process-wide singleton wired to the others (the search
+    service embeds queries with the same OpenAI service the pipeline uses)
+    and to one shared connection pool per upstream. Services are built
+    lazily, and the modules behind them (with the Azure and OpenAI SDKs) are
+    only imported when a service is first built, so importing the app is
+    cheap and makes no network connections. ``startup`` builds them ahead of
+    the first request and reports how long each took. Tests and benchmarks
+    replace services with ``override``.
+    """
+
+    def __init__(self):
+        self._http_pools = None
+        self._scheduler = None
+        self._cache_backend = None
+        self._services: Dict[str, Any] = {}
+        self._build_ms: Dict[str, float] = {}
+        self._lock = threading.RLock()
+        self.started_at: Optional[float] = None
+        self.startup_ms: Optional[float] = None
+
+    @property
+    def scheduler(self):
+        """The upstream scheduler shared by every connection pool, or None when disabled."""
+        if self._scheduler is None and UPSTREAM_SCHEDULER_ENABLED:
+            with self._lock:
+                if self._scheduler is None:
+                    from app.services.upstream_scheduler import UpstreamScheduler
+                    self._scheduler = UpstreamScheduler(
+                        {"openai": OPENAI_MAX_CONCURRENCY, "search": SEARCH_MAX_CONCURRENCY, "cosmos": COSMOS_MAX_CONCURRENCY},
+                        min_concurrency=UPSTREAM_MIN_CONCURRENCY,
+                        max_attempts=UPSTREAM_MAX_ATTEMPTS,
+                        retry_base_seconds=UPSTREAM_RETRY_BASE_SECONDS,
+                        retry_max_seconds=UPSTREAM_RETRY_MAX_SECONDS,
+                        queue_timeout_seconds=UPSTREAM_QUEUE_TIMEOUT_SECONDS,
+                        tokens_per_minute={"openai": OPENAI_TOKENS_PER_MINUTE},
+                    )
+        return self._scheduler
+
+    @property
+    def cache_backend(self):
+        """The cache backend shared by the worker processes, or None when CACHE_BACKEND_URL is empty."""
+        if self._cache_backend is None and CACHE_BACKEND_URL:
+            with self._lock:
+                if self._cache_backend is None:
+                    from app.services.cache_backend import create_cache_backend
+                    self._cache_backend = create_cache_backend(CACHE_BACKEND_URL, CACHE_BACKEND_TTL_SECONDS)
+        return self._cache_backend
+
+    @property
+    def http_pools(self):
+        if self._http_pools is None:
+            with self._lock:
+                if self._http_pools is None:
+                    from app.services.http_pools import HttpPools
+                    self._http_pools = HttpPools(self.scheduler)
+        return self._http_pools
+
+    def _get(self, name: str, build: Callable[[], Any]) -> Any:
+        try:
+            return self._services[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._services:
+                start = time.perf_counter()
+                self._services[name] = build()
+                self._build_ms[name] = (time.perf_counter() - start) * 1000
+            return self._services[name]
+
+    def _build_openai_service(self):
+        from app.services.openai_service import OpenAIService
+        return OpenAIService(
+            http_client=self.http_pools.httpx_client("openai"),
+            async_http_client=self.http_pools.httpx_async_client("openai"),
+            scheduler=self.scheduler,
+            cache_backend=self.cache_backend
+        )
+
+    def _build_search_service(self):
+        from app.services.search_service import SearchService
+        return SearchService(
+            openai_service=self.openai_service,
+            transport=self.http_pools.transport("search"),
+            async_transport=self.http_pools.async_transport("search")
+        )
+
+    def _build_cosmos_service(self):
+        from app.services.cosmos_service import CosmosDBService
+        return CosmosDBService(
+            transport=self.http_pools.transport("cosmos"),
+            async_transport=self.http_pools.async_transport("cosmos"),
+            cache_backend=self.cache_backend
+        )
+
+    def _build_answer_cache(self):
+        if not ANSWER_CACHE_ENABLED:
+            return None
+        from app.services.answer_cache import AnswerCache
+        return AnswerCache(ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES, backend=self.cache_backend)
+
+    def _build_query_rewriter(self):
+        if QUERY_REWRITE_MODE == "off":
+            return None
+        from app.services.query_rewriter import QueryRewriter
+        return QueryRewriter(
+            QUERY_REWRITE_MODE,
+            openai_service=self.openai_service,
+            model=QUERY_REWRITE_MODEL,
+            max_tokens=QUERY_REWRITE_MAX_TOKENS,
+            history_turns=QUERY_REWRITE_HISTORY_TURNS,
+            max_entries=QUERY_REWRITE_CACHE_ENTRIES,
+            backend=self.cache_backend,
+            ttl_seconds=CACHE_BACKEND_TTL_SECONDS
+        )
+
+    def _build_chat_pipeline(self):
+        from app.services.chat_pipeline import ChatPipeline
+        return ChatPipeline(self.search_service, self.openai_service, self.cosmos_service, self.answer_cache, self._build_query_rewriter())
+
+    @property
+    def openai_service(self):
+        return self._get("openai_service", self._build_openai_service)
+
+    @property
+    def search_service(self):
+        return self._get("search_service", self._build_search_service)
+
+    @property
+    def cosmos_service(self):
+        return self._get("cosmos_service", self._build_cosmos_service)
+
+    @property
+    def answer_cache(self):
+        return self._get("answer_cache", self._build_answer_cache)
+
+    @property
+    def chat_pipeline(self):
+        return self._get("chat_pipeline", self._build_chat_pipeline)
+
+    def built(self, name: str) -> Optional[Any]:
+        """The named service if it has been built (or provided), without building it."""
+        return self._services.get(name)
+
+    def override(self, **services):
+        """Use the given instances instead of building the named services."""
+        unknown = set(services) - set(SERVICE_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown services: {', '.join(sorted(unknown))}")
+        with self._lock:
+            self._services.update(services)
+            for name in services:
+                self._build_ms.pop(name, None)
+
+    def build_all(self) -> float:
+        """
+        Build every service that isn't built yet, after loading the token
+        encoding (a download on the first load) that the pipeline counts with.
+
+        Returns:
+            The time it took in milliseconds
+        """
+        from app.services.token_budget import load_encoding
+
+        start = time.perf_counter()
+        load_encoding(TOKEN_ENCODING)
+        for name in SERVICE_NAMES:
+            getattr(self, name)
+        return (time.perf_counter() - start) * 1000
+
+    async def startup(self, eager: bool = SERVICES_EAGER_INIT):
+        """
+        Build every service (unless ``eager`` is off) and print the startup
+        report. Construction runs in a worker thread so that slow client
+        setup doesn't block the event loop.
+        """
+        start = time.perf_counter()
+        self.started_at = time.time()
+        if eager:
+            await asyncio.to_thread(self.build_all)
+            if COSMOS_BOOTSTRAP_ON_STARTUP:
+                await asyncio.to_thread(self.cosmos_service.bootstrap)
+        self.startup_ms = (time.perf_counter() - start) * 1000
+        for line in self.report_lines():
+            logger.info("%s", line)
+
+    def report_lines(self) -> List[str]:
+        lines = [f"Startup completed in {self.startup_ms or 0.0:.1f} ms"]
+        for name in SERVICE_NAMES:
+            if name in self._build_ms:
+                lines.append(f"  {name:<16} {self._build_ms[name]:8.1f} ms")
+            elif name in self._services:
+                lines.append(f"  {name:<16} {'provided':>11}")
+            else:
+                lines.append(f"  {name:<16} {'deferred':>11}")
+        return lines
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "startup_ms": round(self.startup_ms, 1) if self.startup_ms is not None else None,
+            "build_ms": {name: round(ms, 1) for name, ms in self._build_ms.items()},
+            "deferred": [name for name in SERVICE_NAMES if name not in self._services],
+            "http_pools": self._http_pools.stats() if self._http_pools is not None else None,
+            "upstreams": self._scheduler.stats() if self._scheduler is not None else None,
+            "cache_backend": self._cache_backend.stats() if self._cache_backend is not None else None,
+        }
+
+    async def shutdown(self):
+        """Close every service that was built, then the connection pools and the cache backend."""
+        with self._lock:
+            services, self._services = self._services, {}
+            self._build_ms = {}
+        for name in reversed(SERVICE_NAMES):
+            service = services.get(name)
+            close = getattr(service, "close", None)
+            if close is None:
+                continue
+            try:
+                result = close()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.warning("Error closing %s: %s", name, e)
+        if self._http_pools is not None:
+            await self._http_pools.aclose()
+        if self._cache_backend is not None:
+            backend, self._cache_backend = self._cache_backend, None
+            backend.close()
+
+
+services = ServiceContainer()
@@ -0,0 +1,169 @@
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from app.services.token_budget import TokenCounter
+
+WORD_PATTERN = re.compile(r"\S+")
+
+# Word n-gram size used to measure how much of one chunk another contains
+SHINGLE_SIZE = 3
+# Shortest word overlap between the end of one chunk and the start of the
+# next that is treated as the chunker's overlap window
+MIN_MERGE_OVERLAP_WORDS = 5
+# Sections truncated to fit the cap keep at least this many tokens, smaller
+# remainders are dropped instead
+MIN_SECTION_TOKENS = 32
+
+
+@dataclass
+class ContextResult:
+    """The context block for the system prompt and its accounting."""
+    text: str
+    sources: List[str] = field(default_factory=list)
+    chunks_in: int = 0
+    chunks_used: int = 0
+    # Tokens of the plain concatenation of every retrieved chunk
+    raw_tokens: int = 0
+    context_tokens: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.raw_tokens - self.context_tokens
+
+
+@dataclass
+class _Section:
+    title: str
+    words: List[str]
+    shingles: set
+    chunks: int = 1
+
+
+def _shingles(words: List[str]) -> set:
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _overlap_length(left: List[str], right: List[str]) -> int:
+    """Length of the longest suffix of ``left`` that is a prefix of ``right``."""
+    for length in range(min(len(left), len(right)), MIN_MERGE_OVERLAP_WORDS - 1, -1):
+        if left[-length:] == right[:length]:
+            return length
+    return 0
+
+
+class ContextBuilder:
+    """
+    Turns search results into the context block of the system prompt.
+
+    Chunks are taken in rank order. A chunk mostly contained in one already
+    taken (``duplicate_threshold`` of its word shingles) is dropped; chunks
+    of the same parent document are merged into one section, stitched over
+    the overlap window when they are adjacent. Each section is headed by a
+    number and its source title so the answer can cite it, and sections are
+    added until ``max_tokens`` is reached.
+    """
+
+    def __init__(self, counter: TokenCounter, max_tokens: int, duplicate_threshold: float = 0.8):
+        self.counter = counter
+        self.max_tokens = max_tokens
+        self.duplicate_threshold = duplicate_threshold
+
+    def _is_duplicate(self, shingles: set, sections: List[_Section]) -> bool:
+        if not shingles:
+            return True
+        for section in sections:
+            if len(shingles & section.shingles) / len(shingles) >= self.duplicate_threshold:
+                return True
+        return False
+
+    @staticmethod
+    def _merge(section: _Section, words: List[str], shingles: set):
+        """Append a chunk to its parent's section, or prepend it if it comes right before it."""
+        overlap = _overlap_length(section.words, words)
+        if overlap:
+            section.words = section.words + words[overlap:]
+        else:
+            overlap = _overlap_length(words, section.words)
+            if overlap:
+                section.words = words + section.words[overlap:]
+            else:
+                section.words = section.words + ["…"] + words
+        section.shingles |= shingles
+        section.chunks += 1
+
+    def _sections(self, results: List[Dict[str, Any]]) -> List[_Section]:
+        sections: List[_Section] = []
+        by_parent: Dict[str, _Section] = {}
+        for result in results:
+            words = WORD_PATTERN.findall(result.get("chunk") or "")
+            shingles = _shingles(words)
+            if self._is_duplicate(shingles, sections):
+                continue
+
+            parent_id = result.get("parent_id")
+            if parent_id and parent_id in by_parent:
+                self._merge(by_parent[parent_id], words, shingles)
+                continue
+
+            section = _Section(title=result.get("title") or "Untitled", words=words, shingles=shingles)
+            sections.append(section)
+            if parent_id:
+                by_parent[parent_id] = section
+        return sections
+
+    def _truncate(self, header: str, words: List[str], budget: int) -> Optional[str]:
+        """The longest prefix of the section that fits ``budget`` tokens (binary search)."""
+        low, high = 0, len(words)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.counter.count(header + " ".join(words[:middle]) + " …") <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        if low == 0:
+            return None
+        return header + " ".join(words[:low]) + " …"
+
+    def build(self, results: List[Dict[str, Any]]) -> ContextResult:
+        """
+        Build the context block from search results in rank order.
+
+        Returns:
+            The context text, the cited source titles and token accounting
+        """
+        raw_tokens = self.counter.count("".join(f"{result.get('chunk', '')}\n\n" for result in results))
+
+        parts = []
+        sources = []
+        used_tokens = 0
+        chunks_used = 0
+        for section in self._sections(results):
+            header = f"[{len(parts) + 1}] {section.title}\n"
+            text = header + " ".join(section.words)
+            tokens = self.counter.count(text)
+            remaining = self.max_tokens - used_tokens
+            if tokens > remaining:
+                if remaining >= MIN_SECTION_TOKENS:
+                    text = self._truncate(header, section.words, remaining)
+                    if text is not None:
+                        parts.append(text)
+                        sources.append(section.title)
+                        chunks_used += section.chunks
+                break
+            parts.append(text)
+            sources.append(section.title)
+            used_tokens += tokens
+            chunks_used += section.chunks
+
+        context = "\n\n".join(parts)
+        return ContextResult(
+            text=context,
+            sources=sources,
+            chunks_in=len(results),
+            chunks_used=chunks_used,
+            raw_tokens=raw_tokens,
+            context_tokens=self.counter.count(context),
+        )
@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from app.services.cache_backend import CacheBackend
+
+
+def _copy(conversation: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy a conversation so callers can extend its messages list."""
+    conversation = dict(conversation)
+    conversation["messages"] = list(conversation.get("messages", []))
+    return conversation
+
+
+class ConversationCache:
+    """
+    LRU cache of recently active conversations, keyed by conversation id.
+
+    Entries younger than the TTL are served without touching Cosmos DB. Older
+    entries are returned as stale so the caller can revalidate them with a
+    point read of the conversation header and compare ``_etag`` values.
+
+    With a shared backend the conversations live there (as JSON, with the
+    time they were stored) instead of in this process, so the next turn is
+    a hit whichever worker serves it, and a turn saved by one worker is
+    never shadowed by an older copy held by another.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, backend: Optional[CacheBackend] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.backend = backend if backend is not None and backend.shared else None
+
+        self._entries: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.stale = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def get(self, conversation_id: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """
+        Look up a conversation.
+
+        Returns:
+            A copy of the cached conversation (or None) and whether it is
+            still fresh
+        """
+        if self.backend is not None:
+            return self._get_shared(conversation_id)
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                self.misses += 1
+                return None, False
+
+            self._entries.move_to_end(conversation_id)
+            conversation, stored_at = entry
+            fresh = time.monotonic() - stored_at < self.ttl_seconds
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale += 1
+            return _copy(conversation), fresh
+
+    def _get_shared(self, conversation_id: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+        value = self.backend.get("conv:" + conversation_id)
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            return None, False
+        entry = json.loads(value)
+        fresh = time.time() - entry["stored_at"] < self.ttl_seconds
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale += 1
+        return _copy(entry["conversation"]), fresh
+
+    def _put_shared(self, conversation: Dict[str, Any]):
+        entry = {"conversation": conversation, "stored_at": time.time()}
+        self.backend.set("conv:" + conversation["id"], json.dumps(entry, separators=(",", ":"), default=str).encode("utf-8"))
+
+    def put(self, conversation: Dict[str, Any]):
+        if self.backend is not None:
+            self._put_shared(conversation)
+            return
+        with self._lock:
+            self._entries[conversation["id"]] = (_copy(conversation), time.monotonic())
+            self._entries.move_to_end(conversation["id"])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def mark_revalidated(self, conversation_id: str):
+        """Restart the TTL of an entry whose ``_etag`` still matches the stored document."""
+        if self.backend is not None:
+            value = self.backend.get("conv:" + conversation_id)
+            if value is not None:
+                self._put_shared(json.loads(value)["conversation"])
+                with self._lock:
+                    self.revalidated += 1
+            return
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is not None:
+                self._entries[conversation_id] = (entry[0], time.monotonic())
+                self.revalidated += 1
+
+    def invalidate(self, conversation_id: str):
+        if self.backend is not None:
+            self.backend.delete("conv:" + conversation_id)
+            return
+        with self._lock:
+            self._entries.pop(conversation_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        lookups = self.hits + self.stale + self.misses
+        return {
+            "hits": self.hits,
+            "stale": self.stale,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.revalidated) / lookups, 4) if lookups else 0.0,
+            "entries": len(self._entries),
+            "shared": self.backend is not None,
+        }
@@ -1,64 +1,290 @@
 import azure.cosmos.cosmos_client as cosmos_client
 import azure.cosmos.exceptions as exceptions
 from azure.cosmos.partition_key import PartitionKey
-from typing import Dict, List, Any, Optional
+from azure.core import MatchConditions
+from typing import Dict, List, Any, Optional, Tuple
+import asyncio
+import logging
 import os
+import threading
+import time
+
+try:
+    from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+except ImportError:  # aiohttp is not installed, async calls fall back to a worker thread
+    AsyncCosmosClient = None
 
 from app.config import (
     COSMOS_ENDPOINT,
     COSMOS_KEY,
     COSMOS_DATABASE,
-    COSMOS_CONTAINER
+    COSMOS_CONTAINER,
+    COSMOS_STORAGE_LAYOUT,
+    COSMOS_HISTORY_MAX_MESSAGES,
+    COSMOS_WRITE_CONFLICT_RETRIES,
+    CONVERSATION_CACHE_ENABLED,
+    CONVERSATION_CACHE_MAX_ENTRIES,
+    CONVERSATION_CACHE_TTL_SECONDS,
+    USER_REGISTRY_CONTAINER,
+    USER_REGISTRY_CACHE_TTL_SECONDS,
+    USE_ASYNC_CLIENTS,
+    PERSIST_MAX_RETRIES,
+    PERSIST_RETRY_BACKOFF_SECONDS,
+    WRITE_BEHIND_ENABLED,
+    WRITE_BEHIND_FLUSH_INTERVAL_SECONDS,
+    WRITE_BEHIND_MAX_BATCH_SIZE,
+    WRITE_BEHIND_MAX_PENDING_BYTES,
+    WRITE_BEHIND_FLUSH_CONCURRENCY,
+    WRITE_BEHIND_SPILL_DIR,
+    WRITE_BEHIND_FSYNC
 )
+from app.services.conversation_cache import ConversationCache
+from app.services.telemetry import record_request_units
+from app.services.user_registry import UserRegistry
+from app.services.write_behind import WriteBehindBuffer
 
-class CosmosDBService:
+logger = logging.getLogger(__name__)
+
+# Document types of the split storage layout. Documents written by the single
+# document layout have no type and carry the full messages list.
+CONVERSATION_DOC_TYPE = "conversation"
+MESSAGE_DOC_TYPE = "message"
+
+# Cosmos DB transactional batches are limited to 100 operations
+MAX_BATCH_OPERATIONS = 100
+
+# Conversation fields that the chat pipeline carries from a loaded
+# conversation into the next save. message_offset is the sequence number of
+# the first loaded message and persisted_message_count the number of messages
+# already stored, so only new messages are appended. _etag makes the save
+# conditional on nobody else having written the conversation in between.
+CONVERSATION_STATE_KEYS = (
+    "title",
+    "summary",
+    "summary_message_count",
+    "message_offset",
+    "persisted_message_count",
+    "storage_layout",
+    "_etag",
+)
+_TRACKING_KEYS = ("message_offset", "persisted_message_count", "storage_layout", "_etag")
+
+# Request units consumed by the reads of one get_conversation call
+REQUEST_CHARGE_KEY = "_request_charge"
+
+CONVERSATION_BY_ID_QUERY = "SELECT * FROM c WHERE c.id = @conversationId"
+
+HISTORY_QUERY = (
+    "SELECT TOP @limit * FROM c WHERE c.conversation_id = @conversationId "
+    "AND c.type = @type ORDER BY c.seq DESC"
+)
+MESSAGES_BY_CONVERSATION_QUERY = (
+    "SELECT * FROM c WHERE c.conversation_id = @conversationId "
+    "AND c.type = @type ORDER BY c.seq"
+)
+# Sidebar listing: one small row per conversation in either layout, newest first
+CONVERSATION_SUMMARIES_QUERY = (
+    "SELECT c.id, "
+    "IIF(IS_DEFINED(c.title), c.title, LEFT(c.messages[0].content, 100)) AS title, "
+    "c._ts AS last_updated, "
+    "IIF(IS_DEFINED(c.message_count), c.message_count, ARRAY_LENGTH(c.messages)) AS message_count "
+    "FROM c WHERE c.user_id = @userId AND (NOT IS_DEFINED(c.type) OR c.type = @type) "
+    "ORDER BY c._ts DESC"
+)
+
+
+def _message_doc_id(conversation_id: str, seq: int) -> str:
+    return f"{conversation_id}:{seq:06d}"
+
+
+def _message_from_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: doc[key] for key in ("role", "content", "timestamp") if key in doc}
+
+
+def _is_write_conflict(error: Exception) -> bool:
+    """True if a conditional write failed because the stored _etag changed (HTTP 412)."""
+    return getattr(error, "status_code", None) == 412
+
+
+def _batch_etag(results) -> Optional[str]:
+    """The _etag written by the last operation of a transactional batch (the header upsert)."""
+    if not results:
+        return None
+    last = results[-1]
+    return last.get("eTag") or (last.get("resourceBody") or {}).get("_etag")
+
+
+class RequestCharges:
+    """
+    Request units (RU) consumed by Cosmos DB operations, read from the
+    ``x-ms-request-charge`` response header through the SDK's response_hook.
+    """
+    
     def __init__(self):
-        """Initialize the Cosmos DB service with configuration from environment variables"""
+        self.totals: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    def hook(self, operation: str, spent: Optional[List[float]] = None):
+        """
+        Build a response_hook that records the charge of each response
+        under ``operation`` and also appends it to ``spent`` if given.
+        """
+        def record(headers, result):
+            # Queries also call the hook once with the pager before any page is
+            # fetched; only page and item responses carry their own charge.
+            if result is not None and not isinstance(result, (dict, list)):
+                return
+            charge = float(headers.get("x-ms-request-charge", 0) or 0)
+            with self._lock:
+                self.totals[operation] = self.totals.get(operation, 0.0) + charge
+                self.counts[operation] = self.counts.get(operation, 0) + 1
+            record_request_units(operation, charge)
+            if spent is not None:
+                spent.append(charge)
+        return record
+    
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                operation: {
+                    "requests": self.counts[operation],
+                    "request_units": round(total, 2),
+                    "avg_request_units": round(total / self.counts[operation], 2),
+                }
+                for operation, total in self.totals.items()
+            }
+
+class CosmosDBService:
+    def __init__(self, transport=None, async_transport=None, cache_backend=None):
+        """
+        Initialize the Cosmos DB service with configuration from environment variables.
+        
+        Only client objects are created here, without network calls; the
+        database and containers are created by ``bootstrap``.
+        
+        Args:
+            transport: Shared azure-core transport for the sync client
+            async_transport: Shared azure-core transport for the async client
+            cache_backend: Cache shared with the other workers, where the
+                conversation cache keeps its entries
+        """
         try:
             self.endpoint = COSMOS_ENDPOINT
             self.key = COSMOS_KEY
             self.database_name = COSMOS_DATABASE
             self.container_name = COSMOS_CONTAINER
+            self.layout = COSMOS_STORAGE_LAYOUT
+            self.history_max_messages = COSMOS_HISTORY_MAX_MESSAGES
+            self.conflict_retries = COSMOS_WRITE_CONFLICT_RETRIES
+            self.request_charges = RequestCharges()
+            self.write_conflicts = 0
+            self.conversation_cache = None
+            if CONVERSATION_CACHE_ENABLED:
+                self.conversation_cache = ConversationCache(
+                    max_entries=CONVERSATION_CACHE_MAX_ENTRIES,
+                    ttl_seconds=CONVERSATION_CACHE_TTL_SECONDS,
+                    backend=cache_backend
+                )
+            # Conversations saved through the buffer are written in batches in
+            # the background; reads see them as soon as they are queued
+            self.write_buffer = None
+            if WRITE_BEHIND_ENABLED:
+                self.write_buffer = WriteBehindBuffer(
+                    self.save_conversations_async,
+                    partition_key="user_id",
+                    max_batch_size=min(WRITE_BEHIND_MAX_BATCH_SIZE, MAX_BATCH_OPERATIONS),
+                    flush_interval_seconds=WRITE_BEHIND_FLUSH_INTERVAL_SECONDS,
+                    max_pending_bytes=WRITE_BEHIND_MAX_PENDING_BYTES,
+                    flush_concurrency=WRITE_BEHIND_FLUSH_CONCURRENCY,
+                    max_attempts=PERSIST_MAX_RETRIES + 1,
+                    retry_backoff_seconds=PERSIST_RETRY_BACKOFF_SECONDS,
+                    spill_dir=WRITE_BEHIND_SPILL_DIR or None,
+                    fsync=WRITE_BEHIND_FSYNC
+                )
             
-            print(f"Initializing CosmosDBService with endpoint: {self.endpoint}")
+            logger.info("Initializing CosmosDBService with endpoint: %s", self.endpoint)
             
             if not self.endpoint or not self.key:
-                print("WARNING: Cosmos DB endpoint or key is missing!")
+                logger.warning("Cosmos DB endpoint or key is missing!")
                 
-            self.client = cosmos_client.CosmosClient(self.endpoint, self.key)
+            self.client = cosmos_client.CosmosClient(
+                self.endpoint,
+                self.key,
+                **({"transport": transport} if transport is not None else {})
+            )
+            
+            self.database = self.client.get_database_client(self.database_name)
+            self.container = self.database.get_container_client(self.container_name)
             
-            self.database = self._get_or_create_database()
-            self.container = self._get_or_create_container()
+            self.async_client = None
+            self.async_container = None
+            async_database = None
+            if USE_ASYNC_CLIENTS and AsyncCosmosClient is not None:
+                self.async_client = AsyncCosmosClient(
+                    self.endpoint,
+                    self.key,
+                    **({"transport": async_transport} if async_transport is not None else {})
+                )
+                async_database = self.async_client.get_database_client(self.database_name)
+                self.async_container = async_database.get_container_client(self.container_name)
+            
+            self.user_registry = UserRegistry(
+                self.database,
+                USER_REGISTRY_CONTAINER,
+                USER_REGISTRY_CACHE_TTL_SECONDS,
+                async_database
+            )
             
-            print("CosmosDBService initialization completed successfully")
+            logger.info("CosmosDBService initialization completed successfully")
             
         except Exception as e:
-            print(f"ERROR initializing CosmosDBService: {str(e)}")
+            logger.error("Error initializing CosmosDBService: %s", e)
             # Still initialize these to avoid NoneType errors, but the service won't work
             self.database = None
             self.container = None
+            self.async_client = None
+            self.async_container = None
+            self.user_registry = None
     
-    def _get_or_create_database(self):
-        """Create the database if it doesn't exist."""
-        try:
-            return self.client.create_database(id=self.database_name)
-        except exceptions.CosmosResourceExistsError:
-            return self.client.get_database_client(self.database_name)
-    
-    def _get_or_create_container(self):
-        """Create the container if it doesn't exist."""
+    def bootstrap(self) -> Dict[str, bool]:
+        """
+        Create the database, the conversations container and the user
+        registry container if they don't exist. A newly created registry is
+        backfilled from the existing conversations.
+        
+        These are control-plane calls, so they run once per deployment
+        (``python -m app.commands.bootstrap``) rather than on every start.
+        
+        Returns:
+            Which of the resources were created
+        """
+        if self.user_registry is None:
+            raise RuntimeError("CosmosDBService is not initialized")
+        
+        self.client.create_database_if_not_exists(id=self.database_name)
         try:
-            return self.database.create_container(
+            self.database.create_container(
                 id=self.container_name,
                 partition_key=PartitionKey(path="/user_id")
             )
+            container_created = True
         except exceptions.CosmosResourceExistsError:
-            return self.database.get_container_client(self.container_name)
+            container_created = False
+        
+        registry_created = self.user_registry.bootstrap(self.database)
+        if registry_created:
+            logger.info("Registered %s existing users in %s", self.user_registry.backfill(self.container), USER_REGISTRY_CONTAINER)
+        return {"container_created": container_created, "user_registry_created": registry_created}
     
     def save_conversation(self, conversation_data: Dict[str, Any]) -> Dict[str, Any]:
         """
         Save a conversation to Cosmos DB.
         
+        Conversations loaded with an ``_etag`` are only written if the stored
+        document is unchanged. If another writer got there first, the new
+        messages are appended to the latest version and the write is retried.
+        
         Args:
             conversation_data: Dictionary containing conversation details
             
@@ -70,81 +296,438 @@ class CosmosDBService:
             if "user_id" not in conversation_data or not conversation_data["user_id"]:
                 raise ValueError("user_id is required for saving conversations")
                 
-            print(f"Saving conversation with ID: {conversation_data.get('id')} and user_id: {conversation_data.get('user_id')}")
-            return self.container.upsert_item(body=conversation_data)
-        except exceptions.CosmosHttpResponseError as e:
-            print(f"Error saving conversation: {str(e)}")
+            logger.debug("Saving conversation with ID: %s and user_id: %s", conversation_data.get('id'), conversation_data.get('user_id'))
+            for attempt in range(self.conflict_retries + 1):
+                try:
+                    saved = self._write_conversation(conversation_data)
+                    if self.user_registry is not None:
+                        self.user_registry.register(conversation_data["user_id"])
+                    return saved
+                except (exceptions.CosmosHttpResponseError, exceptions.CosmosBatchOperationError) as e:
+                    if not _is_write_conflict(e) or attempt == self.conflict_retries:
+                        raise
+                    self._note_write_conflict(conversation_data)
+                    latest = self.get_conversation(conversation_data["id"], conversation_data["user_id"], buffered=False)
+                    conversation_data = self._rebase(conversation_data, latest)
+        except (exceptions.CosmosHttpResponseError, exceptions.CosmosBatchOperationError) as e:
+            logger.error("Error saving conversation: %s", e)
             raise
     
-    def get_conversation(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+    def _write_conversation(self, conversation_data: Dict[str, Any]) -> Dict[str, Any]:
+        hook = self.request_charges.hook("write")
+        if self._uses_split_layout(conversation_data):
+            user_id, batches, header = self._split_batches(conversation_data)
+            results = None
+            for batch in batches:
+                results = self.container.execute_item_batch(batch_operations=batch, partition_key=user_id, response_hook=hook)
+            self._remember_split(conversation_data, header, _batch_etag(results))
+            return header
+        saved = self.container.upsert_item(
+            body=self._single_document(conversation_data),
+            response_hook=hook,
+            **self._match_conditions(conversation_data)
+        )
+        self._remember(self._with_layout_state(saved))
+        return saved
+    
+    @staticmethod
+    def _match_conditions(conversation_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Keyword arguments that make a single document upsert conditional on the loaded _etag."""
+        etag = conversation_data.get("_etag")
+        if not etag:
+            return {}
+        return {"etag": etag, "match_condition": MatchConditions.IfNotModified}
+    
+    def _note_write_conflict(self, conversation_data: Dict[str, Any]):
+        self.write_conflicts += 1
+        if self.conversation_cache is not None:
+            self.conversation_cache.invalidate(conversation_data["id"])
+        logger.info("Conversation %s changed since it was loaded, retrying on the latest version", conversation_data['id'])
+    
+    @staticmethod
+    def _rebase(conversation_data: Dict[str, Any], latest: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Put the unsaved messages of ``conversation_data`` on top of the latest
+        stored version of the conversation.
+        
+        If the stored messages end with messages we already have (an earlier
+        save of this same conversation finished in the meantime) only the
+        messages after them are new; otherwise everything past
+        ``persisted_message_count`` is appended after the other writer's.
+        """
+        if latest is None:
+            rebased = dict(conversation_data)
+            rebased.pop("_etag", None)
+            return rebased
+        
+        messages = conversation_data.get("messages", [])
+        offset = conversation_data.get("message_offset", 0)
+        stored_count = latest.get("persisted_message_count", 0)
+        stored_messages = latest.get("messages", [])
+        
+        last_stored = stored_count - 1 - offset
+        if stored_messages and 0 <= last_stored < len(messages) and messages[last_stored] == stored_messages[-1]:
+            new_messages = messages[last_stored + 1:]
+        else:
+            new_messages = messages[max(conversation_data.get("persisted_message_count", 0) - offset, 0):]
+        
+        rebased = {key: value for key, value in latest.items() if key != REQUEST_CHARGE_KEY}
+        if conversation_data.get("summary_message_count", 0) > latest.get("summary_message_count", 0):
+            rebased["summary"] = conversation_data.get("summary")
+            rebased["summary_message_count"] = conversation_data["summary_message_count"]
+        rebased["messages"] = list(stored_messages) + list(new_messages)
+        return rebased
+    
+    def _remember(self, conversation: Dict[str, Any]):
+        if self.conversation_cache is not None and conversation.get("_etag"):
+            self.conversation_cache.put(conversation)
+    
+    def _remember_split(self, conversation_data: Dict[str, Any], header: Dict[str, Any], etag: Optional[str]):
+        """Cache a conversation just written in the split layout, keeping the most recent messages only."""
+        messages = list(conversation_data.get("messages", []))
+        offset = conversation_data.get("message_offset", 0)
+        if len(messages) > self.history_max_messages:
+            dropped = len(messages) - self.history_max_messages
+            messages = messages[dropped:]
+            offset += dropped
+        
+        conversation = dict(header)
+        conversation["messages"] = messages
+        conversation["message_offset"] = offset
+        conversation["persisted_message_count"] = header["message_count"]
+        conversation["storage_layout"] = "split"
+        conversation["_etag"] = etag
+        self._remember(conversation)
+    
+    def _uses_split_layout(self, conversation_data: Dict[str, Any]) -> bool:
+        """Conversations already stored per message stay split even if the configured layout changes."""
+        return self.layout == "split" or conversation_data.get("storage_layout") == "split"
+    
+    @staticmethod
+    def _single_document(conversation_data: Dict[str, Any]) -> Dict[str, Any]:
+        """The conversation as one document with the full messages list."""
+        return {key: value for key, value in conversation_data.items() if key not in _TRACKING_KEYS}
+    
+    @staticmethod
+    def _split_batches(conversation_data: Dict[str, Any]):
+        """
+        Build the transactional batches that append new messages as one
+        document each and update the conversation header.
+        
+        Conversations read from the single document format are migrated by
+        writing all their messages; the header upsert then replaces the old
+        document. The header is always in the last batch and, if the
+        conversation was loaded with an ``_etag``, only applies if that
+        document is unchanged, which rolls back the whole batch otherwise.
+        
+        Returns:
+            The partition key, the list of batches and the header document
+        """
+        conversation_id = conversation_data["id"]
+        user_id = conversation_data["user_id"]
+        messages = conversation_data.get("messages", [])
+        offset = conversation_data.get("message_offset", 0)
+        persisted = conversation_data.get("persisted_message_count", 0)
+        if conversation_data.get("storage_layout") == "document":
+            persisted = 0
+        
+        first_new = max(persisted - offset, 0)
+        operations = []
+        for index, message in enumerate(messages[first_new:]):
+            seq = offset + first_new + index
+            doc = {
+                "id": _message_doc_id(conversation_id, seq),
+                "type": MESSAGE_DOC_TYPE,
+                "conversation_id": conversation_id,
+                "user_id": user_id,
+                "seq": seq,
+            }
+            doc.update(message)
+            # Upsert keeps a retried append idempotent
+            operations.append(("upsert", (doc,)))
+        
+        header = {
+            key: value for key, value in conversation_data.items()
+            if key != "messages" and key not in _TRACKING_KEYS
+        }
+        header["type"] = CONVERSATION_DOC_TYPE
+        header["message_count"] = offset + len(messages)
+        if not header.get("title") and offset == 0 and messages:
+            header["title"] = messages[0].get("content", "")[:100]
+        etag = conversation_data.get("_etag")
+        operations.append(("upsert", (header,), {"if_match_etag": etag}) if etag else ("upsert", (header,)))
+        
+        batches = [
+            operations[start:start + MAX_BATCH_OPERATIONS]
+            for start in range(0, len(operations), MAX_BATCH_OPERATIONS)
+        ]
+        return user_id, batches, header
+    
+    @staticmethod
+    def _with_layout_state(conversation: Dict[str, Any], message_docs: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """
+        Return a conversation in the shape the chat pipeline expects.
+        
+        Single documents are returned with all their messages. Split headers
+        get the most recent message documents (``message_docs``, any order)
+        attached along with the offset of the first one.
+        """
+        conversation = dict(conversation)
+        if message_docs is None or "messages" in conversation:
+            messages = conversation.get("messages", [])
+            conversation["message_offset"] = 0
+            conversation["persisted_message_count"] = len(messages)
+            conversation["storage_layout"] = "document"
+            return conversation
+        
+        message_docs = sorted(message_docs, key=lambda doc: doc["seq"])
+        count = conversation.get("message_count", len(message_docs))
+        conversation["messages"] = [_message_from_doc(doc) for doc in message_docs]
+        conversation["message_offset"] = message_docs[0]["seq"] if message_docs else count
+        conversation["persisted_message_count"] = count
+        conversation["storage_layout"] = "split"
+        return conversation
+    
+    def _history_parameters(self, conversation_id: str) -> List[Dict[str, Any]]:
+        return [
+            {"name": "@limit", "value": self.history_max_messages},
+            {"name": "@conversationId", "value": conversation_id},
+            {"name": "@type", "value": MESSAGE_DOC_TYPE},
+        ]
+    
+    def migrate_conversation(self, conversation_id: str) -> bool:
+        """
+        Move a conversation stored as a single document to the split layout.
+        
+        Args:
+            conversation_id: The ID of the conversation to migrate
+            
+        Returns:
+            True if the conversation was migrated
+        """
+        conversation = self.get_conversation(conversation_id)
+        if not conversation or conversation.get("storage_layout") != "document":
+            return False
+        
+        user_id, batches, _ = self._split_batches(conversation)
+        for batch in batches:
+            self.container.execute_item_batch(
+                batch_operations=batch,
+                partition_key=user_id,
+                response_hook=self.request_charges.hook("write")
+            )
+        if self.conversation_cache is not None:
+            self.conversation_cache.invalidate(conversation_id)
+        logger.info("Migrated conversation %s to per-message documents", conversation_id)
+        return True
+    
+    def get_conversation(self, conversation_id: str, user_id: Optional[str] = None, buffered: bool = True) -> Optional[Dict[str, Any]]:
         """
         Retrieve a specific conversation by ID.
         
+        With the owner's user_id this is a point read of the conversation
+        document in its partition; without it a cross-partition query. Recently
+        used conversations are served from the conversation cache, and after
+        its TTL only the header is read again to check the ``_etag``.
+        
         Args:
             conversation_id: The ID of the conversation to retrieve
+            user_id: The ID of the user owning the conversation (partition key)
+            buffered: Return the version queued in the write-behind buffer, if
+                any, instead of the stored one
             
         Returns:
-            The conversation document or None if not found
+            The conversation document or None if not found. The request units
+            spent are under ``_request_charge``.
         """
+        if buffered:
+            pending = self._buffered_conversation(conversation_id, user_id)
+            if pending is not None:
+                return pending
         try:
-            query = f"SELECT * FROM c WHERE c.id = '{conversation_id}'"
-            items = list(self.container.query_items(query=query, enable_cross_partition_query=True))
+            cached = self._cached_conversation(conversation_id)
+            if cached is not None and cached[1]:
+                return dict(cached[0], **{REQUEST_CHARGE_KEY: 0.0})
             
-            if items:
-                return items[0]
-            return None
+            spent: List[float] = []
+            hook = self.request_charges.hook("read", spent)
+            if user_id:
+                try:
+                    conversation = self.container.read_item(item=conversation_id, partition_key=user_id, response_hook=hook)
+                except exceptions.CosmosResourceNotFoundError:
+                    return None
+            else:
+                items = list(self.container.query_items(
+                    query=CONVERSATION_BY_ID_QUERY,
+                    parameters=[{"name": "@conversationId", "value": conversation_id}],
+                    enable_cross_partition_query=True,
+                    response_hook=hook
+                ))
+                conversation = items[0] if items else None
+            
+            if conversation is None:
+                return None
+            if cached is not None and cached[0].get("_etag") == conversation.get("_etag"):
+                self.conversation_cache.mark_revalidated(conversation_id)
+                return dict(cached[0], **{REQUEST_CHARGE_KEY: sum(spent)})
+            
+            message_docs = None
+            if conversation.get("type") == CONVERSATION_DOC_TYPE:
+                message_docs = list(self.container.query_items(
+                    query=HISTORY_QUERY,
+                    parameters=self._history_parameters(conversation_id),
+                    partition_key=conversation["user_id"],
+                    response_hook=self.request_charges.hook("history_query", spent)
+                ))
+            return self._loaded(conversation, message_docs, spent)
             
         except exceptions.CosmosHttpResponseError as e:
-            print(f"Error retrieving conversation: {str(e)}")
+            logger.error("Error retrieving conversation: %s", e)
             return None
     
-    def get_conversations_by_user(self, user_id: str) -> List[Dict[str, Any]]:
+    def _buffered_conversation(self, conversation_id: str, user_id: Optional[str]) -> Optional[Dict[str, Any]]:
+        """The version of a conversation queued in the write-behind buffer, or None."""
+        if self.write_buffer is None:
+            return None
+        conversation = self.write_buffer.get(conversation_id)
+        if conversation is None or (user_id and conversation.get("user_id") != user_id):
+            return None
+        conversation[REQUEST_CHARGE_KEY] = 0.0
+        return conversation
+    
+    def _with_buffered_summaries(self, user_id: str, items: List[Dict[str, Any]], first_page: bool) -> List[Dict[str, Any]]:
+        """
+        Put the conversations queued in the write-behind buffer (the most
+        recently updated ones) at the top of the first page of summaries,
+        and drop their stored versions from every page.
         """
-        Retrieve all conversations for a specific user.
+        if self.write_buffer is None:
+            return items
+        pending = self.write_buffer.pending_in(str(user_id).strip())
+        if not pending:
+            return items
+        pending_ids = {conversation["id"] for conversation in pending}
+        items = [item for item in items if item.get("id") not in pending_ids]
+        if not first_page:
+            return items
+        now = int(time.time())
+        summaries = []
+        for conversation in pending:
+            messages = conversation.get("messages", [])
+            title = conversation.get("title") or (messages[0].get("content", "")[:100] if messages and not conversation.get("message_offset") else None)
+            summaries.append({
+                "id": conversation["id"],
+                "title": title,
+                "last_updated": now,
+                "message_count": conversation.get("message_offset", 0) + len(messages),
+            })
+        return summaries + items
+    
+    async def _cache_call_async(self, function, *args):
+        """
+        Call a step that reads or writes the conversation cache from the
+        event loop; with a shared cache backend (a network round trip) it
+        runs on a worker thread.
+        """
+        if self.conversation_cache is not None and self.conversation_cache.backend is not None:
+            return await asyncio.to_thread(function, *args)
+        return function(*args)
+    
+    def _cached_conversation(self, conversation_id: str):
+        """The cached conversation and whether it is fresh, or None."""
+        if self.conversation_cache is None:
+            return None
+        conversation, fresh = self.conversation_cache.get(conversation_id)
+        return (conversation, fresh) if conversation is not None else None
+    
+    def _loaded(self, conversation: Dict[str, Any], message_docs: Optional[List[Dict[str, Any]]], spent: List[float]) -> Dict[str, Any]:
+        conversation = self._with_layout_state(conversation, message_docs)
+        self._remember(conversation)
+        conversation[REQUEST_CHARGE_KEY] = sum(spent)
+        return conversation
+    
+    def list_conversations(self, user_id: str, page_size: int = 20, continuation: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Retrieve one page of conversation summaries for a user, newest first.
         
         Args:
             user_id: The ID of the user
+            page_size: Maximum number of conversations in the page
+            continuation: Continuation token returned with the previous page
             
         Returns:
-            List of conversation documents
+            The summaries (id, title, last_updated, message_count) and the
+            continuation token of the next page, or None on the last page
         """
         try:
-            print(f"Fetching conversations for user_id: {user_id}")
-            
-            # Try using string conversion on user_id to ensure consistent format
-            user_id = str(user_id).strip()
+            pager = self.container.query_items(
+                query=CONVERSATION_SUMMARIES_QUERY,
+                parameters=self._summary_parameters(user_id),
+                partition_key=str(user_id).strip(),
+                max_item_count=page_size,
+                response_hook=self.request_charges.hook("list")
+            ).by_page(continuation)
+            page = next(pager, None)
+            items = list(page) if page is not None else []
+            return self._with_buffered_summaries(user_id, items, continuation is None), pager.continuation_token
             
-            # First try with partition key (more efficient)
-            try:
-                query = "SELECT * FROM c WHERE c.user_id = @userId ORDER BY c._ts DESC"
-                params = [{"name": "@userId", "value": user_id}]
-                
-                items = list(self.container.query_items(
-                    query=query,
-                    parameters=params,
-                    partition_key=user_id
-                ))
-                
-                print(f"Found {len(items)} conversations with partition key query")
-                
-                # Clean messages to avoid encoding issues
-                try:
-                    for item in items:
-                        if 'messages' in item:
-                            # Just for debugging, don't modify the actual data
-                            pass
-                except Exception as e:
-                    print(f"Warning: Error handling message content: {str(e)}")
-                
-                return items
-                
-            except Exception as partition_error:
-                print(f"Partition key query failed: {str(partition_error)}. Falling back to cross-partition query.")
+        except exceptions.CosmosHttpResponseError as e:
+            logger.error("Error listing conversations: %s", e)
+            return [], None
+    
+    @staticmethod
+    def _summary_parameters(user_id: str) -> List[Dict[str, Any]]:
+        return [
+            {"name": "@userId", "value": str(user_id).strip()},
+            {"name": "@type", "value": CONVERSATION_DOC_TYPE},
+        ]
+    
+    def get_full_conversation(self, conversation_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Retrieve a conversation with all of its messages.
+        
+        get_conversation only loads the most recent messages of split
+        conversations; the rest are read here when the user opens one.
+        
+        Args:
+            conversation_id: The ID of the conversation to retrieve
+            user_id: The ID of the user owning the conversation
             
-        except Exception as e:
-            print(f"Error retrieving user conversations: {str(e)}")
-            # Return empty list instead of crashing
-            return []
+        Returns:
+            The conversation document or None if not found
+        """
+        conversation = self.get_conversation(conversation_id, user_id)
+        if conversation is None or conversation.get("message_offset", 0) == 0:
+            return conversation
+        
+        try:
+            message_docs = list(self.container.query_items(
+                query=MESSAGES_BY_CONVERSATION_QUERY,
+                parameters=self._messages_parameters(conversation_id),
+                partition_key=user_id,
+                response_hook=self.request_charges.hook("history_query")
+            ))
+        except exceptions.CosmosHttpResponseError as e:
+            logger.error("Error retrieving conversation messages: %s", e)
+            return conversation
+        return self._with_all_messages(conversation, message_docs)
+    
+    @staticmethod
+    def _messages_parameters(conversation_id: str) -> List[Dict[str, Any]]:
+        return [
+            {"name": "@conversationId", "value": conversation_id},
+            {"name": "@type", "value": MESSAGE_DOC_TYPE},
+        ]
+    
+    @staticmethod
+    def _with_all_messages(conversation: Dict[str, Any], message_docs: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Prepend the stored messages older than the conversation's recent ones (which may not be stored yet)."""
+        conversation = dict(conversation)
+        offset = conversation.get("message_offset", 0)
+        older = sorted((doc for doc in message_docs if doc["seq"] < offset), key=lambda doc: doc["seq"])
+        conversation["messages"] = [_message_from_doc(doc) for doc in older] + list(conversation.get("messages", []))
+        conversation["message_offset"] = 0
+        return conversation
     
     def get_all_conversations(self, limit: int = 100) -> List[Dict[str, Any]]:
         """
@@ -166,30 +749,303 @@ class CosmosDBService:
             return items
             
         except exceptions.CosmosHttpResponseError as e:
-            print(f"Error retrieving all conversations: {str(e)}")
+            logger.error("Error retrieving all conversations: %s", e)
             return []
     
     def get_all_user_ids(self) -> List[str]:
         """
-        Retrieve all unique user IDs from the database.
+        Retrieve all registered user IDs.
         
         Returns:
             List of unique user IDs
         """
+        user_ids = []
+        continuation = None
+        while True:
+            page, continuation = self.get_user_ids(page_size=1000, continuation=continuation)
+            user_ids.extend(page)
+            if not continuation:
+                return user_ids
+    
+    def get_user_ids(self, prefix: str = "", page_size: int = 100, continuation: Optional[str] = None) -> Tuple[List[str], Optional[str]]:
+        """
+        Retrieve one page of registered user IDs in ascending order.
+        
+        Args:
+            prefix: Only return user IDs starting with this prefix
+            page_size: Maximum number of user IDs in the page
+            continuation: Continuation token returned with the previous page
+            
+        Returns:
+            The user IDs and the continuation token of the next page
+        """
+        if self.user_registry is None:
+            return [], None
         try:
-            query = "SELECT DISTINCT c.user_id FROM c"
-            items = list(self.container.query_items(
-                query=query,
-                enable_cross_partition_query=True
-            ))
+            return self.user_registry.list_user_ids(prefix, page_size, continuation)
+        except exceptions.CosmosHttpResponseError as e:
+            logger.error("Error retrieving user IDs: %s", e)
+            return [], None
+    
+    async def save_conversation_async(self, conversation_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Save a conversation to Cosmos DB using the async client.
+        
+        Args:
+            conversation_data: Dictionary containing conversation details
+            
+        Returns:
+            The saved item
+        """
+        if self.async_container is None:
+            return await asyncio.to_thread(self.save_conversation, conversation_data)
+        
+        try:
+            if "user_id" not in conversation_data or not conversation_data["user_id"]:
+                raise ValueError("user_id is required for saving conversations")
+                
+            logger.debug("Saving conversation with ID: %s and user_id: %s", conversation_data.get('id'), conversation_data.get('user_id'))
+            for attempt in range(self.conflict_retries + 1):
+                try:
+                    saved = await self._write_conversation_async(conversation_data)
+                    if self.user_registry is not None:
+                        await self.user_registry.register_async(conversation_data["user_id"])
+                    return saved
+                except (exceptions.CosmosHttpResponseError, exceptions.CosmosBatchOperationError) as e:
+                    if not _is_write_conflict(e) or attempt == self.conflict_retries:
+                        raise
+                    await self._cache_call_async(self._note_write_conflict, conversation_data)
+                    latest = await self.get_conversation_async(conversation_data["id"], conversation_data["user_id"], buffered=False)
+                    conversation_data = self._rebase(conversation_data, latest)
+        except (exceptions.CosmosHttpResponseError, exceptions.CosmosBatchOperationError) as e:
+            logger.error("Error saving conversation: %s", e)
+            raise
+    
+    async def _write_conversation_async(self, conversation_data: Dict[str, Any]) -> Dict[str, Any]:
+        hook = self.request_charges.hook("write")
+        if self._uses_split_layout(conversation_data):
+            user_id, batches, header = self._split_batches(conversation_data)
+            results = None
+            for batch in batches:
+                results = await self.async_container.execute_item_batch(batch_operations=batch, partition_key=user_id, response_hook=hook)
+            await self._cache_call_async(self._remember_split, conversation_data, header, _batch_etag(results))
+            return header
+        saved = await self.async_container.upsert_item(
+            body=self._single_document(conversation_data),
+            response_hook=hook,
+            **self._match_conditions(conversation_data)
+        )
+        await self._cache_call_async(self._remember, self._with_layout_state(saved))
+        return saved
+    
+    async def save_conversations_async(self, user_id: str, conversations: List[Dict[str, Any]]):
+        """
+        Save several conversations of one user, as flushed by the write-behind buffer.
+        
+        Conversations in the single document layout share the user's
+        partition, so they are upserted together in transactional batches
+        (each upsert conditional on the loaded ``_etag``): one round trip
+        instead of one per conversation. If any of them changed since it was
+        loaded the batch is rolled back and they are saved one by one, which
+        rebases the changed one. Split layout conversations are saved one by
+        one, as their messages already take batches of their own.
+        
+        Args:
+            user_id: The partition key shared by the conversations
+            conversations: Conversation data as passed to ``save_conversation``
+        """
+        single = [c for c in conversations if not self._uses_split_layout(c)]
+        one_by_one = [c for c in conversations if self._uses_split_layout(c)]
+        if len(single) < 2 or self.async_container is None:
+            one_by_one = conversations
+            single = []
+        
+        for start in range(0, len(single), MAX_BATCH_OPERATIONS):
+            batch = single[start:start + MAX_BATCH_OPERATIONS]
+            operations = []
+            for conversation_data in batch:
+                etag = conversation_data.get("_etag")
+                document = self._single_document(conversation_data)
+                operations.append(("upsert", (document,), {"if_match_etag": etag}) if etag else ("upsert", (document,)))
+            try:
+                results = await self.async_container.execute_item_batch(
+                    batch_operations=operations,
+                    partition_key=user_id,
+                    response_hook=self.request_charges.hook("write")
+                )
+            except (exceptions.CosmosHttpResponseError, exceptions.CosmosBatchOperationError) as e:
+                if not _is_write_conflict(e):
+                    raise
+                one_by_one.extend(batch)
+                continue
+            for result in results:
+                saved = result.get("resourceBody")
+                if saved:
+                    await self._cache_call_async(self._remember, self._with_layout_state(saved))
+            if self.user_registry is not None:
+                await self.user_registry.register_async(user_id)
+        
+        for conversation_data in one_by_one:
+            await self.save_conversation_async(conversation_data)
+    
+    async def get_conversation_async(self, conversation_id: str, user_id: Optional[str] = None, buffered: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        Retrieve a specific conversation by ID using the async client.
+        
+        Args:
+            conversation_id: The ID of the conversation to retrieve
+            user_id: The ID of the user owning the conversation (partition key)
+            buffered: Return the version queued in the write-behind buffer, if
+                any, instead of the stored one
             
-            # Extract user_ids from results
-            user_ids = [item['user_id'] for item in items if 'user_id' in item]
-            user_ids.sort()
+        Returns:
+            The conversation document or None if not found
+        """
+        if buffered:
+            pending = self._buffered_conversation(conversation_id, user_id)
+            if pending is not None:
+                return pending
+        if self.async_container is None:
+            return await asyncio.to_thread(self.get_conversation, conversation_id, user_id, False)
+        
+        try:
+            cached = await self._cache_call_async(self._cached_conversation, conversation_id)
+            if cached is not None and cached[1]:
+                return dict(cached[0], **{REQUEST_CHARGE_KEY: 0.0})
+            
+            spent: List[float] = []
+            hook = self.request_charges.hook("read", spent)
+            if user_id:
+                try:
+                    conversation = await self.async_container.read_item(item=conversation_id, partition_key=user_id, response_hook=hook)
+                except exceptions.CosmosResourceNotFoundError:
+                    return None
+            else:
+                items = [item async for item in self.async_container.query_items(
+                    query=CONVERSATION_BY_ID_QUERY,
+                    parameters=[{"name": "@conversationId", "value": conversation_id}],
+                    response_hook=hook
+                )]
+                conversation = items[0] if items else None
             
-            return user_ids
+            if conversation is None:
+                return None
+            if cached is not None and cached[0].get("_etag") == conversation.get("_etag"):
+                await self._cache_call_async(self.conversation_cache.mark_revalidated, conversation_id)
+                return dict(cached[0], **{REQUEST_CHARGE_KEY: sum(spent)})
+            
+            message_docs = None
+            if conversation.get("type") == CONVERSATION_DOC_TYPE:
+                message_docs = [doc async for doc in self.async_container.query_items(
+                    query=HISTORY_QUERY,
+                    parameters=self._history_parameters(conversation_id),
+                    partition_key=conversation["user_id"],
+                    response_hook=self.request_charges.hook("history_query", spent)
+                )]
+            return await self._cache_call_async(self._loaded, conversation, message_docs, spent)
             
         except exceptions.CosmosHttpResponseError as e:
-            print(f"Error retrieving user IDs: {str(e)}")
-            return []
-    
\ No newline at end of file
+            logger.error("Error retrieving conversation: %s", e)
+            return None
+    
+    async def list_conversations_async(self, user_id: str, page_size: int = 20, continuation: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Retrieve one page of conversation summaries for a user using the async client.
+        
+        Args:
+            user_id: The ID of the user
+            page_size: Maximum number of conversations in the page
+            continuation: Continuation token returned with the previous page
+            
+        Returns:
+            The summaries and the continuation token of the next page
+        """
+        if self.async_container is None:
+            return await asyncio.to_thread(self.list_conversations, user_id, page_size, continuation)
+        
+        try:
+            pager = self.async_container.query_items(
+                query=CONVERSATION_SUMMARIES_QUERY,
+                parameters=self._summary_parameters(user_id),
+                partition_key=str(user_id).strip(),
+                max_item_count=page_size,
+                response_hook=self.request_charges.hook("list")
+            ).by_page(continuation)
+            items = []
+            async for page in pager:
+                items = [item async for item in page]
+                break
+            return self._with_buffered_summaries(user_id, items, continuation is None), pager.continuation_token
+            
+        except exceptions.CosmosHttpResponseError as e:
+            logger.error("Error listing conversations: %s", e)
+            return [], None
+    
+    async def get_full_conversation_async(self, conversation_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Retrieve a conversation with all of its messages using the async client.
+        
+        Args:
+            conversation_id: The ID of the conversation to retrieve
+            user_id: The ID of the user owning the conversation
+            
+        Returns:
+            The conversation document or None if not found
+        """
+        if self.async_container is None:
+            return await asyncio.to_thread(self.get_full_conversation, conversation_id, user_id)
+        
+        conversation = await self.get_conversation_async(conversation_id, user_id)
+        if conversation is None or conversation.get("message_offset", 0) == 0:
+            return conversation
+        
+        try:
+            message_docs = [doc async for doc in self.async_container.query_items(
+                query=MESSAGES_BY_CONVERSATION_QUERY,
+                parameters=self._messages_parameters(conversation_id),
+                partition_key=user_id,
+                response_hook=self.request_charges.hook("history_query")
+            )]
+        except exceptions.CosmosHttpResponseError as e:
+            logger.error("Error retrieving conversation messages: %s", e)
+            return conversation
+        return self._with_all_messages(conversation, message_docs)
+    
+    async def get_user_ids_async(self, prefix: str = "", page_size: int = 100, continuation: Optional[str] = None) -> Tuple[List[str], Optional[str]]:
+        """
+        Retrieve one page of registered user IDs using the async client.
+        
+        Args:
+            prefix: Only return user IDs starting with this prefix
+            page_size: Maximum number of user IDs in the page
+            continuation: Continuation token returned with the previous page
+            
+        Returns:
+            The user IDs and the continuation token of the next page
+        """
+        if self.user_registry is None:
+            return [], None
+        if self.user_registry.async_container is None:
+            return await asyncio.to_thread(self.get_user_ids, prefix, page_size, continuation)
+        try:
+            return await self.user_registry.list_user_ids_async(prefix, page_size, continuation)
+        except exceptions.CosmosHttpResponseError as e:
+            logger.error("Error retrieving user IDs: %s", e)
+            return [], None
+    
+    def stats(self) -> Dict[str, Any]:
+        """Request unit usage per operation, write conflicts, conversation cache and user registry counters."""
+        return {
+            "request_charges": self.request_charges.stats(),
+            "write_conflicts": self.write_conflicts,
+            "conversation_cache": self.conversation_cache.stats() if self.conversation_cache is not None else None,
+            "user_registry": self.user_registry.stats() if self.user_registry is not None else None,
+            "write_buffer": self.write_buffer.stats() if self.write_buffer is not None else None,
+        }
+    
+    async def close(self):
+        """Write what is left in the write-behind buffer, then close the async client's connection pool."""
+        if self.write_buffer is not None:
+            await self.write_buffer.close()
+        if self.async_client is not None:
+            await self.async_client.close()
@@ -0,0 +1,78 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent single-text embedding requests into batched calls.
+
+    Callers that arrive within ``max_wait_ms`` of the first pending request
+    are sent together in one embeddings request (at most ``max_batch_size``
+    texts, duplicates sent once); each caller gets back its own vector.
+    """
+
+    def __init__(self, embed_batch: Callable[[List[str]], Awaitable[List[List[float]]]], max_batch_size: int = 16, max_wait_ms: float = 5.0):
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+        self.requests = 0
+        self.batches = 0
+        self.texts_sent = 0
+
+    async def embed(self, text: str) -> List[float]:
+        """Queue a text for the next batch and wait for its vector."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        self.requests += 1
+
+        if len(self._pending) >= self.max_batch_size:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._schedule_flush)
+
+        return await future
+
+    def _schedule_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._pending:
+            batch = self._pending[:self.max_batch_size]
+            del self._pending[:self.max_batch_size]
+            task = asyncio.get_running_loop().create_task(self._flush(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, batch: List[Tuple[str, asyncio.Future]]):
+        unique_texts = list(dict.fromkeys(text for text, _ in batch))
+        self.batches += 1
+        self.texts_sent += len(unique_texts)
+
+        try:
+            vectors = await self.embed_batch(unique_texts)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        by_text = dict(zip(unique_texts, vectors))
+        for text, future in batch:
+            if not future.done():
+                future.set_result(by_text[text])
+
+    def stats(self) -> Dict[str, float]:
+        """Request and upstream batch counters."""
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "texts_sent": self.texts_sent,
+            "avg_batch_size": round(self.texts_sent / self.batches, 2) if self.batches else 0.0,
+        }
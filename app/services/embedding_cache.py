@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.services.cache_backend import CacheBackend
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache for embedding vectors.
+
+    Vectors are stored as float32 arrays (12 KB for a 3072-dimension
+    text-embedding-3-large vector) in an in-process LRU bounded by total
+    bytes. When a backend is given (a SQLite file, so the cache survives
+    restarts, or the cache shared by the API's workers), vectors are also
+    written to it; backend hits are promoted back into memory. Backend
+    calls are made outside the lock, and the async variants make them on a
+    worker thread.
+    """
+
+    def __init__(self, max_bytes: int, backend: Optional[CacheBackend] = None):
+        self.max_bytes = max_bytes
+        self.backend = backend
+
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(text: str, deployment: str) -> str:
+        """Build a cache key from whitespace/case-normalized text and the deployment name."""
+        normalized = " ".join(text.split()).lower()
+        return hashlib.sha256(f"{deployment}\x00{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        Look up a vector, checking memory first and then the backend.
+
+        Returns:
+            A read-only float32 array, or None on a miss
+        """
+        vector = self._get_local(key)
+        if vector is None:
+            vector = self._promote(key, self.backend.get("emb:" + key) if self.backend is not None else None)
+        return vector
+
+    async def get_many_async(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Look up several vectors from the event loop.
+
+        Memory is checked in place; the keys it misses are read from the
+        backend in one call on a worker thread, so a backend round trip
+        never blocks the loop.
+
+        Returns:
+            One read-only float32 array (or None on a miss) per key
+        """
+        vectors = [self._get_local(key) for key in keys]
+        missing = [position for position, vector in enumerate(vectors) if vector is None]
+        values = [None] * len(missing)
+        if missing and self.backend is not None:
+            values = await asyncio.to_thread(self._read_backend, [keys[position] for position in missing])
+        for position, value in zip(missing, values):
+            vectors[position] = self._promote(keys[position], value)
+        return vectors
+
+    def put(self, key: str, embedding) -> np.ndarray:
+        """
+        Store a vector in memory and in the backend.
+
+        Returns:
+            The stored float32 array
+        """
+        vector = self._put_local(key, embedding)
+        if self.backend is not None:
+            self.backend.set("emb:" + key, vector.tobytes())
+        return vector
+
+    async def put_many_async(self, items: List[Tuple[str, Any]]) -> List[np.ndarray]:
+        """
+        Store several (key, embedding) pairs from the event loop; the
+        backend writes are made in one call on a worker thread.
+
+        Returns:
+            The stored float32 arrays
+        """
+        vectors = [self._put_local(key, embedding) for key, embedding in items]
+        if self.backend is not None:
+            await asyncio.to_thread(self._write_backend, [(key, vector) for (key, _), vector in zip(items, vectors)])
+        return vectors
+
+    def _get_local(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return vector
+
+    def _promote(self, key: str, value: Optional[bytes]) -> Optional[np.ndarray]:
+        """Count a memory miss, keeping the backend's vector in memory if it had one."""
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            vector = np.frombuffer(value, dtype=np.float32)
+            self._store(key, vector)
+            self.backend_hits += 1
+            return vector
+
+    def _put_local(self, key: str, embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector.flags.writeable = False
+        with self._lock:
+            self._store(key, vector)
+        return vector
+
+    def _read_backend(self, keys: List[str]) -> List[Optional[bytes]]:
+        return [self.backend.get("emb:" + key) for key in keys]
+
+    def _write_backend(self, items: List[Tuple[str, np.ndarray]]):
+        for key, vector in items:
+            self.backend.set("emb:" + key, vector.tobytes())
+
+    def _store(self, key: str, vector: np.ndarray):
+        """Insert into the in-memory LRU, evicting least recently used vectors over the byte bound."""
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= previous.nbytes
+        self._entries[key] = vector
+        self._bytes += vector.nbytes
+
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        """Hit/miss/eviction counters and current memory footprint."""
+        lookups = self.hits + self.backend_hits + self.misses
+        return {
+            "hits": self.hits,
+            "backend_hits": self.backend_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.backend_hits) / lookups, 4) if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
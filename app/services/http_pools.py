@@ -0,0 +1,324 @@
+from typing import Any, Dict, Optional
+import importlib.util
+import logging
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from azure.core.pipeline.transport import AsyncHttpTransport, HttpTransport, RequestsTransport
+
+try:
+    import aiohttp
+    from azure.core.pipeline.transport import AioHttpTransport
+except ImportError:  # aiohttp is not installed, async calls fall back to a worker thread
+    aiohttp = None
+    AioHttpTransport = None
+
+from app.config import (
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_KEEPALIVE_EXPIRY_SECONDS,
+    HTTP_CONNECT_TIMEOUT_SECONDS,
+    HTTP_READ_TIMEOUT_SECONDS,
+    HTTP2_ENABLED,
+)
+from app.services.upstream_scheduler import UpstreamScheduler
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 in httpx needs the optional h2 package
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class _PooledAioHttpTransport(AioHttpTransport if AioHttpTransport is not None else object):
+    """
+    AioHttpTransport over a tuned aiohttp session.
+
+    aiohttp sessions can only be created inside a running event loop, so the
+    session is created on first use. Clients closing the transport leave the
+    session open; it belongs to the pool and is closed by HttpPools.aclose.
+    """
+
+    def __init__(self, connector_options: Dict[str, Any]):
+        super().__init__()
+        self._connector_options = connector_options
+
+    async def open(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(**self._connector_options),
+                cookie_jar=aiohttp.DummyCookieJar(),
+                auto_decompress=False,
+                trust_env=self._use_env_settings,
+            )
+        self._has_been_opened = True
+        await self.session.__aenter__()
+
+    async def close(self):
+        pass
+
+    async def aclose(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+# Connection failures retried by the scheduler in place of the OpenAI SDK's
+# own retries: the connection was never made, so the request cannot have
+# reached the upstream's model. Failures after it was sent (a connection
+# closed mid-response) are not retried, as a completion is not idempotent
+HTTPX_RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+
+def _azure_status(response) -> int:
+    return response.status_code
+
+
+def _azure_headers(response):
+    return response.headers
+
+
+def _discard_azure_response(response):
+    close = getattr(response.internal_response, "close", None)
+    if close is not None:
+        close()
+
+
+async def _discard_azure_response_async(response):
+    release = getattr(response.internal_response, "release", None)
+    if release is not None:
+        release()
+
+
+class ScheduledHTTPTransport(httpx.BaseTransport):
+    """httpx transport sending every request through an upstream's scheduler lane."""
+
+    def __init__(self, inner: httpx.BaseTransport, scheduler: UpstreamScheduler, upstream: str):
+        self.inner = inner
+        self.scheduler = scheduler
+        self.upstream = upstream
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        return self.scheduler.send_sync(
+            self.upstream,
+            lambda: self.inner.handle_request(request),
+            lambda response: response.status_code,
+            lambda response: response.headers,
+            lambda response: response.close(),
+            retry_errors=HTTPX_RETRY_ERRORS,
+        )
+
+    def close(self):
+        self.inner.close()
+
+
+class ScheduledAsyncHTTPTransport(httpx.AsyncBaseTransport):
+    """Async httpx transport sending every request through an upstream's scheduler lane."""
+
+    def __init__(self, inner: httpx.AsyncBaseTransport, scheduler: UpstreamScheduler, upstream: str):
+        self.inner = inner
+        self.scheduler = scheduler
+        self.upstream = upstream
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.scheduler.send(
+            self.upstream,
+            lambda: self.inner.handle_async_request(request),
+            lambda response: response.status_code,
+            lambda response: response.headers,
+            lambda response: response.aclose(),
+            retry_errors=HTTPX_RETRY_ERRORS,
+        )
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+class ScheduledTransport(HttpTransport):
+    """
+    azure-core transport sending every request through an upstream's
+    scheduler lane. Throttled responses are retried here, so the SDK's own
+    retry policy only sees them once the scheduler has given up, as
+    UpstreamOverloaded (which it does not retry).
+    """
+
+    def __init__(self, inner: HttpTransport, scheduler: UpstreamScheduler, upstream: str):
+        self.inner = inner
+        self.scheduler = scheduler
+        self.upstream = upstream
+
+    def send(self, request, **kwargs):
+        return self.scheduler.send_sync(
+            self.upstream,
+            lambda: self.inner.send(request, **kwargs),
+            _azure_status,
+            _azure_headers,
+            _discard_azure_response,
+        )
+
+    def open(self):
+        self.inner.open()
+
+    def close(self):
+        self.inner.close()
+
+    def __enter__(self):
+        self.inner.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.inner.__exit__(*args)
+
+
+class ScheduledAsyncTransport(AsyncHttpTransport):
+    """Async counterpart of ScheduledTransport."""
+
+    def __init__(self, inner: AsyncHttpTransport, scheduler: UpstreamScheduler, upstream: str):
+        self.inner = inner
+        self.scheduler = scheduler
+        self.upstream = upstream
+
+    async def send(self, request, **kwargs):
+        return await self.scheduler.send(
+            self.upstream,
+            lambda: self.inner.send(request, **kwargs),
+            _azure_status,
+            _azure_headers,
+            _discard_azure_response_async,
+        )
+
+    async def open(self):
+        await self.inner.open()
+
+    async def close(self):
+        await self.inner.close()
+
+    async def __aenter__(self):
+        await self.inner.__aenter__()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.inner.__aexit__(*args)
+
+
+class HttpPools:
+    """
+    One tuned connection pool per upstream, shared by every client that
+    talks to it.
+
+    Azure OpenAI clients get httpx clients (keep-alive, HTTP/2 when the h2
+    package is installed, bounded connections). The Azure AI Search and
+    Cosmos DB SDKs run on azure-core transports, which have no httpx
+    backend, so they get a requests session (sync) and an aiohttp session
+    (async) tuned with the same limits.
+
+    With a scheduler, every pool's transport is wrapped to send its
+    requests through the upstream's lane (concurrency limit and retries).
+    """
+
+    def __init__(self, scheduler: Optional[UpstreamScheduler] = None):
+        self.scheduler = scheduler
+        self.max_connections = HTTP_MAX_CONNECTIONS
+        self.max_keepalive_connections = HTTP_MAX_KEEPALIVE_CONNECTIONS
+        self.keepalive_expiry = HTTP_KEEPALIVE_EXPIRY_SECONDS
+        self.http2 = HTTP2_ENABLED and HTTP2_AVAILABLE
+        self._clients: Dict[str, Any] = {}
+
+    def _httpx_transport_options(self) -> Dict[str, Any]:
+        return {
+            "limits": httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry
+            ),
+            "http2": self.http2,
+        }
+
+    def _httpx_timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(HTTP_READ_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS)
+
+    def _schedule(self, transport, upstream: str, wrapper):
+        return transport if self.scheduler is None else wrapper(transport, self.scheduler, upstream)
+
+    def _get(self, key: str, build):
+        client = self._clients.get(key)
+        if client is None:
+            client = self._clients[key] = build()
+        return client
+
+    def httpx_client(self, upstream: str) -> httpx.Client:
+        """The sync httpx client for ``upstream``."""
+        return self._get(f"{upstream}:httpx", lambda: httpx.Client(
+            transport=self._schedule(httpx.HTTPTransport(**self._httpx_transport_options()), upstream, ScheduledHTTPTransport),
+            timeout=self._httpx_timeout()
+        ))
+
+    def httpx_async_client(self, upstream: str) -> httpx.AsyncClient:
+        """The async httpx client for ``upstream``."""
+        return self._get(f"{upstream}:httpx-async", lambda: httpx.AsyncClient(
+            transport=self._schedule(httpx.AsyncHTTPTransport(**self._httpx_transport_options()), upstream, ScheduledAsyncHTTPTransport),
+            timeout=self._httpx_timeout()
+        ))
+
+    def _requests_session(self) -> requests.Session:
+        session = requests.Session()
+        # Retries are left to the Azure SDK's own retry policy
+        adapter = HTTPAdapter(
+            pool_connections=self.max_keepalive_connections,
+            pool_maxsize=self.max_connections,
+            max_retries=Retry(total=False, redirect=False, raise_on_status=False)
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def transport(self, upstream: str) -> HttpTransport:
+        """The azure-core transport for sync clients of ``upstream``."""
+        return self._get(f"{upstream}:transport", lambda: self._schedule(
+            RequestsTransport(session=self._requests_session(), session_owner=False),
+            upstream,
+            ScheduledTransport
+        ))
+
+    def async_transport(self, upstream: str) -> Optional[AsyncHttpTransport]:
+        """The azure-core transport for async clients of ``upstream``, or None without aiohttp."""
+        if AioHttpTransport is None:
+            return None
+        return self._get(f"{upstream}:transport-async", lambda: self._schedule(
+            _PooledAioHttpTransport({
+                "limit": self.max_connections,
+                "limit_per_host": self.max_connections,
+                "keepalive_timeout": self.keepalive_expiry,
+            }),
+            upstream,
+            ScheduledAsyncTransport
+        ))
+
+    async def aclose(self):
+        """Close every pool."""
+        clients, self._clients = self._clients, {}
+        for key, client in clients.items():
+            if isinstance(client, (ScheduledTransport, ScheduledAsyncTransport)):
+                client = client.inner
+            try:
+                if isinstance(client, httpx.AsyncClient):
+                    await client.aclose()
+                elif isinstance(client, _PooledAioHttpTransport):
+                    await client.aclose()
+                elif isinstance(client, RequestsTransport):
+                    client.session.close()
+                else:
+                    client.close()
+            except Exception as e:
+                logger.warning("Error closing connection pool %s: %s", key, e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pools": sorted(self._clients),
+            "max_connections": self.max_connections,
+            "max_keepalive_connections": self.max_keepalive_connections,
+            "keepalive_expiry_seconds": self.keepalive_expiry,
+            "http2": self.http2,
+            "scheduled": self.scheduler is not None,
+        }
@@ -0,0 +1,469 @@
+"""
+Offline ingestion of source documents into the Azure AI Search index.
+
+Documents are streamed from a folder, split into chunk records (the
+``chunk``/``title``/``parent_id`` fields the retrievers select, keyed by
+``chunk_id``), embedded with batched embeddings calls that run
+concurrently under a tokens-per-minute limit, and uploaded in index
+batches. Chunk keys are derived from the chunk's content hash, so a
+re-run only embeds and uploads chunks whose text changed and deletes the
+ones that disappeared. A checkpoint file records every document whose
+chunks are all in the index; it is saved after each upload batch, so an
+interrupted run resumes where it stopped.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from azure.search.documents import IndexDocumentsBatch
+
+from app.services.token_budget import TokenCounter
+from app.services.upstream_scheduler import TokenBudget
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXTENSIONS = (".md", ".txt")
+CHECKPOINT_FORMAT_VERSION = 1
+# Per-document indexing failures worth retrying: version conflicts and throttling
+RETRYABLE_INDEXING_STATUS = (409, 422, 503)
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_HEADING = re.compile(r"^#+\s*(.+)$", re.MULTILINE)
+
+
+@dataclass
+class SourceDocument:
+    """A document read from the source folder."""
+    parent_id: str
+    title: str
+    text: str
+    content_hash: str
+
+
+def content_hash(*parts: str) -> str:
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+def chunk_key(parent_id: str, chunk_hash: str) -> str:
+    """Index key of a chunk; keys may only hold letters, digits, ``_``, ``-`` and ``=``."""
+    return f"{hashlib.sha256(parent_id.encode('utf-8')).hexdigest()[:16]}_{chunk_hash[:32]}"
+
+
+def read_document(path: str, parent_id: str) -> SourceDocument:
+    with open(path, encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    heading = _HEADING.search(text)
+    title = heading.group(1).strip() if heading else os.path.splitext(os.path.basename(path))[0]
+    return SourceDocument(parent_id=parent_id, title=title, text=text, content_hash=content_hash(title, text))
+
+
+def iter_documents(folder: str) -> Iterator[SourceDocument]:
+    """
+    Read the supported files under ``folder`` one at a time, in a stable
+    order. A document's parent_id is its path relative to the folder.
+    """
+    for root, directories, files in os.walk(folder):
+        directories.sort()
+        for name in sorted(files):
+            if not name.lower().endswith(SUPPORTED_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            yield read_document(path, os.path.relpath(path, folder).replace(os.sep, "/"))
+
+
+class Chunker:
+    """
+    Splits text into chunks of at most ``max_tokens`` tokens along paragraph
+    and then sentence boundaries. Consecutive chunks share up to
+    ``overlap_tokens`` tokens of trailing text, so a passage cut by a chunk
+    boundary is still whole in one of them.
+    """
+
+    def __init__(self, max_tokens: int = 512, overlap_tokens: int = 64, counter: Optional[TokenCounter] = None):
+        self.max_tokens = max_tokens
+        self.overlap_tokens = min(overlap_tokens, max_tokens // 2)
+        self.counter = counter or TokenCounter()
+
+    def _units(self, text: str) -> Iterator[Tuple[str, int]]:
+        """Paragraphs, or the sentences (or words) of paragraphs too long for one chunk, with their token counts."""
+        for paragraph in re.split(r"\n\s*\n", text):
+            paragraph = " ".join(paragraph.split())
+            if not paragraph:
+                continue
+            tokens = self.counter.count(paragraph)
+            if tokens <= self.max_tokens:
+                yield paragraph, tokens
+                continue
+            for sentence in _SENTENCE_END.split(paragraph):
+                tokens = self.counter.count(sentence)
+                if tokens <= self.max_tokens:
+                    yield sentence, tokens
+                    continue
+                words = sentence.split()
+                step = max(1, len(words) * self.max_tokens // tokens)
+                for start in range(0, len(words), step):
+                    piece = " ".join(words[start:start + step])
+                    yield piece, self.counter.count(piece)
+
+    def split(self, text: str) -> List[str]:
+        chunks = []
+        current: List[Tuple[str, int]] = []
+        size = 0
+        for unit, tokens in self._units(text):
+            if current and size + tokens > self.max_tokens:
+                chunks.append("\n\n".join(part for part, _ in current))
+                # Carry the trailing units that fit in the overlap into the next chunk
+                carried: List[Tuple[str, int]] = []
+                carried_size = 0
+                for part, part_tokens in reversed(current):
+                    if carried_size + part_tokens > self.overlap_tokens or carried_size + part_tokens + tokens > self.max_tokens:
+                        break
+                    carried.insert(0, (part, part_tokens))
+                    carried_size += part_tokens
+                current, size = carried, carried_size
+            current.append((unit, tokens))
+            size += tokens
+        if current:
+            chunks.append("\n\n".join(part for part, _ in current))
+        return chunks
+
+
+class IngestionCheckpoint:
+    """
+    What the index holds per document: the document's content hash and its
+    chunk keys. Saved as JSON (written to a temporary file, then renamed, so
+    a crash never leaves a torn checkpoint).
+    """
+
+    def __init__(self, path: Optional[str], index_name: str):
+        self.path = path
+        self.index_name = index_name
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == CHECKPOINT_FORMAT_VERSION and data.get("index") == index_name:
+                self.documents = data["documents"]
+            else:
+                logger.warning("Ignoring checkpoint %s, it was written for another index or format", path)
+
+    def get(self, parent_id: str) -> Optional[Dict[str, Any]]:
+        return self.documents.get(parent_id)
+
+    def record(self, parent_id: str, document_hash: str, keys: Iterable[str]):
+        self.documents[parent_id] = {"hash": document_hash, "chunks": sorted(keys)}
+
+    def remove(self, parent_id: str):
+        self.documents.pop(parent_id, None)
+
+    def save(self):
+        if not self.path:
+            return
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump({"version": CHECKPOINT_FORMAT_VERSION, "index": self.index_name, "documents": self.documents}, f)
+        os.replace(temporary, self.path)
+
+
+@dataclass
+class IngestionStats:
+    documents: int = 0
+    documents_unchanged: int = 0
+    documents_indexed: int = 0
+    documents_removed: int = 0
+    documents_failed: int = 0
+    chunks: int = 0
+    chunks_unchanged: int = 0
+    chunks_embedded: int = 0
+    chunks_uploaded: int = 0
+    chunks_deleted: int = 0
+    embedding_calls: int = 0
+    embedding_tokens: int = 0
+    upload_batches: int = 0
+    elapsed_seconds: float = 0.0
+    failed: List[str] = field(default_factory=list)
+
+    @property
+    def chunks_per_second(self) -> float:
+        """Chunks embedded and uploaded per second of the run."""
+        return self.chunks_uploaded / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        stats = {key: value for key, value in self.__dict__.items() if key != "failed"}
+        stats["chunks_per_second"] = round(self.chunks_per_second, 1)
+        stats["elapsed_seconds"] = round(self.elapsed_seconds, 2)
+        stats["failed"] = list(self.failed)
+        return stats
+
+
+@dataclass
+class _PendingDocument:
+    document_hash: Optional[str]
+    keys: Set[str]
+    remaining: int
+    failed: bool = False
+
+
+class IngestionPipeline:
+    """
+    Chunks, embeds and uploads documents; see the module docstring.
+
+    Three stages run concurrently, connected by bounded queues so that
+    reading can't run far ahead of the upstreams: the caller's task reads
+    and chunks documents into embedding batches, ``embedding_concurrency``
+    workers embed them, and one worker sends index batches of
+    ``upload_batch_size`` actions (uploads of new chunks and deletes of
+    stale ones).
+    """
+
+    def __init__(
+        self,
+        search_client,
+        embed_batch: Callable[[List[str]], Awaitable[List[List[float]]]],
+        checkpoint: IngestionCheckpoint,
+        vector_field: str,
+        chunker: Optional[Chunker] = None,
+        key_field: str = "chunk_id",
+        embedding_batch_size: int = 16,
+        embedding_concurrency: int = 4,
+        embedding_tokens_per_minute: int = 0,
+        upload_batch_size: int = 500,
+        upload_action: str = "merge_or_upload",
+        upload_retries: int = 3,
+    ):
+        """
+        Args:
+            search_client: Async SearchClient of the target index
+            embed_batch: Embeds a list of texts with one embeddings call,
+                e.g. OpenAIService.generate_embeddings_batch_async
+            checkpoint: State of the previous runs
+            vector_field: Index field holding the chunk vector
+            chunker: Splits documents into chunks
+            key_field: Index key field
+            embedding_batch_size: Texts per embeddings call
+            embedding_concurrency: Embeddings calls in flight
+            embedding_tokens_per_minute: Limit on the tokens sent to the
+                embedding deployment (0 for none)
+            upload_batch_size: Index actions per upload batch (at most 1000)
+            upload_action: "merge_or_upload" or "upload"
+            upload_retries: Retries of chunks the index rejected with a
+                transient per-document error
+        """
+        if upload_action not in ("merge_or_upload", "upload"):
+            raise ValueError(f"Unknown upload action {upload_action!r}, expected merge_or_upload or upload")
+        self.search_client = search_client
+        self.embed_batch = embed_batch
+        self.checkpoint = checkpoint
+        self.vector_field = vector_field
+        self.chunker = chunker or Chunker()
+        self.key_field = key_field
+        self.embedding_batch_size = embedding_batch_size
+        self.embedding_concurrency = embedding_concurrency
+        self.budget = TokenBudget(embedding_tokens_per_minute) if embedding_tokens_per_minute > 0 else None
+        self.upload_batch_size = min(upload_batch_size, 1000)
+        self.upload_action = upload_action
+        self.upload_retries = upload_retries
+
+        self.stats = IngestionStats()
+        self._pending: Dict[str, _PendingDocument] = {}
+
+    def _chunk_records(self, document: SourceDocument) -> Dict[str, Tuple[Dict[str, Any], int]]:
+        records = {}
+        for text in self.chunker.split(document.text):
+            key = chunk_key(document.parent_id, content_hash(document.title, text))
+            records[key] = ({
+                self.key_field: key,
+                "parent_id": document.parent_id,
+                "title": document.title,
+                "chunk": text,
+            }, self.chunker.counter.count(text))
+        return records
+
+    async def run(self, documents: Iterable[SourceDocument], prune: bool = True) -> IngestionStats:
+        """
+        Ingest ``documents``. With ``prune``, documents of earlier runs that
+        are not among them any more are removed from the index.
+        """
+        start = time.perf_counter()
+        embed_queue: asyncio.Queue = asyncio.Queue(maxsize=self.embedding_concurrency * 2)
+        upload_queue: asyncio.Queue = asyncio.Queue(maxsize=self.upload_batch_size * 2)
+        uploader = asyncio.create_task(self._upload_worker(upload_queue))
+        embedders = [asyncio.create_task(self._embed_worker(embed_queue, upload_queue)) for _ in range(self.embedding_concurrency)]
+
+        try:
+            seen = set()
+            batch: List[Tuple[str, Dict[str, Any], int]] = []
+            iterator = iter(documents)
+            while True:
+                # Reading files blocks, so it runs in a worker thread
+                document = await asyncio.to_thread(next, iterator, None)
+                if document is None:
+                    break
+                seen.add(document.parent_id)
+                self.stats.documents += 1
+                previous = self.checkpoint.get(document.parent_id)
+                if previous is not None and previous["hash"] == document.content_hash:
+                    self.stats.documents_unchanged += 1
+                    self.stats.chunks_unchanged += len(previous["chunks"])
+                    continue
+
+                records = self._chunk_records(document)
+                indexed = set(previous["chunks"]) if previous is not None else set()
+                new_keys = [key for key in records if key not in indexed]
+                stale_keys = sorted(indexed - set(records))
+                self.stats.chunks += len(records)
+                self.stats.chunks_unchanged += len(records) - len(new_keys)
+                self._pending[document.parent_id] = _PendingDocument(
+                    document.content_hash, set(records), len(new_keys) + len(stale_keys)
+                )
+                if not new_keys and not stale_keys:
+                    self._complete(document.parent_id)
+                for key in stale_keys:
+                    await upload_queue.put(("delete", document.parent_id, {self.key_field: key}))
+                for key in new_keys:
+                    record, tokens = records[key]
+                    batch.append((document.parent_id, record, tokens))
+                    if len(batch) >= self.embedding_batch_size:
+                        await embed_queue.put(batch)
+                        batch = []
+            if batch:
+                await embed_queue.put(batch)
+
+            if prune:
+                for parent_id, indexed in list(self.checkpoint.documents.items()):
+                    if parent_id in seen:
+                        continue
+                    self._pending[parent_id] = _PendingDocument(None, set(), len(indexed["chunks"]))
+                    if not indexed["chunks"]:
+                        self._complete(parent_id)
+                    for key in indexed["chunks"]:
+                        await upload_queue.put(("delete", parent_id, {self.key_field: key}))
+
+            for _ in embedders:
+                await embed_queue.put(None)
+            await asyncio.gather(*embedders)
+            await upload_queue.put(None)
+            await uploader
+        finally:
+            for task in embedders + [uploader]:
+                task.cancel()
+            self.checkpoint.save()
+            self.stats.elapsed_seconds = time.perf_counter() - start
+        return self.stats
+
+    async def _wait_for_tokens(self, tokens: int):
+        if self.budget is None:
+            return
+        while True:
+            wait = self.budget.try_take(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    async def _embed_worker(self, embed_queue: asyncio.Queue, upload_queue: asyncio.Queue):
+        while True:
+            batch = await embed_queue.get()
+            if batch is None:
+                return
+            tokens = sum(tokens for _, _, tokens in batch)
+            await self._wait_for_tokens(tokens)
+            try:
+                vectors = await self.embed_batch([record["chunk"] for _, record, _ in batch])
+                self.stats.embedding_calls += 1
+                self.stats.embedding_tokens += tokens
+            except Exception as e:
+                logger.error("Embedding %d chunks failed: %s", len(batch), e)
+                for parent_id, _, _ in batch:
+                    self._fail(parent_id)
+                continue
+            self.stats.chunks_embedded += len(batch)
+            for (parent_id, record, _), vector in zip(batch, vectors):
+                await upload_queue.put(("upload", parent_id, dict(record, **{self.vector_field: vector})))
+
+    async def _upload_worker(self, upload_queue: asyncio.Queue):
+        done = False
+        while not done:
+            actions = [await upload_queue.get()]
+            # Fill the batch with whatever else is already queued
+            while len(actions) < self.upload_batch_size and not upload_queue.empty():
+                actions.append(upload_queue.get_nowait())
+            if actions[-1] is None:
+                actions.pop()
+                done = True
+            if actions:
+                await self._upload(actions)
+                self.checkpoint.save()
+
+    async def _upload(self, actions: List[Tuple[str, str, Dict[str, Any]]]):
+        for attempt in range(self.upload_retries + 1):
+            batch = IndexDocumentsBatch()
+            uploads = [document for kind, _, document in actions if kind == "upload"]
+            if self.upload_action == "upload":
+                batch.add_upload_actions(uploads)
+            else:
+                batch.add_merge_or_upload_actions(uploads)
+            batch.add_delete_actions([document for kind, _, document in actions if kind == "delete"])
+            self.stats.upload_batches += 1
+            try:
+                results = await self.search_client.index_documents(batch)
+            except Exception as e:
+                logger.error("Uploading %d index actions failed: %s", len(actions), e)
+                for _, parent_id, _ in actions:
+                    self._fail(parent_id)
+                return
+
+            by_key = {result.key: result for result in results}
+            retry = []
+            for action in actions:
+                kind, parent_id, document = action
+                result = by_key.get(document[self.key_field])
+                if result is not None and result.succeeded:
+                    if kind == "upload":
+                        self.stats.chunks_uploaded += 1
+                    else:
+                        self.stats.chunks_deleted += 1
+                    self._settle(parent_id)
+                elif result is not None and result.status_code in RETRYABLE_INDEXING_STATUS and attempt < self.upload_retries:
+                    retry.append(action)
+                else:
+                    logger.error("Index rejected chunk %s of %s: %s", document[self.key_field], parent_id,
+                                 result.error_message if result is not None else "no result")
+                    self._fail(parent_id)
+            if not retry:
+                return
+            actions = retry
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+    def _settle(self, parent_id: str):
+        pending = self._pending.get(parent_id)
+        if pending is None:
+            return
+        pending.remaining -= 1
+        if pending.remaining <= 0:
+            self._complete(parent_id)
+
+    def _complete(self, parent_id: str):
+        pending = self._pending.pop(parent_id)
+        if pending.failed:
+            return
+        if pending.document_hash is None:
+            self.checkpoint.remove(parent_id)
+            self.stats.documents_removed += 1
+        else:
+            self.checkpoint.record(parent_id, pending.document_hash, pending.keys)
+            self.stats.documents_indexed += 1
+
+    def _fail(self, parent_id: str):
+        """Leave a document out of the checkpoint, so the next run retries it."""
+        pending = self._pending.get(parent_id)
+        if pending is None or pending.failed:
+            return
+        pending.failed = True
+        self.stats.documents_failed += 1
+        self.stats.failed.append(parent_id)
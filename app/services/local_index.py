@@ -0,0 +1,150 @@
+import json
+import os
+import shutil
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+# Snapshot layout: a directory with the unit-normalized chunk vectors as a
+# row-major float32 matrix and one metadata record per row
+VECTORS_FILE = "vectors.f32"
+METADATA_FILE = "metadata.json"
+SNAPSHOT_FORMAT_VERSION = 1
+
+# Rows scored per matrix product, which bounds the working set when the
+# memory-mapped matrix is larger than RAM
+SCAN_BLOCK_ROWS = 65536
+
+
+class LocalVectorIndex:
+    """
+    In-process exact vector index over a snapshot of the search index.
+
+    The vectors are memory-mapped, so loading is instant and the OS page
+    cache decides what stays resident. Queries are scored with blocked
+    NumPy matrix products; the vectors are stored normalized so the dot
+    product is the cosine similarity.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, METADATA_FILE), encoding="utf-8") as f:
+            metadata = json.load(f)
+        if metadata.get("version") != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {metadata.get('version')!r} in {path}")
+
+        self.vector_field = metadata["vector_field"]
+        self.dimensions = metadata["dimensions"]
+        self.records: List[Dict[str, Any]] = metadata["records"]
+        self.exported_at = metadata.get("exported_at")
+        self.vectors = np.memmap(
+            os.path.join(path, VECTORS_FILE),
+            dtype=np.float32,
+            mode="r",
+            shape=(len(self.records), self.dimensions)
+        )
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def scores(self, query_vector: np.ndarray) -> np.ndarray:
+        """Cosine similarity of every row to the query."""
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        out = np.empty(len(self.records), dtype=np.float32)
+        for start in range(0, len(self.records), SCAN_BLOCK_ROWS):
+            np.dot(self.vectors[start:start + SCAN_BLOCK_ROWS], query, out=out[start:start + SCAN_BLOCK_ROWS])
+        return out
+
+    def search(self, query_vector: List[float], k: int, select: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """
+        The ``k`` nearest chunks, in the shape of Azure AI Search results.
+
+        Args:
+            query_vector: The query embedding
+            k: Number of results
+            select: Fields to return; the vector field returns the stored vector
+
+        Returns:
+            Results with their fields and ``@search.score``
+        """
+        if not self.records:
+            return []
+        scores = self.scores(query_vector)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        results = []
+        for index in top:
+            record = self.records[index]
+            fields = select or list(record)
+            result = {field: record[field] for field in fields if field in record}
+            if self.vector_field in fields:
+                result[self.vector_field] = self.vectors[index].tolist()
+            result["@search.score"] = float(scores[index])
+            results.append(result)
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "chunks": len(self.records),
+            "dimensions": self.dimensions,
+            "exported_at": self.exported_at,
+        }
+
+
+def write_snapshot(path: str, documents: Iterable[Dict[str, Any]], vector_field: str, fields: List[str], exported_at: Optional[str] = None) -> int:
+    """
+    Write documents with their vectors as a snapshot directory.
+
+    The snapshot is written next to ``path`` and moved into place once
+    complete, so a running index never sees a partial snapshot.
+
+    Args:
+        path: Snapshot directory
+        documents: Search documents including ``vector_field``
+        vector_field: Field holding the chunk vector
+        fields: Metadata fields to keep per chunk
+        exported_at: Timestamp recorded in the metadata
+
+    Returns:
+        The number of chunks written
+    """
+    staging = f"{path}.partial"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    records = []
+    dimensions = None
+    with open(os.path.join(staging, VECTORS_FILE), "wb") as vectors_file:
+        for document in documents:
+            vector = document.get(vector_field)
+            if vector is None:
+                continue
+            row = np.asarray(vector, dtype=np.float32)
+            if dimensions is None:
+                dimensions = len(row)
+            elif len(row) != dimensions:
+                raise ValueError(f"Vector of length {len(row)} in an index of {dimensions} dimensions")
+            row = row / max(float(np.linalg.norm(row)), 1e-12)
+            vectors_file.write(row.tobytes())
+            records.append({field: document[field] for field in fields if field in document})
+
+    with open(os.path.join(staging, METADATA_FILE), "w", encoding="utf-8") as f:
+        json.dump({
+            "version": SNAPSHOT_FORMAT_VERSION,
+            "vector_field": vector_field,
+            "dimensions": dimensions or 0,
+            "exported_at": exported_at,
+            "records": records,
+        }, f)
+
+    previous = f"{path}.previous"
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, previous)
+    os.rename(staging, path)
+    shutil.rmtree(previous, ignore_errors=True)
+    return len(records)
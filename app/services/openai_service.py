@@ -1,31 +1,132 @@
-from openai import AzureOpenAI
-from typing import List, Dict, Any
+from openai import AzureOpenAI, AsyncAzureOpenAI, DEFAULT_MAX_RETRIES, RateLimitError
+from typing import AsyncIterator, List, Dict, Any, Optional
+import asyncio
+import logging
 import os
 
+import httpx
+
 from app.config import (
     AZURE_OPENAI_API_KEY,
     AZURE_OPENAI_ENDPOINT,
     AZURE_OPENAI_MODEL,
     AZURE_OPENAI_API_VERSION,
-    AZURE_OPENAI_EMBEDDING_DEPLOYMENT
+    AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+    EMBEDDING_CACHE_ENABLED,
+    EMBEDDING_CACHE_MAX_BYTES,
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_BATCHING_ENABLED,
+    EMBEDDING_BATCH_MAX_SIZE,
+    EMBEDDING_BATCH_WAIT_MS,
+    USE_ASYNC_CLIENTS
 )
+from app.services.cache_backend import CacheBackend, SqliteCacheBackend
+from app.services.embedding_batcher import EmbeddingBatcher
+from app.services.embedding_cache import EmbeddingCache
+from app.services.telemetry import record_token_usage
+from app.services.upstream_scheduler import UpstreamError, UpstreamOverloaded, UpstreamScheduler, overload_cause, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+def _overload(error: Exception) -> Optional[UpstreamOverloaded]:
+    """
+    The overload behind a failed call: raised by the scheduler, or a 429
+    the SDK gave up retrying (without a scheduler).
+    """
+    overloaded = overload_cause(error)
+    if overloaded is None and isinstance(error, RateLimitError):
+        overloaded = UpstreamOverloaded("openai", 429, "is rate limiting requests", retry_after_seconds(error.response.headers))
+    return overloaded
+
+
+def _completion_failure(error: Exception) -> Exception:
+    """
+    What to raise for a failed completion: UpstreamOverloaded when the
+    deployment was busy, UpstreamError otherwise. A failure is never
+    answered with error text, which would be saved as the assistant's turn.
+    """
+    if isinstance(error, UpstreamError):
+        return error
+    overloaded = _overload(error)
+    if overloaded is not None:
+        return overloaded
+    logger.error("Error generating response: %s", error)
+    return UpstreamError("openai", f"failed to generate a response: {error}")
+
+
+def _answer(response) -> str:
+    """The text of a completion, or UpstreamError when it has none (e.g. it was filtered)."""
+    choice = response.choices[0]
+    if not choice.message.content:
+        raise UpstreamError("openai", f"returned no answer (finish reason {choice.finish_reason})")
+    return choice.message.content
+
+
+def cached_prompt_tokens(usage) -> int:
+    """Prompt tokens of a completion that Azure OpenAI served from its prompt cache."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+
 
 class OpenAIService:
-    def __init__(self):
-        """Initialize the OpenAI service with configuration from environment variables"""
+    def __init__(self, http_client: Optional[httpx.Client] = None, async_http_client: Optional[httpx.AsyncClient] = None, scheduler: Optional[UpstreamScheduler] = None,
+                 cache_backend: Optional[CacheBackend] = None):
+        """
+        Initialize the OpenAI service with configuration from environment variables.
+        
+        Args:
+            http_client: Shared connection pool for the sync client
+            async_http_client: Shared connection pool for the async client
+            scheduler: Upstream scheduler behind the connection pools; it
+                retries throttled calls (so the SDK doesn't) and holds the
+                completions' tokens-per-minute budget
+            cache_backend: Cache shared with the other workers, used as the
+                embedding cache's second tier unless EMBEDDING_CACHE_PATH
+                names a file of its own
+        """
         self.api_key = AZURE_OPENAI_API_KEY
         self.endpoint = AZURE_OPENAI_ENDPOINT
         self.model = AZURE_OPENAI_MODEL
         self.api_version = AZURE_OPENAI_API_VERSION
         self.embedding_deployment = AZURE_OPENAI_EMBEDDING_DEPLOYMENT
+        self.scheduler = scheduler
+        max_retries = 0 if scheduler is not None else DEFAULT_MAX_RETRIES
       
         self.client = AzureOpenAI(
             api_key=self.api_key,
             api_version=self.api_version,
-            azure_endpoint=self.endpoint 
+            azure_endpoint=self.endpoint,
+            http_client=http_client,
+            max_retries=max_retries
         )
+        
+        self.async_client = None
+        if USE_ASYNC_CLIENTS:
+            self.async_client = AsyncAzureOpenAI(
+                api_key=self.api_key,
+                api_version=self.api_version,
+                azure_endpoint=self.endpoint,
+                http_client=async_http_client,
+                max_retries=max_retries
+            )
+        
+        self.embedding_cache = None
+        self._embedding_cache_file = None
+        if EMBEDDING_CACHE_ENABLED:
+            if EMBEDDING_CACHE_PATH:
+                self._embedding_cache_file = SqliteCacheBackend(EMBEDDING_CACHE_PATH)
+            self.embedding_cache = EmbeddingCache(EMBEDDING_CACHE_MAX_BYTES, self._embedding_cache_file or cache_backend)
+        
+        self.embedding_batcher = None
+        if EMBEDDING_BATCHING_ENABLED and self.async_client is not None:
+            self.embedding_batcher = EmbeddingBatcher(
+                self._request_embeddings_async,
+                max_batch_size=EMBEDDING_BATCH_MAX_SIZE,
+                max_wait_ms=EMBEDDING_BATCH_WAIT_MS
+            )
     
-    def generate_response(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 800) -> str:
+    def generate_response(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 800, model: Optional[str] = None,
+                          usage_out: Optional[Dict[str, int]] = None) -> str:
         """
         Generate a response using Azure OpenAI.
         
@@ -33,14 +134,24 @@ class OpenAIService:
             messages: List of message objects with role and content
             temperature: Controls randomness (0-1)
             max_tokens: Maximum number of tokens to generate
+            model: Deployment to use instead of the configured chat model
+            usage_out: Filled with the token usage the response reports
             
         Returns:
             The generated response text
+            
+        Raises:
+            UpstreamOverloaded: The deployment is throttling or the token budget is spent
+            UpstreamError: The completion failed otherwise
         """
+        reserved = 0
+        usage = None
         try:
             # If model isn't set, try to use a default model
-            model_name = self.model
+            model_name = model or self.model
             
+            if self.scheduler is not None:
+                reserved = self.scheduler.reserve_tokens_sync("openai", self._estimate_tokens(messages, max_tokens))
             response = self.client.chat.completions.create(
                 model=model_name,
                 messages=messages,
@@ -48,11 +159,139 @@ class OpenAIService:
                 max_tokens=max_tokens,
                 n=1
             )
-            return response.choices[0].message.content
+            usage = response.usage
+            record_token_usage(model_name, usage)
+            self._report_usage(usage, usage_out)
+            return _answer(response)
+        
+        except Exception as e:
+            raise _completion_failure(e)
+        finally:
+            self._settle_tokens(reserved, usage, max_tokens)
+    
+    async def generate_response_async(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 800, model: Optional[str] = None,
+                                      usage_out: Optional[Dict[str, int]] = None) -> str:
+        """
+        Generate a response using the async Azure OpenAI client.
+        
+        Args:
+            messages: List of message objects with role and content
+            temperature: Controls randomness (0-1)
+            max_tokens: Maximum number of tokens to generate
+            model: Deployment to use instead of the configured chat model
+            usage_out: Filled with the token usage the response reports
+            
+        Returns:
+            The generated response text
+            
+        Raises:
+            UpstreamOverloaded: The deployment is throttling or the token budget is spent
+            UpstreamError: The completion failed otherwise
+        """
+        if self.async_client is None:
+            return await asyncio.to_thread(self.generate_response, messages, temperature, max_tokens, model, usage_out)
+        
+        reserved = 0
+        usage = None
+        try:
+            model_name = model or self.model
+            if self.scheduler is not None:
+                reserved = await self.scheduler.reserve_tokens("openai", self._estimate_tokens(messages, max_tokens))
+            response = await self.async_client.chat.completions.create(
+                model=model_name,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                n=1
+            )
+            usage = response.usage
+            record_token_usage(model_name, usage)
+            self._report_usage(usage, usage_out)
+            return _answer(response)
         
         except Exception as e:
-            print(f"Error generating response: {str(e)}")
-            return f"I'm sorry, but I encountered an error generating a response. Error: {str(e)}"
+            raise _completion_failure(e)
+        finally:
+            self._settle_tokens(reserved, usage, max_tokens)
+    
+    async def generate_response_stream_async(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 800,
+                                             usage_out: Optional[Dict[str, int]] = None) -> AsyncIterator[str]:
+        """
+        Stream a response from Azure OpenAI, yielding content deltas as they arrive.
+        
+        Without the async client the whole response is generated in a worker
+        thread and yielded as a single chunk.
+        
+        Args:
+            messages: List of message objects with role and content
+            temperature: Controls randomness (0-1)
+            max_tokens: Maximum number of tokens to generate
+            usage_out: Filled with the token usage the response reports
+            
+        Yields:
+            Pieces of the generated response text
+            
+        Raises:
+            UpstreamOverloaded: The deployment is throttling or the token budget is spent
+            UpstreamError: The completion failed otherwise, possibly after
+                some text has been yielded
+        """
+        if self.async_client is None:
+            yield await asyncio.to_thread(self.generate_response, messages, temperature, max_tokens, None, usage_out)
+            return
+        
+        reserved = 0
+        usage = None
+        answered = False
+        try:
+            if self.scheduler is not None:
+                reserved = await self.scheduler.reserve_tokens("openai", self._estimate_tokens(messages, max_tokens))
+            stream = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                n=1,
+                stream=True,
+                # The last chunk then carries the token usage of the whole response
+                stream_options={"include_usage": True}
+            )
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                    record_token_usage(self.model, usage)
+                    self._report_usage(usage, usage_out)
+                # Azure sends a leading chunk with only content filter results
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    answered = True
+                    yield delta
+            if not answered:
+                raise UpstreamError("openai", "returned no answer")
+        except Exception as e:
+            raise _completion_failure(e)
+        finally:
+            self._settle_tokens(reserved, usage, max_tokens)
+    
+    @staticmethod
+    def _estimate_tokens(messages: List[Dict[str, str]], max_tokens: int) -> int:
+        """Tokens a completion counts against the quota: its prompt (about four characters per token) plus max_tokens."""
+        return sum(len(message.get("content") or "") for message in messages) // 4 + max_tokens
+    
+    @staticmethod
+    def _report_usage(usage, usage_out: Optional[Dict[str, int]]):
+        if usage_out is not None and usage is not None:
+            usage_out["completion_prompt_tokens"] = usage.prompt_tokens or 0
+            usage_out["cached_prompt_tokens"] = cached_prompt_tokens(usage)
+            usage_out["completion_tokens"] = usage.completion_tokens or 0
+    
+    def _settle_tokens(self, reserved: int, usage, max_tokens: int):
+        """Correct the reservation by the prompt's actual size; failed calls give it all back."""
+        if self.scheduler is not None and reserved:
+            used = usage.prompt_tokens + max_tokens if usage is not None else None
+            self.scheduler.settle_tokens("openai", reserved, used)
     
     def generate_embeddings(self, text: str) -> List[float]:
         """
@@ -64,17 +303,184 @@ class OpenAIService:
         Returns:
             The embedding vector
         """
+        cache_key = None
+        if self.embedding_cache is not None:
+            cache_key = EmbeddingCache.make_key(text, self.embedding_deployment)
+            cached = self.embedding_cache.get(cache_key)
+            if cached is not None:
+                return cached.tolist()
+        
         try:
             # Use the embedding model from config
-            print(f"Generating embeddings with model: {self.embedding_deployment}")
+            logger.debug("Generating embeddings with model: %s", self.embedding_deployment)
             
             response = self.client.embeddings.create(
                 model=self.embedding_deployment,
                 input=text
             )
+            record_token_usage(self.embedding_deployment, response.usage, embedding=True)
             
-            return response.data[0].embedding
+            embedding = response.data[0].embedding
+            if cache_key is not None:
+                self.embedding_cache.put(cache_key, embedding)
+            return embedding
         
         except Exception as e:
-            print(f"Error generating embeddings: {str(e)}")
-            return None
\ No newline at end of file
+            overloaded = _overload(e)
+            if overloaded is not None:
+                raise overloaded
+            logger.error("Error generating embeddings: %s", e)
+            return None
+    
+    def generate_embeddings_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        Generate embeddings for several texts with a single Azure OpenAI request.
+        
+        Cached texts are not sent again.
+        
+        Args:
+            texts: The texts to generate embeddings for
+            
+        Returns:
+            One embedding vector per input text, in input order
+        """
+        vectors, missing = self._lookup_cached_embeddings(texts)
+        if missing:
+            missing_texts = list(missing)
+            response = self.client.embeddings.create(
+                model=self.embedding_deployment,
+                input=missing_texts
+            )
+            self._fill_embeddings(vectors, missing, self._cache_embeddings(missing_texts, response))
+        return vectors
+    
+    async def generate_embeddings_batch_async(self, texts: List[str]) -> List[List[float]]:
+        """
+        Generate embeddings for several texts with a single async Azure OpenAI request.
+        
+        Cached texts are not sent again.
+        
+        Args:
+            texts: The texts to generate embeddings for
+            
+        Returns:
+            One embedding vector per input text, in input order
+        """
+        if self.async_client is None:
+            return await asyncio.to_thread(self.generate_embeddings_batch, texts)
+        
+        vectors, missing = await self._lookup_cached_embeddings_async(texts)
+        if missing:
+            missing_texts = list(missing)
+            self._fill_embeddings(vectors, missing, await self._request_embeddings_async(missing_texts))
+        return vectors
+    
+    async def _request_embeddings_async(self, texts: List[str]) -> List[List[float]]:
+        """Send one embeddings request for the texts and cache the resulting vectors."""
+        response = await self.async_client.embeddings.create(
+            model=self.embedding_deployment,
+            input=texts
+        )
+        embeddings = self._ordered_embeddings(texts, response)
+        if self.embedding_cache is not None:
+            await self.embedding_cache.put_many_async([
+                (EmbeddingCache.make_key(text, self.embedding_deployment), embedding)
+                for text, embedding in zip(texts, embeddings)
+            ])
+        return embeddings
+    
+    def _lookup_cached_embeddings(self, texts: List[str]):
+        """
+        Split a batch into cached vectors and texts that still need embedding.
+        
+        Returns:
+            A list of vectors (None where missing) and a mapping of each
+            missing text to the positions it occupies in the batch
+        """
+        vectors = [None] * len(texts)
+        missing: Dict[str, List[int]] = {}
+        for position, text in enumerate(texts):
+            if self.embedding_cache is not None:
+                cached = self.embedding_cache.get(EmbeddingCache.make_key(text, self.embedding_deployment))
+                if cached is not None:
+                    vectors[position] = cached.tolist()
+                    continue
+            missing.setdefault(text, []).append(position)
+        return vectors, missing
+    
+    async def _lookup_cached_embeddings_async(self, texts: List[str]):
+        """``_lookup_cached_embeddings`` with the cache backend read off the event loop."""
+        vectors = [None] * len(texts)
+        cached = [None] * len(texts)
+        if self.embedding_cache is not None:
+            cached = await self.embedding_cache.get_many_async([EmbeddingCache.make_key(text, self.embedding_deployment) for text in texts])
+        missing: Dict[str, List[int]] = {}
+        for position, (text, vector) in enumerate(zip(texts, cached)):
+            if vector is not None:
+                vectors[position] = vector.tolist()
+            else:
+                missing.setdefault(text, []).append(position)
+        return vectors, missing
+    
+    def _ordered_embeddings(self, texts: List[str], response) -> List[List[float]]:
+        """Order the vectors of an embeddings response like the request texts."""
+        record_token_usage(self.embedding_deployment, response.usage, embedding=True)
+        embeddings = [None] * len(texts)
+        for item in response.data:
+            embeddings[item.index] = item.embedding
+        return embeddings
+    
+    def _cache_embeddings(self, texts: List[str], response) -> List[List[float]]:
+        """Order the vectors of an embeddings response like the request texts and cache them."""
+        embeddings = self._ordered_embeddings(texts, response)
+        if self.embedding_cache is not None:
+            for text, embedding in zip(texts, embeddings):
+                self.embedding_cache.put(EmbeddingCache.make_key(text, self.embedding_deployment), embedding)
+        return embeddings
+    
+    def _fill_embeddings(self, vectors, missing, embeddings):
+        """Place freshly generated vectors at every batch position of their text."""
+        for text, embedding in zip(missing, embeddings):
+            for position in missing[text]:
+                vectors[position] = embedding
+    
+    async def generate_embeddings_async(self, text: str) -> List[float]:
+        """
+        Generate embeddings for the given text using the async Azure OpenAI client.
+        
+        Concurrent calls are coalesced into batched requests when the
+        embedding batcher is enabled.
+        
+        Args:
+            text: The text to generate embeddings for
+            
+        Returns:
+            The embedding vector
+        """
+        if self.async_client is None:
+            return await asyncio.to_thread(self.generate_embeddings, text)
+        
+        if self.embedding_cache is not None:
+            vectors, missing = await self._lookup_cached_embeddings_async([text])
+            if not missing:
+                return vectors[0]
+        
+        try:
+            if self.embedding_batcher is not None:
+                return await self.embedding_batcher.embed(text)
+            return (await self._request_embeddings_async([text]))[0]
+        
+        except Exception as e:
+            overloaded = _overload(e)
+            if overloaded is not None:
+                raise overloaded
+            logger.error("Error generating embeddings: %s", e)
+            return None
+    
+    async def close(self):
+        """Close the underlying HTTP connection pools."""
+        if self.async_client is not None:
+            await self.async_client.close()
+        self.client.close()
+        if self._embedding_cache_file is not None:
+            self._embedding_cache_file.close()
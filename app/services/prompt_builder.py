@@ -0,0 +1,134 @@
+import logging
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from app.services.context_builder import ContextResult
+from app.services.token_budget import HistoryManager, HistoryWindow, TokenCounter
+
+logger = logging.getLogger(__name__)
+
+# Line that separates a template's instructions from its context block
+SECTION_SEPARATOR = "\n---\n"
+TEMPLATE_FILE_PATTERN = re.compile(r"^v(\d+)\.txt$")
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """
+    A system prompt in two parts: the static instructions, and the block
+    that introduces the retrieved context (with a ``{context}`` placeholder).
+    Token counts of the static parts are taken once, when it is loaded.
+    """
+    name: str
+    version: int
+    instructions: str
+    context_template: str
+    instructions_tokens: int = 0
+    # Tokens of the context block without the context itself
+    context_overhead_tokens: int = 0
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}@v{self.version}"
+
+    @classmethod
+    def load(cls, path: str, name: str, version: int, counter: TokenCounter) -> "PromptTemplate":
+        """Read a template file: the instructions, a ``---`` line, then the context block."""
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        instructions, separator, context_template = text.partition(SECTION_SEPARATOR)
+        if not separator or "{context}" not in context_template:
+            raise ValueError(f"Prompt template {path} needs a '---' line followed by a block with {{context}}")
+        instructions = instructions.strip()
+        context_template = context_template.strip()
+        return cls(
+            name=name,
+            version=version,
+            instructions=instructions,
+            context_template=context_template,
+            instructions_tokens=counter.count(instructions),
+            context_overhead_tokens=counter.count(context_template.replace("{context}", "")),
+        )
+
+    def context_message(self, context: str) -> str:
+        return self.context_template.replace("{context}", context)
+
+
+class PromptBuilder:
+    """
+    Builds the messages of a completion from versioned prompt templates,
+    read once from ``<folder>/<name>/v<N>.txt``.
+
+    Messages are ordered from the least to the most changing: the
+    template's instructions, the rolling summary, the conversation history,
+    then the retrieved context and the new question. Azure OpenAI caches
+    prompt prefixes of 1024 tokens and more, so a follow-up turn reuses the
+    cached instructions and history of the turns before it; with the
+    context inside the first system message every turn would start
+    differently after a few hundred tokens.
+
+    The template is chosen per tenant or search index through ``overrides``
+    (key to "name" for the latest version, or "name@vN"), else ``default``.
+    """
+
+    def __init__(self, history_manager: HistoryManager, folder: str, default: str, overrides: Optional[Dict[str, str]] = None):
+        self.history_manager = history_manager
+        self.templates: Dict[str, PromptTemplate] = {}
+        self._latest: Dict[str, PromptTemplate] = {}
+        self._load(folder)
+        self.default = self.get(default)
+        self.overrides = {key: self.get(spec) for key, spec in (overrides or {}).items()}
+
+    def _load(self, folder: str):
+        for name in sorted(os.listdir(folder)):
+            directory = os.path.join(folder, name)
+            if not os.path.isdir(directory):
+                continue
+            for filename in sorted(os.listdir(directory)):
+                match = TEMPLATE_FILE_PATTERN.match(filename)
+                if match is None:
+                    continue
+                template = PromptTemplate.load(os.path.join(directory, filename), name, int(match.group(1)), self.history_manager.counter)
+                self.templates[template.key] = template
+                latest = self._latest.get(name)
+                if latest is None or template.version > latest.version:
+                    self._latest[name] = template
+        logger.info("Loaded %d prompt template(s) from %s", len(self.templates), folder)
+
+    def get(self, spec: str) -> PromptTemplate:
+        """A template by "name" (its latest version) or "name@vN"."""
+        template = self.templates.get(spec) if "@" in spec else self._latest.get(spec)
+        if template is None:
+            raise ValueError(f"Unknown prompt template {spec!r}, have {sorted(self.templates)}")
+        return template
+
+    def select(self, *keys: Optional[str]) -> PromptTemplate:
+        """The template of the first of ``keys`` (tenant, index, ...) with an override, else the default."""
+        for key in keys:
+            if key and key in self.overrides:
+                return self.overrides[key]
+        return self.default
+
+    def build(self, template: PromptTemplate, query: str, history: List[Dict[str, Any]], context: ContextResult,
+              summary: Optional[str] = None) -> HistoryWindow:
+        """
+        Build the messages for a completion, trimming the history to the token budget.
+
+        Args:
+            template: Template from ``select``
+            query: The new user prompt
+            history: Previous messages not covered by the summary, oldest first
+            context: The retrieved context
+            summary: Rolling summary of the older turns
+        """
+        return self.history_manager.fit(
+            template.instructions,
+            history,
+            query,
+            summary=summary,
+            context=template.context_message(context.text),
+            system_tokens=template.instructions_tokens,
+            context_tokens=template.context_overhead_tokens + context.context_tokens,
+        )
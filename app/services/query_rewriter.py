@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from app.services.cache_backend import CacheBackend
+from app.services.upstream_scheduler import UpstreamError, UpstreamOverloaded
+
+logger = logging.getLogger(__name__)
+
+WORD_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9'-]*")
+# Openings of questions that continue the previous one ("and for kids?")
+FOLLOW_UP_PATTERN = re.compile(r"^\s*(and|but|also|so|then|what about|how about|what if)\b", re.IGNORECASE)
+# Words that point back at something named earlier in the conversation
+REFERRING_WORDS = {
+    "it", "its", "it's", "that", "this", "those", "these", "they", "them", "their", "there",
+    "he", "she", "his", "her", "one", "ones", "same", "else",
+}
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "could", "do", "does", "for", "from",
+    "get", "go", "has", "have", "how", "i", "if", "in", "is", "me", "my", "of", "on", "or", "please",
+    "should", "so", "tell", "than", "the", "to", "was", "we", "what", "when", "where", "which", "who",
+    "why", "will", "with", "would", "you", "your", "about", "also", "any", "then", "much", "many",
+}
+# Questions with at most this many content words and nothing that names
+# their subject (a capitalized word or a code) are read as follow-ups
+MAX_ELLIPTIC_WORDS = 6
+# Terms carried over from the earlier questions by the heuristic
+MAX_CARRIED_TERMS = 12
+# Characters of each earlier answer shown to the rewriting model
+ANSWER_EXCERPT_CHARS = 300
+
+REWRITE_PROMPT = (
+    "Rewrite the user's last question as a standalone search query for the Margie's Travel "
+    "documents. Use the earlier turns only to resolve what the question refers to (trips, "
+    "hotels, codes, places); keep its meaning and wording otherwise. If it is already "
+    "standalone, repeat it unchanged. Reply with the query only."
+)
+
+
+def _content_words(text: str) -> List[str]:
+    return [word for word in WORD_PATTERN.findall(text) if word.lower() not in STOPWORDS and word.lower() not in REFERRING_WORDS]
+
+
+def is_follow_up(query: str) -> bool:
+    """Whether a question probably depends on the turns before it."""
+    if FOLLOW_UP_PATTERN.match(query):
+        return True
+    words = WORD_PATTERN.findall(query)
+    if any(word.lower() in REFERRING_WORDS for word in words):
+        return True
+    # A name or a code after the first word means the question says what it is about
+    if any((word[0].isupper() and word != "I") or any(ch.isdigit() for ch in word) for word in words[1:]):
+        return False
+    return len(_content_words(query)) <= MAX_ELLIPTIC_WORDS
+
+
+class QueryRewriter:
+    """
+    Turns a follow-up question into a standalone search query before it is
+    embedded, so "what about for children?" retrieves the chunks of the
+    trip the conversation is about.
+
+    Modes:
+
+    - "heuristic": questions that refer back (pronouns, "what about ...",
+      or a few words without a name) get the content words of the last
+      ``history_turns`` user questions appended, newest first
+    - "model": the last ``history_turns`` turns and the question are
+      condensed by a small chat deployment; if that fails the heuristic
+      is used instead
+
+    First-turn questions are never rewritten. Rewrites are cached per
+    conversation, turn and question (locally, and in the backend when it
+    is shared, read and written on a worker thread), so a retried turn
+    does not pay for it again.
+    """
+
+    def __init__(self, mode: str = "heuristic", openai_service=None, model: Optional[str] = None, max_tokens: int = 60,
+                 history_turns: int = 3, max_entries: int = 10000, backend: Optional[CacheBackend] = None,
+                 ttl_seconds: float = 86400):
+        if mode not in ("heuristic", "model"):
+            raise ValueError(f"Unknown query rewrite mode {mode!r}")
+        if mode == "model" and openai_service is None:
+            raise ValueError("The model query rewrite mode needs an OpenAI service")
+        self.mode = mode
+        self.openai_service = openai_service
+        self.model = model
+        self.max_tokens = max_tokens
+        self.history_turns = history_turns
+        self.max_entries = max_entries
+        self.backend = backend if backend is not None and backend.shared else None
+        self.ttl_seconds = ttl_seconds
+
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.first_turns = 0
+        self.rewrites = 0
+        self.unchanged = 0
+        self.cache_hits = 0
+        self.model_calls = 0
+        self.model_failures = 0
+
+    @staticmethod
+    def _key(conversation_id: str, turn: int, query: str) -> str:
+        digest = hashlib.sha1(query.encode("utf-8")).hexdigest()[:16]
+        return f"rewrite:{conversation_id}:{turn}:{digest}"
+
+    async def rewrite(self, conversation_id: str, turn: int, query: str, history: List[Dict[str, Any]]) -> str:
+        """
+        The search query for a question.
+
+        Args:
+            conversation_id: Conversation the question belongs to
+            turn: Messages in the conversation before the question
+            query: The user prompt
+            history: Loaded previous messages, oldest first
+
+        Returns:
+            The standalone query, or ``query`` itself
+        """
+        if not turn or not history:
+            with self._lock:
+                self.first_turns += 1
+            return query
+
+        key = self._key(conversation_id, turn, query)
+        cached = await self._get(key)
+        if cached is not None:
+            return cached
+
+        earlier = [message for message in history if message.get("role") in ("user", "assistant")][-2 * self.history_turns:]
+        rewritten = None
+        if self.mode == "model":
+            rewritten = await self._rewrite_with_model(query, earlier)
+        if rewritten is None:
+            rewritten = self._rewrite_with_heuristic(query, earlier)
+
+        with self._lock:
+            if rewritten == query:
+                self.unchanged += 1
+            else:
+                self.rewrites += 1
+        await self._set(key, rewritten)
+        if rewritten != query:
+            logger.debug("Rewrote %r as %r", query, rewritten)
+        return rewritten
+
+    def _rewrite_with_heuristic(self, query: str, earlier: List[Dict[str, Any]]) -> str:
+        if not is_follow_up(query):
+            return query
+        seen = {word.lower() for word in WORD_PATTERN.findall(query)}
+        carried = []
+        for message in reversed(earlier):
+            if message["role"] != "user":
+                continue
+            for word in _content_words(message.get("content") or ""):
+                if word.lower() not in seen:
+                    seen.add(word.lower())
+                    carried.append(word)
+        if not carried:
+            return query
+        return f"{query} {' '.join(carried[:MAX_CARRIED_TERMS])}"
+
+    async def _rewrite_with_model(self, query: str, earlier: List[Dict[str, Any]]) -> Optional[str]:
+        lines = []
+        for message in earlier:
+            content = message.get("content") or ""
+            if message["role"] == "assistant" and len(content) > ANSWER_EXCERPT_CHARS:
+                content = content[:ANSWER_EXCERPT_CHARS] + "..."
+            lines.append(f"{message['role']}: {content}")
+        with self._lock:
+            self.model_calls += 1
+        try:
+            rewritten = await self.openai_service.generate_response_async(
+                [
+                    {"role": "system", "content": REWRITE_PROMPT},
+                    {"role": "user", "content": "Earlier turns:\n" + "\n".join(lines) + f"\n\nLast question: {query}"},
+                ],
+                temperature=0,
+                max_tokens=self.max_tokens,
+                model=self.model,
+            )
+        except (UpstreamOverloaded, UpstreamError) as e:
+            # An optional stage; the heuristic answers instead of failing the turn
+            rewritten = None
+            logger.warning("Query rewrite skipped: %s", e)
+        rewritten = (rewritten or "").strip().strip('"')
+        if not rewritten:
+            with self._lock:
+                self.model_failures += 1
+            return None
+        return rewritten
+
+    async def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            rewritten = self._entries.get(key)
+            if rewritten is not None:
+                self._entries.move_to_end(key)
+                self.cache_hits += 1
+                return rewritten
+        if self.backend is None:
+            return None
+        value = await asyncio.to_thread(self.backend.get, key)
+        if value is None:
+            return None
+        rewritten = value.decode("utf-8")
+        with self._lock:
+            self.cache_hits += 1
+        await self._set(key, rewritten, shared=False)
+        return rewritten
+
+    async def _set(self, key: str, rewritten: str, shared: bool = True):
+        with self._lock:
+            self._entries[key] = rewritten
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if shared and self.backend is not None:
+            await asyncio.to_thread(self.backend.set, key, rewritten.encode("utf-8"), ttl_seconds=self.ttl_seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "first_turns": self.first_turns,
+                "rewrites": self.rewrites,
+                "unchanged": self.unchanged,
+                "cache_hits": self.cache_hits,
+                "model_calls": self.model_calls,
+                "model_failures": self.model_failures,
+                "entries": len(self._entries),
+            }
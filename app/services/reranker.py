@@ -0,0 +1,113 @@
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# "none" keeps the search service's order, "cosine" orders by relevance and
+# "mmr" trades relevance against similarity to the chunks already chosen
+RERANKERS = ("none", "cosine", "mmr")
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def _min_max(values: np.ndarray) -> np.ndarray:
+    span = values.max() - values.min()
+    if span <= 0:
+        return np.ones_like(values)
+    return (values - values.min()) / span
+
+
+def relevance_scores(query_vector: np.ndarray, doc_vectors: np.ndarray, search_scores: np.ndarray, search_weight: float) -> np.ndarray:
+    """
+    Blend cosine similarity to the query with the search service's own score.
+
+    Both are min-max scaled over the candidates first. Keeping part of the
+    search score lets keyword matches from hybrid queries (hotel names,
+    booking codes) survive re-ranking even when their vectors are not the
+    closest.
+    """
+    cosine = doc_vectors @ (query_vector / max(float(np.linalg.norm(query_vector)), 1e-12))
+    return (1 - search_weight) * _min_max(cosine) + search_weight * _min_max(search_scores)
+
+
+def mmr_select(relevance: np.ndarray, doc_vectors: np.ndarray, top: int, diversity_lambda: float) -> List[int]:
+    """
+    Maximal marginal relevance: repeatedly pick the candidate with the best
+    ``lambda * relevance - (1 - lambda) * max similarity to the picks so far``.
+
+    Args:
+        relevance: Relevance score per candidate
+        doc_vectors: Unit-normalized candidate vectors, one row each
+        top: Number of candidates to pick
+        diversity_lambda: 1.0 is pure relevance, lower values favor diversity
+
+    Returns:
+        Indices of the picked candidates in pick order
+    """
+    count = len(relevance)
+    similarity = doc_vectors @ doc_vectors.T
+    max_similarity = np.full(count, -np.inf)
+    available = np.ones(count, dtype=bool)
+    picked = []
+
+    for _ in range(min(top, count)):
+        if picked:
+            scores = diversity_lambda * relevance - (1 - diversity_lambda) * max_similarity
+        else:
+            scores = relevance.copy()
+        scores[~available] = -np.inf
+        index = int(np.argmax(scores))
+        picked.append(index)
+        available[index] = False
+        max_similarity = np.maximum(max_similarity, similarity[index])
+    return picked
+
+
+def rerank(
+    results: List[Dict[str, Any]],
+    query_embedding: Optional[List[float]],
+    top: int,
+    method: str = "mmr",
+    vector_field: str = "text_vector",
+    diversity_lambda: float = 0.7,
+    search_weight: float = 0.5,
+) -> List[Dict[str, Any]]:
+    """
+    Choose the final chunks from over-fetched search candidates.
+
+    Candidates without a returned vector (the field is not retrievable, or
+    no query embedding is available) keep the search service's order.
+    Vectors are removed from the returned results.
+
+    Args:
+        results: Search results in the service's order
+        query_embedding: Embedding of the query
+        top: Number of chunks to return
+        method: One of RERANKERS
+        vector_field: Result field holding the chunk vector
+        diversity_lambda: MMR trade-off between relevance and diversity
+        search_weight: Share of the search score in the relevance score
+
+    Returns:
+        The chosen results
+    """
+    if method not in RERANKERS:
+        raise ValueError(f"Unknown reranker {method!r}, expected one of {', '.join(RERANKERS)}")
+
+    order = list(range(min(top, len(results))))
+    vectors = [result.get(vector_field) for result in results]
+    if method != "none" and results and query_embedding is not None and all(vector is not None for vector in vectors):
+        doc_vectors = _normalize_rows(np.asarray(vectors, dtype=np.float32))
+        search_scores = np.asarray([result.get("@search.score") or 0.0 for result in results], dtype=np.float32)
+        relevance = relevance_scores(np.asarray(query_embedding, dtype=np.float32), doc_vectors, search_scores, search_weight)
+        if method == "mmr":
+            order = mmr_select(relevance, doc_vectors, top, diversity_lambda)
+        else:
+            order = [int(index) for index in np.argsort(-relevance, kind="stable")[:top]]
+
+    return [
+        {key: value for key, value in results[index].items() if key != vector_field}
+        for index in order
+    ]
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from azure.search.documents.models import VectorizedQuery
+
+from app.services.local_index import LocalVectorIndex
+
+logger = logging.getLogger(__name__)
+
+SELECT_FIELDS = ["title", "chunk", "parent_id"]
+
+
+class Retriever:
+    """
+    A retrieval backend behind SearchService.
+
+    ``search`` returns up to ``candidates`` results shaped like Azure AI
+    Search results (selected fields plus ``@search.score``), including the
+    chunk vectors when ``with_vectors`` is set. Errors are raised so the
+    caller can fail over.
+    """
+
+    name = "retriever"
+
+    def search(self, query_text: str, query_embedding: List[float], mode: str, candidates: int, with_vectors: bool) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def search_async(self, query_text: str, query_embedding: List[float], mode: str, candidates: int, with_vectors: bool) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self.search, query_text, query_embedding, mode, candidates, with_vectors)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name}
+
+
+class AzureSearchRetriever(Retriever):
+    """Vector or hybrid (keyword + vector) queries against the Azure AI Search index."""
+
+    name = "azure"
+
+    def __init__(self, search_client, async_search_client, vector_field: str):
+        self.search_client = search_client
+        self.async_search_client = async_search_client
+        self.vector_field = vector_field
+
+    def _search_arguments(self, query_text, query_embedding, mode, candidates, with_vectors):
+        """
+        Keyword arguments for SearchClient.search. Hybrid queries send the
+        query text alongside the vector query; the chunk vectors are only
+        selected when they are needed for re-ranking.
+        """
+        select = list(SELECT_FIELDS)
+        if with_vectors:
+            select.append(self.vector_field)
+        return {
+            "search_text": query_text if mode == "hybrid" else None,
+            "vector_queries": [VectorizedQuery(
+                vector=query_embedding,
+                k_nearest_neighbors=candidates,
+                fields=self.vector_field
+            )],
+            "select": select,
+            "top": candidates,
+        }
+
+    def search(self, query_text, query_embedding, mode, candidates, with_vectors):
+        return list(self.search_client.search(
+            **self._search_arguments(query_text, query_embedding, mode, candidates, with_vectors)
+        ))
+
+    async def search_async(self, query_text, query_embedding, mode, candidates, with_vectors):
+        if self.async_search_client is None:
+            return await super().search_async(query_text, query_embedding, mode, candidates, with_vectors)
+        results = await self.async_search_client.search(
+            **self._search_arguments(query_text, query_embedding, mode, candidates, with_vectors)
+        )
+        return [result async for result in results]
+
+
+class LocalIndexRetriever(Retriever):
+    """
+    Exact vector search over a local snapshot of the index.
+
+    The snapshot has no keyword index, so hybrid queries are answered with
+    their vector part only.
+    """
+
+    name = "local"
+
+    def __init__(self, index: LocalVectorIndex):
+        self.index = index
+
+    @classmethod
+    def from_path(cls, path: Optional[str]) -> Optional["LocalIndexRetriever"]:
+        """Load the snapshot at ``path``, or return None if there is none."""
+        if not path:
+            return None
+        try:
+            index = LocalVectorIndex(path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Local index snapshot unavailable at %s: %s", path, e)
+            return None
+        logger.info("Loaded local index snapshot with %d chunks from %s", len(index), path)
+        return cls(index)
+
+    def search(self, query_text, query_embedding, mode, candidates, with_vectors):
+        select = list(SELECT_FIELDS)
+        if with_vectors:
+            select.append(self.index.vector_field)
+        return self.index.search(query_embedding, candidates, select)
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.index.stats(), backend=self.name)
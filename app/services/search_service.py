@@ -1,60 +1,227 @@
+import asyncio
+from typing import Optional
+
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
-from azure.search.documents.models import VectorizedQuery
 from app.services.openai_service import OpenAIService
 import logging
 
+try:
+    from azure.search.documents.aio import SearchClient as AsyncSearchClient
+except ImportError:  # aiohttp is not installed, async calls fall back to a worker thread
+    AsyncSearchClient = None
+
 from app.config import (
     AZURE_SEARCH_SERVICE_ENDPOINT,
-    AZURE_SEARCH_INDEX_NAME, 
+    AZURE_SEARCH_INDEX_NAME,
     AZURE_SEARCH_API_KEY,
     VECTOR_FIELD_NAME,
+    RETRIEVAL_MODE,
+    RETRIEVAL_CANDIDATES,
+    RETRIEVAL_TOP,
+    RETRIEVAL_RERANKER,
+    RETRIEVAL_MMR_LAMBDA,
+    RETRIEVAL_SEARCH_SCORE_WEIGHT,
+    RETRIEVAL_BACKEND,
+    RETRIEVAL_FAILOVER,
+    LOCAL_INDEX_PATH,
+    USE_ASYNC_CLIENTS,
 )
+from app.services.reranker import rerank
+from app.services.retrievers import AzureSearchRetriever, LocalIndexRetriever
+from app.services.upstream_scheduler import overload_cause
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_MODES = ("vector", "hybrid")
 
 class SearchService:
-    def __init__(self):
-        """Initialize the search service with configuration from environment variables"""
+    def __init__(self, openai_service: Optional[OpenAIService] = None, transport=None, async_transport=None):
+        """
+        Initialize the search service with configuration from environment variables.
+        
+        Args:
+            openai_service: OpenAI service used to embed queries; shared with
+                the chat pipeline so both use one connection pool. A private
+                one is created if not given.
+            transport: Shared azure-core transport for the sync search client
+            async_transport: Shared azure-core transport for the async search client
+        """
         self.endpoint = AZURE_SEARCH_SERVICE_ENDPOINT
         self.key = AZURE_SEARCH_API_KEY
         self.index_name = AZURE_SEARCH_INDEX_NAME
         self.vector_field_name = VECTOR_FIELD_NAME
-        
+
         self.search_client = SearchClient(
             endpoint=self.endpoint,
             index_name=self.index_name,
-            credential=AzureKeyCredential(self.key)
+            credential=AzureKeyCredential(self.key),
+            **({"transport": transport} if transport is not None else {})
+        )
+
+        self.async_search_client = None
+        if USE_ASYNC_CLIENTS and AsyncSearchClient is not None:
+            self.async_search_client = AsyncSearchClient(
+                endpoint=self.endpoint,
+                index_name=self.index_name,
+                credential=AzureKeyCredential(self.key),
+                **({"transport": async_transport} if async_transport is not None else {})
+            )
+
+        self._owns_openai_service = openai_service is None
+        self.openai_service = openai_service if openai_service is not None else OpenAIService()
+
+        # RETRIEVAL_BACKEND picks the retriever that serves reads; with
+        # RETRIEVAL_FAILOVER the other one (if available) takes over when it fails
+        azure = AzureSearchRetriever(self.search_client, self.async_search_client, self.vector_field_name)
+        local = LocalIndexRetriever.from_path(LOCAL_INDEX_PATH)
+        if RETRIEVAL_BACKEND == "local" and local is not None:
+            self.retriever, self.fallback_retriever = local, azure
+        else:
+            self.retriever, self.fallback_retriever = azure, local
+        if not RETRIEVAL_FAILOVER:
+            self.fallback_retriever = None
+        self.failovers = 0
+
+    def embed_query(self, query_text):
+        """Embed a query with the (cached) embedding deployment."""
+        return self.openai_service.generate_embeddings(query_text)
+
+    async def embed_query_async(self, query_text):
+        """Embed a query with the (cached) embedding deployment using the async client."""
+        return await self.openai_service.generate_embeddings_async(query_text)
+
+    def _retrieval_options(self, mode=None, candidates=None, top=None, reranker=None):
+        """Fill in per-request retrieval options from the configured defaults."""
+        mode = mode or RETRIEVAL_MODE
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode {mode!r}, expected one of {', '.join(RETRIEVAL_MODES)}")
+        top = top or RETRIEVAL_TOP
+        candidates = max(candidates or RETRIEVAL_CANDIDATES, top)
+        return mode, candidates, top, reranker or RETRIEVAL_RERANKER
+
+    def _retrievers(self):
+        """The primary retriever, then the fallback once the primary has failed."""
+        yield self.retriever
+        if self.fallback_retriever is not None:
+            self.failovers += 1
+            logger.warning("Failing over to the %s retriever", self.fallback_retriever.name)
+            yield self.fallback_retriever
+
+    def _rerank(self, results, query_embedding, top, reranker):
+        return rerank(
+            results,
+            query_embedding,
+            top,
+            method=reranker,
+            vector_field=self.vector_field_name,
+            diversity_lambda=RETRIEVAL_MMR_LAMBDA,
+            search_weight=RETRIEVAL_SEARCH_SCORE_WEIGHT,
         )
 
-        self.openai_service = OpenAIService()
-    
-    def vector_search(self, query_text, top=3):
+    def search(self, query_text, query_embedding=None, mode=None, candidates=None, top=None, reranker=None):
+        """
+        Retrieve chunks for a query: fetch ``candidates`` results with a
+        vector or hybrid (keyword + vector) query, then re-rank them locally
+        and keep ``top``. If the retriever fails, the fallback retriever
+        (if configured) serves the query. If the last one to fail was
+        overloaded, UpstreamOverloaded is raised instead of returning no
+        results.
+
+        Args:
+            query_text: The query to search for
+            query_embedding: Precomputed embedding of query_text, if available
+            mode: "vector" or "hybrid" (default RETRIEVAL_MODE)
+            candidates: Number of results to fetch (default RETRIEVAL_CANDIDATES)
+            top: Number of results to return (default RETRIEVAL_TOP)
+            reranker: "none", "cosine" or "mmr" (default RETRIEVAL_RERANKER)
+
+        Returns:
+            List of search results
+        """
+        mode, candidates, top, reranker = self._retrieval_options(mode, candidates, top, reranker)
+        if query_embedding is None:
+            query_embedding = self.embed_query(query_text)
+
+        overloaded = None
+        for retriever in self._retrievers():
+            try:
+                results = retriever.search(query_text, query_embedding, mode, candidates, reranker != "none")
+                logger.debug("Successfully retrieved results from %s search", mode)
+                return self._rerank(results, query_embedding, top, reranker)
+            except Exception as e:
+                overloaded = overload_cause(e)
+                logger.warning("%s search error: %s", retriever.name, e)
+        if overloaded is not None:
+            raise overloaded
+        return []
+
+    async def search_async(self, query_text, query_embedding=None, mode=None, candidates=None, top=None, reranker=None):
+        """
+        Retrieve chunks for a query without blocking the event loop.
+
+        Arguments are the same as for search.
+
+        Returns:
+            List of search results
+        """
+        mode, candidates, top, reranker = self._retrieval_options(mode, candidates, top, reranker)
+        if query_embedding is None:
+            query_embedding = await self.embed_query_async(query_text)
+
+        overloaded = None
+        for retriever in self._retrievers():
+            try:
+                results = await retriever.search_async(query_text, query_embedding, mode, candidates, reranker != "none")
+                logger.debug("Successfully retrieved results from %s search", mode)
+                return self._rerank(results, query_embedding, top, reranker)
+            except Exception as e:
+                overloaded = overload_cause(e)
+                logger.warning("%s search error: %s", retriever.name, e)
+        if overloaded is not None:
+            raise overloaded
+        return []
+
+    def vector_search(self, query_text, top=RETRIEVAL_TOP, query_embedding=None):
         """
         Perform a vector search using Azure AI Search.
-        
+
         Args:
             query_text: The query to search for
             top: Number of results to return
-            
+            query_embedding: Precomputed embedding of query_text, if available
+
         Returns:
             List of search results
         """
-    
-        query_embedding = self.openai_service.generate_embeddings(query_text)
-        
-        vector_query = VectorizedQuery(
-            vector=query_embedding,
-            k_nearest_neighbors=top,
-            fields=self.vector_field_name
-        )
-        try:
-            results = self.search_client.search(
-                search_text=None,  
-                vector_queries=[vector_query],
-                select=["title", "chunk", "parent_id"],
-                top=top
-            )
-            print("Successfully retrieved results from vector search")
-            return list(results)
-        except Exception as e:
-            print(f"Vector search error: {str(e)}")
-            
\ No newline at end of file
+        return self.search(query_text, query_embedding, mode="vector", candidates=top, top=top, reranker="none")
+
+    async def vector_search_async(self, query_text, top=RETRIEVAL_TOP, query_embedding=None):
+        """
+        Perform a vector search using the async Azure AI Search client.
+
+        Args:
+            query_text: The query to search for
+            top: Number of results to return
+            query_embedding: Precomputed embedding of query_text, if available
+
+        Returns:
+            List of search results
+        """
+        return await self.search_async(query_text, query_embedding, mode="vector", candidates=top, top=top, reranker="none")
+
+    def stats(self):
+        """Retriever backends and failover count."""
+        return {
+            "retriever": self.retriever.stats(),
+            "fallback_retriever": self.fallback_retriever.stats() if self.fallback_retriever is not None else None,
+            "failovers": self.failovers,
+        }
+
+    async def close(self):
+        """Close the underlying HTTP connection pools."""
+        if self.async_search_client is not None:
+            await self.async_search_client.close()
+        self.search_client.close()
+        if self._owns_openai_service:
+            await self.openai_service.close()
@@ -0,0 +1,213 @@
+"""
+Hot-path instrumentation: stage spans, upstream usage and cache counters,
+exported as Prometheus metrics (and OpenTelemetry spans with OTEL_ENABLED).
+
+Recording is a histogram observation or counter increment per event.
+Counters the services already keep (cache hits, persistence, failovers)
+are read from their ``stats()`` when /metrics is scraped instead of being
+counted twice.
+"""
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from app.config import METRICS_ENABLED, OTEL_ENABLED
+
+try:
+    from opentelemetry import trace
+except ImportError:  # opentelemetry-api is optional
+    trace = None
+
+_tracer = trace.get_tracer("app.chat_pipeline") if OTEL_ENABLED and trace is not None else None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+REQUEST_UNIT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_duration_seconds",
+    "Duration of chat pipeline stages (history, embedding, search, prompt, completion, save, ...)",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "rag_http_request_duration_seconds",
+    "Duration of API requests by route template and status code",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+OPENAI_TOKENS = Counter(
+    "rag_openai_tokens",
+    "Tokens reported in Azure OpenAI usage, by deployment and kind (prompt, cached_prompt, completion, embedding)",
+    ["deployment", "kind"],
+)
+COSMOS_REQUEST_UNITS = Histogram(
+    "rag_cosmos_request_units",
+    "Request units charged per Cosmos DB response, by operation",
+    ["operation"],
+    buckets=REQUEST_UNIT_BUCKETS,
+)
+
+
+def observe_stage(stage: str, seconds: float):
+    if METRICS_ENABLED:
+        STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+@contextmanager
+def span(stage: str, **attributes: Any) -> Iterator[None]:
+    """Time a pipeline stage into the stage histogram (and an OpenTelemetry span)."""
+    start = time.perf_counter()
+    try:
+        if _tracer is None:
+            yield
+        else:
+            with _tracer.start_as_current_span(stage, attributes=attributes or None):
+                yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def record_token_usage(deployment: str, usage, embedding: bool = False):
+    """Count the tokens of an OpenAI response's ``usage`` (ignored when absent)."""
+    if usage is None or not METRICS_ENABLED:
+        return
+    if embedding:
+        OPENAI_TOKENS.labels(deployment, "embedding").inc(usage.prompt_tokens or 0)
+        return
+    OPENAI_TOKENS.labels(deployment, "prompt").inc(usage.prompt_tokens or 0)
+    OPENAI_TOKENS.labels(deployment, "completion").inc(usage.completion_tokens or 0)
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached:
+        OPENAI_TOKENS.labels(deployment, "cached_prompt").inc(cached)
+
+
+def record_request_units(operation: str, charge: float):
+    if METRICS_ENABLED:
+        COSMOS_REQUEST_UNITS.labels(operation).observe(charge)
+
+
+def _stats(service) -> Optional[Dict[str, Any]]:
+    stats = getattr(service, "stats", None)
+    return stats() if stats is not None else None
+
+
+class ServiceStatsCollector:
+    """
+    Exposes the counters kept by the services that are already built as
+    Prometheus metrics at scrape time, without building anything.
+    """
+
+    def __init__(self, container):
+        self.container = container
+
+    def collect(self):
+        lookups = CounterMetricFamily("rag_cache_lookups", "Cache lookups by cache and result", labels=["cache", "result"])
+        entries = GaugeMetricFamily("rag_cache_entries", "Entries held by each cache", labels=["cache"])
+
+        openai_service = self.container.built("openai_service")
+        embedding_cache = getattr(openai_service, "embedding_cache", None)
+        stats = _stats(embedding_cache)
+        if stats:
+            lookups.add_metric(["embedding", "hit"], stats["hits"])
+            lookups.add_metric(["embedding", "backend_hit"], stats["backend_hits"])
+            lookups.add_metric(["embedding", "miss"], stats["misses"])
+            entries.add_metric(["embedding"], stats["entries"])
+
+        stats = _stats(self.container.built("answer_cache"))
+        if stats:
+            lookups.add_metric(["answer", "hit"], stats["hits"])
+            lookups.add_metric(["answer", "miss"], stats["lookups"] - stats["hits"])
+            entries.add_metric(["answer"], stats["entries"])
+
+        cosmos_service = self.container.built("cosmos_service")
+        stats = _stats(getattr(cosmos_service, "conversation_cache", None))
+        if stats:
+            for result, key in (("hit", "hits"), ("revalidated", "revalidated"), ("stale", "stale"), ("miss", "misses")):
+                lookups.add_metric(["conversation", result], stats[key])
+            entries.add_metric(["conversation"], stats["entries"])
+
+        stats = _stats(getattr(cosmos_service, "user_registry", None))
+        if stats:
+            lookups.add_metric(["user_ids", "hit"], stats["cache_hits"])
+            lookups.add_metric(["user_ids", "miss"], stats["cache_misses"])
+            entries.add_metric(["user_ids"], stats["cached_pages"])
+
+        stats = _stats(self.container.built("chat_pipeline"))
+        rewrites = stats.get("query_rewrite") if stats else None
+        if rewrites:
+            lookups.add_metric(["query_rewrite", "hit"], rewrites["cache_hits"])
+            lookups.add_metric(["query_rewrite", "miss"], rewrites["rewrites"] + rewrites["unchanged"])
+            entries.add_metric(["query_rewrite"], rewrites["entries"])
+
+        yield lookups
+        yield entries
+
+        if stats and "persisted" in stats:
+            persisted = CounterMetricFamily("rag_conversation_saves", "Background conversation saves by result", labels=["result"])
+            persisted.add_metric(["saved"], stats["persisted"])
+            persisted.add_metric(["retried"], stats["persist_retries"])
+            persisted.add_metric(["failed"], stats["persist_failures"])
+            yield persisted
+
+        stats = _stats(getattr(cosmos_service, "write_buffer", None))
+        if stats:
+            documents = CounterMetricFamily("rag_write_behind_documents", "Conversations through the write-behind buffer by outcome", labels=["outcome"])
+            for outcome, key in (("submitted", "submitted"), ("coalesced", "coalesced"), ("written", "written"), ("retried", "retries"), ("dropped", "dropped")):
+                documents.add_metric([outcome], stats[key])
+            yield documents
+            yield GaugeMetricFamily("rag_write_behind_pending", "Conversations queued in the write-behind buffer", value=stats["pending"])
+            yield GaugeMetricFamily("rag_write_behind_pending_bytes", "Bytes of the conversations queued in the write-behind buffer", value=stats["pending_bytes"])
+
+        stats = _stats(self.container.built("search_service"))
+        if stats and "failovers" in stats:
+            failovers = CounterMetricFamily("rag_retrieval_failovers", "Searches served by the fallback retriever")
+            failovers.add_metric([], stats["failovers"])
+            yield failovers
+
+        scheduler = self.container.scheduler
+        if scheduler is not None:
+            calls = CounterMetricFamily("rag_upstream_calls", "Upstream HTTP calls by upstream and kind (sent, retried, throttled by the upstream, rejected)", labels=["upstream", "kind"])
+            limit = GaugeMetricFamily("rag_upstream_concurrency_limit", "Adaptive concurrency limit of each upstream", labels=["upstream"])
+            in_flight = GaugeMetricFamily("rag_upstream_in_flight", "Upstream calls in flight", labels=["upstream"])
+            for upstream, stats in scheduler.stats().items():
+                for kind in ("calls", "retries", "throttled", "rejected"):
+                    calls.add_metric([upstream, kind], stats[kind])
+                limit.add_metric([upstream], stats["limit"])
+                in_flight.add_metric([upstream], stats["in_flight"])
+            yield calls
+            yield limit
+            yield in_flight
+
+
+_service_collector: Optional[ServiceStatsCollector] = None
+
+
+def register_service_metrics(container):
+    """Export the container's service counters (once per process)."""
+    global _service_collector
+    if METRICS_ENABLED and _service_collector is None:
+        _service_collector = ServiceStatsCollector(container)
+        REGISTRY.register(_service_collector)
+
+
+def render_metrics():
+    """
+    The Prometheus text exposition of every metric, and its content type.
+
+    With several workers (PROMETHEUS_MULTIPROC_DIR set, see
+    app/commands/serve.py) the histograms and counters above are summed over
+    every worker's files; the service counters are those of the worker that
+    answered the scrape.
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        if _service_collector is not None:
+            registry.register(_service_collector)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
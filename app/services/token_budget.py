@@ -0,0 +1,133 @@
+import logging
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Per-message overhead of the chat format (role and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Tokens that prime the assistant reply
+REPLY_PRIMING_TOKENS = 2
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate for English text (about four characters per token)."""
+    return (len(text) + 3) // 4
+
+
+@lru_cache(maxsize=None)
+def load_encoding(encoding_name: str):
+    """
+    The tiktoken encoding, loaded once per process, or None if it can't be.
+
+    tiktoken downloads the encoding's BPE file on first use, so
+    ServiceContainer.build_all loads it at startup or warmup, before a
+    request needs it.
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        logger.warning("tiktoken encoding %s unavailable (%s), estimating token counts", encoding_name, e)
+        return None
+
+
+class TokenCounter:
+    """
+    Counts tokens with tiktoken when its encoding can be loaded, otherwise
+    with a pluggable estimator.
+    """
+
+    def __init__(self, encoding_name: str = "o200k_base", estimator: Callable[[str], int] = estimate_tokens):
+        self._count = estimator
+        self.backend = "estimate"
+        encoding = load_encoding(encoding_name)
+        if encoding is not None:
+            self._count = lambda text: len(encoding.encode(text, disallowed_special=()))
+            self.backend = "tiktoken"
+
+    def count(self, text: str) -> int:
+        return self._count(text or "")
+
+    def count_message(self, message: Dict[str, Any]) -> int:
+        return self.count(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+    def count_messages(self, messages: List[Dict[str, Any]]) -> int:
+        return sum(self.count_message(message) for message in messages) + REPLY_PRIMING_TOKENS
+
+
+@dataclass
+class HistoryWindow:
+    """Outcome of fitting conversation history into the prompt budget."""
+    messages: List[Dict[str, str]]
+    dropped: List[Dict[str, Any]] = field(default_factory=list)
+    prompt_tokens: int = 0
+    history_tokens: int = 0
+
+
+class HistoryManager:
+    """
+    Keeps the system prompt, retrieved context, rolling summary and the most
+    recent turns within a prompt token budget.
+
+    The system prompt, context and the new user message are always kept; history is
+    filled in from the newest message backwards until the budget is spent.
+    """
+
+    def __init__(self, counter: TokenCounter, max_prompt_tokens: int):
+        self.counter = counter
+        self.max_prompt_tokens = max_prompt_tokens
+
+    def fit(self, system_message: str, history: List[Dict[str, Any]], user_message: str, summary: Optional[str] = None,
+            context: Optional[str] = None, system_tokens: Optional[int] = None, context_tokens: Optional[int] = None) -> HistoryWindow:
+        """
+        Build the message list for a completion.
+
+        Args:
+            system_message: System prompt, sent first
+            history: Previous messages, oldest first
+            user_message: The new user prompt
+            summary: Rolling summary of turns older than ``history``
+            context: Retrieved context, sent as a system message right
+                before the user message so the messages ahead of it stay
+                the same from one turn to the next
+            system_tokens: Tokens of ``system_message``, if already known
+            context_tokens: Tokens of ``context``, if already known
+
+        Returns:
+            The messages to send and the history messages that did not fit
+        """
+        head = [{"role": "system", "content": system_message}]
+        used = (system_tokens if system_tokens is not None else self.counter.count(system_message)) + MESSAGE_OVERHEAD_TOKENS
+        if summary:
+            head.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+            used += self.counter.count_message(head[-1])
+        tail = []
+        if context:
+            tail.append({"role": "system", "content": context})
+            used += (context_tokens if context_tokens is not None else self.counter.count(context)) + MESSAGE_OVERHEAD_TOKENS
+        tail.append({"role": "user", "content": user_message})
+        used += self.counter.count_message(tail[-1]) + REPLY_PRIMING_TOKENS
+        remaining = self.max_prompt_tokens - used
+
+        kept = []
+        history_tokens = 0
+        candidates = [msg for msg in history if msg["role"] != "system"]
+        cutoff = len(candidates)
+        for index in range(len(candidates) - 1, -1, -1):
+            cost = self.counter.count_message(candidates[index])
+            if cost > remaining:
+                break
+            remaining -= cost
+            history_tokens += cost
+            cutoff = index
+            kept.append({"role": candidates[index]["role"], "content": candidates[index]["content"]})
+        kept.reverse()
+
+        return HistoryWindow(
+            messages=head + kept + tail,
+            dropped=candidates[:cutoff],
+            prompt_tokens=used + history_tokens,
+            history_tokens=history_tokens,
+        )
@@ -0,0 +1,542 @@
+"""
+Scheduling of the calls made to the upstreams (Azure OpenAI, Azure AI Search
+and Cosmos DB).
+
+Every HTTP request to an upstream goes through the transport of its shared
+connection pool, which HttpPools wraps with the upstream's lane of one
+process-wide UpstreamScheduler. A lane
+
+- caps the requests in flight with an AIMD limit: it grows by one every
+  ``limit`` successful calls and halves when the upstream throttles,
+- retries throttled and unavailable responses (408, 429, 5xx) with
+  full-jitter exponential backoff, never sooner than the upstream's
+  Retry-After,
+- gives up early rather than overrun the request's deadline.
+
+Completions additionally reserve their estimated tokens from the deployment's
+tokens-per-minute budget before they are sent. When a call can't be made in
+time the lane raises UpstreamOverloaded, which the API answers with 429 or
+503 and a Retry-After header instead of a made-up answer.
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, Mapping, Optional, Tuple, Type
+
+# Responses worth retrying: throttled, timed out or temporarily unavailable
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+# Responses that mean the upstream is saturated and the limit should shrink
+THROTTLED_STATUS_CODES = frozenset({429, 503})
+
+_deadline: ContextVar[Optional[float]] = ContextVar("upstream_deadline", default=None)
+
+
+class UpstreamOverloaded(Exception):
+    """
+    An upstream call could not be completed in time: the upstream kept
+    throttling, the local concurrency limit or token budget had no room, or
+    the request's deadline passed.
+
+    Attributes:
+        upstream: "openai", "search" or "cosmos"
+        status_code: 429 when throttled or over the token budget, 503 otherwise
+        retry_after: Seconds after which a retry may succeed, if known
+    """
+
+    def __init__(self, upstream: str, status_code: int, reason: str, retry_after: Optional[float] = None):
+        super().__init__(f"{upstream} {reason}")
+        self.upstream = upstream
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class UpstreamError(Exception):
+    """
+    An upstream call failed for a reason other than overload (an error
+    response, a content filter, a broken connection), so there is no
+    answer to give. The API answers 502; nothing of the turn is saved.
+
+    Attributes:
+        upstream: "openai", "search" or "cosmos"
+    """
+
+    status_code = 502
+
+    def __init__(self, upstream: str, reason: str):
+        super().__init__(f"{upstream} {reason}")
+        self.upstream = upstream
+        self.reason = reason
+
+
+def overload_cause(error: Optional[BaseException]) -> Optional[UpstreamOverloaded]:
+    """
+    The UpstreamOverloaded behind ``error``, if any. SDKs wrap exceptions
+    raised by their transport (the OpenAI SDK in APIConnectionError), so the
+    chain of causes is searched.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, UpstreamOverloaded):
+            return error
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def retry_after_seconds(headers: Mapping[str, str]) -> Optional[float]:
+    """
+    The delay an upstream asked for: ``retry-after-ms`` (Azure OpenAI),
+    ``x-ms-retry-after-ms`` (Cosmos DB) or ``Retry-After`` in seconds or as
+    an HTTP date.
+    """
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        value = headers.get(name)
+        if value:
+            try:
+                return max(0.0, float(value) / 1000)
+            except ValueError:
+                pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+@contextmanager
+def deadline(seconds: Optional[float]):
+    """
+    Bound the upstream calls made inside the block (in this task, and in the
+    tasks and worker threads it starts) to finish within ``seconds``.
+    Nested deadlines can only shorten the outer one. None or 0 leaves the
+    current deadline as it is.
+    """
+    current = _deadline.get()
+    if seconds:
+        expires = time.monotonic() + seconds
+        if current is not None:
+            expires = min(current, expires)
+    else:
+        expires = current
+    token = _deadline.set(expires)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_remaining() -> Optional[float]:
+    """Seconds until the current deadline (negative once it passed), or None without one."""
+    expires = _deadline.get()
+    return None if expires is None else expires - time.monotonic()
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit with additive increase and multiplicative decrease,
+    shared by threads and event loops alike (sync SDK clients run in worker
+    threads next to the async ones).
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, decrease_factor: float = 0.5, decrease_cooldown: float = 1.0):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.decrease_factor = decrease_factor
+        # One burst of 429s is one congestion signal, not one per response
+        self.decrease_cooldown = decrease_cooldown
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._async_waiters: Deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        self._sync_waiters = 0
+        self._last_decrease = float("-inf")
+
+    def _try_acquire_locked(self) -> bool:
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+
+    def _wake_locked(self):
+        free = int(self.limit) - self.in_flight
+        if free <= 0:
+            return
+        if self._sync_waiters:
+            self._condition.notify(free)
+        for _ in range(min(free, len(self._async_waiters))):
+            loop, future = self._async_waiters.popleft()
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def acquire_sync(self, timeout: Optional[float]) -> bool:
+        """Take a slot, waiting up to ``timeout`` seconds (None waits forever)."""
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while not self._try_acquire_locked():
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._sync_waiters += 1
+                try:
+                    self._condition.wait(remaining)
+                finally:
+                    self._sync_waiters -= 1
+            return True
+
+    async def acquire(self, timeout: Optional[float]) -> bool:
+        """Take a slot without blocking the event loop, waiting up to ``timeout`` seconds."""
+        loop = asyncio.get_running_loop()
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if self._try_acquire_locked():
+                    return True
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+            remaining = None if end is None else end - time.monotonic()
+            try:
+                if remaining is None or remaining > 0:
+                    await asyncio.wait({future}, timeout=remaining)
+            finally:
+                if not future.done():
+                    with self._lock:
+                        try:
+                            self._async_waiters.remove((loop, future))
+                        except ValueError:
+                            # Woken while giving up: pass the slot on
+                            self._wake_locked()
+            if end is not None and time.monotonic() >= end:
+                with self._lock:
+                    if self._try_acquire_locked():
+                        return True
+                return False
+
+    def release(self, outcome: str):
+        """
+        Give a slot back and adapt the limit to how the call went:
+        "success" grows it, "throttled" shrinks it, anything else (errors
+        that say nothing about the upstream's capacity) leaves it alone.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if outcome == "success":
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            elif outcome == "throttled":
+                now = time.monotonic()
+                if now - self._last_decrease >= self.decrease_cooldown:
+                    self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+                    self._last_decrease = now
+            self._wake_locked()
+
+
+class TokenBudget:
+    """
+    Tokens-per-minute budget of a deployment: a bucket that refills at the
+    quota's rate. Azure OpenAI enforces the quota over short windows (one
+    or ten seconds), so the bucket only holds ``burst_seconds`` worth of
+    tokens. Calls reserve their estimated tokens up front and settle with
+    what they were charged; a call larger than the bucket waits for a full
+    one and leaves it in debt.
+    """
+
+    def __init__(self, tokens_per_minute: int, burst_seconds: float = 1.0):
+        self.tokens_per_minute = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.capacity = self.rate * burst_seconds
+        self.available = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_take(self, tokens: int) -> float:
+        """Take ``tokens`` if there is room; otherwise the seconds until there will be."""
+        with self._lock:
+            now = time.monotonic()
+            self.available = min(self.capacity, self.available + (now - self._updated) * self.rate)
+            self._updated = now
+            needed = min(float(tokens), self.capacity)
+            if self.available >= needed:
+                self.available -= tokens
+                return 0.0
+            return (needed - self.available) / self.rate
+
+    def settle(self, reserved: int, used: Optional[int]):
+        """Correct a reservation by the tokens charged (all of it back if the call failed)."""
+        with self._lock:
+            self.available = min(self.capacity, self.available + reserved - (used or 0))
+
+
+class UpstreamLane:
+    """Limiter, token budget and counters of one upstream."""
+
+    def __init__(self, name: str, limiter: AdaptiveLimiter, budget: Optional[TokenBudget] = None):
+        self.name = name
+        self.limiter = limiter
+        self.budget = budget
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.rejected = 0
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "limit": round(self.limiter.limit, 2),
+            "max_limit": self.limiter.max_limit,
+            "in_flight": self.limiter.in_flight,
+            "calls": self.calls,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "rejected": self.rejected,
+        }
+        if self.budget is not None:
+            stats["tokens_per_minute"] = self.budget.tokens_per_minute
+            stats["tokens_available"] = int(self.budget.available)
+        return stats
+
+
+class UpstreamScheduler:
+    """
+    One lane per upstream; see the module docstring.
+
+    ``send``/``send_sync`` run one HTTP exchange with its retries. They take
+    the exchange as a callable plus accessors for the response's status and
+    headers and a way to discard a response that is retried, so the same
+    scheduling applies to httpx and azure-core transports.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: Mapping[str, int],
+        min_concurrency: int = 1,
+        max_attempts: int = 4,
+        retry_base_seconds: float = 0.5,
+        retry_max_seconds: float = 10.0,
+        queue_timeout_seconds: float = 10.0,
+        tokens_per_minute: Optional[Mapping[str, int]] = None,
+    ):
+        self.max_attempts = max(1, max_attempts)
+        self.retry_base = retry_base_seconds
+        self.retry_max = retry_max_seconds
+        self.queue_timeout = queue_timeout_seconds
+        self.lanes: Dict[str, UpstreamLane] = {}
+        for name, limit in max_concurrency.items():
+            tpm = (tokens_per_minute or {}).get(name) or 0
+            self.lanes[name] = UpstreamLane(
+                name,
+                AdaptiveLimiter(limit, min_concurrency),
+                TokenBudget(tpm) if tpm > 0 else None
+            )
+
+    def lane(self, upstream: str) -> UpstreamLane:
+        return self.lanes[upstream]
+
+    def _wait_limit(self, upstream: str) -> float:
+        """How long a call may wait for a slot or tokens: the queue timeout, or less before a deadline."""
+        remaining = time_remaining()
+        if remaining is None:
+            return self.queue_timeout
+        if remaining <= 0:
+            raise UpstreamOverloaded(upstream, 503, "call skipped, the request deadline has passed")
+        return min(self.queue_timeout, remaining)
+
+    def backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        """Full-jitter exponential backoff, but never sooner than the upstream's Retry-After."""
+        delay = random.uniform(0, min(self.retry_max, self.retry_base * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            # Spread the callers that were all told the same Retry-After
+            delay = retry_after + random.uniform(0, self.retry_base)
+        return delay
+
+    def _outcome(self, status: int, headers: Mapping[str, str]) -> str:
+        """
+        "throttled" for 429/503, or another retryable status with a
+        Retry-After; "error" for the other retryable statuses.
+        """
+        if status in THROTTLED_STATUS_CODES:
+            return "throttled"
+        if status in RETRYABLE_STATUS_CODES:
+            return "throttled" if retry_after_seconds(headers) is not None else "error"
+        return "success"
+
+    def _retry_delay(self, lane: UpstreamLane, attempt: int, retry_after: Optional[float]) -> Optional[float]:
+        """
+        The backoff before the next attempt, or None when there is no
+        attempt left or it would start past the deadline.
+        """
+        if attempt >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt, retry_after)
+        remaining = time_remaining()
+        if remaining is not None and delay >= remaining:
+            return None
+        lane.retries += 1
+        return delay
+
+    def _overloaded(self, lane: UpstreamLane, status: int, retry_after: Optional[float]) -> UpstreamOverloaded:
+        lane.rejected += 1
+        return UpstreamOverloaded(
+            lane.name,
+            429 if status == 429 else 503,
+            f"still answered {status} after retries",
+            retry_after or self.retry_base
+        )
+
+    async def send(
+        self,
+        upstream: str,
+        exchange: Callable[[], Awaitable[Any]],
+        status_of: Callable[[Any], int],
+        headers_of: Callable[[Any], Mapping[str, str]],
+        discard: Callable[[Any], Awaitable[None]],
+        retry_errors: Tuple[Type[BaseException], ...] = (),
+    ) -> Any:
+        """
+        Run ``exchange`` (one HTTP request) within the upstream's limit,
+        retrying retryable responses and the ``retry_errors`` exceptions
+        (connection failures the SDK would otherwise have retried).
+        """
+        lane = self.lane(upstream)
+        attempt = 0
+        while True:
+            attempt += 1
+            if not await lane.limiter.acquire(self._wait_limit(upstream)):
+                lane.rejected += 1
+                raise UpstreamOverloaded(upstream, 503, "is at its concurrency limit", self.retry_base)
+            lane.calls += 1
+            outcome = "error"
+            response = None
+            try:
+                remaining = time_remaining()
+                try:
+                    response = await asyncio.wait_for(exchange(), remaining) if remaining is not None else await exchange()
+                except asyncio.TimeoutError:
+                    # The caller's deadline, not the upstream, cut the call
+                    # short, so the outcome stays neutral for the limit
+                    lane.rejected += 1
+                    raise UpstreamOverloaded(upstream, 503, "did not answer before the request deadline") from None
+                except retry_errors:
+                    delay = self._retry_delay(lane, attempt, None)
+                    if delay is None:
+                        raise
+                else:
+                    status = status_of(response)
+                    outcome = self._outcome(status, headers_of(response))
+            finally:
+                lane.limiter.release(outcome)
+
+            if response is not None:
+                if status not in RETRYABLE_STATUS_CODES:
+                    return response
+                if outcome == "throttled":
+                    lane.throttled += 1
+                retry_after = retry_after_seconds(headers_of(response))
+                delay = self._retry_delay(lane, attempt, retry_after)
+                await discard(response)
+                if delay is None:
+                    raise self._overloaded(lane, status, retry_after)
+            await asyncio.sleep(delay)
+
+    def send_sync(
+        self,
+        upstream: str,
+        exchange: Callable[[], Any],
+        status_of: Callable[[Any], int],
+        headers_of: Callable[[Any], Mapping[str, str]],
+        discard: Callable[[Any], None],
+        retry_errors: Tuple[Type[BaseException], ...] = (),
+    ) -> Any:
+        """Blocking ``send`` for the sync clients (the deadline is checked between attempts)."""
+        lane = self.lane(upstream)
+        attempt = 0
+        while True:
+            attempt += 1
+            if not lane.limiter.acquire_sync(self._wait_limit(upstream)):
+                lane.rejected += 1
+                raise UpstreamOverloaded(upstream, 503, "is at its concurrency limit", self.retry_base)
+            lane.calls += 1
+            outcome = "error"
+            response = None
+            try:
+                try:
+                    response = exchange()
+                except retry_errors:
+                    delay = self._retry_delay(lane, attempt, None)
+                    if delay is None:
+                        raise
+                else:
+                    status = status_of(response)
+                    outcome = self._outcome(status, headers_of(response))
+            finally:
+                lane.limiter.release(outcome)
+
+            if response is not None:
+                if status not in RETRYABLE_STATUS_CODES:
+                    return response
+                if outcome == "throttled":
+                    lane.throttled += 1
+                retry_after = retry_after_seconds(headers_of(response))
+                delay = self._retry_delay(lane, attempt, retry_after)
+                discard(response)
+                if delay is None:
+                    raise self._overloaded(lane, status, retry_after)
+            time.sleep(delay)
+
+    def _budget_wait(self, upstream: str, tokens: int) -> Tuple[Optional[TokenBudget], float]:
+        lane = self.lane(upstream)
+        if lane.budget is None or tokens <= 0:
+            return None, 0.0
+        wait = lane.budget.try_take(tokens)
+        if wait and wait > self._wait_limit(upstream):
+            lane.rejected += 1
+            raise UpstreamOverloaded(upstream, 429, "is over its tokens-per-minute budget", wait)
+        return lane.budget, wait
+
+    async def reserve_tokens(self, upstream: str, tokens: int) -> int:
+        """
+        Take ``tokens`` from the upstream's budget, waiting for them to
+        refill if needed. Returns the tokens reserved, to be passed to
+        ``settle_tokens`` (0 when the upstream has no budget).
+        """
+        while True:
+            budget, wait = self._budget_wait(upstream, tokens)
+            if budget is None:
+                return 0
+            if not wait:
+                return tokens
+            await asyncio.sleep(wait)
+
+    def reserve_tokens_sync(self, upstream: str, tokens: int) -> int:
+        while True:
+            budget, wait = self._budget_wait(upstream, tokens)
+            if budget is None:
+                return 0
+            if not wait:
+                return tokens
+            time.sleep(wait)
+
+    def settle_tokens(self, upstream: str, reserved: int, used: Optional[int]):
+        """Correct a reservation by the tokens the call counted against the quota (None if it failed)."""
+        budget = self.lane(upstream).budget
+        if budget is not None and reserved:
+            budget.settle(reserved, used)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: lane.stats() for name, lane in self.lanes.items()}
@@ -0,0 +1,231 @@
+import azure.cosmos.exceptions as exceptions
+from azure.cosmos.partition_key import PartitionKey
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# All registry documents share one logical partition so that listing and
+# prefix search are single-partition queries ordered by id.
+REGISTRY_PARTITION = "users"
+
+USER_IDS_QUERY = "SELECT c.id FROM c WHERE STARTSWITH(c.id, @prefix) ORDER BY c.id"
+DISTINCT_USER_IDS_QUERY = "SELECT DISTINCT c.user_id FROM c"
+
+# Listing pages kept in the TTL cache
+MAX_CACHED_PAGES = 256
+
+
+class UserRegistry:
+    """
+    Registry of user ids, one small document per user in its own container.
+
+    Users are registered the first time a conversation of theirs is saved,
+    so listing costs depend on the number of users returned instead of the
+    number of conversations. Listing pages are served from a TTL cache that
+    is cleared whenever a new user is registered by this process.
+    """
+
+    def __init__(self, database, container_name: str, cache_ttl_seconds: float, async_database=None):
+        self.container_name = container_name
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self.container = database.get_container_client(container_name)
+        self.async_container = None
+        if async_database is not None:
+            self.async_container = async_database.get_container_client(container_name)
+
+        self._known_users = set()
+        self._pages: "OrderedDict[Tuple[str, int, Optional[str]], Tuple[Tuple[List[str], Optional[str]], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.registered = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def bootstrap(self, database) -> bool:
+        """
+        Create the registry container if it doesn't exist.
+
+        Returns:
+            True if the container was created (and needs a backfill)
+        """
+        try:
+            database.create_container(
+                id=self.container_name,
+                partition_key=PartitionKey(path="/registry")
+            )
+            return True
+        except exceptions.CosmosResourceExistsError:
+            return False
+
+    @staticmethod
+    def _document(user_id: str) -> Dict[str, Any]:
+        return {
+            "id": user_id,
+            "registry": REGISTRY_PARTITION,
+            "created_at": datetime.utcnow().isoformat(),
+        }
+
+    def _should_register(self, user_id: str) -> bool:
+        with self._lock:
+            return user_id not in self._known_users
+
+    def _registered(self, user_id: str, created: bool):
+        with self._lock:
+            self._known_users.add(user_id)
+            if created:
+                self.registered += 1
+                self._pages.clear()
+
+    def register(self, user_id: str):
+        """
+        Add a user to the registry if this process hasn't seen them yet.
+
+        Args:
+            user_id: The ID of the user
+        """
+        user_id = str(user_id).strip()
+        if not user_id or not self._should_register(user_id):
+            return
+        try:
+            self.container.create_item(body=self._document(user_id))
+            self._registered(user_id, True)
+        except exceptions.CosmosResourceExistsError:
+            self._registered(user_id, False)
+        except exceptions.CosmosHttpResponseError as e:
+            logger.warning("Error registering user %s: %s", user_id, e)
+
+    async def register_async(self, user_id: str):
+        """
+        Add a user to the registry using the async client.
+
+        Args:
+            user_id: The ID of the user
+        """
+        if self.async_container is None:
+            self.register(user_id)
+            return
+        user_id = str(user_id).strip()
+        if not user_id or not self._should_register(user_id):
+            return
+        try:
+            await self.async_container.create_item(body=self._document(user_id))
+            self._registered(user_id, True)
+        except exceptions.CosmosResourceExistsError:
+            self._registered(user_id, False)
+        except exceptions.CosmosHttpResponseError as e:
+            logger.warning("Error registering user %s: %s", user_id, e)
+
+    def _cached_page(self, key) -> Optional[Tuple[List[str], Optional[str]]]:
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is not None and time.monotonic() - entry[1] < self.cache_ttl_seconds:
+                self._pages.move_to_end(key)
+                self.cache_hits += 1
+                return entry[0]
+            self.cache_misses += 1
+            return None
+
+    def _cache_page(self, key, page: Tuple[List[str], Optional[str]]):
+        with self._lock:
+            self._pages[key] = (page, time.monotonic())
+            self._pages.move_to_end(key)
+            while len(self._pages) > MAX_CACHED_PAGES:
+                self._pages.popitem(last=False)
+
+    def list_user_ids(self, prefix: str = "", page_size: int = 100, continuation: Optional[str] = None) -> Tuple[List[str], Optional[str]]:
+        """
+        Retrieve one page of user ids in ascending order.
+
+        Args:
+            prefix: Only return user ids starting with this prefix
+            page_size: Maximum number of user ids in the page
+            continuation: Continuation token returned with the previous page
+
+        Returns:
+            The user ids and the continuation token of the next page, or None
+            on the last page
+        """
+        key = (prefix, page_size, continuation)
+        page = self._cached_page(key)
+        if page is not None:
+            return page
+
+        pager = self.container.query_items(
+            query=USER_IDS_QUERY,
+            parameters=[{"name": "@prefix", "value": prefix}],
+            partition_key=REGISTRY_PARTITION,
+            max_item_count=page_size
+        ).by_page(continuation)
+        items = next(pager, None)
+        page = ([item["id"] for item in items] if items is not None else [], pager.continuation_token)
+        self._cache_page(key, page)
+        return page
+
+    async def list_user_ids_async(self, prefix: str = "", page_size: int = 100, continuation: Optional[str] = None) -> Tuple[List[str], Optional[str]]:
+        """
+        Retrieve one page of user ids using the async client.
+
+        Args:
+            prefix: Only return user ids starting with this prefix
+            page_size: Maximum number of user ids in the page
+            continuation: Continuation token returned with the previous page
+
+        Returns:
+            The user ids and the continuation token of the next page
+        """
+        if self.async_container is None:
+            return self.list_user_ids(prefix, page_size, continuation)
+
+        key = (prefix, page_size, continuation)
+        page = self._cached_page(key)
+        if page is not None:
+            return page
+
+        pager = self.async_container.query_items(
+            query=USER_IDS_QUERY,
+            parameters=[{"name": "@prefix", "value": prefix}],
+            partition_key=REGISTRY_PARTITION,
+            max_item_count=page_size
+        ).by_page(continuation)
+        user_ids = []
+        async for items in pager:
+            user_ids = [item["id"] async for item in items]
+            break
+        page = (user_ids, pager.continuation_token)
+        self._cache_page(key, page)
+        return page
+
+    def backfill(self, conversations_container) -> int:
+        """
+        Register every user that already has conversations. This runs the
+        cross-partition DISTINCT query once, when the registry is bootstrapped.
+
+        Args:
+            conversations_container: The container holding the conversations
+
+        Returns:
+            The number of users registered
+        """
+        items = conversations_container.query_items(
+            query=DISTINCT_USER_IDS_QUERY,
+            enable_cross_partition_query=True
+        )
+        before = self.registered
+        for item in items:
+            if item.get("user_id"):
+                self.register(item["user_id"])
+        return self.registered - before
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "registered": self.registered,
+            "known_users": len(self._known_users),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cached_pages": len(self._pages),
+        }
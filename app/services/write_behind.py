@@ -0,0 +1,374 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.services.upstream_scheduler import overload_cause
+
+try:
+    import fcntl
+except ImportError:  # Windows: spill files can't be locked, so run one process per spill folder
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SPILL_PREFIX = "write-behind-"
+RETRY_MAX_SECONDS = 30.0
+
+
+def _encoded(document: Dict[str, Any]) -> Tuple[str, int]:
+    """A document as one JSON line and its size in UTF-8 bytes."""
+    line = json.dumps(document, separators=(",", ":"), default=str)
+    return line, len(line.encode("utf-8"))
+
+
+@dataclass
+class _Entry:
+    document: Dict[str, Any]
+    partition: str
+    size: int
+    version: int
+    # Monotonic time of the oldest write not yet flushed, and of the latest one
+    queued_at: float
+    updated_at: float
+    attempts: int = 0
+    retry_at: float = 0.0
+    flushing: bool = False
+
+
+class WriteBehindBuffer:
+    """
+    Write-behind buffer for documents that are always written whole, keyed
+    by ``id`` and partitioned by ``partition_key`` (conversations by user).
+
+    ``submit`` returns immediately. A newer version of a document that is
+    still queued replaces it, so several quick turns of a conversation become
+    one write. A background task flushes the queued documents, grouped by
+    partition, in batches of up to ``max_batch_size`` once that many are due
+    or the oldest has waited ``flush_interval_seconds``; ``flush_partition``
+    writes one batch. Failed batches are retried with exponential backoff,
+    indefinitely while the upstream is overloaded, otherwise up to
+    ``max_attempts`` times.
+
+    The queue is bounded by the size of its documents' JSON in UTF-8 bytes:
+    once it holds ``max_pending_bytes``, ``full`` is set and callers should
+    stop accepting work (the chat pipeline answers 503 with Retry-After)
+    until flushes catch up. Documents already submitted are never refused.
+
+    With a ``spill_dir``, every submitted document is appended to a journal
+    file before ``submit`` returns and the file is emptied once everything
+    in it has been written, so documents queued when the process stops or
+    crashes are recovered on the next start. Each process writes its own
+    file and keeps it locked; a starting process takes over the files of
+    processes that are gone. Recovered documents are written once the
+    flush task starts, on the first ``submit`` or ``get`` on the event loop.
+    """
+
+    def __init__(
+        self,
+        flush_partition: Callable[[str, List[Dict[str, Any]]], Awaitable[Any]],
+        partition_key: str = "user_id",
+        max_batch_size: int = 100,
+        flush_interval_seconds: float = 0.5,
+        max_pending_bytes: int = 64 * 1024 * 1024,
+        flush_concurrency: int = 8,
+        max_attempts: int = 4,
+        retry_backoff_seconds: float = 0.5,
+        spill_dir: Optional[str] = None,
+        fsync: bool = False,
+    ):
+        self.flush_partition = flush_partition
+        self.partition_key = partition_key
+        self.max_batch_size = max_batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_pending_bytes = max_pending_bytes
+        self.flush_concurrency = flush_concurrency
+        self.max_attempts = max_attempts
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.fsync = fsync
+
+        self._entries: Dict[str, _Entry] = {}
+        self._bytes = 0
+        self._version = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.written = 0
+        self.batches = 0
+        self.retries = 0
+        self.dropped = 0
+        self.recovered = 0
+
+        self.spill_path: Optional[str] = None
+        self._spill = None
+        self._spill_bytes = 0
+        if spill_dir:
+            self._open_spill(spill_dir)
+
+    @property
+    def full(self) -> bool:
+        """Whether the queue holds ``max_pending_bytes`` or more."""
+        return self._bytes >= self.max_pending_bytes
+
+    def get(self, document_id: str) -> Optional[Dict[str, Any]]:
+        """A copy of the queued (not yet written) version of a document, or None."""
+        self._start()
+        entry = self._entries.get(document_id)
+        if entry is None:
+            return None
+        document = dict(entry.document)
+        if isinstance(document.get("messages"), list):
+            document["messages"] = list(document["messages"])
+        return document
+
+    def pending_in(self, partition: str) -> List[Dict[str, Any]]:
+        """The queued documents of one partition, most recently submitted first."""
+        entries = sorted(
+            (entry for entry in self._entries.values() if entry.partition == partition),
+            key=lambda entry: entry.version,
+            reverse=True,
+        )
+        return [self.get(entry.document["id"]) for entry in entries]
+
+    def submit(self, document: Dict[str, Any]):
+        """Queue a document for writing, replacing a queued older version of it. Call it on the event loop."""
+        if self._closed:
+            raise RuntimeError("WriteBehindBuffer is closed")
+        line, size = _encoded(document)
+        if self._spill is not None:
+            self._append(line, size)
+
+        now = time.monotonic()
+        self._version += 1
+        entry = self._entries.get(document["id"])
+        if entry is None:
+            self._entries[document["id"]] = _Entry(document, str(document[self.partition_key]), size, self._version, now, now)
+        else:
+            self._bytes -= entry.size
+            entry.document = document
+            entry.size = size
+            entry.version = self._version
+            entry.updated_at = now
+            self.coalesced += 1
+        self._bytes += size
+        self.submitted += 1
+        self._start()
+        if entry is None or len(self._entries) >= self.max_batch_size:
+            # A new entry may be due before whatever the flush task is waiting for
+            self._wake.set()
+
+    def _start(self):
+        """Start the flush task on the running event loop, if there is one and it isn't running yet."""
+        if self._closed or (self._task is not None and not self._task.done()):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._task = loop.create_task(self._run())
+
+    def _next_delay(self) -> Optional[float]:
+        """Seconds until the next flush is due, or None when nothing is queued."""
+        now = time.monotonic()
+        waiting = [entry for entry in self._entries.values() if not entry.flushing]
+        if not waiting:
+            return None
+        if sum(1 for entry in waiting if entry.retry_at <= now) >= self.max_batch_size:
+            return 0.0
+        due = min(max(entry.queued_at + self.flush_interval_seconds, entry.retry_at) for entry in waiting)
+        return max(due - now, 0.0)
+
+    async def _run(self):
+        while not self._closed:
+            delay = self._next_delay()
+            if delay is None or delay > 0:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.flush()
+
+    async def flush(self, force: bool = False):
+        """Write every queued document that is due (every one with ``force``)."""
+        now = time.monotonic()
+        ready: Dict[str, List[_Entry]] = defaultdict(list)
+        for entry in self._entries.values():
+            if entry.flushing:
+                continue
+            if force or (entry.retry_at <= now and (
+                    entry.queued_at + self.flush_interval_seconds <= now or len(self._entries) >= self.max_batch_size)):
+                ready[entry.partition].append(entry)
+
+        semaphore = asyncio.Semaphore(self.flush_concurrency)
+
+        async def flush_batch(partition: str, batch: List[_Entry]):
+            async with semaphore:
+                await self._flush_batch(partition, batch)
+
+        await asyncio.gather(*(
+            flush_batch(partition, entries[start:start + self.max_batch_size])
+            for partition, entries in ready.items()
+            for start in range(0, len(entries), self.max_batch_size)
+        ))
+        self._truncate_spill()
+
+    async def _flush_batch(self, partition: str, batch: List[_Entry]):
+        versions = [(entry, entry.version) for entry in batch]
+        for entry in batch:
+            entry.flushing = True
+        try:
+            await self.flush_partition(partition, [entry.document for entry in batch])
+        except Exception as e:
+            overloaded = overload_cause(e) is not None
+            for entry, _ in versions:
+                entry.flushing = False
+                entry.attempts += 1
+                if not overloaded and entry.attempts >= self.max_attempts:
+                    self._remove(entry)
+                    self.dropped += 1
+                    logger.error("Giving up writing %s after %d attempts: %s", entry.document["id"], entry.attempts, e)
+                    continue
+                self.retries += 1
+                entry.retry_at = time.monotonic() + min(self.retry_backoff_seconds * 2 ** (entry.attempts - 1), RETRY_MAX_SECONDS)
+            logger.warning("Error writing %d buffered document(s) of partition %s: %s", len(batch), partition, e)
+            return
+
+        self.batches += 1
+        self.written += len(batch)
+        for entry, version in versions:
+            entry.flushing = False
+            if entry.version == version:
+                self._remove(entry)
+            else:
+                # Resubmitted while being written: the newer version is still queued
+                entry.queued_at = entry.updated_at
+                entry.attempts = 0
+
+    def _remove(self, entry: _Entry):
+        if self._entries.get(entry.document["id"]) is entry:
+            del self._entries[entry.document["id"]]
+            self._bytes -= entry.size
+
+    def _open_spill(self, spill_dir: str):
+        os.makedirs(spill_dir, exist_ok=True)
+        self.spill_path = os.path.join(spill_dir, f"{SPILL_PREFIX}{os.getpid()}.jsonl")
+        recovered: Dict[str, Dict[str, Any]] = {}
+        for path in sorted(glob.glob(os.path.join(spill_dir, f"{SPILL_PREFIX}*.jsonl"))):
+            recovered.update(self._claim(path))
+
+        self._spill = open(self.spill_path, "a", encoding="utf-8")
+        if fcntl is not None:
+            fcntl.flock(self._spill.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._spill.truncate(0)
+        self._spill_bytes = 0
+        if recovered:
+            logger.info("Recovered %d buffered document(s) from %s", len(recovered), spill_dir)
+        for document in recovered.values():
+            line, size = _encoded(document)
+            self._append(line, size)
+            self._version += 1
+            now = time.monotonic()
+            self._entries[document["id"]] = _Entry(document, str(document[self.partition_key]), size, self._version, now, now)
+            self._bytes += size
+        self.recovered = len(recovered)
+
+    def _claim(self, path: str) -> Dict[str, Dict[str, Any]]:
+        """Read and delete the spill file of a process that is gone (one that holds its lock is skipped)."""
+        try:
+            f = open(path, "r+", encoding="utf-8")
+        except FileNotFoundError:
+            return {}
+        with f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return {}
+                try:
+                    # Another process may have claimed and deleted it while we waited for the lock
+                    if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                        return {}
+                except FileNotFoundError:
+                    return {}
+            documents = {}
+            for line in f:
+                try:
+                    document = json.loads(line)
+                except ValueError:
+                    # A line torn by a crash mid-write; everything before it is intact
+                    continue
+                documents[document["id"]] = document
+            if path != self.spill_path:
+                os.remove(path)
+            return documents
+
+    def _append(self, line: str, size: int):
+        self._spill.write(line + "\n")
+        self._spill.flush()
+        if self.fsync:
+            os.fsync(self._spill.fileno())
+        self._spill_bytes += size + 1
+
+    def _truncate_spill(self):
+        """Empty the spill file once nothing in it is still queued, or rewrite it when it holds mostly written documents."""
+        if self._spill is None:
+            return
+        if not self._entries:
+            if self._spill_bytes:
+                self._spill.truncate(0)
+                self._spill.seek(0)
+                self._spill_bytes = 0
+        elif self._spill_bytes > 4 * self._bytes + 1024 * 1024:
+            self._spill.truncate(0)
+            self._spill.seek(0)
+            self._spill_bytes = 0
+            for entry in self._entries.values():
+                self._append(*_encoded(entry.document))
+
+    async def close(self, timeout: float = 10.0):
+        """
+        Flush what is queued (for up to ``timeout`` seconds) and stop. Documents
+        that could not be written stay in the spill file for the next start.
+        """
+        self._closed = True
+        self._wake.set()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+        deadline = time.monotonic() + timeout
+        while self._entries and time.monotonic() < deadline:
+            await self.flush(force=True)
+            if self._entries:
+                await asyncio.sleep(min(self.retry_backoff_seconds, max(deadline - time.monotonic(), 0)))
+        if self._entries:
+            logger.warning("Stopping with %d buffered document(s) unwritten%s", len(self._entries),
+                           f", kept in {self.spill_path}" if self._spill is not None else "")
+        if self._spill is not None:
+            empty = not self._entries
+            self._spill.close()
+            self._spill = None
+            if empty:
+                os.remove(self.spill_path)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._entries),
+            "pending_bytes": self._bytes,
+            "full": self.full,
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "written": self.written,
+            "batches": self.batches,
+            "retries": self.retries,
+            "dropped": self.dropped,
+            "recovered": self.recovered,
+        }
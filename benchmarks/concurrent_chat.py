@@ -0,0 +1,79 @@
+"""
+Concurrency check for /api/openai against local stand-ins.
+
+Replaces the Cosmos, Search and OpenAI services in the service container with
+stand-ins that simulate upstream latency, then fires N chats at once through
+the ASGI app. With the async pipeline the batch should finish in roughly the
+time of a single chat; the blocking stand-ins show the old behaviour.
+Client-side times include the background Cosmos save, the per-stage
+timings reported by the API show the latency before the response is sent.
+
+Usage:
+    python -m benchmarks.concurrent_chat --requests 20 --latency 0.2
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+# The services read their configuration at import time
+os.environ.setdefault("AZURE_SEARCH_SERVICE_ENDPOINT", "https://search.invalid")
+os.environ.setdefault("AZURE_SEARCH_INDEX_NAME", "bench")
+os.environ.setdefault("AZURE_SEARCH_API_KEY", "bench")
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "bench")
+os.environ.setdefault("COSMOS_ENDPOINT", "https://cosmos.invalid")
+os.environ.setdefault("COSMOS_KEY", "YmVuY2g=")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+from app.main import app
+from app.services.chat_pipeline import ChatPipeline
+from app.services.container import services
+from benchmarks.stand_ins import StandInCosmos, StandInOpenAI, StandInSearch
+
+
+async def run_batch(n_requests):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one(i):
+            response = await client.post("/api/openai", json={"prompt": f"question {i}", "user_id": f"user-{i}"})
+            response.raise_for_status()
+            return response.json()["timings"]
+
+        start = time.perf_counter()
+        timings = await asyncio.gather(*(one(i) for i in range(n_requests)))
+        return time.perf_counter() - start, timings
+
+
+def install_stand_ins(latency, blocking):
+    cosmos_service = StandInCosmos(latency, blocking)
+    search_service = StandInSearch(latency, blocking)
+    openai_service = StandInOpenAI(latency, blocking)
+    services.override(
+        cosmos_service=cosmos_service,
+        search_service=search_service,
+        openai_service=openai_service,
+        answer_cache=None,
+        chat_pipeline=ChatPipeline(search_service, openai_service, cosmos_service)
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20, help="Number of concurrent chats")
+    parser.add_argument("--latency", type=float, default=0.2, help="Simulated latency per upstream call (seconds)")
+    args = parser.parse_args()
+
+    for label, blocking in (("blocking", True), ("async", False)):
+        install_stand_ins(args.latency, blocking)
+        single, single_timings = asyncio.run(run_batch(1))
+        batch, _ = asyncio.run(run_batch(args.requests))
+        print(f"{label:>8}: 1 chat {single:.3f}s, {args.requests} concurrent chats {batch:.3f}s "
+              f"({batch / single:.1f}x a single chat)")
+        print(f"{'':>8}  stage timings of a single chat (ms): {single_timings[0]}")
+
+
+if __name__ == "__main__":
+    main()
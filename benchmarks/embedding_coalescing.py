@@ -0,0 +1,84 @@
+"""
+Embedding request coalescing against a local fake embeddings server.
+
+Runs concurrent clients that each embed a stream of distinct texts through
+OpenAIService.generate_embeddings_async, first with the batcher disabled and
+then enabled, and reports client requests per second next to upstream
+embeddings calls per second. The fake server only serves a few calls at a
+time, like a rate-limited deployment, so batching should raise requests per
+second while upstream calls per second drop.
+
+Usage:
+    python -m benchmarks.embedding_coalescing --clients 64 --duration 3
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fake_openai
+from benchmarks.servers import BackgroundServer
+
+
+async def drive(service, clients: int, duration: float) -> int:
+    deadline = time.perf_counter() + duration
+    completed = 0
+
+    async def client(client_id):
+        nonlocal completed
+        i = 0
+        while time.perf_counter() < deadline:
+            vector = await service.generate_embeddings_async(f"client {client_id} question {i}")
+            if vector is None:
+                raise RuntimeError("embedding request failed")
+            completed += 1
+            i += 1
+
+    await asyncio.gather(*(client(c) for c in range(clients)))
+    return completed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=64, help="Concurrent callers")
+    parser.add_argument("--duration", type=float, default=3.0, help="Seconds per run")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake server latency per call (seconds)")
+    parser.add_argument("--max-concurrent-calls", type=int, default=4, help="Calls the fake server serves at once")
+    parser.add_argument("--batch-size", type=int, default=16, help="Coalescer max batch size")
+    parser.add_argument("--wait-ms", type=float, default=5.0, help="Coalescer batching window")
+    args = parser.parse_args()
+
+    fake = fake_openai.create_app(latency=args.latency, max_concurrent_calls=args.max_concurrent_calls)
+    with BackgroundServer(fake) as server:
+        os.environ["AZURE_OPENAI_ENDPOINT"] = server.url
+        os.environ.setdefault("AZURE_OPENAI_API_KEY", "bench")
+        os.environ["EMBEDDING_CACHE_ENABLED"] = "False"
+
+        from app.services.embedding_batcher import EmbeddingBatcher
+        from app.services.openai_service import OpenAIService
+
+        for label, batching in (("unbatched", False), ("coalesced", True)):
+            service = OpenAIService()
+            service.embedding_batcher = None
+            if batching:
+                service.embedding_batcher = EmbeddingBatcher(
+                    service._request_embeddings_async,
+                    max_batch_size=args.batch_size,
+                    max_wait_ms=args.wait_ms
+                )
+
+            calls_before = fake.state.calls["embeddings"]
+            start = time.perf_counter()
+            completed = asyncio.run(drive(service, args.clients, args.duration))
+            elapsed = time.perf_counter() - start
+            calls = fake.state.calls["embeddings"] - calls_before
+
+            print(f"{label:>9}: {completed / elapsed:8.1f} requests/s, {calls / elapsed:7.1f} upstream calls/s, "
+                  f"{completed / max(calls, 1):5.1f} texts per call")
+
+
+if __name__ == "__main__":
+    main()
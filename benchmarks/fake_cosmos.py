@@ -0,0 +1,577 @@
+"""
+Local stand-in for the Cosmos DB gateway (the REST API the SDK talks to).
+
+Keeps databases, containers and documents in memory and serves the calls
+CosmosDBService and UserRegistry make through the azure-cosmos SDK: the
+account read, database and container creation, point reads, create,
+upsert and replace (with If-Match), transactional batches, partition key
+ranges and queries with continuation tokens. Queries are evaluated by a
+small interpreter for the SQL subset the app uses (TOP, DISTINCT,
+projections with aliases, AND/OR/NOT, comparisons, IS_DEFINED, IIF, LEFT,
+ARRAY_LENGTH, STARTSWITH and ORDER BY). Authorization is not checked.
+
+Every data-plane call sleeps for a fixed latency, reports a request charge
+that grows with the document size, and is counted by operation.
+"""
+import asyncio
+import json
+import re
+import time
+import uuid
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, Request, Response
+
+UNDEFINED = object()
+
+
+class QueryError(ValueError):
+    pass
+
+
+# --- SQL subset -------------------------------------------------------------
+
+TOKEN_PATTERN = re.compile(
+    r"\s*(?:(?P<number>\d+(?:\.\d+)?)|(?P<string>'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")"
+    r"|(?P<param>@\w+)|(?P<name>[A-Za-z_]\w*)|(?P<op><=|>=|!=|<>|[=<>()\[\],.*]))"
+)
+KEYWORDS = {"SELECT", "DISTINCT", "VALUE", "TOP", "FROM", "WHERE", "ORDER", "BY", "ASC", "DESC",
+            "AND", "OR", "NOT", "AS", "TRUE", "FALSE", "NULL"}
+
+
+def tokenize(text: str) -> List[Tuple[str, Any]]:
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if not match or match.end() == position:
+            raise QueryError(f"Unexpected character at {position}: {text[position:position + 20]!r}")
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "number":
+            tokens.append(("literal", float(value) if "." in value else int(value)))
+        elif kind == "string":
+            tokens.append(("literal", value[1:-1].encode().decode("unicode_escape")))
+        elif kind == "name" and value.upper() in KEYWORDS:
+            tokens.append(("keyword", value.upper()))
+        else:
+            tokens.append((kind, value))
+    tokens.append(("end", None))
+    return tokens
+
+
+class Query:
+    """A parsed query: ``run(documents, parameters)`` returns the result rows."""
+
+    def __init__(self, text: str):
+        self.tokens = tokenize(text)
+        self.position = 0
+        self.distinct = False
+        self.value = False
+        self.top = None
+        self.projection = None  # None for *, else [(alias, expression)]
+        self.where = None
+        self.order_by: List[Tuple[Any, bool]] = []
+        self._parse()
+
+    # parsing
+
+    def _peek(self, offset=0):
+        return self.tokens[self.position + offset]
+
+    def _next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def _accept(self, kind, value=None) -> bool:
+        token = self._peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.position += 1
+            return True
+        return False
+
+    def _expect(self, kind, value=None):
+        token = self._next()
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise QueryError(f"Expected {value or kind}, got {token[1]!r}")
+        return token
+
+    def _parse(self):
+        self._expect("keyword", "SELECT")
+        self.distinct = self._accept("keyword", "DISTINCT")
+        if self._accept("keyword", "TOP"):
+            self.top = self._primary()
+        self.value = self._accept("keyword", "VALUE")
+        if self._accept("op", "*"):
+            self.projection = None
+        else:
+            self.projection = []
+            while True:
+                expression = self._expression()
+                if self._accept("keyword", "AS"):
+                    alias = self._expect("name")[1]
+                elif expression[0] == "path":
+                    alias = expression[2][-1] if expression[2] else expression[1]
+                else:
+                    alias = f"${len(self.projection) + 1}"
+                self.projection.append((alias, expression))
+                if not self._accept("op", ","):
+                    break
+        self._expect("keyword", "FROM")
+        self.alias = self._expect("name")[1]
+        if self._accept("keyword", "WHERE"):
+            self.where = self._expression()
+        if self._accept("keyword", "ORDER"):
+            self._expect("keyword", "BY")
+            while True:
+                expression = self._expression()
+                descending = self._accept("keyword", "DESC")
+                if not descending:
+                    self._accept("keyword", "ASC")
+                self.order_by.append((expression, descending))
+                if not self._accept("op", ","):
+                    break
+        self._expect("end")
+
+    def _expression(self):
+        left = self._conjunction()
+        while self._accept("keyword", "OR"):
+            left = ("or", left, self._conjunction())
+        return left
+
+    def _conjunction(self):
+        left = self._negation()
+        while self._accept("keyword", "AND"):
+            left = ("and", left, self._negation())
+        return left
+
+    def _negation(self):
+        if self._accept("keyword", "NOT"):
+            return ("not", self._negation())
+        return self._comparison()
+
+    def _comparison(self):
+        left = self._primary()
+        token = self._peek()
+        if token[0] == "op" and token[1] in ("=", "!=", "<>", "<", "<=", ">", ">="):
+            self.position += 1
+            return ("compare", token[1], left, self._primary())
+        return left
+
+    def _primary(self):
+        kind, value = self._next()
+        if kind == "literal":
+            return ("literal", value)
+        if kind == "param":
+            return ("param", value)
+        if kind == "keyword" and value in ("TRUE", "FALSE", "NULL"):
+            return ("literal", {"TRUE": True, "FALSE": False, "NULL": None}[value])
+        if kind == "op" and value == "(":
+            expression = self._expression()
+            self._expect("op", ")")
+            return expression
+        if kind == "name" and self._peek() == ("op", "("):
+            self.position += 1
+            arguments = []
+            if not self._accept("op", ")"):
+                while True:
+                    arguments.append(self._expression())
+                    if self._accept("op", ")"):
+                        break
+                    self._expect("op", ",")
+            return ("call", value.upper(), arguments)
+        if kind == "name":
+            steps = []
+            while True:
+                if self._accept("op", "."):
+                    steps.append(self._expect("name")[1])
+                elif self._accept("op", "["):
+                    steps.append(self._expect("literal")[1])
+                    self._expect("op", "]")
+                else:
+                    break
+            return ("path", value, steps)
+        raise QueryError(f"Unexpected {value!r}")
+
+    # evaluation
+
+    def _evaluate(self, node, document, parameters):
+        kind = node[0]
+        if kind == "literal":
+            return node[1]
+        if kind == "param":
+            if node[1] not in parameters:
+                raise QueryError(f"Missing parameter {node[1]}")
+            return parameters[node[1]]
+        if kind == "path":
+            value = document
+            for step in node[2]:
+                if isinstance(step, str) and isinstance(value, dict) and step in value:
+                    value = value[step]
+                elif isinstance(step, int) and isinstance(value, list) and 0 <= step < len(value):
+                    value = value[step]
+                else:
+                    return UNDEFINED
+            return value
+        if kind == "and":
+            return self._evaluate(node[1], document, parameters) is True and self._evaluate(node[2], document, parameters) is True
+        if kind == "or":
+            return self._evaluate(node[1], document, parameters) is True or self._evaluate(node[2], document, parameters) is True
+        if kind == "not":
+            value = self._evaluate(node[1], document, parameters)
+            return (not value) if isinstance(value, bool) else UNDEFINED
+        if kind == "compare":
+            return self._compare(node[1], self._evaluate(node[2], document, parameters), self._evaluate(node[3], document, parameters))
+        if kind == "call":
+            return self._call(node[1], [self._evaluate(argument, document, parameters) for argument in node[2]])
+        raise QueryError(f"Cannot evaluate {kind}")
+
+    @staticmethod
+    def _compare(operator, left, right):
+        if left is UNDEFINED or right is UNDEFINED:
+            return UNDEFINED
+        if operator == "=":
+            return left == right
+        if operator in ("!=", "<>"):
+            return left != right
+        if type(left) is not type(right) and not (isinstance(left, (int, float)) and isinstance(right, (int, float))):
+            return UNDEFINED
+        return {"<": left < right, "<=": left <= right, ">": left > right, ">=": left >= right}[operator]
+
+    @staticmethod
+    def _call(name, arguments):
+        if name == "IS_DEFINED":
+            return arguments[0] is not UNDEFINED
+        if name == "IIF":
+            return arguments[1] if arguments[0] is True else arguments[2]
+        if name == "LEFT":
+            return arguments[0][:arguments[1]] if isinstance(arguments[0], str) else UNDEFINED
+        if name == "ARRAY_LENGTH":
+            return len(arguments[0]) if isinstance(arguments[0], list) else UNDEFINED
+        if name == "STARTSWITH":
+            if not isinstance(arguments[0], str) or not isinstance(arguments[1], str):
+                return UNDEFINED
+            return arguments[0].startswith(arguments[1])
+        raise QueryError(f"Unsupported function {name}")
+
+    @staticmethod
+    def _sort_key(value):
+        # Cosmos orders undefined < null < booleans < numbers < strings
+        if value is UNDEFINED:
+            return (0, 0)
+        if value is None:
+            return (1, 0)
+        if isinstance(value, bool):
+            return (2, value)
+        if isinstance(value, (int, float)):
+            return (3, value)
+        if isinstance(value, str):
+            return (4, value)
+        return (5, json.dumps(value, sort_keys=True))
+
+    def run(self, documents: List[Dict[str, Any]], parameters: Dict[str, Any]) -> List[Any]:
+        rows = [doc for doc in documents if self.where is None or self._evaluate(self.where, doc, parameters) is True]
+        for expression, descending in reversed(self.order_by):
+            rows.sort(key=lambda doc: self._sort_key(self._evaluate(expression, doc, parameters)), reverse=descending)
+
+        results = []
+        for doc in rows:
+            if self.projection is None:
+                results.append(doc)
+                continue
+            if self.value:
+                value = self._evaluate(self.projection[0][1], doc, parameters)
+                if value is not UNDEFINED:
+                    results.append(value)
+                continue
+            row = {}
+            for alias, expression in self.projection:
+                value = self._evaluate(expression, doc, parameters)
+                if value is not UNDEFINED:
+                    row[alias] = value
+            results.append(row)
+
+        if self.distinct:
+            seen = set()
+            unique = []
+            for row in results:
+                key = json.dumps(row, sort_keys=True)
+                if key not in seen:
+                    seen.add(key)
+                    unique.append(row)
+            results = unique
+        if self.top is not None:
+            results = results[:self._evaluate(self.top, {}, parameters)]
+        return results
+
+
+# --- Gateway ----------------------------------------------------------------
+
+def _request_charge(operation: str, size: int, count: int = 1) -> float:
+    """Rough RU model: reads ~1 RU/KB, writes ~5 RU/KB, queries 2.5 RU plus per document."""
+    kilobytes = max(size / 1024, 1.0)
+    if operation == "read":
+        return round(kilobytes, 2)
+    if operation == "query":
+        return round(2.5 + 0.5 * count + 0.2 * kilobytes, 2)
+    return round(5.0 * kilobytes + 1.0, 2)
+
+
+class FakeContainer:
+    def __init__(self, name: str, partition_key_path: str):
+        self.name = name
+        self.partition_key_path = partition_key_path
+        self.rid = uuid.uuid4().hex[:8]
+        self.documents: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+    def properties(self) -> Dict[str, Any]:
+        return {
+            "id": self.name,
+            "_rid": self.rid,
+            "_self": f"dbs/fake/colls/{self.rid}/",
+            "partitionKey": {"paths": [self.partition_key_path], "kind": "Hash", "version": 2},
+            "indexingPolicy": {"indexingMode": "consistent", "automatic": True},
+        }
+
+    def partition_of(self, document: Dict[str, Any]) -> str:
+        return json.dumps([document.get(self.partition_key_path.lstrip("/"))])
+
+    def write(self, document: Dict[str, Any], mode: str, if_match: Optional[str] = None) -> Tuple[int, Dict[str, Any]]:
+        """Create, upsert or replace a document; returns (status, stored document or error body)."""
+        key = (self.partition_of(document), document["id"])
+        existing = self.documents.get(key)
+        if mode == "create" and existing is not None:
+            return 409, {"code": "Conflict", "message": "Entity with the specified id already exists in the system."}
+        if mode == "replace" and existing is None:
+            return 404, {"code": "NotFound", "message": "Entity with the specified id does not exist in the system."}
+        if if_match and (existing is None or existing["_etag"] != if_match):
+            return 412, {"code": "PreconditionFailed", "message": "Operation cannot be performed because one of the specified precondition is not met."}
+        stored = dict(document)
+        stored.update({
+            "_rid": uuid.uuid4().hex[:12],
+            "_self": f"dbs/fake/colls/{self.rid}/docs/{document['id']}",
+            "_etag": f'"{uuid.uuid4()}"',
+            "_attachments": "attachments/",
+            "_ts": int(time.time()),
+        })
+        self.documents[key] = stored
+        return (201 if existing is None else 200), stored
+
+
+class _StripTrailingSlash:
+    """The SDK addresses resources as ``dbs/{db}/``; route them like ``dbs/{db}``."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and len(scope["path"]) > 1 and scope["path"].endswith("/"):
+            scope = dict(scope, path=scope["path"].rstrip("/"))
+        await self.app(scope, receive, send)
+
+
+def create_app(latency: float = 0.005, databases: Optional[Dict[str, Dict[str, str]]] = None) -> FastAPI:
+    """
+    Args:
+        latency: Seconds each data-plane call takes
+        databases: Databases and containers (name to partition key path)
+            that exist from the start, e.g. ``{"db": {"conversations": "/user_id"}}``
+    """
+    app = FastAPI()
+    app.add_middleware(_StripTrailingSlash)
+    app.state.calls = Counter()
+    app.state.request_units = 0.0
+    app.state.databases = {
+        database: {name: FakeContainer(name, path) for name, path in containers.items()}
+        for database, containers in (databases or {}).items()
+    }
+    query_cache: Dict[str, Query] = {}
+
+    def respond(status: int, body: Any, operation: Optional[str] = None, charge: float = 0.0, headers: Optional[Dict[str, str]] = None) -> Response:
+        if operation is not None:
+            app.state.calls[operation] += 1
+            app.state.request_units += charge
+        response_headers = {
+            "x-ms-request-charge": str(charge),
+            "x-ms-activity-id": str(uuid.uuid4()),
+            "x-ms-session-token": "0:-1#1",
+        }
+        if isinstance(body, dict) and "_etag" in body:
+            response_headers["etag"] = body["_etag"]
+        response_headers.update(headers or {})
+        return Response(json.dumps(body), status_code=status, media_type="application/json", headers=response_headers)
+
+    def not_found(operation: Optional[str] = None) -> Response:
+        return respond(404, {"code": "NotFound", "message": "Resource Not Found"}, operation, 1.0)
+
+    def container_of(database: str, container: str) -> Optional[FakeContainer]:
+        return app.state.databases.get(database, {}).get(container)
+
+    @app.get("/")
+    async def account(request: Request):
+        endpoint = str(request.base_url)
+        location = [{"name": "Local", "databaseAccountEndpoint": endpoint}]
+        return respond(200, {
+            "id": "fake",
+            "_rid": "fake",
+            "_self": "",
+            "_dbs": "//dbs/",
+            "media": "//media/",
+            "addresses": "//addresses/",
+            "writableLocations": location,
+            "readableLocations": location,
+            "enableMultipleWriteLocations": False,
+            "userConsistencyPolicy": {"defaultConsistencyLevel": "Session"},
+        }, "metadata")
+
+    @app.post("/dbs")
+    async def create_database(request: Request):
+        body = await request.json()
+        if body["id"] in app.state.databases:
+            return respond(409, {"code": "Conflict", "message": "Database already exists"}, "metadata")
+        app.state.databases[body["id"]] = {}
+        return respond(201, {"id": body["id"], "_rid": body["id"], "_self": f"dbs/{body['id']}/"}, "metadata")
+
+    @app.get("/dbs/{database}")
+    async def read_database(database: str):
+        if database not in app.state.databases:
+            return not_found("metadata")
+        return respond(200, {"id": database, "_rid": database, "_self": f"dbs/{database}/"}, "metadata")
+
+    @app.post("/dbs/{database}/colls")
+    async def create_container(database: str, request: Request):
+        if database not in app.state.databases:
+            return not_found("metadata")
+        body = await request.json()
+        if body["id"] in app.state.databases[database]:
+            return respond(409, {"code": "Conflict", "message": "Container already exists"}, "metadata")
+        container = FakeContainer(body["id"], body["partitionKey"]["paths"][0])
+        app.state.databases[database][body["id"]] = container
+        return respond(201, container.properties(), "metadata")
+
+    @app.get("/dbs/{database}/colls/{name}")
+    async def read_container(database: str, name: str):
+        container = container_of(database, name)
+        if container is None:
+            return not_found("metadata")
+        return respond(200, container.properties(), "metadata")
+
+    @app.get("/dbs/{database}/colls/{name}/pkranges")
+    async def partition_key_ranges(database: str, name: str):
+        container = container_of(database, name)
+        if container is None:
+            return not_found("metadata")
+        return respond(200, {
+            "_rid": container.rid,
+            "PartitionKeyRanges": [{"id": "0", "_rid": container.rid, "minInclusive": "", "maxExclusive": "FF", "parents": []}],
+            "_count": 1,
+        }, "metadata", headers={"etag": '"pkranges"'})
+
+    @app.get("/dbs/{database}/colls/{name}/docs/{doc_id:path}")
+    async def read_document(database: str, name: str, doc_id: str, request: Request):
+        container = container_of(database, name)
+        if container is None:
+            return not_found("read")
+        await asyncio.sleep(latency)
+        document = container.documents.get((request.headers.get("x-ms-documentdb-partitionkey", "[]"), doc_id))
+        if document is None:
+            return not_found("read")
+        if request.headers.get("if-none-match") == document["_etag"]:
+            return respond(304, None, "read", 1.0)
+        return respond(200, document, "read", _request_charge("read", len(json.dumps(document))))
+
+    @app.put("/dbs/{database}/colls/{name}/docs/{doc_id:path}")
+    async def replace_document(database: str, name: str, doc_id: str, request: Request):
+        container = container_of(database, name)
+        if container is None:
+            return not_found("replace")
+        body = await request.body()
+        await asyncio.sleep(latency)
+        status, result = container.write(json.loads(body), "replace", request.headers.get("if-match"))
+        return respond(status, result, "replace", _request_charge("write", len(body)))
+
+    @app.post("/dbs/{database}/colls/{name}/docs")
+    async def documents(database: str, name: str, request: Request):
+        container = container_of(database, name)
+        if container is None:
+            return not_found("write")
+        headers = request.headers
+        body = await request.body()
+        await asyncio.sleep(latency)
+
+        if headers.get("x-ms-cosmos-is-query-plan-request", "").lower() == "true":
+            return respond(400, {"code": "BadRequest", "message": "Query plans are not supported; use single-partition queries"}, "query_plan")
+
+        if headers.get("x-ms-documentdb-isquery", "").lower() == "true":
+            return run_query(container, json.loads(body), headers)
+
+        if headers.get("x-ms-cosmos-is-batch-request", "").lower() == "true":
+            return run_batch(container, json.loads(body), len(body))
+
+        mode = "upsert" if headers.get("x-ms-documentdb-is-upsert", "").lower() == "true" else "create"
+        status, result = container.write(json.loads(body), mode, headers.get("if-match"))
+        return respond(status, result, mode, _request_charge("write", len(body)))
+
+    def run_query(container: FakeContainer, body: Dict[str, Any], headers) -> Response:
+        text = body["query"]
+        query = query_cache.get(text)
+        try:
+            if query is None:
+                query = query_cache[text] = Query(text)
+            parameters = {parameter["name"]: parameter["value"] for parameter in body.get("parameters", [])}
+            partition = headers.get("x-ms-documentdb-partitionkey")
+            documents = [doc for (pk, _), doc in container.documents.items() if partition is None or pk == partition]
+            rows = query.run(documents, parameters)
+        except QueryError as e:
+            return respond(400, {"code": "BadRequest", "message": str(e)}, "query")
+
+        start = int(headers.get("x-ms-continuation") or 0)
+        page_size = int(headers.get("x-ms-max-item-count") or -1)
+        end = len(rows) if page_size <= 0 else start + page_size
+        page = rows[start:end]
+        response_headers = {"x-ms-item-count": str(len(page))}
+        if end < len(rows):
+            response_headers["x-ms-continuation"] = str(end)
+        charge = _request_charge("query", len(json.dumps(page)), len(page))
+        return respond(200, {"_rid": container.rid, "Documents": page, "_count": len(page)}, "query", charge, response_headers)
+
+    def run_batch(container: FakeContainer, operations: List[Dict[str, Any]], size: int) -> Response:
+        # All or nothing: apply to a copy and keep it only if every operation succeeds
+        snapshot = dict(container.documents)
+        results = []
+        failed = False
+        for operation in operations:
+            kind = operation["operationType"]
+            mode = {"Create": "create", "Upsert": "upsert", "Replace": "replace"}.get(kind)
+            if mode is None:
+                results.append({"statusCode": 400, "requestCharge": 0.0})
+                failed = True
+                break
+            status, result = container.write(operation["resourceBody"], mode, operation.get("ifMatch"))
+            entry = {"statusCode": status, "requestCharge": _request_charge("write", len(json.dumps(operation["resourceBody"])))}
+            if status < 300:
+                entry.update({"eTag": result["_etag"], "resourceBody": result})
+            results.append(entry)
+            if status >= 300:
+                failed = True
+                break
+        charge = round(sum(result["requestCharge"] for result in results), 2)
+        if failed:
+            container.documents = snapshot
+            for index, result in enumerate(results):
+                if result["statusCode"] < 300:
+                    results[index] = {"statusCode": 424, "requestCharge": 0.0}
+            results.extend({"statusCode": 424, "requestCharge": 0.0} for _ in range(len(operations) - len(results)))
+            return respond(207, results, "batch", charge)
+        return respond(200, results, "batch", charge)
+
+    @app.get("/_stats")
+    async def stats():
+        """Calls served so far (read by the load test)."""
+        return {"calls": dict(app.state.calls), "request_units": round(app.state.request_units, 2)}
+
+    return app
@@ -0,0 +1,257 @@
+"""
+Local stand-in for the Azure OpenAI data plane.
+
+Serves the embeddings and chat completions routes with configurable
+latency and a cap on concurrently served calls per route, which stands in
+for a rate-limited deployment. Embedding vectors are deterministic per
+input text so repeated texts embed the same. Chat completions answer with
+text taken from the prompt; they take a time to first token plus a time
+per generated token, and stream as server-sent events when asked to
+(including the final usage chunk for ``stream_options.include_usage``).
+Like Azure OpenAI's prompt caching, a prompt that starts with messages
+sent before reports them as ``prompt_tokens_details.cached_tokens`` once
+they add up to 1024 tokens (in 128-token steps beyond that).
+
+Like a deployment with a quota, the chat route can throttle: calls over a
+tokens-per-minute quota (prompt plus max_tokens, counted over a sliding
+window) or over a number of concurrent calls are answered 429 with
+``retry-after-ms`` and ``Retry-After`` headers, as Azure OpenAI does.
+It can also answer every chat call with an error status instead.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from typing import Callable, Deque, List, Optional, Tuple
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def fake_embedding(text: str, dimensions: int) -> np.ndarray:
+    """Deterministic unit vector for a text."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def _answer_words(messages: List[dict], count: int) -> List[str]:
+    """The words of the answer: the start of the last system message's context, then the question."""
+    system = next((m["content"] for m in reversed(messages) if m["role"] == "system"), "")
+    question = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+    words = (system.rsplit("documents:", 1)[-1] + " " + question).split()
+    while words and len(words) < count:
+        words = words + words
+    return words[:count] or ["OK"]
+
+
+def _prompt_tokens(messages: List[dict]) -> int:
+    # About four characters per token, like the repo's fallback estimate
+    return sum(len(m.get("content") or "") for m in messages) // 4 + 4 * len(messages)
+
+
+# Prompt caching: shortest cacheable prefix, granularity beyond it, and the
+# number of message prefixes remembered
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_STEP_TOKENS = 128
+PROMPT_CACHE_ENTRIES = 20000
+
+
+def create_app(
+    latency: float = 0.05,
+    max_concurrent_calls: int = 4,
+    dimensions: int = 256,
+    embed: Optional[Callable[[str, int], "np.ndarray"]] = None,
+    first_token_latency: float = 0.2,
+    token_latency: float = 0.01,
+    answer_tokens: int = 60,
+    max_concurrent_chat_calls: int = 64,
+    tokens_per_minute: int = 0,
+    throttle_concurrency: int = 0,
+    quota_window: float = 60.0,
+    error_status: int = 0,
+) -> FastAPI:
+    """
+    Args:
+        latency: Seconds per embeddings call
+        max_concurrent_calls: Embeddings calls served at once
+        dimensions: Embedding dimensions
+        embed: Function of (text, dimensions) returning the vector,
+            ``fake_embedding`` by default
+        first_token_latency: Seconds before a completion's first token
+        token_latency: Seconds per further generated token
+        answer_tokens: Tokens per completion (capped by max_tokens)
+        max_concurrent_chat_calls: Chat completion calls served at once
+        tokens_per_minute: Chat quota; calls beyond it get 429 (0 for none)
+        throttle_concurrency: Chat calls in flight beyond which calls get
+            429 (0 for none)
+        quota_window: Seconds over which the quota is counted (the quota
+            is scaled to it, so a short window throttles in short bursts)
+        error_status: Status every chat call is answered with, e.g. 400
+            or 503 (0 to answer normally)
+    """
+    embed = embed or fake_embedding
+    app = FastAPI()
+    app.state.calls = Counter()
+    app.state.inputs = 0
+    app.state.tokens = Counter()
+    limiter = asyncio.Semaphore(max_concurrent_calls)
+    chat_limiter = asyncio.Semaphore(max_concurrent_chat_calls)
+    # (time, tokens) of the chat calls admitted within the quota window
+    admitted: Deque[Tuple[float, int]] = deque()
+    in_flight = Counter()
+    prompt_prefixes: "OrderedDict[str, None]" = OrderedDict()
+
+    def cached_tokens(messages: List[dict]) -> int:
+        """Leading prompt tokens that match (whole) messages of an earlier prompt."""
+        digest = hashlib.sha256()
+        tokens = cached = 0
+        for message in messages:
+            digest.update(json.dumps([message.get("role"), message.get("content")]).encode("utf-8"))
+            tokens += _prompt_tokens([message])
+            key = digest.hexdigest()
+            if key in prompt_prefixes:
+                prompt_prefixes.move_to_end(key)
+                cached = tokens
+            else:
+                prompt_prefixes[key] = None
+        while len(prompt_prefixes) > PROMPT_CACHE_ENTRIES:
+            prompt_prefixes.popitem(last=False)
+        if cached < PROMPT_CACHE_MIN_TOKENS:
+            return 0
+        return cached - (cached - PROMPT_CACHE_MIN_TOKENS) % PROMPT_CACHE_STEP_TOKENS
+
+    def throttle(cost: int) -> Optional[JSONResponse]:
+        """The 429 response for a chat call that is over the quota, or None to admit it."""
+        now = time.monotonic()
+        while admitted and admitted[0][0] <= now - quota_window:
+            admitted.popleft()
+        retry_after = None
+        if throttle_concurrency and in_flight["chat"] >= throttle_concurrency:
+            retry_after = 1.0
+        elif tokens_per_minute:
+            quota = tokens_per_minute * quota_window / 60
+            used = sum(tokens for _, tokens in admitted)
+            if admitted and used + cost > quota:
+                # Wait until enough of the window's tokens have aged out
+                for admitted_at, tokens in admitted:
+                    used -= tokens
+                    if used + cost <= quota:
+                        break
+                retry_after = max(0.001, admitted_at + quota_window - now)
+        if retry_after is None:
+            admitted.append((now, cost))
+            return None
+        app.state.calls["throttled"] += 1
+        return JSONResponse(
+            {"error": {"code": "429", "message": f"Rate limit exceeded. Please retry after {math.ceil(retry_after)} seconds."}},
+            status_code=429,
+            headers={"retry-after-ms": str(int(retry_after * 1000)), "retry-after": str(math.ceil(retry_after))},
+        )
+
+    @app.post("/openai/deployments/{deployment}/embeddings")
+    async def embeddings(deployment: str, request: Request):
+        body = await request.json()
+        inputs = body["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+
+        async with limiter:
+            app.state.calls["embeddings"] += 1
+            app.state.inputs += len(inputs)
+            await asyncio.sleep(latency)
+
+        tokens = sum(len(text) // 4 + 1 for text in inputs)
+        app.state.tokens["embedding"] += tokens
+        return {
+            "object": "list",
+            "model": deployment,
+            "data": [
+                {"object": "embedding", "index": index, "embedding": np.asarray(embed(text, dimensions)).tolist()}
+                for index, text in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    @app.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(deployment: str, request: Request):
+        body = await request.json()
+        messages = body["messages"]
+        count = min(answer_tokens, body.get("max_tokens") or answer_tokens)
+        words = _answer_words(messages, count)
+        usage = {
+            "prompt_tokens": _prompt_tokens(messages),
+            "completion_tokens": len(words),
+            "total_tokens": _prompt_tokens(messages) + len(words),
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+
+        if error_status:
+            app.state.calls["failed"] += 1
+            return JSONResponse({"error": {"code": str(error_status), "message": "Stand-in failure"}}, status_code=error_status)
+        throttled = throttle(usage["prompt_tokens"] + (body.get("max_tokens") or answer_tokens))
+        if throttled is not None:
+            return throttled
+        app.state.tokens["prompt"] += usage["prompt_tokens"]
+        app.state.tokens["completion"] += usage["completion_tokens"]
+        usage["prompt_tokens_details"] = {"cached_tokens": cached_tokens(messages)}
+        app.state.tokens["cached_prompt"] += usage["prompt_tokens_details"]["cached_tokens"]
+
+        if not body.get("stream"):
+            in_flight["chat"] += 1
+            try:
+                async with chat_limiter:
+                    app.state.calls["chat"] += 1
+                    await asyncio.sleep(first_token_latency + token_latency * (len(words) - 1))
+            finally:
+                in_flight["chat"] -= 1
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": deployment,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        def event(choices, **extra):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": deployment, "choices": choices}
+            chunk.update(extra)
+            return f"data: {json.dumps(chunk)}\n\n"
+
+        async def stream():
+            try:
+                async with chat_limiter:
+                    app.state.calls["chat_stream"] += 1
+                    # Azure leads with a chunk that only carries the prompt filter results
+                    yield event([], prompt_filter_results=[])
+                    await asyncio.sleep(first_token_latency)
+                    for index, word in enumerate(words):
+                        if index:
+                            await asyncio.sleep(token_latency)
+                        content = word if index == 0 else " " + word
+                        yield event([{"index": 0, "delta": {"role": "assistant", "content": content} if index == 0 else {"content": content}, "finish_reason": None}])
+                    yield event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+                    if include_usage:
+                        yield event([], usage=usage)
+                    yield "data: [DONE]\n\n"
+            finally:
+                in_flight["chat"] -= 1
+
+        in_flight["chat"] += 1
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.get("/_stats")
+    async def stats():
+        """Calls served so far (read by the load test)."""
+        return {"calls": dict(app.state.calls), "inputs": app.state.inputs, "tokens": dict(app.state.tokens)}
+
+    return app
@@ -0,0 +1,62 @@
+"""
+Local stand-in for the Azure AI Search data plane.
+
+Serves the documents search route the SDK's SearchClient.search calls,
+answering vector, keyword and hybrid queries over the fixture corpus with
+LocalSearchIndex from benchmarks/local_search.py, and the documents index
+route that upload, merge-or-upload and delete batches go to (indexed
+documents are kept by key, not searched). Every call sleeps for a fixed
+latency and is counted.
+"""
+import asyncio
+from collections import Counter
+from types import SimpleNamespace
+
+from fastapi import FastAPI, Request
+
+from benchmarks.local_search import LocalSearchIndex, load_fixture
+
+
+def create_app(latency: float = 0.02, chunks=None, dimensions: int = 256, key_field: str = "chunk_id") -> FastAPI:
+    index = LocalSearchIndex(chunks if chunks is not None else load_fixture()["chunks"], latency=0, dimensions=dimensions)
+    app = FastAPI()
+    app.state.calls = Counter()
+    app.state.documents = {}
+
+    @app.post("/indexes('{index_name}')/docs/search.post.search")
+    async def search(index_name: str, request: Request):
+        body = await request.json()
+        vector_queries = [
+            SimpleNamespace(vector=query["vector"], k_nearest_neighbors=query.get("k") or 50)
+            for query in body.get("vectorQueries") or []
+        ]
+        select = body["select"].split(",") if body.get("select") else None
+        app.state.calls["vector" if not body.get("search") else ("hybrid" if vector_queries else "keyword")] += 1
+        await asyncio.sleep(latency)
+        return {"value": index._run(body.get("search"), vector_queries, select, body.get("top") or 50)}
+
+    @app.post("/indexes('{index_name}')/docs/search.index")
+    async def index_documents(index_name: str, request: Request):
+        body = await request.json()
+        app.state.calls["index"] += 1
+        results = []
+        for action in body["value"]:
+            kind = action.pop("@search.action")
+            key = action[key_field]
+            app.state.calls[f"index_{kind}"] += 1
+            if kind == "delete":
+                app.state.documents.pop(key, None)
+            elif kind == "merge":
+                app.state.documents[key].update(action)
+            else:
+                app.state.documents[key] = action
+            results.append({"key": key, "status": True, "errorMessage": None, "statusCode": 200})
+        await asyncio.sleep(latency)
+        return {"value": results}
+
+    @app.get("/_stats")
+    async def stats():
+        """Calls served so far (read by the load test)."""
+        return {"calls": dict(app.state.calls), "documents": len(app.state.documents)}
+
+    return app
@@ -0,0 +1,199 @@
+"""
+Per-request overhead of the ASGI-to-Functions bridge.
+
+Runs the same requests through the previous inline proxy of function_app.py
+(reproduced below) and through FunctionsAsgiAdapter, in front of a bare
+ASGI app that does no work of its own, so the times are the bridge's. Logging
+is configured at INFO, the Functions default, with a handler that formats
+every record into memory. Starlette streaming responses are left out: the
+inline proxy never finishes them (its receive() returns the request again
+instead of waiting for a disconnect, so the disconnect listener spins).
+
+Usage:
+    python -m benchmarks.functions_adapter --requests 2000
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import azure.functions as func
+
+from app.api.functions_adapter import FunctionsAsgiAdapter
+
+CHUNK = b"x" * 4096
+
+
+async def bare_app(scope, receive, send):
+    """Reads the body and answers with the body size, in one chunk or in chunks (?chunks=N)."""
+    message = await receive()
+    query = dict(pair.split(b"=", 1) for pair in scope["query_string"].split(b"&") if b"=" in pair)
+    chunks = int(query.get(b"chunks", b"0"))
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+    if chunks:
+        for index in range(chunks):
+            await send({"type": "http.response.body", "body": CHUNK, "more_body": index < chunks - 1})
+    else:
+        await send({"type": "http.response.body", "body": json.dumps({"received": len(message["body"])}).encode()})
+
+
+async def inline_proxy(req: func.HttpRequest) -> func.HttpResponse:
+    """The previous func_asher_chatbot body, calling bare_app."""
+    route = req.route_params.get('route', '')
+    if route:
+        path = '/' + route
+    else:
+        path = '/'
+
+    method = req.method
+    logging.info(f"Received {method} request to {path}")
+    logging.info(f"Query parameters: {dict(req.params)}")
+    logging.info(f"Headers: {dict(req.headers)}")
+
+    params = {}
+    for param_name, param_value in req.params.items():
+        if param_name != 'code':
+            params[param_name] = param_value
+
+    query_string = b'&'.join([f"{k}={v}".encode() for k, v in params.items()])
+    logging.info(f"Query string: {query_string}")
+
+    headers = []
+    for key, value in req.headers.items():
+        if key.lower() not in ('host', 'x-forwarded-for', 'x-functions-key'):
+            headers.append((key.lower().encode(), value.encode()))
+
+    body = req.get_body()
+    if body:
+        logging.info(f"Request body: {body.decode('utf-8', errors='replace')}")
+
+    if body and not any(k == b'content-type' for k, _ in headers):
+        headers.append((b'content-type', b'application/json'))
+
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0', 'spec_version': '2.1'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'https',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query_string,
+        'headers': headers,
+        'server': ('azure-functions', ''),
+        'client': ('', 0),
+    }
+
+    async def receive():
+        return {
+            'type': 'http.request',
+            'body': body or b'',
+            'more_body': False,
+        }
+
+    response_status = None
+    response_headers = []
+    response_body = bytearray()
+    streamed = False
+
+    async def send(message):
+        nonlocal response_status, response_headers, response_body, streamed
+        if message['type'] == 'http.response.start':
+            response_status = message['status']
+            response_headers = message.get('headers', [])
+        elif message['type'] == 'http.response.body':
+            response_body.extend(message.get('body', b''))
+            if message.get('more_body', False):
+                streamed = True
+
+    try:
+        await bare_app(scope, receive, send)
+        headers_dict = {}
+        for key, value in response_headers:
+            headers_dict[key.decode('utf-8')] = value.decode('utf-8')
+        if streamed:
+            logging.info("Streamed response buffered by the Functions proxy")
+            headers_dict['x-stream-mode'] = 'buffered'
+        logging.info(f"Response status: {response_status}")
+        if response_body:
+            try:
+                body_snippet = response_body[:200].decode('utf-8', errors='replace')
+                logging.info(f"Response body (partial): {body_snippet}...")
+            except Exception:
+                logging.info("Could not log response body due to encoding issues")
+        return func.HttpResponse(body=bytes(response_body), status_code=response_status, headers=headers_dict)
+    except Exception as e:
+        logging.error(f"Error processing request: {str(e)}")
+        return func.HttpResponse(body=json.dumps({"error": str(e)}), status_code=500, mimetype="application/json")
+
+
+def make_request(method, params, body):
+    return func.HttpRequest(
+        method=method,
+        url="https://bench.azurewebsites.net/api/bench",
+        headers={
+            "content-type": "application/json",
+            "authorization": "Bearer bench",
+            "user-agent": "bench/1.0",
+            "accept": "application/json",
+            "x-forwarded-for": "10.0.0.1",
+        },
+        params=params,
+        route_params={"route": "api/bench"},
+        body=body,
+    )
+
+
+CASES = (
+    ("GET, 3 query params", lambda: make_request("GET", {"code": "key", "page_size": "20", "prefix": "user a"}, b"")),
+    ("POST, 16 KB JSON body", lambda: make_request("POST", {}, json.dumps({"prompt": "q" * 16000}).encode())),
+    ("GET, 64 x 4 KB chunks", lambda: make_request("GET", {"chunks": "64"}, b"")),
+)
+
+
+async def measure(handler, req, count):
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = await handler(req)
+        timings.append((time.perf_counter() - start) * 1e6)
+        assert response.status_code == 200
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per case and implementation")
+    args = parser.parse_args()
+
+    sink = io.StringIO()
+    handler = logging.StreamHandler(sink)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    logging.basicConfig(level=logging.INFO, handlers=[handler], force=True)
+
+    adapter = FunctionsAsgiAdapter(app=bare_app)
+    implementations = (("inline proxy", inline_proxy), ("adapter", adapter.handle))
+
+    print(f"{args.requests} requests per case, logging at INFO")
+    print(f"{'case':<24} {'implementation':<14} {'p50 us':>8} {'p95 us':>8} {'log bytes/req':>14}")
+    for label, build in CASES:
+        req = build()
+        for name, implementation in implementations:
+            asyncio.run(measure(implementation, req, 50))
+            sink.seek(0)
+            sink.truncate()
+            timings = sorted(asyncio.run(measure(implementation, req, args.requests)))
+            log_bytes = len(sink.getvalue()) / args.requests
+            print(f"{label:<24} {name:<14} {statistics.median(timings):8.1f} "
+                  f"{timings[int(0.95 * (len(timings) - 1))]:8.1f} {log_bytes:14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Cold start of the Azure Functions entry point (function_app.py).
+
+Each run starts a fresh interpreter that imports function_app, as the
+Functions worker does when it indexes the app, and then serves requests
+through func_asher_chatbot: a health check (GET /api/) and a chat
+(POST /api/openai). Cosmos DB, Search and OpenAI are replaced with the
+service-level stand-ins from benchmarks/stand_ins.py, so the times are
+imports and in-process work only; the SDK client construction and the
+upstream round trips are not part of them.
+
+Modes:
+    eager         FUNCTIONS_FAST_START=False: API, SDKs and services loaded at import
+    fast          FUNCTIONS_FAST_START=True: everything deferred to the first request
+    fast+warmup   fast, with the warmup trigger run before the first request
+
+The import profile (python -X importtime) lists the heaviest modules
+imported by `import function_app` in each mode.
+
+Usage:
+    python -m benchmarks.functions_cold_start --runs 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STAND_IN_ENV = {
+    "AZURE_SEARCH_SERVICE_ENDPOINT": "https://search.invalid",
+    "AZURE_SEARCH_INDEX_NAME": "bench",
+    "AZURE_SEARCH_API_KEY": "bench",
+    "AZURE_OPENAI_API_KEY": "bench",
+    "COSMOS_ENDPOINT": "https://cosmos.invalid",
+    "COSMOS_KEY": "YmVuY2g=",
+}
+MODES = {
+    "eager": {"FUNCTIONS_FAST_START": "False"},
+    "fast": {"FUNCTIONS_FAST_START": "True"},
+    "fast+warmup": {"FUNCTIONS_FAST_START": "True"},
+}
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)")
+
+
+def child_environment(mode):
+    env = dict(os.environ)
+    for name, value in STAND_IN_ENV.items():
+        env.setdefault(name, value)
+    env.update(MODES[mode])
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+
+def run_child(mode, latency):
+    """Measure one cold start in this (fresh) process and print it as JSON."""
+    process_start = time.perf_counter()
+    from benchmarks.stand_ins import StandInCosmos, StandInOpenAI, StandInSearch
+    from app.services.container import services
+
+    services.override(
+        cosmos_service=StandInCosmos(latency, blocking=False),
+        search_service=StandInSearch(latency, blocking=False),
+        openai_service=StandInOpenAI(latency, blocking=False),
+        answer_cache=None
+    )
+
+    start = time.perf_counter()
+    import function_app
+    import azure.functions as func
+    timings = {"import_ms": (time.perf_counter() - start) * 1000}
+
+    if mode == "fast+warmup":
+        start = time.perf_counter()
+        function_app.warmup(None)
+        timings["warmup_ms"] = (time.perf_counter() - start) * 1000
+
+    def request(method, route, body=None):
+        return func.HttpRequest(
+            method=method,
+            url=f"https://bench.azurewebsites.net/{route}",
+            headers={"content-type": "application/json"},
+            params={},
+            route_params={"route": route},
+            body=json.dumps(body).encode() if body is not None else b"",
+        )
+
+    async def serve():
+        for name, req in (
+            ("first_health_ms", request("GET", "api/")),
+            ("first_chat_ms", request("POST", "api/openai", {"prompt": "first question", "user_id": "bench"})),
+            ("second_chat_ms", request("POST", "api/openai", {"prompt": "second question", "user_id": "bench"})),
+        ):
+            start = time.perf_counter()
+            response = await function_app.func_asher_chatbot(req)
+            timings[name] = (time.perf_counter() - start) * 1000
+            if response.status_code != 200:
+                raise RuntimeError(f"{name}: status {response.status_code}: {response.get_body()[:200]!r}")
+
+    asyncio.run(serve())
+    timings["to_first_chat_ms"] = (time.perf_counter() - process_start) * 1000 - timings["second_chat_ms"]
+    print(json.dumps(timings))
+
+
+def import_profile(mode, top):
+    """
+    Total import time of `import function_app` (the sum of every module's own
+    time, so service construction in eager mode is left out) and the
+    heaviest modules it imports directly, in microseconds.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import function_app"],
+        env=child_environment(mode), cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            depth = (len(match.group(3)) - 1) // 2
+            entries.append((int(match.group(2)), depth, match.group(4), int(match.group(1))))
+    total = sum(own for _, _, name, own in entries if name != "function_app")
+    heaviest = sorted((entry for entry in entries if entry[1] == 1), reverse=True)[:top]
+    return total, heaviest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Cold starts per mode")
+    parser.add_argument("--latency", type=float, default=0.05, help="Stand-in latency per upstream call (seconds)")
+    parser.add_argument("--top", type=int, default=6, help="Modules listed in the import profile")
+    parser.add_argument("--child", choices=sorted(MODES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.latency)
+        return
+
+    columns = ("import_ms", "warmup_ms", "first_health_ms", "first_chat_ms", "second_chat_ms", "to_first_chat_ms")
+    print(f"median of {args.runs} cold starts, stand-in latency {args.latency * 1000:.0f} ms per upstream call")
+    print(f"{'mode':<12}" + "".join(f"{column[:-3]:>17}" for column in columns))
+    for mode in MODES:
+        runs = []
+        for _ in range(args.runs):
+            result = subprocess.run(
+                [sys.executable, "-m", "benchmarks.functions_cold_start", "--child", mode, "--latency", str(args.latency)],
+                env=child_environment(mode), cwd=ROOT, capture_output=True, text=True
+            )
+            if result.returncode != 0:
+                sys.exit(f"{mode} run failed:\n{result.stderr}")
+            runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+        cells = []
+        for column in columns:
+            values = [run[column] for run in runs if column in run]
+            cells.append(f"{statistics.median(values):17.1f}" if values else f"{'-':>17}")
+        print(f"{mode:<12}" + "".join(cells))
+
+    for mode in ("eager", "fast"):
+        total, heaviest = import_profile(mode, args.top)
+        print(f"\nimport function_app ({mode}): {total / 1000:.1f} ms of module imports")
+        for cumulative, _, name, _ in heaviest:
+            print(f"  {name:<32} {cumulative / 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Ingestion throughput against local fake embeddings and search servers.
+
+Writes a synthetic corpus (documents assembled from the fixture passages)
+to a temporary folder and ingests it with IngestionPipeline through the
+app's OpenAI service and an async SearchClient, pointed at
+benchmarks/fake_openai.py and benchmarks/fake_search.py:
+
+1. a full run with one embeddings call in flight,
+2. a full run with --concurrency calls in flight,
+3. an incremental run after --change-ratio of the documents were edited
+   and one was deleted, which should only embed and upload the edited
+   chunks.
+
+Reports chunks/s and the embeddings and index calls of each run.
+
+Usage:
+    python -m benchmarks.ingestion_throughput --documents 200 --concurrency 8
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fake_openai, fake_search
+from benchmarks.local_search import load_fixture
+from benchmarks.servers import BackgroundServer
+
+
+def write_corpus(folder: str, documents: int, paragraphs: int, seed: int = 7):
+    passages = [chunk["chunk"] for chunk in load_fixture()["chunks"]]
+    rng = random.Random(seed)
+    for number in range(documents):
+        body = "\n\n".join(f"{rng.choice(passages)} (section {number}.{index})" for index in range(paragraphs))
+        with open(os.path.join(folder, f"doc-{number:05d}.md"), "w", encoding="utf-8") as f:
+            f.write(f"# Margie's Travel document {number}\n\n{body}\n")
+
+
+def edit_corpus(folder: str, ratio: float, seed: int = 11):
+    """Rewrite one paragraph of ``ratio`` of the documents and delete one document."""
+    rng = random.Random(seed)
+    names = sorted(os.listdir(folder))
+    for name in rng.sample(names, max(1, int(len(names) * ratio))):
+        path = os.path.join(folder, name)
+        with open(path, encoding="utf-8") as f:
+            paragraphs = f.read().split("\n\n")
+        paragraphs[-1] = f"Updated {rng.random():.6f}: {paragraphs[-1]}"
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n\n".join(paragraphs))
+    os.remove(os.path.join(folder, names[-1]))
+
+
+async def run_all(args, folder, checkpoint_path, fakes):
+    from azure.core.credentials import AzureKeyCredential
+    from azure.search.documents.aio import SearchClient
+
+    from app.services.container import services
+    from app.services.ingestion import Chunker, IngestionCheckpoint, IngestionPipeline, iter_documents
+
+    search_client = SearchClient(
+        endpoint=os.environ["AZURE_SEARCH_SERVICE_ENDPOINT"],
+        index_name="bench",
+        credential=AzureKeyCredential("bench"),
+        transport=services.http_pools.async_transport("search"),
+    )
+    chunker = Chunker(args.chunk_tokens, args.overlap_tokens)
+    runs = [("full, 1 in flight", 1, True), (f"full, {args.concurrency} in flight", args.concurrency, True),
+            ("incremental", args.concurrency, False)]
+    print(f"{'run':<22} {'chunks':>7} {'unchanged':>10} {'deleted':>8} {'seconds':>8} {'chunks/s':>9} {'embed calls':>12} {'index calls':>12}")
+    async with search_client:
+        for label, concurrency, full in runs:
+            if not full:
+                edit_corpus(folder, args.change_ratio)
+            checkpoint = IngestionCheckpoint(checkpoint_path, "bench")
+            if full:
+                checkpoint.documents = {}
+            pipeline = IngestionPipeline(
+                search_client,
+                services.openai_service.generate_embeddings_batch_async,
+                checkpoint,
+                "text_vector",
+                chunker=chunker,
+                embedding_batch_size=args.batch_size,
+                embedding_concurrency=concurrency,
+                upload_batch_size=args.upload_batch_size,
+            )
+            embed_before = fakes["openai"].state.calls["embeddings"]
+            index_before = fakes["search"].state.calls["index"]
+            stats = await pipeline.run(iter_documents(folder))
+            print(f"{label:<22} {stats.chunks_uploaded:>7} {stats.chunks_unchanged:>10} {stats.chunks_deleted:>8} "
+                  f"{stats.elapsed_seconds:>8.2f} {stats.chunks_per_second:>9.1f} "
+                  f"{fakes['openai'].state.calls['embeddings'] - embed_before:>12} {fakes['search'].state.calls['index'] - index_before:>12}")
+            if stats.failed:
+                print(f"  failed documents: {len(stats.failed)}")
+    await services.shutdown()
+    print(f"\nDocuments in the fake index: {len(fakes['search'].state.documents)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=200, help="Documents in the corpus")
+    parser.add_argument("--paragraphs", type=int, default=12, help="Paragraphs per document")
+    parser.add_argument("--chunk-tokens", type=int, default=256, help="Largest chunk, in tokens")
+    parser.add_argument("--overlap-tokens", type=int, default=32, help="Overlap between chunks, in tokens")
+    parser.add_argument("--batch-size", type=int, default=16, help="Chunks per embeddings call")
+    parser.add_argument("--concurrency", type=int, default=8, help="Embeddings calls in flight in the concurrent runs")
+    parser.add_argument("--upload-batch-size", type=int, default=500, help="Index actions per upload batch")
+    parser.add_argument("--change-ratio", type=float, default=0.1, help="Share of documents edited before the incremental run")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="Fake embeddings call latency (seconds)")
+    parser.add_argument("--embedding-concurrency", type=int, default=16, help="Embeddings calls the fake serves at once")
+    parser.add_argument("--search-latency", type=float, default=0.02, help="Fake index call latency (seconds)")
+    args = parser.parse_args()
+
+    fakes = {
+        "openai": fake_openai.create_app(latency=args.embedding_latency, max_concurrent_calls=args.embedding_concurrency),
+        "search": fake_search.create_app(latency=args.search_latency),
+    }
+    with BackgroundServer(fakes["openai"]) as openai_server, BackgroundServer(fakes["search"]) as search_server, \
+            tempfile.TemporaryDirectory() as folder:
+        os.environ.update({
+            "AZURE_OPENAI_ENDPOINT": openai_server.url,
+            "AZURE_SEARCH_SERVICE_ENDPOINT": search_server.url,
+            "EMBEDDING_CACHE_ENABLED": "False",
+            "EMBEDDING_BATCHING_ENABLED": "False",
+        })
+        for name in ("AZURE_OPENAI_API_KEY", "AZURE_SEARCH_API_KEY", "AZURE_SEARCH_INDEX_NAME", "AZURE_OPENAI_EMBEDDING_DEPLOYMENT"):
+            os.environ.setdefault(name, "bench")
+        corpus = os.path.join(folder, "documents")
+        os.makedirs(corpus)
+        write_corpus(corpus, args.documents, args.paragraphs)
+        print(f"{args.documents} documents of {args.paragraphs} paragraphs in {corpus}")
+        asyncio.run(run_all(args, corpus, os.path.join(folder, "checkpoint.json"), fakes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+"""
+End-to-end load test of the API against local fake upstreams.
+
+Starts fake Azure OpenAI (chat, streaming chat and embeddings), Azure AI
+Search and Cosmos DB servers (benchmarks/fake_*.py) in one child process,
+the API (python -m app.commands.serve with --workers processes) in
+another, pointed at them through the usual environment variables, and
+drives it with simulated users. Every
+layer of the app runs for real, including the Azure and OpenAI SDKs and
+their connection pools; only the services behind them are fakes. The
+fakes and the driver need CPU too, so compare runs made on the same
+machine, preferably one with a few cores to spare.
+
+Each simulated user holds conversations of a realistic length (1 to
+--max-turns turns, most of them short), asking the fixture questions and
+follow-ups (--repeat-ratio of them worded verbatim, so caches can hit)
+through /api/openai or, for --stream-ratio of the turns,
+/api/openai/stream. After a conversation the user opens the sidebar
+(/api/conversations) and the conversation (/api/conversations/{id}) with
+probability --browse-ratio, and lists /api/user-ids with probability
+--admin-ratio.
+
+Reported: p50/p95/p99 latency, requests per second and errors per
+endpoint, and the calls each fake upstream served, in total and per chat
+turn. --openai-tpm and --openai-max-concurrency make the fake chat
+deployment throttle (429 with Retry-After); the report then also counts
+the turns rejected as busy (429/503) and those whose completion failed
+(502, or an "error" event in a stream). --output saves the results as JSON and --compare prints the change
+against a saved run, so changes to app/services/* can be checked for
+regressions.
+
+Usage:
+    python -m benchmarks.load_test --users 32 --duration 30
+    python -m benchmarks.load_test --output before.json
+    python -m benchmarks.load_test --compare before.json --env EMBEDDING_BATCHING_ENABLED=False
+    python -m benchmarks.load_test --openai-tpm 60000 --env UPSTREAM_SCHEDULER_ENABLED=False
+    python -m benchmarks.load_test --compare before.json --env WRITE_BEHIND_ENABLED=True
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FOLLOW_UPS = (
+    "How much does it cost?",
+    "Which hotel do guests stay at?",
+    "When is the best time to go?",
+    "What activities are included?",
+    "Can you tell me more about that?",
+    "Is breakfast included?",
+    "How long is the trip?",
+    "What should I pack?",
+)
+ENDPOINTS = ("chat", "chat_stream", "conversations", "conversation", "user_ids")
+COSMOS_CONTAINERS = {"Conversations": "/user_id", "Users": "/registry"}
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def conversation_length(rng, max_turns):
+    """Turns in a conversation: geometric with mean ~3, capped at max_turns."""
+    turns = 1
+    while turns < max_turns and rng.random() < 0.65:
+        turns += 1
+    return turns
+
+
+# --- fake upstreams (child process) ------------------------------------------
+
+def serve_fakes(args):
+    """Run the three fake servers until stdin closes; print their URLs as JSON."""
+    from benchmarks import fake_cosmos, fake_openai, fake_search
+    from benchmarks.local_search import stand_in_embedding
+    from benchmarks.servers import BackgroundServer
+
+    apps = {
+        "openai": fake_openai.create_app(
+            latency=args.embedding_latency,
+            max_concurrent_calls=args.embedding_concurrency,
+            embed=stand_in_embedding,
+            first_token_latency=args.first_token_latency,
+            token_latency=args.token_latency,
+            answer_tokens=args.answer_tokens,
+            tokens_per_minute=args.openai_tpm,
+            throttle_concurrency=args.openai_max_concurrency,
+            quota_window=args.openai_quota_window,
+        ),
+        "search": fake_search.create_app(latency=args.search_latency),
+        "cosmos": fake_cosmos.create_app(
+            latency=args.cosmos_latency,
+            databases={"asher_chatDB": COSMOS_CONTAINERS},
+        ),
+    }
+    servers = {name: BackgroundServer(app) for name, app in apps.items()}
+    for server in servers.values():
+        server.__enter__()
+    print(json.dumps({name: server.url for name, server in servers.items()}), flush=True)
+    sys.stdin.read()
+    for server in servers.values():
+        server.__exit__(None, None, None)
+
+
+def start_fakes(args):
+    command = [sys.executable, "-m", "benchmarks.load_test", "--serve-fakes"]
+    for name in ("embedding_latency", "embedding_concurrency", "first_token_latency", "token_latency",
+                 "answer_tokens", "search_latency", "cosmos_latency", "openai_tpm", "openai_max_concurrency",
+                 "openai_quota_window"):
+        command += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    process = subprocess.Popen(command, cwd=ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    urls = json.loads(process.stdout.readline())
+    return process, urls
+
+
+def start_app(args, urls, port):
+    env = dict(os.environ)
+    env.update({
+        "AZURE_OPENAI_ENDPOINT": urls["openai"],
+        "AZURE_OPENAI_API_KEY": "bench",
+        "AZURE_SEARCH_SERVICE_ENDPOINT": urls["search"],
+        "AZURE_SEARCH_INDEX_NAME": "bench",
+        "AZURE_SEARCH_API_KEY": "bench",
+        "VECTOR_FIELD_NAME": "text_vector",
+        "COSMOS_ENDPOINT": urls["cosmos"],
+        "COSMOS_KEY": "YmVuY2g=",
+        "COSMOS_DATABASE": "asher_chatDB",
+        "COSMOS_CONTAINER": "Conversations",
+        "USER_REGISTRY_CONTAINER": "Users",
+        "EMBEDDING_CACHE_PATH": "",
+        "LOCAL_INDEX_PATH": "",
+        "LOG_LEVEL": "WARNING",
+    })
+    env.setdefault("AZURE_OPENAI_MODEL", "bench-chat")
+    env.setdefault("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "bench-embedding")
+    for assignment in args.env:
+        name, _, value = assignment.partition("=")
+        env[name] = value
+    command = [sys.executable, "-m", "app.commands.serve", "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(args.workers), "--log-level", "warning"]
+    return subprocess.Popen(command, cwd=ROOT, env=env)
+
+
+async def wait_until_ready(client, url, process, timeout=120.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process is not None and process.poll() is not None:
+            sys.exit(f"The API exited with status {process.returncode}")
+        try:
+            if (await client.get(url + "/health")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    sys.exit("The API did not become ready")
+
+
+async def upstream_stats(client, urls):
+    if not urls:
+        return {}
+    stats = {}
+    for name, url in urls.items():
+        stats[name] = (await client.get(url + "/_stats")).json()
+    return stats
+
+
+def upstream_delta(before, after):
+    """Calls (and tokens, request units) served between two /_stats snapshots."""
+    delta = {}
+    for name, stats in after.items():
+        calls = Counter(stats["calls"])
+        calls.subtract(before.get(name, {}).get("calls", {}))
+        delta[name] = {"calls": {key: value for key, value in calls.items() if value}}
+        if "tokens" in stats:
+            tokens = Counter(stats["tokens"])
+            tokens.subtract(before[name].get("tokens", {}))
+            delta[name]["tokens"] = {key: value for key, value in tokens.items() if value}
+        if "request_units" in stats:
+            delta[name]["request_units"] = round(stats["request_units"] - before[name]["request_units"], 2)
+    return delta
+
+
+# --- load driver --------------------------------------------------------------
+
+class Driver:
+    def __init__(self, client, base_url, args, queries):
+        self.client = client
+        self.base_url = base_url
+        self.args = args
+        self.queries = queries
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.statuses = defaultdict(Counter)
+        self.recording = False
+
+    async def call(self, endpoint, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            if endpoint == "chat_stream":
+                body = b""
+                async with self.client.stream(method, self.base_url + path, **kwargs) as response:
+                    async for chunk in response.aiter_bytes():
+                        body += chunk
+                status = response.status_code
+                events = [json.loads(line) for line in body.splitlines() if line]
+                result = events[0] if events and events[-1].get("type") == "done" else None
+                if result is None and status == 200:
+                    # An "error" event carries the status the request would have failed with
+                    status = events[-1].get("status", 599) if events and events[-1].get("type") == "error" else 599
+            else:
+                response = await self.client.request(method, self.base_url + path, **kwargs)
+                status = response.status_code
+                result = response.json() if status == 200 else None
+        except httpx.HTTPError:
+            status, result = 598, None
+        if self.recording:
+            self.latencies[endpoint].append((time.perf_counter() - start) * 1000)
+            self.statuses[endpoint][status] += 1
+            if status != 200:
+                self.errors[endpoint] += 1
+        return result
+
+    async def user(self, user_number, deadline):
+        rng = random.Random(user_number)
+        user_id = f"load-user-{user_number % self.args.user_pool:04d}"
+        asked = 0
+        while time.perf_counter() < deadline:
+            conversation_id = None
+            topic = rng.choice(self.queries)
+            for turn in range(conversation_length(rng, self.args.max_turns)):
+                if time.perf_counter() >= deadline:
+                    return
+                prompt = topic if turn == 0 else rng.choice(FOLLOW_UPS)
+                asked += 1
+                if rng.random() >= self.args.repeat_ratio:
+                    # Most questions are worded differently from any asked before
+                    prompt = f"{prompt} (trip {user_number}-{asked})"
+                body = {"prompt": prompt, "user_id": user_id}
+                if conversation_id:
+                    body["conversation_id"] = conversation_id
+                stream = rng.random() < self.args.stream_ratio
+                result = await self.call("chat_stream" if stream else "chat", "POST", "/api/openai/stream" if stream else "/api/openai", json=body)
+                if result is None:
+                    break
+                conversation_id = result["conversation_id"]
+                if self.args.think_ms:
+                    await asyncio.sleep(rng.uniform(0.5, 1.5) * self.args.think_ms / 1000)
+
+            if conversation_id and rng.random() < self.args.browse_ratio:
+                await self.call("conversations", "GET", "/api/conversations", params={"user_id": user_id, "page_size": 20})
+                await self.call("conversation", "GET", f"/api/conversations/{conversation_id}", params={"user_id": user_id})
+            if rng.random() < self.args.admin_ratio:
+                await self.call("user_ids", "GET", "/api/user-ids", params={"page_size": 100})
+
+    async def run(self, users, seconds, first_user=0):
+        deadline = time.perf_counter() + seconds
+        await asyncio.gather(*(self.user(first_user + number, deadline) for number in range(users)))
+
+
+def summarize(driver, elapsed, upstream, args):
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        values = driver.latencies.get(endpoint, [])
+        if not values:
+            continue
+        endpoints[endpoint] = {
+            "requests": len(values),
+            "errors": driver.errors[endpoint],
+            "rps": round(len(values) / elapsed, 2),
+            "p50_ms": round(percentile(values, 0.50), 1),
+            "p95_ms": round(percentile(values, 0.95), 1),
+            "p99_ms": round(percentile(values, 0.99), 1),
+            "statuses": {str(status): count for status, count in sorted(driver.statuses[endpoint].items())},
+        }
+    total = sum(len(values) for values in driver.latencies.values())
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "serve_fakes")},
+        "elapsed_s": round(elapsed, 2),
+        "requests": total,
+        "rps": round(total / elapsed, 2),
+        "chat_turns": sum(len(driver.latencies.get(endpoint, [])) for endpoint in ("chat", "chat_stream")),
+        "busy": sum(row["statuses"].get(code, 0) for row in endpoints.values() for code in ("429", "503")),
+        "failed": sum(row["statuses"].get(code, 0) for row in endpoints.values() for code in ("502",)),
+        "endpoints": endpoints,
+        "upstream": upstream,
+    }
+
+
+def report(results, baseline=None):
+    def change(path, value):
+        if baseline is None:
+            return ""
+        reference = baseline
+        for key in path:
+            reference = reference.get(key, {}) if isinstance(reference, dict) else {}
+        if not isinstance(reference, (int, float)) or not reference:
+            return f"{'':>9}"
+        return f"{(value - reference) / reference * 100:+8.1f}%"
+
+    print(f"\n{results['requests']} requests in {results['elapsed_s']:.1f} s: {results['rps']:.1f} requests/s "
+          f"{change(('rps',), results['rps'])}, {results['chat_turns']} chat turns")
+    print(f"{'endpoint':<14} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for endpoint, row in results["endpoints"].items():
+        print(f"{endpoint:<14} {row['requests']:>9} {row['errors']:>7} {row['rps']:>8.1f} "
+              f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+        if baseline is not None:
+            print(f"{'':<14} {'':>9} {'':>7} {change(('endpoints', endpoint, 'rps'), row['rps'])}"
+                  + "".join(change(("endpoints", endpoint, key), row[key]) + " " for key in ("p50_ms", "p95_ms", "p99_ms")))
+
+    if results.get("busy") or results.get("failed"):
+        print(f"\nrejected as busy (429/503): {results['busy']}, failed completions (502 or stream error): {results['failed']}")
+
+    turns = max(results["chat_turns"], 1)
+    if results["upstream"]:
+        print(f"\n{'upstream call':<26} {'calls':>9} {'per turn':>9}")
+        for name, stats in results["upstream"].items():
+            for call, count in sorted(stats["calls"].items()):
+                print(f"{name + ' ' + call:<26} {count:>9} {count / turns:>9.2f} {change(('upstream', name, 'calls', call), count)}")
+            for kind, count in sorted(stats.get("tokens", {}).items()):
+                print(f"{name + ' tokens ' + kind:<26} {count:>9} {count / turns:>9.1f}")
+            if "request_units" in stats:
+                print(f"{name + ' request units':<26} {stats['request_units']:>9.0f} {stats['request_units'] / turns:>9.1f}")
+
+
+async def drive(args, base_url, urls, app_process):
+    from benchmarks.local_search import load_fixture
+
+    queries = [query["query"] for query in load_fixture()["queries"]]
+    limits = httpx.Limits(max_connections=args.users * 2, max_keepalive_connections=args.users * 2)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(120.0)) as client:
+        await wait_until_ready(client, base_url, app_process)
+        driver = Driver(client, base_url, args, queries)
+        if args.warmup:
+            await driver.run(min(args.users, 8), args.warmup, first_user=10_000)
+
+        before = await upstream_stats(client, urls)
+        driver.recording = True
+        start = time.perf_counter()
+        await driver.run(args.users, args.duration)
+        elapsed = time.perf_counter() - start
+        driver.recording = False
+        # Let the background saves of the last turns finish before counting
+        await asyncio.sleep(0.5)
+        after = await upstream_stats(client, urls)
+    return summarize(driver, elapsed, upstream_delta(before, after), args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=32, help="Concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Seconds of unmeasured load first")
+    parser.add_argument("--user-pool", type=int, default=200, help="Distinct user ids the simulated users share")
+    parser.add_argument("--max-turns", type=int, default=12, help="Longest conversation, in turns")
+    parser.add_argument("--stream-ratio", type=float, default=0.3, help="Share of turns sent to /api/openai/stream")
+    parser.add_argument("--browse-ratio", type=float, default=0.5, help="Chance of opening the conversation list after a conversation")
+    parser.add_argument("--admin-ratio", type=float, default=0.05, help="Chance of listing /api/user-ids after a conversation")
+    parser.add_argument("--repeat-ratio", type=float, default=0.3, help="Share of questions sent verbatim (the rest are made unique)")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="Mean pause between a user's turns")
+    parser.add_argument("--target", help="Load an already running API at this URL instead of starting one (no upstream counts)")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="Environment for the started API (repeatable)")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes of the started API")
+    parser.add_argument("--embedding-latency", type=float, default=0.03, help="Fake embeddings call latency (seconds)")
+    parser.add_argument("--embedding-concurrency", type=int, default=16, help="Embeddings calls the fake serves at once")
+    parser.add_argument("--first-token-latency", type=float, default=0.2, help="Fake completion time to first token (seconds)")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="Fake completion time per further token (seconds)")
+    parser.add_argument("--answer-tokens", type=int, default=60, help="Tokens per fake completion")
+    parser.add_argument("--search-latency", type=float, default=0.03, help="Fake search call latency (seconds)")
+    parser.add_argument("--cosmos-latency", type=float, default=0.005, help="Fake Cosmos DB call latency (seconds)")
+    parser.add_argument("--openai-tpm", type=int, default=0, help="Fake chat deployment quota in tokens per minute (0 for none)")
+    parser.add_argument("--openai-max-concurrency", type=int, default=0, help="Fake chat calls in flight before it answers 429 (0 for none)")
+    parser.add_argument("--openai-quota-window", type=float, default=10.0, help="Seconds over which the fake counts its quota")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="Show changes against results saved with --output")
+    parser.add_argument("--serve-fakes", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_fakes:
+        serve_fakes(args)
+        return
+
+    fakes = app_process = None
+    urls = {}
+    try:
+        if args.target:
+            base_url = args.target.rstrip("/")
+        else:
+            from benchmarks.servers import free_port
+
+            fakes, urls = start_fakes(args)
+            port = free_port()
+            app_process = start_app(args, urls, port)
+            base_url = f"http://127.0.0.1:{port}"
+
+        print(f"{args.users} users for {args.duration:.0f} s against {base_url}")
+        results = asyncio.run(drive(args, base_url, urls, app_process))
+    finally:
+        if app_process is not None:
+            app_process.terminate()
+            app_process.wait(timeout=30)
+        if fakes is not None:
+            fakes.stdin.close()
+            fakes.wait(timeout=30)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
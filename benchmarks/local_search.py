@@ -0,0 +1,168 @@
+"""
+Local stand-in for the Azure AI Search client over the fixture corpus.
+
+Implements the subset of SearchClient.search the app uses: vector queries
+(exact kNN by cosine), keyword queries (BM25) and hybrid queries fused with
+Reciprocal Rank Fusion like the service does. Every call sleeps for a fixed
+latency to stand in for the network round trip.
+
+The stand-in embedding is a hashed bag of words that ignores codes and
+proper nouns (tokens with digits or capitals), the kind of exact terms a
+dense embedding model represents poorly.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import time
+from collections import Counter
+
+import numpy as np
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "travel_corpus.json")
+VECTOR_FIELD = "text_vector"
+RRF_K = 60
+
+STOPWORDS = {
+    "a", "an", "and", "are", "at", "be", "by", "can", "do", "does", "for", "from", "has", "have", "how",
+    "i", "in", "is", "it", "me", "my", "of", "on", "or", "the", "to", "what", "when", "where", "which",
+    "with", "please", "tell", "about", "this", "that", "each", "so", "our", "their", "they",
+}
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9'-]+")
+
+
+def load_fixture(path=FIXTURE_PATH):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def keyword_tokens(text):
+    return [token.lower() for token in TOKEN_PATTERN.findall(text) if token.lower() not in STOPWORDS]
+
+
+def stand_in_embedding(text, dimensions=256):
+    """Hashed bag-of-words vector of the lowercase, digit-free words in ``text``."""
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for token in TOKEN_PATTERN.findall(text):
+        if any(ch.isdigit() for ch in token) or not token.islower() or token in STOPWORDS:
+            continue
+        digest = hashlib.sha256(token.rstrip("s").encode("utf-8")).digest()
+        vector[int.from_bytes(digest[:4], "little") % dimensions] += 1.0 if digest[4] & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+class LocalSearchIndex:
+    """Synchronous stand-in for azure.search.documents.SearchClient."""
+
+    def __init__(self, chunks, latency=0.02, dimensions=256):
+        self.latency = latency
+        self.documents = []
+        for chunk in chunks:
+            document = dict(chunk)
+            document[VECTOR_FIELD] = stand_in_embedding(chunk["chunk"], dimensions)
+            self.documents.append(document)
+        self.matrix = np.asarray([doc[VECTOR_FIELD] for doc in self.documents], dtype=np.float32)
+
+        self.doc_tokens = [Counter(keyword_tokens(doc["title"] + " " + doc["chunk"])) for doc in self.documents]
+        self.avg_length = sum(sum(tokens.values()) for tokens in self.doc_tokens) / len(self.doc_tokens)
+        document_frequency = Counter(token for tokens in self.doc_tokens for token in tokens)
+        count = len(self.documents)
+        self.idf = {
+            token: math.log(1 + (count - freq + 0.5) / (freq + 0.5))
+            for token, freq in document_frequency.items()
+        }
+        self.calls = 0
+
+    def _bm25(self, text, k1=1.2, b=0.75):
+        query = keyword_tokens(text)
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        for index, tokens in enumerate(self.doc_tokens):
+            length = sum(tokens.values())
+            for token in query:
+                freq = tokens.get(token, 0)
+                if freq:
+                    scores[index] += self.idf[token] * freq * (k1 + 1) / (freq + k1 * (1 - b + b * length / self.avg_length))
+        return scores
+
+    @staticmethod
+    def _ranking(scores, limit, positive_only=False):
+        order = np.argsort(-scores, kind="stable")[:limit]
+        return [int(index) for index in order if not positive_only or scores[index] > 0]
+
+    def _run(self, search_text, vector_queries, select, top):
+        if search_text == "*" and not vector_queries:
+            # Match-all query, as used to export the index
+            order = list(range(len(self.documents)))[:top]
+            scores = {index: 1.0 for index in order}
+            return self._results(order, scores, select)
+
+        rankings = []
+        single_scores = None
+        if vector_queries:
+            query = vector_queries[0]
+            cosine = self.matrix @ np.asarray(query.vector, dtype=np.float32)
+            rankings.append(self._ranking(cosine, query.k_nearest_neighbors))
+            single_scores = cosine
+        if search_text:
+            bm25 = self._bm25(search_text)
+            rankings.append(self._ranking(bm25, max(top, 50), positive_only=True))
+            single_scores = bm25
+
+        if len(rankings) == 1:
+            order = rankings[0][:top]
+            scores = {index: float(single_scores[index]) for index in order}
+        else:
+            fused = Counter()
+            for ranking in rankings:
+                for rank, index in enumerate(ranking):
+                    fused[index] += 1.0 / (RRF_K + rank + 1)
+            order = [index for index, _ in sorted(fused.items(), key=lambda item: -item[1])[:top]]
+            scores = dict(fused)
+
+        return self._results(order, scores, select)
+
+    def _results(self, order, scores, select):
+        results = []
+        for index in order:
+            document = self.documents[index]
+            result = {field: document[field] for field in (select or document) if field in document}
+            result["@search.score"] = scores[index]
+            results.append(result)
+        return results
+
+    def search(self, search_text=None, vector_queries=None, select=None, top=1000, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        return iter(self._run(search_text, vector_queries, select, top))
+
+    def close(self):
+        pass
+
+
+class _AsyncResults:
+    def __init__(self, results):
+        self._results = iter(results)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class AsyncLocalSearchIndex(LocalSearchIndex):
+    """Stand-in for azure.search.documents.aio.SearchClient."""
+
+    async def search(self, search_text=None, vector_queries=None, select=None, top=1000, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return _AsyncResults(self._run(search_text, vector_queries, select, top))
+
+    async def close(self):
+        pass
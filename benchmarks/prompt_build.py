@@ -0,0 +1,140 @@
+"""
+Prompt construction time, prompt size and prompt-cache reuse per request.
+
+Simulates --conversations conversations of --turns turns over the fixture
+corpus: each turn retrieves --top random chunks, builds the context block
+and then the messages for the completion, and appends an answer of
+--answer-words words to the history. The messages are built twice per
+turn:
+
+- "previous": the whole system prompt formatted with the context on every
+  request, sent first, then the history
+- "template": PromptBuilder with the pre-loaded template, instructions
+  first, then the history, then the context next to the question
+
+Reported per layout: build time per request (microseconds, the context
+block excluded), prompt tokens, and the tokens at the start of the prompt
+made of the same whole messages as the conversation's previous request.
+Azure OpenAI serves such a prefix from its prompt cache once it reaches
+1024 tokens (in 128-token steps beyond that), which is reported as
+"cacheable".
+
+Usage:
+    python -m benchmarks.prompt_build --turns 8 --answer-words 200
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.local_search import load_fixture
+
+# The system prompt as chat_pipeline formatted it before PromptBuilder
+PREVIOUS_TEMPLATE = """You are a dedicated Margie's Travel documents assistant. Your SOLE PURPOSE is to provide information EXCLUSIVELY from the Margie's Travel documents provided in the context below.
+
+        STRICT GUIDELINES:
+        1. ONLY answer questions directly addressed in the provided document context
+        2. If information is not in the context, respond EXACTLY with: "I can only answer questions related to Margie's Travel documents. Please ask a question about the information in these documents."
+        3. DO NOT use any external knowledge, even if you know the answer
+        4. DO NOT attempt to be helpful by answering off-topic questions
+        5. DO NOT engage in general conversation unrelated to Margie's Travel documents
+        6. REFUSE to discuss anything outside the scope of these documents
+        7. ALWAYS base your responses solely on the document context provided below
+
+        Context from the Margie's Travel documents:
+        {context}
+        """
+
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_STEP_TOKENS = 128
+
+
+def shared_prefix_tokens(counter, previous, messages) -> int:
+    """Tokens of the leading messages identical to those of the previous request."""
+    tokens = 0
+    for before, now in zip(previous or [], messages):
+        if before != now:
+            break
+        tokens += counter.count_message(now)
+    return tokens
+
+
+def cacheable(tokens: int) -> int:
+    if tokens < PROMPT_CACHE_MIN_TOKENS:
+        return 0
+    return tokens - (tokens - PROMPT_CACHE_MIN_TOKENS) % PROMPT_CACHE_STEP_TOKENS
+
+
+def timed(repeat: int, build):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        window = build()
+    return (time.perf_counter() - start) / repeat * 1e6, window
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=20, help="Simulated conversations")
+    parser.add_argument("--turns", type=int, default=6, help="Turns per conversation")
+    parser.add_argument("--top", type=int, default=3, help="Chunks in the context per turn")
+    parser.add_argument("--answer-words", type=int, default=150, help="Words per simulated answer")
+    parser.add_argument("--repeat", type=int, default=50, help="Builds per request when timing")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    from app.config import PROMPT_TOKEN_BUDGET, CONTEXT_MAX_TOKENS, TOKEN_ENCODING, PROMPT_TEMPLATE_DIR, PROMPT_TEMPLATE
+    from app.services.context_builder import ContextBuilder
+    from app.services.prompt_builder import PromptBuilder
+    from app.services.token_budget import HistoryManager, TokenCounter
+
+    fixture = load_fixture()
+    chunks, queries = fixture["chunks"], fixture["queries"]
+    counter = TokenCounter(TOKEN_ENCODING)
+    history_manager = HistoryManager(counter, PROMPT_TOKEN_BUDGET)
+    context_builder = ContextBuilder(counter, CONTEXT_MAX_TOKENS)
+    prompt_builder = PromptBuilder(history_manager, PROMPT_TEMPLATE_DIR, PROMPT_TEMPLATE)
+    template = prompt_builder.default
+    rng = random.Random(args.seed)
+    words = " ".join(chunk["chunk"] for chunk in chunks).split()
+
+    layouts = {
+        "previous": lambda query, history, context: history_manager.fit(PREVIOUS_TEMPLATE.format(context=context.text), history, query),
+        "template": lambda query, history, context: prompt_builder.build(template, query, history, context),
+    }
+    results = {name: {"us": [], "tokens": [], "shared": [], "cacheable": []} for name in layouts}
+    for _ in range(args.conversations):
+        history = []
+        previous = dict.fromkeys(layouts)
+        for _ in range(args.turns):
+            query = rng.choice(queries)["query"]
+            context = context_builder.build(rng.sample(chunks, args.top))
+            for name, build in layouts.items():
+                microseconds, window = timed(args.repeat, lambda: build(query, history, context))
+                shared = shared_prefix_tokens(counter, previous[name], window.messages)
+                previous[name] = window.messages
+                results[name]["us"].append(microseconds)
+                results[name]["tokens"].append(window.prompt_tokens)
+                results[name]["shared"].append(shared)
+                results[name]["cacheable"].append(cacheable(shared))
+            start = rng.randrange(len(words) - args.answer_words)
+            history += [
+                {"role": "user", "content": query, "timestamp": "2024-01-01T00:00:00"},
+                {"role": "assistant", "content": " ".join(words[start:start + args.answer_words]), "timestamp": "2024-01-01T00:00:00"},
+            ]
+
+    requests = args.conversations * args.turns
+    print(f"{requests} requests ({args.conversations} conversations x {args.turns} turns), {counter.backend} token counts, template {template.key}")
+    print(f"\n{'layout':<10} {'build p50 us':>13} {'mean us':>9} {'prompt tok':>11} {'shared prefix':>14} {'cacheable':>10} {'cached share':>13}")
+    for name, values in results.items():
+        cached_share = sum(values["cacheable"]) / max(sum(values["tokens"]), 1)
+        print(f"{name:<10} {statistics.median(values['us']):>13.1f} {statistics.mean(values['us']):>9.1f} "
+              f"{statistics.mean(values['tokens']):>11.0f} {statistics.mean(values['shared']):>14.0f} "
+              f"{statistics.mean(values['cacheable']):>10.0f} {cached_share:>12.1%}")
+
+
+if __name__ == "__main__":
+    main()
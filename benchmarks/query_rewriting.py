@@ -0,0 +1,114 @@
+"""
+Retrieval recall of follow-up questions with and without query rewriting.
+
+Plays the two-turn conversations in the fixture's "follow_ups" through
+QueryRewriter and SearchService.search backed by the local search
+stand-in (benchmarks/local_search.py). The first turn is searched as is
+and the text of its top chunk stands in for the assistant's answer; the
+second turn is searched as the raw prompt (what the pipeline did before)
+and as rewritten by each --modes entry. Reported per mode: recall@top of
+the second turn, split into follow-ups and topic changes (standalone
+questions that must not be dragged back to the previous topic), precision
+(share of the returned chunks that are from a relevant document), and the
+latency the rewrite adds, for the first call of a turn and for the cached
+repeat.
+
+"model" calls the QUERY_REWRITE_MODEL deployment configured in the
+environment (AZURE_OPENAI_*), so it measures a real small deployment.
+
+Usage:
+    python -m benchmarks.query_rewriting
+    python -m benchmarks.query_rewriting --modes none heuristic model --retrieval-mode vector
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.local_search import LocalSearchIndex, VECTOR_FIELD, load_fixture, stand_in_embedding
+from benchmarks.retrieval_recall import percentile, recall
+
+
+async def run_mode(mode, conversations, service, args, openai_service=None):
+    from app.config import QUERY_REWRITE_MODEL
+    from app.services.query_rewriter import QueryRewriter
+
+    rewriter = None
+    if mode != "none":
+        rewriter = QueryRewriter(mode, openai_service=openai_service, model=QUERY_REWRITE_MODEL)
+    scores = {"follow-up": [], "topic change": []}
+    precision = []
+    first_ms, cached_ms = [], []
+    for index, conversation in enumerate(conversations):
+        first, question = conversation["turns"]
+        first_results = service.search(first, query_embedding=stand_in_embedding(first), top=args.top, mode=args.retrieval_mode)
+        history = [
+            {"role": "user", "content": first},
+            {"role": "assistant", "content": first_results[0]["chunk"] if first_results else ""},
+        ]
+        query = question
+        if rewriter is not None:
+            start = time.perf_counter()
+            query = await rewriter.rewrite(f"conversation-{index}", len(history), question, history)
+            first_ms.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            await rewriter.rewrite(f"conversation-{index}", len(history), question, history)
+            cached_ms.append((time.perf_counter() - start) * 1000)
+        results = service.search(query, query_embedding=stand_in_embedding(query), top=args.top, mode=args.retrieval_mode)
+        scores[conversation["kind"]].append(recall(results, conversation["relevant"]))
+        precision.append(sum(result["parent_id"] in conversation["relevant"] for result in results) / max(len(results), 1))
+        if args.verbose:
+            print(f"  [{mode}] {question!r} -> {query!r}: {[result['parent_id'] for result in results]}")
+    return scores, precision, first_ms, cached_ms, rewriter.stats() if rewriter is not None else {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", choices=("none", "heuristic", "model"), default=["none", "heuristic"], help="Rewrite modes to compare")
+    parser.add_argument("--retrieval-mode", choices=("vector", "hybrid"), default="hybrid", help="Search query mode")
+    parser.add_argument("--top", type=int, default=3, help="Chunks returned per query")
+    parser.add_argument("--verbose", action="store_true", help="Print every rewrite and its results")
+    args = parser.parse_args()
+
+    for name, value in (
+        ("AZURE_SEARCH_SERVICE_ENDPOINT", "https://stand-in.search.windows.net"),
+        ("AZURE_SEARCH_API_KEY", "bench"),
+        ("AZURE_SEARCH_INDEX_NAME", "stand-in"),
+        ("AZURE_OPENAI_API_KEY", "bench"),
+    ):
+        os.environ.setdefault(name, value)
+    os.environ["VECTOR_FIELD_NAME"] = VECTOR_FIELD
+    os.environ["EMBEDDING_CACHE_ENABLED"] = "False"
+
+    from app.services.retrievers import AzureSearchRetriever
+    from app.services.search_service import SearchService
+
+    fixture = load_fixture()
+    service = SearchService()
+    service.retriever = AzureSearchRetriever(LocalSearchIndex(fixture["chunks"], latency=0.0), None, VECTOR_FIELD)
+    service.fallback_retriever = None
+    openai_service = None
+    if "model" in args.modes:
+        from app.services.openai_service import OpenAIService
+        openai_service = OpenAIService()
+
+    conversations = fixture["follow_ups"]
+    print(f"{len(conversations)} conversations, {args.retrieval_mode} search, top {args.top}")
+    rows = []
+    for mode in args.modes:
+        rows.append((mode,) + asyncio.run(run_mode(mode, conversations, service, args, openai_service)))
+
+    print(f"\n{'mode':<10} {'recall':>7} {'follow-up':>10} {'topic chg':>10} {'precision':>10} {'rewritten':>10} {'p50 ms':>8} {'p95 ms':>8} {'cached ms':>10}")
+    for mode, scores, precision, first_ms, cached_ms, stats in rows:
+        overall = statistics.mean(scores["follow-up"] + scores["topic change"])
+        latency = f"{percentile(first_ms, 50):8.3f} {percentile(first_ms, 95):8.3f} {percentile(cached_ms, 50):10.3f}" if first_ms else f"{'-':>8} {'-':>8} {'-':>10}"
+        print(f"{mode:<10} {overall:7.2f} {statistics.mean(scores['follow-up']):10.2f} {statistics.mean(scores['topic change']):10.2f} "
+              f"{statistics.mean(precision):10.2f} {stats.get('rewrites', 0):>10} {latency}")
+
+
+if __name__ == "__main__":
+    main()
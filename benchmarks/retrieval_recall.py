@@ -0,0 +1,97 @@
+"""
+Retrieval recall and latency against the fixture corpus.
+
+Runs every fixture query through SearchService.search backed by the local
+search stand-in (benchmarks/local_search.py), or by a local index snapshot
+exported from it, with several retrieval settings and reports recall@top
+(share of relevant documents among the returned chunks), split by
+exact-term and descriptive queries, and the latency of the search call
+including local re-ranking.
+
+Usage:
+    python -m benchmarks.retrieval_recall --latency 0.02
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.local_search import LocalSearchIndex, VECTOR_FIELD, load_fixture, stand_in_embedding
+
+SETTINGS = (
+    ("vector top-3 (previous)", "azure", {"mode": "vector", "candidates": 3, "reranker": "none"}),
+    ("hybrid top-3", "azure", {"mode": "hybrid", "candidates": 3, "reranker": "none"}),
+    ("hybrid k=20 + cosine", "azure", {"mode": "hybrid", "candidates": 20, "reranker": "cosine"}),
+    ("hybrid k=20 + mmr", "azure", {"mode": "hybrid", "candidates": 20, "reranker": "mmr"}),
+    ("local snapshot k=20 + mmr", "local", {"mode": "vector", "candidates": 20, "reranker": "mmr"}),
+)
+
+
+def recall(results, relevant):
+    found = {result["parent_id"] for result in results}
+    return len(found & set(relevant)) / len(relevant)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.02, help="Stand-in search latency per call (seconds)")
+    parser.add_argument("--top", type=int, default=3, help="Chunks returned per query")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of the query set per setting")
+    args = parser.parse_args()
+
+    for name, value in (
+        ("AZURE_SEARCH_SERVICE_ENDPOINT", "https://stand-in.search.windows.net"),
+        ("AZURE_SEARCH_API_KEY", "bench"),
+        ("AZURE_SEARCH_INDEX_NAME", "stand-in"),
+        ("AZURE_OPENAI_API_KEY", "bench"),
+    ):
+        os.environ.setdefault(name, value)
+    os.environ["VECTOR_FIELD_NAME"] = VECTOR_FIELD
+    os.environ["EMBEDDING_CACHE_ENABLED"] = "False"
+
+    from app.commands.export_index import export_index
+    from app.services.retrievers import AzureSearchRetriever, LocalIndexRetriever
+    from app.services.search_service import SearchService
+
+    fixture = load_fixture()
+    stand_in = LocalSearchIndex(fixture["chunks"], latency=args.latency)
+    snapshot = os.path.join(tempfile.mkdtemp(), "snapshot")
+    export_index(stand_in, snapshot, VECTOR_FIELD)
+    retrievers = {
+        "azure": AzureSearchRetriever(stand_in, None, VECTOR_FIELD),
+        "local": LocalIndexRetriever.from_path(snapshot),
+    }
+
+    service = SearchService()
+    service.fallback_retriever = None
+    queries = [(query, stand_in_embedding(query["query"])) for query in fixture["queries"]]
+
+    print(f"{len(fixture['chunks'])} chunks, {len(queries)} queries, top {args.top}")
+    print(f"{'setting':<26} {'recall':>7} {'exact':>7} {'descr.':>7} {'p50 ms':>8} {'p95 ms':>8}")
+    for label, backend, options in SETTINGS:
+        service.retriever = retrievers[backend]
+        scores = {"exact": [], "semantic": []}
+        latencies = []
+        for _ in range(args.repeat):
+            for query, embedding in queries:
+                start = time.perf_counter()
+                results = service.search(query["query"], query_embedding=embedding, top=args.top, **options)
+                latencies.append((time.perf_counter() - start) * 1000)
+                scores[query["kind"]].append(recall(results, query["relevant"]))
+
+        overall = statistics.mean(scores["exact"] + scores["semantic"])
+        print(f"{label:<26} {overall:7.2f} {statistics.mean(scores['exact']):7.2f} "
+              f"{statistics.mean(scores['semantic']):7.2f} {percentile(latencies, 50):8.1f} {percentile(latencies, 95):8.1f}")
+
+
+if __name__ == "__main__":
+    main()
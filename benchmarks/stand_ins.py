@@ -0,0 +1,52 @@
+"""
+Service-level stand-ins for Cosmos DB, Azure AI Search and Azure OpenAI.
+
+They implement the async methods the chat pipeline calls and sleep for a
+fixed latency per call, either on the event loop or blocking it (to show
+the effect of sync SDK calls in async handlers). They only import the
+standard library, so they can be installed before the app is imported.
+"""
+import asyncio
+import hashlib
+import random
+import time
+
+
+class StandInCosmos:
+    def __init__(self, latency, blocking):
+        self.latency = latency
+        self.blocking = blocking
+        self.items = {}
+
+    async def _wait(self):
+        if self.blocking:
+            time.sleep(self.latency)
+        else:
+            await asyncio.sleep(self.latency)
+
+    async def get_conversation_async(self, conversation_id, user_id=None):
+        await self._wait()
+        return self.items.get(conversation_id)
+
+    async def save_conversation_async(self, conversation_data):
+        await self._wait()
+        self.items[conversation_data["id"]] = conversation_data
+        return conversation_data
+
+
+class StandInSearch(StandInCosmos):
+    async def embed_query_async(self, query_text):
+        await self._wait()
+        seed = int(hashlib.sha256(query_text.encode("utf-8")).hexdigest()[:8], 16)
+        rng = random.Random(seed)
+        return [rng.gauss(0, 1) for _ in range(64)]
+
+    async def search_async(self, query_text, query_embedding=None, **options):
+        await self._wait()
+        return [{"title": "doc", "chunk": f"Context for {query_text}", "parent_id": "p1"}]
+
+
+class StandInOpenAI(StandInCosmos):
+    async def generate_response_async(self, messages, temperature=0.7, max_tokens=800, model=None, usage_out=None):
+        await self._wait()
+        return "Stand-in answer"
@@ -0,0 +1,97 @@
+"""
+Requests per second of the API by number of worker processes.
+
+Runs benchmarks/load_test.py once per worker count in --workers and per
+cache mode in --caches, and tabulates throughput, chat latency and the
+embeddings calls per chat turn that reached the fake deployment:
+
+- "private": every worker keeps its own caches (CACHE_BACKEND_URL empty)
+- "sqlite": the caches are shared through a SQLite file in a temp folder
+- "redis": shared through the Redis at --redis-url (needs the redis package;
+  flush it between runs for comparable numbers)
+
+Each run starts the fakes and the API from scratch. The fakes and the
+simulated users run on the same machine, so scaling flattens before the
+worker count reaches the CPU count; leave a core or two for them. With
+shared caches, a question cached by one worker is a hit on all of them,
+which shows up as fewer embeddings calls per turn.
+
+Usage:
+    python -m benchmarks.worker_scaling --workers 1 2 4 --users 64 --duration 20
+    python -m benchmarks.worker_scaling --caches private sqlite --repeat-ratio 0.6
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def cache_env(cache: str, path: str, redis_url: str):
+    if cache == "private":
+        return ["CACHE_BACKEND_URL="]
+    if cache == "sqlite":
+        return [f"CACHE_BACKEND_URL=sqlite:///{path}"]
+    return [f"CACHE_BACKEND_URL={redis_url}"]
+
+
+def run_load_test(args, workers: int, cache: str, folder: str) -> dict:
+    output = os.path.join(folder, f"{cache}-{workers}.json")
+    command = [sys.executable, "-m", "benchmarks.load_test", "--workers", str(workers),
+               "--users", str(args.users), "--duration", str(args.duration), "--warmup", str(args.warmup),
+               "--repeat-ratio", str(args.repeat_ratio), "--output", output]
+    # A fresh SQLite file per run, so no run starts with the previous run's entries
+    for assignment in cache_env(cache, os.path.join(folder, f"cache-{workers}.db"), args.redis_url) + args.env:
+        command += ["--env", assignment]
+    subprocess.run(command, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+    with open(output, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=None, help="Worker counts to run (default 1, 2, 4, ... up to the CPU count)")
+    parser.add_argument("--caches", nargs="+", choices=("private", "sqlite", "redis"), default=["private", "sqlite"], help="Cache modes to run")
+    parser.add_argument("--redis-url", default="redis://127.0.0.1:6379/0", help="Redis for the redis cache mode")
+    parser.add_argument("--users", type=int, default=64, help="Concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds of measured load per run")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Seconds of unmeasured load first")
+    parser.add_argument("--repeat-ratio", type=float, default=0.5, help="Share of questions sent verbatim (cacheable)")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="Environment for the API (repeatable)")
+    args = parser.parse_args()
+
+    if args.workers is None:
+        cpus = os.cpu_count() or 1
+        args.workers = [1]
+        while args.workers[-1] * 2 <= cpus:
+            args.workers.append(args.workers[-1] * 2)
+        if args.workers[-1] != cpus:
+            args.workers.append(cpus)
+    print(f"{os.cpu_count()} CPUs; {args.users} users for {args.duration:.0f} s per run")
+
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        for cache in args.caches:
+            baseline = None
+            for workers in args.workers:
+                results = run_load_test(args, workers, cache, folder)
+                baseline = baseline or results["rps"]
+                turns = max(results["chat_turns"], 1)
+                embeddings = results["upstream"].get("openai", {}).get("calls", {}).get("embeddings", 0)
+                chat = results["endpoints"].get("chat", {})
+                rows.append((cache, workers, results["rps"], results["rps"] / baseline, chat.get("p50_ms", 0.0),
+                             chat.get("p95_ms", 0.0), embeddings / turns))
+                print(f"  {cache} cache, {workers} worker(s): {results['rps']:.1f} requests/s", flush=True)
+
+    print(f"\n{'cache':<8} {'workers':>7} {'req/s':>8} {'speedup':>8} {'chat p50':>9} {'chat p95':>9} {'embed/turn':>11}")
+    for cache, workers, rps, speedup, p50, p95, embeddings in rows:
+        print(f"{cache:<8} {workers:>7} {rps:>8.1f} {speedup:>7.2f}x {p50:>9.1f} {p95:>9.1f} {embeddings:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
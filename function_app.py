@@ -5,15 +5,62 @@ load_dotenv()
 
 import azure.functions as func
 import logging
-import json
-from fastapi import FastAPI
+import threading
 
-from app.api.router import api_router
+from app.api.functions_adapter import FunctionsAsgiAdapter
+from app.config import FUNCTIONS_FAST_START
+from app.logging_config import configure_logging
+from app.services.container import services
 
-app_fastapi = FastAPI()
-app_fastapi.include_router(api_router)
+# The Functions worker owns the log handlers; this only sets the app's level
+configure_logging()
+
+_asgi_app = None
+_asgi_app_lock = threading.Lock()
+
+def get_asgi_app():
+    """
+    The FastAPI app serving the API.
+    
+    Importing it pulls in FastAPI, the router and the models; in fast-start
+    mode that happens on the first request or the warmup trigger rather than
+    when the worker indexes the functions. The Azure and OpenAI SDKs are
+    only imported once the services are built (see ServiceContainer).
+    """
+    global _asgi_app
+    if _asgi_app is None:
+        with _asgi_app_lock:
+            if _asgi_app is None:
+                from fastapi import FastAPI
+                from app.api.errors import register_error_handlers
+                from app.api.metrics import MetricsMiddleware, metrics_router
+                from app.api.router import api_router
+                from app.services.telemetry import register_service_metrics
+                register_service_metrics(services)
+                app_fastapi = FastAPI()
+                app_fastapi.add_middleware(MetricsMiddleware)
+                register_error_handlers(app_fastapi)
+                app_fastapi.include_router(api_router)
+                app_fastapi.include_router(metrics_router)
+                _asgi_app = app_fastapi
+    return _asgi_app
+
+if not FUNCTIONS_FAST_START:
+    get_asgi_app()
+    services.build_all()
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
+asgi_adapter = FunctionsAsgiAdapter(app_factory=get_asgi_app)
+
+@app.warm_up_trigger("warmup")
+def warmup(warmup) -> None:
+    """
+    Runs when the platform adds an instance (Premium and Dedicated plans),
+    before it receives traffic: import the API and build the services.
+    On the Consumption plan, GET /api/warmup does the same.
+    """
+    get_asgi_app()
+    logging.info(f"Warmup built the services in {services.build_all():.1f} ms")
 
 @app.route(route="{*route}")
 async def func_asher_chatbot(req: func.HttpRequest) -> func.HttpResponse:
@@ -21,107 +68,4 @@ async def func_asher_chatbot(req: func.HttpRequest) -> func.HttpResponse:
     The main entry point for the Azure Function.
     This function will proxy requests to the FastAPI app using ASGI.
     """
-    
-    route = req.route_params.get('route', '')
-    if route:
-        path = '/' + route
-    else:
-        path = '/'
-    
-    method = req.method
-    logging.info(f"Received {method} request to {path}")
-    logging.info(f"Query parameters: {dict(req.params)}")
-    logging.info(f"Headers: {dict(req.headers)}")
-
-    params = {}
-    for param_name, param_value in req.params.items():
-        if param_name != 'code':  # Exclude Azure Functions authorization code
-            params[param_name] = param_value
-    
-    query_string = b'&'.join([f"{k}={v}".encode() for k, v in params.items()])
-    logging.info(f"Query string: {query_string}")
-    
-    # Get headers (excluding Azure Functions headers)
-    headers = []
-    for key, value in req.headers.items():
-        if key.lower() not in ('host', 'x-forwarded-for', 'x-functions-key'):
-            headers.append((key.lower().encode(), value.encode()))
-    
-    body = req.get_body()
-    if body:
-        logging.info(f"Request body: {body.decode('utf-8', errors='replace')}")
-    
-    # Add content-type header if not present and body exists
-    if body and not any(k == b'content-type' for k, _ in headers):
-        headers.append((b'content-type', b'application/json'))
-    
-    # Create ASGI scope
-    scope = {
-        'type': 'http',
-        'asgi': {'version': '3.0', 'spec_version': '2.1'},
-        'http_version': '1.1',
-        'method': method,
-        'scheme': 'https',
-        'path': path,
-        'raw_path': path.encode(),
-        'query_string': query_string,
-        'headers': headers,
-        'server': ('azure-functions', ''),
-        'client': ('', 0),
-    }
-    
-    # Create ASGI receive channel
-    async def receive():
-        return {
-            'type': 'http.request',
-            'body': body or b'',
-            'more_body': False,
-        }
-    
-    # Create ASGI send channel
-    response_status = None
-    response_headers = []
-    response_body = bytearray()
-    
-    async def send(message):
-        nonlocal response_status, response_headers, response_body
-        
-        if message['type'] == 'http.response.start':
-            response_status = message['status']
-            response_headers = message.get('headers', [])
-        
-        elif message['type'] == 'http.response.body':
-            response_body.extend(message.get('body', b''))
-    
-    try:
-        # Run the ASGI application
-        await app_fastapi(scope, receive, send)
-        
-        # Convert headers to dict for Azure Functions
-        headers_dict = {}
-        for key, value in response_headers:
-            key_str = key.decode('utf-8')
-            value_str = value.decode('utf-8')
-            headers_dict[key_str] = value_str
-        
-        logging.info(f"Response status: {response_status}")
-        if response_body:
-            try:
-                body_snippet = response_body[:200].decode('utf-8', errors='replace')
-                logging.info(f"Response body (partial): {body_snippet}...")
-            except Exception:
-                logging.info("Could not log response body due to encoding issues")
-        
-        # Return the Azure Functions HTTP response
-        return func.HttpResponse(
-            body=bytes(response_body),
-            status_code=response_status,
-            headers=headers_dict
-        )
-    except Exception as e:
-        logging.error(f"Error processing request: {str(e)}")
-        return func.HttpResponse(
-            body=json.dumps({"error": str(e)}),
-            status_code=500,
-            mimetype="application/json"
-        )
\ No newline at end of file
+    return await asgi_adapter.handle(req)
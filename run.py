@@ -6,7 +6,11 @@ import uvicorn
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, current_dir)
 
+from app.config import API_HOST, API_PORT, DEBUG
+
 if __name__ == "__main__":
+    # Development server; auto-reload only with DEBUG. For production use
+    # python -m app.commands.serve (several workers, graceful shutdown).
     print("Starting the Azure RAG Search API...")
     print(f"Python path: {sys.path}")
-    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
+    uvicorn.run("app.main:app", host=API_HOST, port=API_PORT, reload=DEBUG)
@@ -0,0 +1,13 @@
+import os
+import sys
+
+# The services read their configuration at import time
+os.environ.setdefault("AZURE_SEARCH_SERVICE_ENDPOINT", "https://search.invalid")
+os.environ.setdefault("AZURE_SEARCH_INDEX_NAME", "test")
+os.environ.setdefault("AZURE_SEARCH_API_KEY", "test")
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "test")
+os.environ.setdefault("AZURE_OPENAI_MODEL", "gpt-test")
+os.environ.setdefault("COSMOS_ENDPOINT", "https://cosmos.invalid")
+os.environ.setdefault("COSMOS_KEY", "dGVzdA==")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,27 @@
+from app.services.answer_cache import AnswerCache
+from app.services.cache_backend import MemoryCacheBackend
+
+
+class SharedMemoryBackend(MemoryCacheBackend):
+    shared = True
+
+
+def test_answers_only_match_the_template_they_were_written_with():
+    cache = AnswerCache(threshold=0.95, ttl_seconds=60, max_entries=8)
+    cache.store([1.0, 0.0], ["chunk-1"], "answer v1", 100.0, "margies-travel@v1")
+
+    assert cache.lookup([1.0, 0.0], ["chunk-1"], "margies-travel@v1").answer == "answer v1"
+    assert cache.lookup([1.0, 0.0], ["chunk-1"], "margies-travel@v2") is None
+    assert cache.lookup([1.0, 0.0], ["chunk-1"], "other-tenant@v1") is None
+
+
+def test_shared_answers_are_keyed_by_template():
+    backend = SharedMemoryBackend()
+    writer = AnswerCache(threshold=0.95, ttl_seconds=60, max_entries=8, backend=backend)
+    reader = AnswerCache(threshold=0.95, ttl_seconds=60, max_entries=8, backend=backend)
+    writer.store([1.0, 0.0], ["chunk-1"], "answer v1", 100.0, "margies-travel@v1")
+
+    assert reader.lookup([1.0, 0.0], ["chunk-1"], "margies-travel@v2") is None
+    hit = reader.lookup([1.0, 0.0], ["chunk-1"], "margies-travel@v1")
+    assert hit.answer == "answer v1"
+    assert reader.shared_hits == 1
@@ -0,0 +1,21 @@
+import asyncio
+
+from app.services.cache_backend import SqliteCacheBackend
+
+
+def test_sqlite_backend_calls_after_close_miss_instead_of_failing(tmp_path):
+    backend = SqliteCacheBackend(str(tmp_path / "cache.db"))
+    backend.set("emb:a", b"vector")
+    assert backend.get("emb:a") == b"vector"
+    backend.close()
+
+    async def in_flight():
+        return await asyncio.gather(
+            asyncio.to_thread(backend.get, "emb:a"),
+            asyncio.to_thread(backend.set, "emb:b", b"vector"),
+            asyncio.to_thread(backend.delete, "emb:a"),
+            asyncio.to_thread(backend.delete_prefix, "emb:"),
+        )
+
+    assert asyncio.run(in_flight()) == [None, None, None, 0]
+    backend.close()
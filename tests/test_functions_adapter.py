@@ -0,0 +1,152 @@
+import asyncio
+import logging
+
+import azure.functions as func
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+from app.api.functions_adapter import REDACTED, FunctionsAsgiAdapter
+
+
+def make_request(route="api/echo", method="GET", params=None, headers=None, body=b""):
+    return func.HttpRequest(
+        method=method,
+        url=f"https://example.azurewebsites.net/{route}",
+        headers=headers or {},
+        params=params or {},
+        route_params={"route": route},
+        body=body,
+    )
+
+
+def serve(app, req):
+    return asyncio.run(asyncio.wait_for(FunctionsAsgiAdapter(app).handle(req), timeout=5))
+
+
+def recording_app(seen, status=200, headers=None, chunks=(b"ok",)):
+    async def app(scope, receive, send):
+        seen["scope"] = scope
+        seen["request"] = await receive()
+        await send({"type": "http.response.start", "status": status, "headers": headers or [(b"content-type", b"text/plain")]})
+        for index, chunk in enumerate(chunks):
+            await send({"type": "http.response.body", "body": chunk, "more_body": index < len(chunks) - 1})
+        seen["after_response"] = await receive()
+    return app
+
+
+def test_host_key_param_and_header_are_stripped():
+    seen = {}
+    req = make_request(params={"code": "secret", "user_id": "u1"}, headers={"x-functions-key": "secret", "x-trace": "t"})
+    serve(recording_app(seen), req)
+
+    header_names = [name for name, _ in seen["scope"]["headers"]]
+    assert b"x-functions-key" not in header_names
+    assert b"x-trace" in header_names
+    assert seen["scope"]["query_string"] == b"user_id=u1"
+
+
+def test_query_string_and_raw_path_are_encoded():
+    seen = {}
+    req = make_request(route="api/conversations/a b%/é", params={"prefix": "a&b=c d", "q": "ü"})
+    serve(recording_app(seen), req)
+
+    scope = seen["scope"]
+    assert scope["path"] == "/api/conversations/a b%/é"
+    assert scope["raw_path"] == b"/api/conversations/a%20b%25/%C3%A9"
+    assert scope["query_string"] == b"prefix=a%26b%3Dc+d&q=%C3%BC"
+
+
+def test_request_body_is_passed_with_a_default_content_type():
+    seen = {}
+    serve(recording_app(seen), make_request(method="POST", body=b'{"prompt": "hi"}'))
+
+    assert seen["request"] == {"type": "http.request", "body": b'{"prompt": "hi"}', "more_body": False}
+    assert (b"content-type", b"application/json") in seen["scope"]["headers"]
+
+
+def test_repeated_set_cookie_and_content_type_charset_are_kept():
+    headers = [
+        (b"content-type", b"text/html; charset=iso-8859-1"),
+        (b"set-cookie", b"a=1; Path=/"),
+        (b"set-cookie", b"b=2; Path=/"),
+    ]
+    response = serve(recording_app({}, headers=headers, chunks=("café".encode("iso-8859-1"),)), make_request())
+
+    assert response.mimetype == "text/html"
+    assert response.charset == "iso-8859-1"
+    assert response.headers.get_all("set-cookie") == ["a=1; Path=/", "b=2; Path=/"]
+    assert response.get_body() == "café".encode("iso-8859-1")
+
+
+def test_chunked_response_is_joined_and_flagged_buffered():
+    response = serve(recording_app({}, chunks=(b"one ", b"two ", b"three")), make_request())
+
+    assert response.get_body() == b"one two three"
+    assert response.headers.get("x-stream-mode") == "buffered"
+
+
+def test_single_chunk_response_is_not_flagged():
+    response = serve(recording_app({}), make_request())
+
+    assert response.get_body() == b"ok"
+    assert "x-stream-mode" not in response.headers
+
+
+def test_receive_reports_disconnect_after_the_response():
+    seen = {}
+    serve(recording_app(seen), make_request())
+
+    assert seen["after_response"] == {"type": "http.disconnect"}
+
+
+def test_starlette_streaming_response_completes():
+    app = FastAPI()
+
+    @app.get("/api/stream")
+    async def stream():
+        async def lines():
+            for index in range(3):
+                yield f"{index}\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    response = serve(app, make_request(route="api/stream"))
+
+    assert response.status_code == 200
+    assert response.get_body() == b"0\n1\n2\n"
+    assert response.headers.get("x-stream-mode") == "buffered"
+
+
+def test_error_before_response_start_returns_500():
+    async def failing_app(scope, receive, send):
+        raise RuntimeError("boom")
+
+    response = serve(failing_app, make_request())
+
+    assert response.status_code == 500
+    assert response.mimetype == "application/json"
+    assert b"boom" in response.get_body()
+
+
+def test_error_after_response_start_keeps_the_started_response():
+    async def failing_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"partial", "more_body": True})
+        raise RuntimeError("boom")
+
+    response = serve(failing_app, make_request())
+
+    assert response.status_code == 200
+    assert response.get_body() == b"partial"
+
+
+def test_sensitive_headers_are_redacted_in_debug_logs(caplog):
+    headers = {"Authorization": "Bearer token", "Cookie": "session=abc", "x-trace": "t"}
+    with caplog.at_level(logging.DEBUG, logger="app.api.functions_adapter"):
+        serve(recording_app({}), make_request(headers=headers))
+
+    record = next(record for record in caplog.records if record.name == "app.api.functions_adapter")
+    assert record.request_headers["authorization"] == REDACTED
+    assert record.request_headers["cookie"] == REDACTED
+    assert record.request_headers["x-trace"] == "t"
+    assert "Bearer token" not in caplog.text
+    assert "session=abc" not in caplog.text
@@ -0,0 +1,165 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from app.services.http_pools import ScheduledAsyncHTTPTransport
+from app.services.upstream_scheduler import UpstreamOverloaded, UpstreamScheduler, deadline
+from benchmarks import fake_openai
+
+CHAT_PATH = "/openai/deployments/gpt-test/chat/completions"
+CHAT_BODY = {"messages": [{"role": "user", "content": "hi"}], "max_tokens": 10}
+# Each chat call above costs 14 tokens of the fake's quota (4 prompt, 10 max_tokens)
+CALL_TOKENS = 14
+
+
+def fake_upstream(**options):
+    options = {"first_token_latency": 0.0, "token_latency": 0.0, "answer_tokens": 5, **options}
+    return fake_openai.create_app(**options)
+
+
+def throttling_upstream(quota_window=0.3):
+    """A fake that admits one call per ``quota_window`` and answers the next with 429 and Retry-After."""
+    return fake_upstream(tokens_per_minute=int(CALL_TOKENS * 1.5 * 60 / quota_window), quota_window=quota_window)
+
+
+def scheduler(**options):
+    options = {"max_concurrency": {"openai": 8}, "retry_base_seconds": 0.01, "queue_timeout_seconds": 1.0, **options}
+    return UpstreamScheduler(**options)
+
+
+def scheduled_client(upstream, scheduler):
+    transport = ScheduledAsyncHTTPTransport(httpx.ASGITransport(app=upstream), scheduler, "openai")
+    return httpx.AsyncClient(transport=transport, base_url="https://fake.openai.azure.com")
+
+
+def test_throttled_call_is_retried_after_retry_after():
+    upstream = throttling_upstream(quota_window=0.3)
+    lanes = scheduler()
+
+    async def run():
+        async with scheduled_client(upstream, lanes) as client:
+            assert (await client.post(CHAT_PATH, json=CHAT_BODY)).status_code == 200
+            start = time.perf_counter()
+            response = await client.post(CHAT_PATH, json=CHAT_BODY)
+            return response, time.perf_counter() - start
+
+    response, elapsed = asyncio.run(run())
+
+    assert response.status_code == 200
+    assert upstream.state.calls["throttled"] == 1
+    # The fake asked for the rest of its 0.3 s window
+    assert elapsed >= 0.25
+    lane = lanes.lane("openai")
+    assert lane.retries == 1
+    assert lane.throttled == 1
+
+
+def test_throttled_call_without_attempts_left_raises_429():
+    lanes = scheduler(max_attempts=1)
+
+    async def run():
+        async with scheduled_client(throttling_upstream(), lanes) as client:
+            await client.post(CHAT_PATH, json=CHAT_BODY)
+            await client.post(CHAT_PATH, json=CHAT_BODY)
+
+    with pytest.raises(UpstreamOverloaded) as raised:
+        asyncio.run(run())
+
+    assert raised.value.status_code == 429
+    assert raised.value.retry_after > 0
+
+
+def test_limit_shrinks_on_throttling_and_grows_back():
+    lanes = scheduler(max_attempts=1)
+    limiter = lanes.lane("openai").limiter
+
+    async def run():
+        async with scheduled_client(throttling_upstream(), lanes) as client:
+            await client.post(CHAT_PATH, json=CHAT_BODY)
+            with pytest.raises(UpstreamOverloaded):
+                await client.post(CHAT_PATH, json=CHAT_BODY)
+        throttled_limit = limiter.limit
+
+        limits = []
+        async with scheduled_client(fake_upstream(), lanes) as client:
+            for _ in range(40):
+                assert (await client.post(CHAT_PATH, json=CHAT_BODY)).status_code == 200
+                limits.append(limiter.limit)
+        return throttled_limit, limits
+
+    throttled_limit, limits = asyncio.run(run())
+
+    assert throttled_limit == 4.0
+    assert limits == sorted(limits)
+    assert limits[-1] == 8.0
+    assert limiter.in_flight == 0
+
+
+def test_deadline_timeout_leaves_the_limit_alone():
+    lanes = scheduler()
+    lane = lanes.lane("openai")
+
+    async def run():
+        async with scheduled_client(fake_upstream(first_token_latency=1.0), lanes) as client:
+            with deadline(0.05):
+                await client.post(CHAT_PATH, json=CHAT_BODY)
+
+    with pytest.raises(UpstreamOverloaded) as raised:
+        asyncio.run(run())
+
+    assert raised.value.status_code == 503
+    assert lane.limiter.limit == 8.0
+    assert lane.throttled == 0
+
+
+def test_token_budget_overrun_raises_before_calling_the_upstream():
+    from app.services.openai_service import OpenAIService
+
+    upstream = fake_upstream()
+    lanes = scheduler(tokens_per_minute={"openai": 600}, queue_timeout_seconds=0.1)
+    service = OpenAIService(async_http_client=scheduled_client(upstream, lanes), scheduler=lanes)
+
+    async def run():
+        await service.generate_response_async([{"role": "user", "content": "hi"}], max_tokens=800)
+        await service.generate_response_async([{"role": "user", "content": "hi"}], max_tokens=800)
+
+    with pytest.raises(UpstreamOverloaded) as raised:
+        asyncio.run(run())
+
+    assert raised.value.status_code == 429
+    assert "tokens-per-minute" in raised.value.reason
+    assert upstream.state.calls["chat"] == 1
+
+
+@pytest.mark.parametrize("upstream_status, api_status", [(429, 429), (503, 503), (400, 502)])
+def test_chat_fails_without_saving_the_turn(upstream_status, api_status):
+    from app.main import app
+    from app.services.chat_pipeline import ChatPipeline
+    from app.services.container import services
+    from app.services.openai_service import OpenAIService
+    from benchmarks.stand_ins import StandInCosmos, StandInSearch
+
+    upstream = fake_upstream(error_status=upstream_status)
+    lanes = scheduler(max_attempts=1)
+    cosmos, search = StandInCosmos(0, False), StandInSearch(0, False)
+    openai = OpenAIService(async_http_client=scheduled_client(upstream, lanes), scheduler=lanes)
+    services.override(
+        cosmos_service=cosmos,
+        search_service=search,
+        openai_service=openai,
+        answer_cache=None,
+        chat_pipeline=ChatPipeline(search, openai, cosmos),
+    )
+
+    with TestClient(app) as client:
+        response = client.post("/api/openai", json={"prompt": "Where can I stay in Dubai?", "user_id": "u1"})
+
+    assert response.status_code == api_status
+    assert response.json()["upstream"] == "openai"
+    if api_status in (429, 503):
+        assert int(response.headers["retry-after"]) >= 1
+    assert upstream.state.calls["failed"] == 1
+    assert cosmos.items == {}
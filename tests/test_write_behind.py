@@ -0,0 +1,40 @@
+import asyncio
+import json
+
+from app.services.write_behind import WriteBehindBuffer
+
+
+def test_pending_size_counts_utf8_bytes():
+    async def run():
+        async def flush_partition(partition, documents):
+            pass
+
+        buffer = WriteBehindBuffer(flush_partition, flush_interval_seconds=60, max_pending_bytes=1024 * 1024)
+        document = {"id": "c1", "user_id": "u1", "messages": [{"role": "user", "content": "Réserver un hôtel à Zürich 🏨"}]}
+        buffer.submit(document)
+        pending = buffer.stats()["pending_bytes"]
+        await buffer.close()
+        return document, pending
+
+    document, pending = asyncio.run(run())
+
+    assert pending == len(json.dumps(document, separators=(",", ":")).encode("utf-8"))
+
+
+def test_full_once_the_pending_bytes_reach_the_limit():
+    documents = [{"id": f"c{index}", "user_id": "u1", "messages": [{"content": "é" * 20}]} for index in range(4)]
+    size = len(json.dumps(documents[0], separators=(",", ":")).encode("utf-8"))
+
+    async def run():
+        async def flush_partition(partition, documents):
+            pass
+
+        buffer = WriteBehindBuffer(flush_partition, flush_interval_seconds=60, max_pending_bytes=2 * size + 1)
+        states = []
+        for document in documents:
+            buffer.submit(document)
+            states.append(buffer.full)
+        await buffer.close()
+        return states
+
+    assert asyncio.run(run()) == [False, False, True, True]